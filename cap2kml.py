@@ -18,6 +18,11 @@
 
 Based on code in experimental/users/bent/cap2kml/cap2kml, especially
 cap_alert.h and cap_util.cc.
+
+Placemarks depend only on the alert, so the crawler serializes each one with
+PlacemarkText and stores it.  KmlText assembles a KML document from such
+serialized placemarks, and KmlTexts does the same piece by piece, so that
+large documents can be written as they are generated.
 """
 
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
@@ -28,7 +33,26 @@ import re
 # Third party
 import pyfo
 
-from google.appengine.runtime import DeadlineExceededError
+try:
+  import google3
+  from google3.apphosting.runtime.apiproxy_errors import DeadlineExceededError
+
+  from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
+except ImportError:
+  from google.appengine.runtime import DeadlineExceededError
+
+  import packed_geometry
+
+
+# Version of the placemark serialization.  Increment this whenever
+# CapAlertAsKmlPlacemark changes, so that stored placemarks are rebuilt.
+PLACEMARK_VERSION = 1
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+
+_KML_PROLOG = u'<?xml version="1.0" encoding="utf-8"?>\n'
+_KML_HEADER = u'<kml xmlns="%s"><Document>' % KML_NAMESPACE
+_KML_FOOTER = u'</Document></kml>'
 
 
 class Error(Exception):
@@ -48,8 +72,78 @@ def Kml(nodes):
   Returns:
     Tuple for pyfo to produce the <kml> node.
   """
-  return ('kml', ('Document', nodes),
-          dict(xmlns='http://www.opengis.net/kml/2.2'))
+  return ('kml', ('Document', nodes), dict(xmlns=KML_NAMESPACE))
+
+
+def KmlText(placemark_texts):
+  """Returns the text of a KML Document from serialized placemarks.
+
+  This is equivalent to serializing Kml(placemarks), but does not need to
+  rebuild placemarks that are already serialized.
+
+  Args:
+    placemark_texts: Iterable of results of PlacemarkText (unicode)
+
+  Returns:
+    XML text of the <kml> node, with the XML prolog (unicode)
+  """
+  return u''.join(KmlTexts(placemark_texts))
+
+
+def KmlTexts(placemark_texts):
+  """Generates the text of a KML Document from serialized placemarks.
+
+  Args:
+    placemark_texts: Iterable of results of PlacemarkText (unicode), which is
+        consumed as the text is generated.
+
+  Yields:
+    Consecutive pieces of the XML text of the <kml> node, with the XML prolog
+    (unicode)
+  """
+  yield _KML_PROLOG
+  yield _KML_HEADER
+  for placemark_text in placemark_texts:
+    yield placemark_text
+  yield _KML_FOOTER
+
+
+def PlacemarkText(cap):
+  """Serializes the KML Placemark for a CAP alert.
+
+  Args:
+    cap: caplib.Alert object
+
+  Returns:
+    XML text of the Placemark node (unicode), or the empty string if there is
+    not enough valid data to produce a Placemark node.
+
+  Raises:
+    MultipleInfoError: if the alert has more than one info node.
+  """
+  placemark = CapAlertAsKmlPlacemark(cap).ToKml()
+  if not placemark:
+    return u''
+  text = pyfo.pyfo(placemark)
+  if isinstance(text, str):
+    text = text.decode('utf-8')
+  return text
+
+
+def NetworkLinkText(name, href):
+  """Serializes a KML NetworkLink, e.g. to the next page of a query.
+
+  Args:
+    name: Name of the link (str or unicode)
+    href: URL of the linked KML (str or unicode)
+
+  Returns:
+    XML text of the NetworkLink node (unicode)
+  """
+  text = pyfo.pyfo(('NetworkLink', [('name', name), ('Link', ('href', href))]))
+  if isinstance(text, str):
+    text = text.decode('utf-8')
+  return text
 
 
 class CapAlertAsKmlPlacemark(object):
@@ -241,16 +335,17 @@ class CapAlertAsKmlPlacemark(object):
     Args:
       area: caplib.Area object
     """
-    for circle in area.circle:
+    geometry = packed_geometry.AreaGeometry(area)
+    for circle in geometry.circles:
       self._AddCircle(circle)
-    for polygon in area.polygon:
+    for polygon in geometry.polygons:
       self._AddPolygon(polygon)
 
   def _AddCircle(self, circle):
     """Incorporates a single CAP Alert Info Area circle.
 
     Args:
-      circle: caplib.Circle
+      circle: packed_geometry.PackedCircle
     """
     geometry = _CapCircleToKml(circle)
     if geometry:
@@ -261,7 +356,7 @@ class CapAlertAsKmlPlacemark(object):
     """Incorporates a single CAP Alert Info Area polygon.
 
     Args:
-      polygon: caplib.Polygon
+      polygon: packed_geometry.PackedPolygon
     """
     geometry = _CapPolygonToKml(polygon)
     if geometry:
@@ -287,37 +382,37 @@ def _AtomLink(url):
   return atom_link
 
 
-def _Point(cap_point):
+def _Point(latitude, longitude):
   """Forms a KML Point.
 
   Args:
-    cap_point: caplib.Point
+    latitude: Decimal degrees (float)
+    longitude: Decimal degrees (float)
 
   Returns:
     Object for pyfo to make a KML Point node
   """
-  point = ('Point', _Coordinates([cap_point]))
+  point = ('Point', _Coordinates((longitude, latitude)))
   _DebugPyfo(point)
   return point
 
 
-def _Coordinates(points):
+def _Coordinates(coordinates):
   """Forms a KML coordinates note.
 
   Args:
-    points: List of caplib.Point objects.
+    coordinates: Longitude, latitude pairs, e.g. the coordinates of a
+        packed_geometry.PackedPolygon (sequence of float)
 
   Returns:
     Object for pyfo to make a KML coordinates node
   """
-  point_strings = []
-  for point in points:
-    # Note that KML is lon, lat[, alt].  We don't specify altitude because CAP
-    # has a 2-D "on the Earth's surface) geometry model.
-    point_string = '%f,%f' % (point.longitude, point.latitude)
-    point_strings.append(point_string)
-
-  coordinates = ('coordinates', ' '.join(point_strings))
+  # Note that KML is lon, lat[, alt].  We don't specify altitude because CAP
+  # has a 2-D "on the Earth's surface) geometry model.  Format all of the
+  # points at once, which is much faster than one at a time.
+  point_count = len(coordinates) / 2
+  coordinates = ('coordinates',
+                 ' '.join(['%f,%f'] * point_count) % tuple(coordinates))
   _DebugPyfo(coordinates)
   return coordinates
 
@@ -331,15 +426,14 @@ def _CapCircleToKml(cap_circle):
   Based on cap_util.cc:CapCircleToKml.
 
   Args:
-    circle: caplib.Circle
+    cap_circle: packed_geometry.PackedCircle
 
   Returns:
     Tuple for pyfo to produce a KML geometry node, or None if parse error.
   """
   try:
-    # TODO(Matt Frantz): What is the unit of radius in a CAP circle?
     # TODO(Matt Frantz): Use the radius to make a KML circle.
-    return _Point(cap_circle.point)
+    return _Point(cap_circle.latitude, cap_circle.longitude)
   except (DeadlineExceededError, AssertionError):
     raise
   except Exception, e:
@@ -355,7 +449,7 @@ def _CapPolygonToKml(cap_polygon):
   Based on cap_util.cc:CapPolygonToKml.
 
   Args:
-    cap_polygon: caplib.Polygon
+    cap_polygon: packed_geometry.PackedPolygon
 
   Returns:
     Tuple for pyfo to produce a KML geometry node, or None if parse error.
@@ -363,9 +457,9 @@ def _CapPolygonToKml(cap_polygon):
   try:
     # CAP specifies latitude and longitude in decimal degrees, following
     # WGS-84, so no coordinate transformation is required.
-    vertices = list(cap_polygon)
     polygon = ('Polygon', ('outerBoundaryIs',
-                           ('LinearRing', _Coordinates(vertices))))
+                           ('LinearRing',
+                            _Coordinates(cap_polygon.coordinates))))
     _DebugPyfo(polygon)
     return polygon
   except (DeadlineExceededError, AssertionError):
@@ -30,9 +30,10 @@ queues persist in cap_schema.CrawlShard models in the Datastore.  Each
 CrawlShard instance is a single atom of work, which is a single URL to visit.
 The URL may be CAP or an index (RSS or ATOM) of CAP's.
 
-The worker thread (at /crawlworker) is provided with a single shard of work
-consisting of a single URL to fetch.  If an index of CAP URL's is retrieved,
-it may push shards onto the task queue.
+The worker thread (at /crawlworker) is provided with a batch of shards of
+work, each consisting of a single URL to fetch.  The URL's are fetched
+concurrently.  If an index of CAP URL's is retrieved, it may push shards onto
+the task queue.
 
 A thread is implemented not using Python threads (which are disallowed in
 AppEngine), but by servicing a unique request under the /crawl URL.  Those
@@ -47,6 +48,7 @@ import logging
 import os
 import random
 import sys
+import time
 import traceback
 
 try:
@@ -54,6 +56,7 @@ try:
   import google3
   import cap as caplib
 
+  from google3.apphosting.api import apiproxy_stub_map
   from google3.apphosting.api import urlfetch
   from google3.apphosting.api import taskqueue
   from google3.apphosting.ext import db
@@ -62,18 +65,23 @@ try:
   from google3.apphosting.runtime.apiproxy_errors import DeadlineExceededError
   from google3.pyglib import logging
 
+  from google3.dotorg.gongo.appengine_cap2kml import cap2kml
   from google3.dotorg.gongo.appengine_cap2kml import cap_fake
   from google3.dotorg.gongo.appengine_cap2kml import cap_index_parse
   from google3.dotorg.gongo.appengine_cap2kml import cap_parse_db
   from google3.dotorg.gongo.appengine_cap2kml import cap_parse_mem
   from google3.dotorg.gongo.appengine_cap2kml import cap_schema
   from google3.dotorg.gongo.appengine_cap2kml import db_util
+  from google3.dotorg.gongo.appengine_cap2kml import geo_index
+  from google3.dotorg.gongo.appengine_cap2kml import host_throttle
+  from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
   from google3.dotorg.gongo.appengine_cap2kml import webapp_util
   from google3.dotorg.gongo.appengine_cap2kml import xml_util
 
 except ImportError:
   import cap as caplib
 
+  from google.appengine.api import apiproxy_stub_map
   from google.appengine.api import urlfetch
   from google.appengine.api.labs import taskqueue
   from google.appengine.ext import db
@@ -81,12 +89,16 @@ except ImportError:
   from google.appengine.ext.webapp.util import run_wsgi_app
   from google.appengine.runtime import DeadlineExceededError
 
+  import cap2kml
   import cap_fake
   import cap_index_parse
   import cap_parse_db
   import cap_parse_mem
   import cap_schema
   import db_util
+  import geo_index
+  import host_throttle
+  import packed_geometry
   import webapp_util
   import xml_util
 
@@ -127,17 +139,34 @@ def _MakeAtomFeed(urls):
 # http://code.google.com/appengine/docs/python/urlfetch/fetchfunction.html
 URLFETCH_DEADLINE_SECS = 10
 
+# HTTP status code indicating that a conditional fetch found no changes.
+HTTP_NOT_MODIFIED = 304
 
-def FetchUrl(url):
+# Don't remember larger indices in a FetchValidator, because Datastore limits
+# the size of each model.
+MAX_INDEX_URLS_TO_REMEMBER = 2000
+
+
+def FetchUrl(url, validator=None, fetcher=None):
   """Returns the contents of the URL, allowing for 'testdata/' local files.
 
   Also supports fake feed URL's defined in cap_fake.FAKE_FEED_URLS.
 
+  If a validator is provided, and it remembers the content that was previously
+  fetched, the fetch will be conditional.
+
   Args:
     url: URL, possibly beginning with 'testdata/' (string)
+    validator: cap_schema.FetchValidator object, or None for an unconditional
+        fetch.  If the content is fetched, the validator is updated, but not
+        saved.
+    fetcher: AsyncUrlFetcher object (or anything with a compatible Fetch
+        method) that may already have started fetching the URL, or None to
+        fetch synchronously.
 
   Returns:
-    Contents of the URL (string)
+    Contents of the URL (string), or None if the content has not been modified
+    since the validator was last updated.
   """
   if url in cap_fake.FAKE_FEED_URLS:
     return _MakeAtomFeed(cap_fake.FAKE_FEED_URLS[url]())
@@ -155,42 +184,770 @@ def FetchUrl(url):
     except:
       logging.error('Cannot read file: %s', path)
       raise
-  else:
+  elif not validator and not fetcher:
     return urlfetch.fetch(url, deadline=URLFETCH_DEADLINE_SECS).content
+  else:
+    headers = {}
+    if validator:
+      headers = _ConditionalHeaders(validator)
+    if fetcher:
+      response = fetcher.Fetch(url, headers)
+    else:
+      response = urlfetch.fetch(url, headers=headers,
+                                deadline=URLFETCH_DEADLINE_SECS)
+    if validator:
+      if response.status_code == HTTP_NOT_MODIFIED:
+        logging.debug('Not modified: %r', url)
+        return None
+      _UpdateValidator(validator, response)
+    return response.content
+
+
+def _IsLocalUrl(url):
+  """Determines whether FetchUrl can satisfy a URL without the network.
+
+  Args:
+    url: URL (str)
+
+  Returns:
+    True, iff the URL is a fake feed or a 'testdata/' file.
+  """
+  return url in cap_fake.FAKE_FEED_URLS or url.startswith('testdata/')
+
+
+class AsyncUrlFetcher(object):
+  """Fetches many URL's concurrently using asynchronous urlfetch RPC's.
+
+  Fetches are started with Start, and their responses are collected (waiting
+  if necessary) with Fetch.  A different concurrent fetcher (e.g. for a
+  runtime other than App Engine) can be used in its place, as long as it
+  provides the same methods.
+  """
+
+  def __init__(self):
+    # Maps URL to (headers, rpc) for fetches in progress.
+    self._rpcs = {}
+    # Maps URL to (headers, response) for completed fetches.
+    self._responses = {}
+
+  def Start(self, url, headers=None):
+    """Starts fetching a URL without waiting for the response.
+
+    Args:
+      url: URL (str)
+      headers: Dict of HTTP request headers, or None.
+    """
+    if not headers:
+      headers = {}
+    rpc = urlfetch.create_rpc(deadline=URLFETCH_DEADLINE_SECS)
+    urlfetch.make_fetch_call(rpc, url, headers=headers)
+    self._rpcs[url] = (headers, rpc)
+
+  def Fetch(self, url, headers=None):
+    """Returns the response for a URL, fetching it if necessary.
+
+    A response from a started fetch is reused, unless it is a 304 (Not
+    Modified) that was requested with different headers.
+
+    Args:
+      url: URL (str)
+      headers: Dict of HTTP request headers, or None.
+
+    Returns:
+      urlfetch response object
+
+    Raises:
+      urlfetch.Error: if the fetch fails.
+    """
+    if not headers:
+      headers = {}
+    if url in self._rpcs:
+      started_headers, rpc = self._rpcs.pop(url)
+      self._responses[url] = (started_headers, rpc.get_result())
+    if url in self._responses:
+      cached_headers, response = self._responses[url]
+      if (response.status_code != HTTP_NOT_MODIFIED or
+          cached_headers == headers):
+        return response
+    response = urlfetch.fetch(url, headers=headers,
+                              deadline=URLFETCH_DEADLINE_SECS)
+    self._responses[url] = (headers, response)
+    return response
+
+
+def GetFetchValidator(url):
+  """Returns the validators from the most recent fetch of the URL.
+
+  Args:
+    url: URL to be fetched (str)
+
+  Returns:
+    cap_schema.FetchValidator object, which is new (and not saved) if the URL
+    has never been fetched.
+  """
+  return GetFetchValidators([url])[0]
+
+
+def GetFetchValidators(urls):
+  """Returns the validators from the most recent fetches of many URL's.
+
+  Args:
+    urls: URL's to be fetched (list of str)
+
+  Returns:
+    List of cap_schema.FetchValidator objects, parallel to urls.  Each is new
+    (and not saved) if its URL has never been fetched.
+  """
+  key_names = [_FetchValidatorKeyName(url) for url in urls]
+  validators = cap_schema.FetchValidator.get_by_key_name(key_names)
+  for i, validator in enumerate(validators):
+    if not validator:
+      validators[i] = cap_schema.FetchValidator(key_name=key_names[i],
+                                                url=urls[i])
+  return validators
+
+
+def _FetchValidatorKeyName(url):
+  """Generates a stable, unique key name for the validators of a URL.
+
+  Args:
+    url: URL that will be fetched (str)
+
+  Returns:
+    Key name (str) for the cap_schema.FetchValidator model.
+  """
+  return 'FetchValidator %s' % url
+
+
+def _ConditionalHeaders(validator):
+  """Returns the HTTP request headers for a conditional fetch.
+
+  Conditional headers are only useful if we remember what the content was, so
+  that we can carry it forward if it has not been modified.
+
+  Args:
+    validator: cap_schema.FetchValidator object
+
+  Returns:
+    Dict of HTTP header names and values (str:str), possibly empty.
+  """
+  headers = {}
+  # Look at the reference without dereferencing it.
+  alert_key = cap_schema.FetchValidator.alert.get_value_for_datastore(
+      validator)
+  if alert_key or validator.index_urls:
+    if validator.etag:
+      headers['If-None-Match'] = str(validator.etag)
+    if validator.last_modified:
+      headers['If-Modified-Since'] = str(validator.last_modified)
+  return headers
+
+
+def _UpdateValidator(validator, response):
+  """Saves the validators from a fetch that returned new content.
+
+  Args:
+    validator: cap_schema.FetchValidator object (modified, but not saved)
+    response: urlfetch response object
+  """
+  validator.etag = response.headers.get('ETag')
+  validator.last_modified = response.headers.get('Last-Modified')
+  # The content has changed, so anything we remembered about it is stale.
+  validator.alert = None
+  validator.index_urls = []
+
+
+class ShardTimer(object):
+  """Accumulates the resources spent on a shard of crawl work.
+
+  Attributes:
+    profile: Dict mapping cap_schema.PROFILE_FIELDS names to amounts (int)
+  """
+
+  def __init__(self, _time=time.time):
+    """Initializes a ShardTimer object.
+
+    Args:
+      _time: dependency injection of clock function that returns seconds
+          (float)
+    """
+    self._time = _time
+    self.profile = dict([(x, 0) for x in cap_schema.PROFILE_FIELDS])
+
+  def Add(self, name, amount):
+    """Adds to one of the amounts.
+
+    Args:
+      name: One of cap_schema.PROFILE_FIELDS (str)
+      amount: Amount to add (int)
+    """
+    self.profile[name] += amount
+
+  def Time(self, name, func, *args, **kwargs):
+    """Calls a function, adding its elapsed time to one of the amounts.
+
+    Times are not rounded until they are saved, so that many short calls can
+    be timed individually.
+
+    Args:
+      name: One of the cap_schema.PROFILE_FIELDS that is measured in
+          milliseconds (str)
+      func: Function to be called.
+      args: Positional arguments to func.
+      kwargs: Keyword arguments to func.
+
+    Returns:
+      Result of func.
+    """
+    start = self._time()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      self.Add(name, 1000.0 * (self._time() - start))
+
+  def SaveTo(self, shard):
+    """Copies the amounts to a shard.
+
+    Args:
+      shard: cap_schema.CrawlShard object (modified, but not saved)
+    """
+    for name, amount in self.profile.iteritems():
+      setattr(shard, name, int(round(amount)))
+
+
+class _RpcCounter(object):
+  """Counts the App Engine API calls made by this process.
+
+  Attributes:
+    count: Number of calls so far (int)
+  """
+
+  # Name under which the counter is registered as an API hook.
+  HOOK_NAME = 'cap_crawl_rpc_counter'
+
+  def __init__(self):
+    self.count = 0
+
+  def __call__(self, service, call, request, response):
+    self.count += 1
 
+  def Install(self):
+    """Makes sure that the counter sees the calls of the current API proxy."""
+    # This does nothing if the hook is already registered.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(self.HOOK_NAME, self)
 
-def GetCap(feed, crawl, cap_url):
+
+_RPC_COUNTER = _RpcCounter()
+
+
+def _TimedFetch(url, validator, fetcher, timer):
+  """Calls FetchUrl, adding its latency and the content size to a timer.
+
+  Args:
+    url: URL (str)
+    validator: See FetchUrl.
+    fetcher: See FetchUrl.
+    timer: ShardTimer object
+
+  Returns:
+    Result of FetchUrl.
+  """
+  content = timer.Time(cap_schema.FETCH_MS, FetchUrl, url,
+                       validator=validator, fetcher=fetcher)
+  if content is not None:
+    timer.Add(cap_schema.FETCH_BYTES, len(content))
+  return content
+
+
+def GetCap(feed, crawl, cap_url, validator=None, fetcher=None, timer=None):
   """Retrieves a CAP file and saves it in the Datastore.
 
   Args:
     feed: Feed object or reference
     crawl: cap_schema.Crawl object
     cap_url: URL of a CAP file (string)
+    validator: cap_schema.FetchValidator object for a conditional fetch, or
+        None.  It is updated, but not saved.
+    fetcher: AsyncUrlFetcher object, or None to fetch synchronously.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+
+  Returns:
+    cap_schema.CapAlert object (already populated and saved)
+
+  Raises:
+    cap_parse_mem.NotCapError: if the URL did not contain CAP.
+  """
+  if not timer:
+    timer = ShardTimer()
+  cap_text = _TimedFetch(cap_url, validator, fetcher, timer)
+  return ProcessCap(feed, crawl, cap_url, cap_text, validator=validator,
+                    fetcher=fetcher, timer=timer)
+
+
+def ProcessCap(feed, crawl, cap_url, cap_text, validator=None, fetcher=None,
+               timer=None):
+  """Saves the result of fetching a CAP file in the Datastore.
+
+  Args:
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of a CAP file (string)
+    cap_text: Result of FetchUrl (string), which is None if the content has
+        not been modified since the validator was last updated.
+    validator: cap_schema.FetchValidator object that was used for the fetch,
+        or None.  It is updated, but not saved.
+    fetcher: AsyncUrlFetcher object, or None to fetch synchronously, in case
+        the content must be fetched again.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
 
   Returns:
     cap_schema.CapAlert object (already populated and saved)
+
+  Raises:
+    cap_parse_mem.NotCapError: if the URL did not contain CAP.
+  """
+  if not timer:
+    timer = ShardTimer()
+  if cap_text is None:
+    # Nothing has changed since the last fetch, so don't bother parsing.
+    previous_alert = db_util.SafelyDereference(validator, 'alert')
+    if previous_alert:
+      logging.debug('Carrying forward CAP for %r', cap_url)
+      alert_db = timer.Time(cap_schema.PUT_MS, _CarryForwardAlert,
+                            previous_alert, feed, crawl, cap_url)
+      # Refer to the newest copy, so that purging old crawls doesn't lose it.
+      validator.alert = alert_db
+      return alert_db
+    elif validator.index_urls:
+      raise cap_parse_mem.NotCapError(cap_url)
+    else:
+      # The alert we remembered has been purged, so we need the content.
+      validator.alert = None
+      cap_text = _TimedFetch(cap_url, validator, fetcher, timer)
+  return SaveCap(feed, crawl, cap_url, cap_text, validator=validator,
+                 timer=timer)
+
+
+def SaveCap(feed, crawl, cap_url, cap_text, validator=None, timer=None):
+  """Saves CAP that has already been fetched in the Datastore.
+
+  Args:
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of the CAP file (string)
+    cap_text: Contents of the URL (string)
+    validator: cap_schema.FetchValidator object for the URL, or None.  It is
+        updated, but not saved.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+
+  Returns:
+    cap_schema.CapAlert object (already populated and saved)
+
+  Raises:
+    cap_parse_mem.NotCapError: if the text is not CAP.
+  """
+  if not timer:
+    timer = ShardTimer()
+  cap_text = xml_util.ParseText(cap_text)
+  digest = cap_schema.AlertDigest(cap_text)
+  alert_db = _MaybeReuseAlert(feed, crawl, cap_url, digest, timer)
+  if not alert_db:
+    parsed_cap = ParseCap(cap_text, timer=timer)
+    alert_db = _SaveNewCap(feed, crawl, cap_url, digest, parsed_cap, timer)
+  if validator:
+    validator.alert = alert_db
+  return alert_db
+
+
+class ParsedCap(object):
+  """CAP text that has been parsed in memory, but not saved.
+
+  Attributes:
+    text: CAP XML (unicode)
+    extract: Result of cap_parse_mem.MemoryCapParser.ExtractAlert
+    alert: In-memory CAP alert model (caplib.Alert)
+    errors: Parse errors (list)
+  """
+
+  def __init__(self, text, extract, alert, errors):
+    self.text = text
+    self.extract = extract
+    self.alert = alert
+    self.errors = errors
+
+
+def ParseCap(cap_text, timer=None):
+  """Parses CAP in memory, as SaveCap does.
+
+  Args:
+    cap_text: CAP XML (str or unicode)
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+
+  Returns:
+    ParsedCap object
+
+  Raises:
+    cap_parse_mem.NotCapError: if the text is not CAP.
   """
-  cap_text = xml_util.ParseText(FetchUrl(cap_url))
-  parser = cap_parse_mem.MemoryCapParser()
+  if not timer:
+    timer = ShardTimer()
+  cap_text = xml_util.ParseText(cap_text)
+  parser = cap_parse_mem.MemoryCapParser(
+      backend=cap_parse_mem.ELEMENT_TREE_BACKEND)
   new_alert_model = lambda: caplib.Alert()
-  alert_mem, errors = parser.MakeAlert(new_alert_model, cap_text)
-  alert_db = cap_parse_db.MakeDbAlertFromMem(alert_mem)
+  # Keep the extract, so that queries need not parse the XML again.
+  alert_extract = timer.Time(cap_schema.PARSE_MS, parser.ExtractAlert,
+                             cap_text)
+  alert_mem, errors = timer.Time(cap_schema.PARSE_MS,
+                                 parser.MakeAlertFromExtract,
+                                 new_alert_model, alert_extract)
+  return ParsedCap(cap_text, alert_extract, alert_mem, errors)
+
+
+def SaveParsedCap(feed, crawl, cap_url, parsed_cap, validator=None,
+                  timer=None):
+  """Saves CAP that has already been parsed (by ParseCap) in the Datastore.
+
+  Args:
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of the CAP file (string)
+    parsed_cap: ParsedCap object
+    validator: cap_schema.FetchValidator object for the URL, or None.  It is
+        updated, but not saved.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+
+  Returns:
+    cap_schema.CapAlert object (already populated and saved)
+  """
+  if not timer:
+    timer = ShardTimer()
+  digest = cap_schema.AlertDigest(parsed_cap.text)
+  alert_db = _MaybeReuseAlert(feed, crawl, cap_url, digest, timer)
+  if not alert_db:
+    alert_db = _SaveNewCap(feed, crawl, cap_url, digest, parsed_cap, timer)
+  if validator:
+    validator.alert = alert_db
+  return alert_db
+
+
+def _MaybeReuseAlert(feed, crawl, cap_url, digest, timer):
+  """Carries forward an alert that has exactly the same text, if any.
+
+  Args:
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of the CAP file (string)
+    digest: Result of cap_schema.AlertDigest for the text
+    timer: ShardTimer object
+
+  Returns:
+    New cap_schema.CapAlert object (already saved), or None if the text has
+    not been seen before.
+  """
+  previous_alert = _FindAlertByDigest(digest)
+  if not previous_alert:
+    return None
+  # We've seen this exact alert before, so don't bother parsing.
+  logging.debug('Reusing CAP %s for %r', digest, cap_url)
+  return timer.Time(cap_schema.PUT_MS, _CarryForwardAlert,
+                    previous_alert, feed, crawl, cap_url)
+
+
+def _SaveNewCap(feed, crawl, cap_url, digest, parsed_cap, timer):
+  """Converts and saves an alert whose text has not been seen before.
+
+  Args:
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of the CAP file (string)
+    digest: Result of cap_schema.AlertDigest for the text
+    parsed_cap: ParsedCap object
+    timer: ShardTimer object
+
+  Returns:
+    cap_schema.CapAlert object (already populated and saved)
+  """
+  alert_mem = parsed_cap.alert
+  alert_db = timer.Time(cap_schema.CONVERT_MS,
+                        cap_parse_db.MakeDbAlertFromMem, alert_mem)
+  # KML placemarks and normalized XML depend only on the alert, so serve
+  # them from storage.
+  placemark = timer.Time(cap_schema.CONVERT_MS, _MakePlacemark, alert_mem)
+  normalized_text = timer.Time(cap_schema.CONVERT_MS, _NormalizeAlertText,
+                               parsed_cap.text)
+  # So are the shapes of its areas, which are expensive to parse.
+  geometry = timer.Time(cap_schema.CONVERT_MS, _PackGeometry, alert_mem)
   alert_db.crawl = crawl
   alert_db.feed = feed
   alert_db.url = cap_url
-  alert_db.text = cap_text
-  for error in errors:
+  alert_db.digest = digest
+  for error in parsed_cap.errors:
     alert_db.parse_errors.append(xml_util.ParseText(str(error)))
-  # Save the alert model to the db.
+  timer.Time(cap_schema.PUT_MS, _PutNewAlert, alert_db, digest,
+             parsed_cap.text, parsed_cap.extract, placemark, normalized_text,
+             geometry)
+  return alert_db
+
+
+def _TryDerive(description, func, *args):
+  """Derives a field to store with a newly parsed alert, if possible.
+
+  Args:
+    description: What deriving the field does, e.g. 'make placemark' (str)
+    func: Function that derives the field
+    args: Positional arguments of func
+
+  Returns:
+    Result of func, or None if it raised, in which case queries will derive
+    the field themselves.
+  """
+  try:
+    return func(*args)
+  except (DeadlineExceededError, AssertionError):
+    raise
+  except Exception, e:
+    logging.debug('%s', traceback.format_exc())
+    logging.info('Unable to %s: %r', description, e)
+    return None
+
+
+def _MakePlacemark(alert_mem):
+  """Serializes the KML Placemark for a newly parsed alert.
+
+  Args:
+    alert_mem: In-memory CAP alert model (caplib.Alert)
+
+  Returns:
+    Result of cap2kml.PlacemarkText (unicode), or None (see _TryDerive).
+  """
+  return _TryDerive('make placemark', cap2kml.PlacemarkText, alert_mem)
+
+
+def _NormalizeAlertText(cap_text):
+  """Normalizes the XML of a newly parsed alert.
+
+  Args:
+    cap_text: XML text of the alert (db.Text)
+
+  Returns:
+    Result of cap_parse_mem.NormalizeAlertText (unicode), or None (see
+    _TryDerive).
+  """
+  return _TryDerive('normalize alert', cap_parse_mem.NormalizeAlertText,
+                    cap_text)
+
+
+def _PackGeometry(alert_mem):
+  """Serializes the shapes of the areas of a newly parsed alert.
+
+  Args:
+    alert_mem: In-memory CAP alert model (caplib.Alert)
+
+  Returns:
+    Result of packed_geometry.Encode (str), or None (see _TryDerive).
+  """
+  return _TryDerive(
+      'pack geometry',
+      lambda: packed_geometry.Encode(packed_geometry.PackAlert(alert_mem)))
+
+
+def _PutNewAlert(alert_db, digest, cap_text, alert_extract, placemark=None,
+                 normalized_text=None, geometry=None):
+  """Saves a newly parsed alert, along with its text.
+
+  Args:
+    alert_db: cap_schema.CapAlert object, with its crawl and feed assigned
+        (modified and saved)
+    digest: Result of cap_schema.AlertDigest (str)
+    cap_text: XML text of the alert (db.Text)
+    alert_extract: Result of cap_parse_mem.CapParser.ExtractAlert (dict)
+    placemark: Result of _MakePlacemark (unicode or None)
+    normalized_text: Result of _NormalizeAlertText (unicode or None)
+    geometry: Result of _PackGeometry (str or None)
+  """
+  alert_db.body = _SaveAlertBody(digest, cap_text, alert_extract, placemark,
+                                 normalized_text, geometry)
+  alert_db.put()
+  # New content means the feed is active, which speeds up its crawls.
+  crawl_key = cap_schema.CapAlert.crawl.get_value_for_datastore(alert_db)
+  feed_key = cap_schema.CapAlert.feed.get_value_for_datastore(alert_db)
+  cap_schema.MarkFeedChanged(crawl_key, feed_key)
+
+
+def _FindAlertByDigest(digest):
+  """Finds an alert with identical content from any crawl.
+
+  Args:
+    digest: Result of cap_schema.AlertDigest (str)
+
+  Returns:
+    cap_schema.CapAlert object, or None if there are none.
+  """
+  return cap_schema.CapAlert.gql('WHERE digest = :1', digest).get()
+
+
+def _SaveAlertBody(digest, cap_text, alert_extract, placemark=None,
+                   normalized_text=None, geometry=None):
+  """Saves the text of an alert, unless it has already been saved.
+
+  A body that was saved by older code is given the fields that are derived by
+  this code.  A body that was marked as orphaned is no longer.
+
+  Args:
+    digest: Result of cap_schema.AlertDigest (str)
+    cap_text: XML text of the alert (db.Text)
+    alert_extract: Result of cap_parse_mem.CapParser.ExtractAlert (dict)
+    placemark: Result of _MakePlacemark (unicode), or None if the alert has no
+        stored placemark.
+    normalized_text: Result of _NormalizeAlertText (unicode), or None if the
+        alert has no stored normalized text.
+    geometry: Result of _PackGeometry (str), or None if the alert has no
+        stored geometry.
+
+  Returns:
+    cap_schema.CapAlertBody object (already saved)
+  """
+  fields = _DerivedBodyFields(alert_extract, placemark, normalized_text,
+                              geometry)
+  key_name = cap_schema.CapAlertBodyKeyName(digest)
+  body = cap_schema.CapAlertBody.get_or_insert(
+      key_name, text=cap_text,
+      **cap_schema.FitAlertBodyFields(key_name, cap_text, fields))
+  if body.orphaned:
+    # Claim the body before a purge deletes it (see
+    # cap_mirror.PurgeOrphanedAlertBodies).
+    body.orphaned = None
+    body.put()
+  _UpdateAlertBody(digest, body, fields)
+  return body
+
+
+def _DerivedBodyFields(alert_extract, placemark, normalized_text, geometry):
+  """Lists the fields of a CapAlertBody that are derived from its text.
+
+  The fields are listed in order of their value to queries, since those that
+  do not fit in the body are dropped from the end (see
+  cap_schema.FitAlertBodyFields).
+
+  Args:
+    alert_extract: Result of cap_parse_mem.CapParser.ExtractAlert (dict), or
+        None.
+    placemark: Result of _MakePlacemark (unicode or None)
+    normalized_text: Result of _NormalizeAlertText (unicode or None)
+    geometry: Result of _PackGeometry (str or None)
+
+  Returns:
+    List of (name, version name, version, value or None)
+  """
+  if alert_extract is not None:
+    alert_extract = db.Text(cap_parse_mem.EncodeExtract(alert_extract))
+  if placemark is not None:
+    placemark = db.Text(placemark)
+  if normalized_text is not None:
+    normalized_text = db.Text(normalized_text)
+  if geometry is not None:
+    geometry = db.Blob(geometry)
+  return [
+      ('extract', 'extract_version', cap_parse_mem.EXTRACT_VERSION,
+       alert_extract),
+      ('geometry', 'geometry_version', packed_geometry.VERSION, geometry),
+      ('placemark', 'placemark_version', cap2kml.PLACEMARK_VERSION,
+       placemark),
+      ('normalized_text', 'normalized_version',
+       cap_parse_mem.NORMALIZER_VERSION, normalized_text),
+      ]
+
+
+def _UpdateAlertBody(digest, body, fields):
+  """Replaces the derived fields of a body that were derived by older code.
+
+  Args:
+    digest: Result of cap_schema.AlertDigest (str)
+    body: cap_schema.CapAlertBody object (modified and saved, if necessary)
+    fields: Result of _DerivedBodyFields
+  """
+  current_fields = []
+  is_stale = False
+  for name, version_name, version, value in fields:
+    if getattr(body, version_name) == version:
+      value = getattr(body, name)
+    else:
+      is_stale = True
+    current_fields.append((name, version_name, version, value))
+  if is_stale:
+    logging.debug('Updating derived fields of %s', digest)
+    for name, value in cap_schema.FitAlertBodyFields(
+        body.key().name(), body.text, current_fields).iteritems():
+      setattr(body, name, value)
+    body.put()
+
+
+def _CarryForwardAlert(previous_alert, feed, crawl, cap_url):
+  """Copies an alert from a previous crawl into the current crawl.
+
+  The copy shares the previous alert's CapAlertBody, if any.
+
+  Args:
+    previous_alert: cap_schema.CapAlert object from a previous crawl
+    feed: Feed object or reference
+    crawl: cap_schema.Crawl object
+    cap_url: URL of the CAP file (string)
+
+  Returns:
+    cap_schema.CapAlert object (already populated and saved)
+  """
+  alert_db = db_util.CloneModel(cap_schema.CapAlert, previous_alert,
+                                crawl=crawl, feed=feed, url=cap_url)
+  if previous_alert.geohash_version != geo_index.VERSION:
+    _ReindexAlertAreas(alert_db)
   alert_db.put()
   return alert_db
 
 
-def GetFeedIndex(feed_url):
+def _ReindexAlertAreas(alert_db):
+  """Indexes the areas of an alert that was indexed by an older geo_index.
+
+  The alert is rebuilt from its stored extract, if it has one.  Otherwise, it
+  keeps its old index until its content changes.
+
+  Args:
+    alert_db: cap_schema.CapAlert object (modified, not saved)
+  """
+  alert_extract = alert_db.GetExtract(cap_parse_mem.EXTRACT_VERSION)
+  if not alert_extract:
+    return
+  try:
+    parser = cap_parse_mem.MemoryCapParser(
+        backend=cap_parse_mem.ELEMENT_TREE_BACKEND)
+    alert_mem, unused_errors = parser.MakeAlertFromExtract(
+        lambda: caplib.Alert(), cap_parse_mem.DecodeExtract(alert_extract))
+    cap_parse_db.AssignGeohash(alert_db, alert_mem)
+  except (DeadlineExceededError, AssertionError):
+    raise
+  except Exception, e:
+    logging.debug('%s', traceback.format_exc())
+    logging.info('Unable to index alert areas: %r', e)
+
+
+def GetFeedIndex(feed_url, validator=None, fetcher=None, timer=None,
+                 on_urls=None):
   """Returns the list of CAP URL's in the current feed's index.
 
   Args:
     feed_url: URL of the feed (str)
+    validator: cap_schema.FetchValidator object for a conditional fetch, or
+        None.  It is updated, but not saved.
+    fetcher: AsyncUrlFetcher object, or None to fetch synchronously.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+    on_urls: Function that is called with batches of URL's (list of str) as
+        they are parsed, or None.  Together, the batches are the whole index.
 
   Returns:
     List of CAP URL's (strings)
@@ -199,8 +956,110 @@ def GetFeedIndex(feed_url):
     CapIndexFormatError: if there is a problem parsing.
     Exception: if problems fetching the URL.
   """
-  index_text = FetchUrl(feed_url)
-  return cap_index_parse.ParseCapIndex(index_text)
+  if not timer:
+    timer = ShardTimer()
+  index_text = _TimedFetch(feed_url, validator, fetcher, timer)
+  return ProcessFeedIndex(feed_url, index_text, validator=validator,
+                          timer=timer, on_urls=on_urls)
+
+
+def ProcessFeedIndex(feed_url, index_text, validator=None, timer=None,
+                     on_urls=None):
+  """Returns the list of CAP URL's in the result of fetching an index.
+
+  Args:
+    feed_url: URL of the feed (str)
+    index_text: Result of FetchUrl (string), which is None if the content has
+        not been modified since the validator was last updated.
+    validator: cap_schema.FetchValidator object that was used for the fetch,
+        or None.  It is updated, but not saved.
+    timer: ShardTimer object that accumulates the time spent in each stage,
+        or None.
+    on_urls: Function that is called with batches of URL's (list of str) as
+        they are parsed, or None.  Together, the batches are the whole index.
+
+  Returns:
+    List of CAP URL's (strings)
+
+  Raises:
+    CapIndexFormatError: if there is a problem parsing.
+  """
+  if not timer:
+    timer = ShardTimer()
+  if index_text is None:
+    logging.debug('Carrying forward index for %r', feed_url)
+    urls = list(validator.index_urls)
+    if on_urls:
+      for batch in _Batches(urls, INDEX_URLS_BATCH_SIZE):
+        on_urls(batch)
+    return urls
+
+  # The index is parsed incrementally, so that the first URL's can be handed
+  # to on_urls before the rest of a very large index is parsed.
+  urls = []
+  batch_start = 0
+  for url in _TimedIter(timer, cap_schema.PARSE_MS,
+                        cap_index_parse.IterCapIndex(index_text)):
+    urls.append(url)
+    if on_urls and len(urls) - batch_start >= INDEX_URLS_BATCH_SIZE:
+      on_urls(urls[batch_start:])
+      batch_start = len(urls)
+  if on_urls and len(urls) > batch_start:
+    on_urls(urls[batch_start:])
+  if validator and len(urls) <= MAX_INDEX_URLS_TO_REMEMBER:
+    validator.index_urls = [db.Text(x) for x in urls]
+  return urls
+
+
+def _TimedIter(timer, name, iterable):
+  """Iterates, adding the time spent producing the items to a timer.
+
+  Args:
+    timer: ShardTimer object
+    name: One of the cap_schema.PROFILE_FIELDS that is measured in
+        milliseconds (str)
+    iterable: Anything that can be iterated.
+
+  Yields:
+    Items of iterable.
+  """
+  iterator = iter(iterable)
+  while True:
+    try:
+      item = timer.Time(name, iterator.next)
+    except StopIteration:
+      return
+    yield item
+
+
+# Kinds of documents distinguished by ClassifyDocument.
+CAP_DOCUMENT = 'cap'
+INDEX_DOCUMENT = 'index'
+
+
+def ClassifyDocument(text):
+  """Determines whether a document is CAP or an index, from its root element.
+
+  Only the start of the document is parsed.  The root element is recognized by
+  its namespace, so CAP 1.0, 1.1, and 1.2 are all recognized, whatever prefix
+  they use.
+
+  Args:
+    text: XML (str)
+
+  Returns:
+    CAP_DOCUMENT, INDEX_DOCUMENT, or None if it is neither (or not XML).
+  """
+  root_name = xml_util.GetRootName(text)
+  if not root_name:
+    return None
+  elif cap_parse_mem.IsCapAlertName(*root_name):
+    return CAP_DOCUMENT
+  elif (root_name in cap_index_parse.RSS_NAMES or
+        root_name in cap_index_parse.ATOM_FEED_NAMES):
+    return INDEX_DOCUMENT
+  else:
+    return None
 
 
 def _CrawlShardKeyName(crawl, url):
@@ -220,6 +1079,31 @@ def _CrawlShardKeyName(crawl, url):
 # configuration in queue.yaml.
 PUSH_TASKQUEUE_NAME = 'crawlpush'
 
+# Maximum number of URL's in a single /crawlpush task.  This keeps the task
+# payload well under the Task Queue size limit.
+PUSH_BATCH_SIZE = 50
+
+# Maximum number of tasks that can be added to a queue in one call.
+MAX_TASKS_PER_ADD = 100
+
+# Number of URL's from an index that are passed to the on_urls callback of
+# GetFeedIndex at a time.  This is as many as _EnqueuePushBatch can add to the
+# task queue in one call.
+INDEX_URLS_BATCH_SIZE = PUSH_BATCH_SIZE * MAX_TASKS_PER_ADD
+
+
+def _Batches(items, batch_size):
+  """Splits a list into consecutive batches.
+
+  Args:
+    items: List of anything.
+    batch_size: Maximum length of each batch (int)
+
+  Returns:
+    List of lists, none of which are empty.
+  """
+  return [items[i:i + batch_size] for i in xrange(0, len(items), batch_size)]
+
 
 def _EnqueuePush(crawl, feed, url):
   """Adds a shard to the crawl task queue.
@@ -229,71 +1113,114 @@ def _EnqueuePush(crawl, feed, url):
     feed: cap_schema.Feed object
     url: URL to be fetched (str)
   """
+  _EnqueuePushBatch(crawl, feed, [url])
+
+
+def _EnqueuePushBatch(crawl, feed, urls):
+  """Adds shards for many URL's to the crawl task queue.
+
+  The URL's are split among as few /crawlpush tasks as possible.
+
+  Args:
+    crawl: cap_schema.Crawl object
+    feed: cap_schema.Feed object
+    urls: URL's to be fetched (list of str)
+  """
+  crawl_key = str(crawl.key())
+  feed_key = str(feed.key())
+  tasks = []
+  for batch in _Batches(list(urls), PUSH_BATCH_SIZE):
+    tasks.append(taskqueue.Task(
+        url='/crawlpush', method='POST',
+        params={'crawl': crawl_key, 'feed': feed_key, 'url': batch}))
+  if not tasks:
+    return
+  # Count the tasks before they can run, so that the crawl can't look done
+  # while they are pending.
+  cap_schema.IncrementCrawlCounter(crawl, cap_schema.PUSHES_ENQUEUED,
+                                   len(tasks))
   queue = taskqueue.Queue(name=PUSH_TASKQUEUE_NAME)
-  task = taskqueue.Task(
-      url='/crawlpush', method='GET',
-      params={'crawl': str(crawl.key()), 'feed': str(feed.key()), 'url': url})
-  queue.add(task)
+  for task_batch in _Batches(tasks, MAX_TASKS_PER_ADD):
+    queue.add(task_batch)
 
 
-def _MaybePushShardUnsafe(crawl, feed, url):
-  """Pushes a shard of work onto an appropriate queue.
+def _MaybePushShards(crawl, feed, urls):
+  """Pushes shards of work for any URL's not yet seen in this crawl.
 
-  Called by _MaybePushShard to wrap in a transaction.
+  Existing shards are found with a single batch get, so URL's that were
+  already pushed cost one Datastore round trip in all.  Each missing shard is
+  then created in its own transaction, because the same URL may be pushed by
+  concurrent tasks (e.g. if it is listed by two feeds).  Only the shards that
+  are actually created are enqueued, so a shard that another task created,
+  and possibly completed, is never replaced.
 
   Args:
     crawl: cap_schema.Crawl object
     feed: cap_schema.Feed object
-    url: URL to be fetched (str)
+    urls: URL's to be fetched (list of str)
 
   Returns:
-    (shard, is_new)
-    shard: cap_schema.CrawlShard object, possibly new.
-    is_new: If True, shard was just added.
+    List of new cap_schema.CrawlShard objects, possibly empty.
 
   Postconditions:
-    May add a new CrawlShard.
+    May add new CrawlShards, and enqueues them.
   """
-  logging.debug('MaybePushShard %r', url)
   assert crawl
-  # Use a key that will help us know whether this URL has been crawled on
-  # this crawl before.
-  key_name = _CrawlShardKeyName(crawl, url)
-
-  # See if we already exist.
-  shard = cap_schema.CrawlShard.get_by_key_name(key_name)
-  is_new = not shard
-  if is_new:
-    shard = cap_schema.CrawlShard(
-        key_name=key_name, crawl=crawl, feed=feed, url=url)
-    shard.put()
+  logging.debug('MaybePushShards %d URLs', len(urls))
+  # Use keys that will help us know whether each URL has been crawled on this
+  # crawl before.  Ignore duplicate URL's within the batch.
+  key_names = []
+  unique_urls = []
+  seen_key_names = set()
+  for url in urls:
+    key_name = _CrawlShardKeyName(crawl, url)
+    if key_name not in seen_key_names:
+      seen_key_names.add(key_name)
+      key_names.append(key_name)
+      unique_urls.append(url)
+  if not key_names:
+    return []
+
+  # See which already exist.
+  existing_shards = cap_schema.CrawlShard.get_by_key_name(key_names)
+  new_shards = []
+  for key_name, url, shard in zip(key_names, unique_urls, existing_shards):
+    if not shard:
+      shard = db.run_in_transaction(_InsertShardUnsafe, key_name, crawl, feed,
+                                    url)
+      if shard:
+        new_shards.append(shard)
+  if not new_shards:
+    return []
+  cap_schema.IncrementCrawlCounter(crawl, cap_schema.SHARDS_CREATED,
+                                   len(new_shards))
 
-  return (shard, is_new)
+  # Add the new shards to the task queue.  Avoid enqueueing completed shards.
+  _EnqueueShards([str(shard.key()) for shard in new_shards])
+  return new_shards
 
 
-def _MaybePushShard(crawl, feed, url):
-  """Pushes a shard of work onto an appropriate queue.
+def _InsertShardUnsafe(key_name, crawl, feed, url):
+  """Creates a shard, unless it already exists.
+
+  Called by _MaybePushShards to wrap in a transaction.
 
   Args:
+    key_name: Result of _CrawlShardKeyName (str)
     crawl: cap_schema.Crawl object
     feed: cap_schema.Feed object
     url: URL to be fetched (str)
 
   Returns:
-    (shard, is_new)
-    shard: cap_schema.CrawlShard object, possibly new.
-    is_new: If True, shard was just added.
-
-  Postconditions:
-    May add a new CrawlShard.
+    New cap_schema.CrawlShard object (already saved), or None if the shard
+    already exists.
   """
-  shard, is_new = db.run_in_transaction(_MaybePushShardUnsafe, crawl, feed, url)
-
-  # Add the shard to the task queue.  Avoid enqueueing completed shards.
-  if is_new:
-    _EnqueueShard(str(shard.key()))
-
-  return shard, is_new
+  if cap_schema.CrawlShard.get_by_key_name(key_name):
+    return None
+  shard = cap_schema.CrawlShard(
+      key_name=key_name, crawl=crawl, feed=feed, url=url)
+  shard.put()
+  return shard
 
 
 # Name of the task queue for /crawlworker, which corresponds to the
@@ -301,95 +1228,278 @@ def _MaybePushShard(crawl, feed, url):
 WORKER_TASKQUEUE_NAME = 'crawlworker'
 
 
-def _EnqueueShard(shard_key):
-  """Adds a shard to the crawl task queue.
+# Maximum number of shards processed by a single /crawlworker task.  Their
+# URL's are fetched concurrently.
+WORKER_BATCH_SIZE = 10
+
+
+def _EnqueueShards(shard_keys, countdown=None):
+  """Adds shards to the crawl task queue.
+
+  The shards are split among as few /crawlworker tasks as possible.
 
   Args:
-    shard_key: Encoded key for the cap_schema.CrawlShard model (str).
+    shard_keys: Encoded keys for the cap_schema.CrawlShard models (list of
+        str).
+    countdown: Seconds to wait before running the tasks (int), or None to run
+        them as soon as possible.
   """
   queue = taskqueue.Queue(name=WORKER_TASKQUEUE_NAME)
-  task = taskqueue.Task(url='/crawlworker', method='GET',
-                        params={'shard': shard_key})
-  queue.add(task)
+  tasks = [taskqueue.Task(url='/crawlworker', method='POST',
+                          params={'shard': batch}, countdown=countdown)
+           for batch in _Batches(list(shard_keys), WORKER_BATCH_SIZE)]
+  for task_batch in _Batches(tasks, MAX_TASKS_PER_ADD):
+    queue.add(task_batch)
+
+
+def _EnqueueNudge():
+  """Adds a task that nudges the crawl master (see CrawlNudge)."""
+  queue = taskqueue.Queue()
+  queue.add(taskqueue.Task(url='/crawl', method='GET'))
 
 
 class CrawlControllerWorker(object):
   """Controls a single crawl worker.
 
-  The worker performs one shard of work, recording the results in the
-  cap_schema.CrawlShard model.  It may create and enqueue other shards of
-  work.
+  The worker performs a batch of shards of work, recording the results in the
+  cap_schema.CrawlShard models.  The URL's of all shards are fetched
+  concurrently, and each shard is parsed and stored as soon as its response is
+  available.  It may create and enqueue other shards of work.
   """
 
-  def __init__(self, shard_key, _now=datetime.datetime.now):
+  def __init__(self, shard_keys, _now=datetime.datetime.now, fetcher=None):
     """Initializes a CrawlControllerWorker object.
 
     Args:
-      shard_key: Encoded key of the cap_schema.CrawlShard (str or unicode)
+      shard_keys: Encoded keys of the cap_schema.CrawlShard models (list of
+          str or unicode)
       _now: dependency injection of clock function that returns
           datetime.datetime object.
+      fetcher: AsyncUrlFetcher object (or a compatible concurrent fetcher), or
+          None for a new AsyncUrlFetcher.
     """
     self._now = _now
-    self._shard = cap_schema.CrawlShard.get(db.Key(shard_key))
-    if not self._shard:
-      logging.error('No shard having key %r', shard_key)
+    if fetcher:
+      self._fetcher = fetcher
+    else:
+      self._fetcher = AsyncUrlFetcher()
+    # Maps Feed key to the resources spent on its shards (see
+    # cap_schema.EmptyProfile).
+    self._feed_profiles = {}
+    _RPC_COUNTER.Install()
+    self._shards = []
+    shards = cap_schema.CrawlShard.get([db.Key(x) for x in shard_keys])
+    for shard_key, shard in zip(shard_keys, shards):
+      if shard:
+        self._shards.append(shard)
+      else:
+        logging.error('No shard having key %r', shard_key)
 
-  def GetShard(self):
-    """Returns the model of the current crawl shard.
+  def GetShards(self):
+    """Returns the models of the current crawl shards.
 
     Returns:
-      cap_schema.CrawlShard object.
+      List of cap_schema.CrawlShard objects.
+    """
+    return self._shards
+
+  def DoShards(self):
+    """Processes the batch of work (a URL per shard).
+
+    Postconditions:
+      For each shard, see _DoShard.
+    """
+    # Avoid fetching the same shard twice.  This shouldn't happen because of
+    # the way _MaybePushShards works.
+    shards = []
+    for shard in self._shards:
+      if shard.is_done:
+        logging.error('Shard is already done: %r', shard.url)
+      else:
+        shards.append(shard)
+    if not shards:
+      return
+
+    # Remember what we find, so that the next crawl can skip unmodified
+    # content.
+    validators = GetFetchValidators([shard.url for shard in shards])
+
+    # Be polite: put off any shard whose host has no budget left, and start
+    # the rest of the fetches before waiting for any of them.  Whatever
+    # happens, give back the host budget of every fetch that got one.
+    ready = []
+    deferred = {}
+    throttled = []
+    try:
+      for shard, validator in zip(shards, validators):
+        if _IsLocalUrl(shard.url):
+          ready.append((shard, validator))
+          continue
+        # A bad URL fails only its own shard, not the whole batch.
+        try:
+          wait_secs = host_throttle.Acquire(shard.url)
+          if wait_secs:
+            deferred.setdefault(wait_secs, []).append(str(shard.key()))
+            continue
+          throttled.append(shard)
+          self._fetcher.Start(shard.url, _ConditionalHeaders(validator))
+        except (DeadlineExceededError, AssertionError):
+          raise
+        except Exception, e:
+          self._FailShard(shard, e)
+          continue
+        ready.append((shard, validator))
+
+      for wait_secs, shard_keys in deferred.iteritems():
+        logging.debug('Deferring %d shards for %d secs', len(shard_keys),
+                      wait_secs)
+        _EnqueueShards(shard_keys, countdown=wait_secs)
+
+      for shard, validator in ready:
+        try:
+          self._DoShard(shard, validator)
+        finally:
+          if shard in throttled:
+            throttled.remove(shard)
+            host_throttle.Release(shard.url)
+    finally:
+      for shard in throttled:
+        host_throttle.Release(shard.url)
+
+    crawl_key = cap_schema.CrawlShard.crawl.get_value_for_datastore(shards[0])
+    for feed_key, profile in self._feed_profiles.iteritems():
+      cap_schema.AddCrawlProfile(crawl_key, feed_key, profile)
+    self._feed_profiles = {}
+
+    # If we finished the crawl, let the master know now rather than waiting
+    # for cron.
+    counts = cap_schema.GetCrawlCounters(crawl_key)
+    if cap_schema.CrawlWorkRemaining(counts) <= 0:
+      logging.debug('Last shard is done; nudging the master')
+      _EnqueueNudge()
+
+  def _FailShard(self, shard, e):
+    """Completes a shard whose fetch could not even be started.
+
+    Args:
+      shard: cap_schema.CrawlShard object
+      e: Exception that prevented the fetch
+
+    Postconditions:
+      Updates shard.error, and completes the shard as _DoShard does.
+    """
+    shard.started = self._now()
+    rpc_count_before = _RPC_COUNTER.count
+    self._SetShardError(shard, e)
+    self._FinishShard(shard, ShardTimer(), rpc_count_before)
+
+  def _SetShardError(self, shard, e):
+    """Records the error that ended the processing of a shard.
+
+    Args:
+      shard: cap_schema.CrawlShard object
+      e: Exception that was caught, whose traceback is being handled.
+    """
+    logging.error('Skipping URL %r: %r', shard.url, e)
+    shard.error = db.Text('Skipping URL %r: %r: %s' %
+                          (shard.url, e, traceback.format_exc()))
+
+  def _FinishShard(self, shard, timer, rpc_count_before):
+    """Marks a shard as done, whether or not it was successful.
+
+    Args:
+      shard: cap_schema.CrawlShard object
+      timer: ShardTimer object for the shard
+      rpc_count_before: _RPC_COUNTER.count when the shard was started (int)
     """
-    return self._shard
+    shard.is_done = True
+    shard.finished = self._now()
+    timer.Add(cap_schema.RPC_COUNT, _RPC_COUNTER.count - rpc_count_before)
+    timer.SaveTo(shard)
+    self._AddFeedProfile(shard, timer)
+    shard.put()
+    crawl_key = cap_schema.CrawlShard.crawl.get_value_for_datastore(shard)
+    cap_schema.IncrementCrawlCounter(crawl_key, cap_schema.SHARDS_COMPLETED)
+    if shard.error:
+      cap_schema.IncrementCrawlCounter(crawl_key, cap_schema.SHARDS_ERRORED)
 
-  def DoShard(self):
+  def _DoShard(self, shard, validator):
     """Processes a single unit of work (a URL).
 
+    Args:
+      shard: cap_schema.CrawlShard object
+      validator: cap_schema.FetchValidator object for the shard's URL
+
     Postconditions:
       Updates shard.started and shard.completed.
+      Updates the resources spent on the shard (see cap_schema.PROFILE_FIELDS)
+      in the shard, and adds them to the profile of its feed.
       May update the CapAlert Datastore.
       May add more CrawlShards (if nested index)
       Updates shard.error, if an error occurs.
       May push a new feed into the queue, affecting _NextFeed.
     """
-    shard = self._shard
-    if not shard:
-      return
-
-    # Avoid fetching the same shard twice.  This shouldn't happen because of
-    # the way _MaybePushShard works.
-    if shard.is_done:
-      logging.error('Shard is already done: %r', shard.url)
-      return
-
     shard.started = self._now()
     url = shard.url
+    timer = ShardTimer()
+    rpc_count_before = _RPC_COUNTER.count
     # Catch any errors for this URL, so that we can record them in the shard
     # record.
     try:
-      # Assume the URL contains CAP, but catch NotCapError if it is not.
-      try:
-        cap = GetCap(shard.feed, shard.crawl, url)
+      # Fetch once, and decide from the content which parser it needs.
+      content = _TimedFetch(url, validator, self._fetcher, timer)
+      if content is None:
+        # Not modified, so it is whatever it was last time.
+        is_index = bool(validator.index_urls)
+      else:
+        is_index = (timer.Time(cap_schema.PARSE_MS, ClassifyDocument, content)
+                    == INDEX_DOCUMENT)
+      cap = None
+      if not is_index:
+        # It might not be CAP if we couldn't tell, so catch NotCapError.
+        try:
+          cap = ProcessCap(shard.feed, shard.crawl, url, content,
+                           validator=validator, fetcher=self._fetcher,
+                           timer=timer)
+        except cap_parse_mem.NotCapError:
+          logging.debug('Not CAP ... assuming CAP index: %r', url)
+      if cap:
         shard.parse_errors = cap.parse_errors
         logging.debug('Created CAP for %r', url)
-      except cap_parse_mem.NotCapError:
-        logging.debug('Not CAP ... assuming CAP index: %r', url)
-        # Try to process the URL as an index.
-        urls = GetFeedIndex(url)
+      else:
+        # Push the URL's as they are parsed, so that a huge index makes
+        # progress even if we run out of time.
+        push = lambda batch: _EnqueuePushBatch(shard.crawl, shard.feed, batch)
+        urls = ProcessFeedIndex(url, content, validator=validator, timer=timer,
+                                on_urls=push)
         logging.debug('Found %d URLs in nested index', len(urls))
-        for url in urls:
-          _EnqueuePush(shard.crawl, shard.feed, url)
+      timer.Time(cap_schema.PUT_MS, validator.put)
     except (DeadlineExceededError, AssertionError):
       raise
     except Exception, e:
-      logging.error('Skipping URL %r: %r', url, e)
-      shard.error = db.Text('Skipping URL %r: %r: %s' %
-                            (url, e, traceback.format_exc()))
+      self._SetShardError(shard, e)
 
     # Whether or not we were successful, we are done with this shard.
-    shard.is_done = True
-    shard.finished = self._now()
-    shard.put()
+    self._FinishShard(shard, timer, rpc_count_before)
+
+  def _AddFeedProfile(self, shard, timer):
+    """Accumulates the resources spent on a shard with others of its feed.
+
+    Args:
+      shard: cap_schema.CrawlShard object
+      timer: ShardTimer object for the shard
+    """
+    feed_key = cap_schema.CrawlShard.feed.get_value_for_datastore(shard)
+    profile = self._feed_profiles.setdefault(
+        feed_key, cap_schema.EmptyProfile())
+    profile[cap_schema.PROFILE_SHARDS] += 1
+    for name, amount in timer.profile.iteritems():
+      profile[name] += int(round(amount))
+
+
+# After a crawl has been running this long, the master no longer trusts the
+# crawl counters alone to decide whether it is done.
+STALE_CRAWL_AGE = datetime.timedelta(hours=1)
 
 
 class CrawlControllerMaster(object):
@@ -447,11 +1557,29 @@ class CrawlControllerMaster(object):
   def _AreMoreShardsInProgress(self):
     """Determines if any worker has pending work.
 
+    The crawl counters answer this in constant time.  When they say that the
+    crawl is done, or the crawl is so old that the counters may have missed an
+    update, we confirm with a query.
+
     Returns:
       True, iff there are incomplete shards for the current crawl.
     """
+    counts = cap_schema.GetCrawlCounters(self._crawl)
+    remaining = cap_schema.CrawlWorkRemaining(counts)
+    if remaining > 0 and not self._IsCrawlStale():
+      logging.debug('%d shards remaining', remaining)
+      return True
     return bool(self._QueryAnyIncompleteShard())
 
+  def _IsCrawlStale(self):
+    """Determines if the current crawl has been running suspiciously long.
+
+    Returns:
+      True, iff the crawl started more than STALE_CRAWL_AGE ago.
+    """
+    started = self._crawl.started
+    return not started or self._now() - started > STALE_CRAWL_AGE
+
   def _QueryAnyIncompleteShard(self):
     """Finds an incomplete shard for any worker in the current crawl.
 
@@ -490,6 +1618,8 @@ class CrawlControllerMaster(object):
       Current Crawl.finished is set to now.
       Current Crawl is saved.
       All relevant Feed.last_crawl references are set to the current crawl.
+      The serving generation includes the current crawl.
+      Cached query responses are invalidated.
     """
     logging.debug('Crawl is done')
     # Update the Datastore.
@@ -498,10 +1628,17 @@ class CrawlControllerMaster(object):
     crawl.is_done = True
     crawl.finished = self._now()
     crawl.put()
-    # Update the feeds with the last completed crawl.
-    for feed in cap_schema.Feed.gql('WHERE url IN :1', crawl.feed_urls):
+    # Update the feeds with the last completed crawl, and adapt their crawl
+    # periods to whether they changed.
+    feeds = list(cap_schema.Feed.gql('WHERE url IN :1', crawl.feed_urls))
+    changed_feeds = cap_schema.GetChangedFeeds(crawl, feeds)
+    for feed in feeds:
       feed.last_crawl = crawl
-      feed.put()
+      feed.RecordChange(feed.key() in changed_feeds)
+    db.put(feeds)
+    # Queries are served from the last crawls, which have just changed.
+    cap_schema.UpdateServingGeneration(
+        crawl.key(), [feed.key() for feed in feeds if feed.is_root])
 
   def _NewCrawl(self):
     """Starts a new crawl.
@@ -555,7 +1692,7 @@ class CrawlControllerMaster(object):
       # If we've never crawled this feed, or we haven't crawled it recently,
       # add it to the list.
       if not last_crawled or crawl_started > last_crawled + datetime.timedelta(
-          minutes=feed.crawl_period_in_minutes):
+          minutes=feed.GetCrawlPeriodInMinutes()):
         feeds.append(feed)
     return feeds
 
@@ -589,68 +1726,79 @@ class CrawlNudgeHandler(webapp.RequestHandler):
     webapp_util.WriteTemplate(self.response, 'crawl.html', dict(crawl=crawl))
 
 
-def CrawlPush(crawl_key, feed_key, url):
-  """Decodes the keys and maybe pushes a shard of work.
+def CrawlPush(crawl_key, feed_key, urls):
+  """Decodes the keys and maybe pushes shards of work.
 
   Args:
     crawl_key: Key (unicode or str) of a cap_schema.Crawl
     feed_key: Key (unicode or str) of a cap_schema.Feed
-    url: URL that needs to be crawled (unicode or str)
+    urls: URL's that need to be crawled (list of unicode or str)
 
   Returns:
-    (shard, is_new)
-    shard: cap_schema.CrawlShard object, possibly new.
-    is_new: If True, shard was just added.
+    List of new cap_schema.CrawlShard objects, or None if the keys are
+    invalid.
   """
   crawl = cap_schema.Crawl.get(db.Key(crawl_key))
   if not crawl:
+    # Counting the push would only create orphaned counters.
     logging.error('No crawl having key %r', crawl_key)
-    return
-
+    return None
   feed = cap_schema.Feed.get(db.Key(feed_key))
+  shards = None
   if not feed:
     logging.error('No feed having key %r', feed_key)
-    return
+  else:
+    shards = _MaybePushShards(crawl, feed, urls)
 
-  return _MaybePushShard(crawl, feed, url)
+  # This task is done, even if it was useless, so stop counting it against
+  # the crawl.  (If pushing raised, the task will be retried, so it is not
+  # done yet.)
+  cap_schema.IncrementCrawlCounter(crawl.key(), cap_schema.PUSHES_DONE)
+  return shards
 
 
 class CrawlPushHandler(webapp.RequestHandler):
-  """Responds to requests to push a URL into the crawl queue."""
+  """Responds to requests to push URL's into the crawl queue."""
 
   def get(self):
+    self.post()
+
+  def post(self):
     crawl_key = self.request.get('crawl')
     feed_key = self.request.get('feed')
-    url = self.request.get('url')
-    if crawl_key and feed_key and url:
-      CrawlPush(crawl_key, feed_key, url)
+    urls = self.request.get_all('url')
+    if crawl_key and feed_key and urls:
+      CrawlPush(crawl_key, feed_key, urls)
     else:
       logging.error('Must specify crawl, feed, and url')
 
 
-def CrawlWorker(shard_key, _now=datetime.datetime.now):
-  """Seeds the task queues for a crawl.
+def CrawlWorker(shard_keys, _now=datetime.datetime.now):
+  """Performs a batch of crawl work.
 
   Args:
-    shard_key: Key of a cap_schema.CrawlShard
+    shard_keys: Keys of cap_schema.CrawlShard models (list of str or unicode)
     _now: dependency injection of clock function that returns
         datetime.datetime object.
 
   Returns:
     CrawlControllerWorker object
   """
-  controller = CrawlControllerWorker(shard_key, _now=_now)
-  controller.DoShard()
+  controller = CrawlControllerWorker(shard_keys, _now=_now)
+  controller.DoShards()
   return controller
 
 
 class CrawlWorkerHandler(webapp.RequestHandler):
-  """Responds to requests from the task queue to crawl a URL."""
+  """Responds to requests from the task queue to crawl a batch of URL's."""
 
   def get(self):
-    shard_key = self.request.get('shard')
-    if shard_key:
-      controller = CrawlWorker(shard_key)
+    self.post()
+
+  def post(self):
+    shard_keys = self.request.get_all('shard')
+    if shard_keys:
+      controller = CrawlWorker(shard_keys)
     else:
       logging.error('Must specify shard')
 
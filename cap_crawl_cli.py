@@ -0,0 +1,475 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Crawls CAP feeds from the command line, in a single process.
+
+The App Engine crawl (see cap_crawl) is spread across cron and task queue
+requests, so it can't easily be run or timed as a whole.  This tool crawls a
+list of feeds end to end with a pool of threads, using the same fetching and
+parsing code, and reports the throughput and the time spent in each stage.
+
+Usage:
+
+  cap_crawl_cli.py [--threads=N] [--fake] [--datastore_path=PATH] [FEED ...]
+
+Each FEED may be an HTTP URL, a 'testdata/' file, or one of the fake feeds in
+cap_fake.FAKE_FEED_URLS (--fake crawls all of them).
+
+What happens to the alerts depends on the sink.  By default they are parsed
+and discarded (NullSink), which is useful for benchmarks.  With
+--datastore_path, they are saved (DatastoreSink) in a local Datastore file
+that the dev_appserver can load.
+"""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import datetime
+import logging
+import optparse
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+import urllib2
+
+try:
+  # google3
+  import google3
+
+  from google3.apphosting.api import apiproxy_stub_map
+  from google3.apphosting.api import datastore_file_stub
+
+  from google3.dotorg.gongo.appengine_cap2kml import cap_crawl
+  from google3.dotorg.gongo.appengine_cap2kml import cap_fake
+  from google3.dotorg.gongo.appengine_cap2kml import cap_index_parse
+  from google3.dotorg.gongo.appengine_cap2kml import cap_parse_mem
+  from google3.dotorg.gongo.appengine_cap2kml import cap_schema
+
+except ImportError:
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+
+  import cap_crawl
+  import cap_fake
+  import cap_index_parse
+  import cap_parse_mem
+  import cap_schema
+
+
+DEFAULT_NUM_THREADS = 10
+
+# Names of the stages that are timed for each URL.
+FETCH_STAGE = 'fetch'
+PARSE_STAGE = 'parse'
+STORE_STAGE = 'store'
+STAGES = (FETCH_STAGE, PARSE_STAGE, STORE_STAGE)
+
+
+class _UrllibResponse(object):
+  """Response from UrllibFetcher, which resembles a urlfetch response.
+
+  Attributes:
+    status_code: HTTP status code (int)
+    content: Body of the response (str)
+    headers: HTTP response headers (mimetools.Message)
+  """
+
+  def __init__(self, status_code, content, headers):
+    self.status_code = status_code
+    self.content = content
+    self.headers = headers
+
+
+class UrllibFetcher(object):
+  """Fetches URL's with urllib2, for use outside of App Engine.
+
+  Provides the same methods as cap_crawl.AsyncUrlFetcher, so it can be passed
+  to cap_crawl.FetchUrl.  Each fetch is synchronous, so concurrency comes from
+  calling it from many threads.
+  """
+
+  def Start(self, url, headers=None):
+    """Does nothing, since fetches are not started in advance."""
+    pass
+
+  def Fetch(self, url, headers=None):
+    """Returns the response for a URL.
+
+    Args:
+      url: URL (str)
+      headers: Dict of HTTP request headers, or None.
+
+    Returns:
+      _UrllibResponse object
+
+    Raises:
+      urllib2.URLError: if the fetch fails.
+    """
+    if not headers:
+      headers = {}
+    request = urllib2.Request(url, headers=headers)
+    try:
+      handle = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+      if e.code == cap_crawl.HTTP_NOT_MODIFIED:
+        return _UrllibResponse(e.code, '', e.info())
+      raise
+    try:
+      return _UrllibResponse(getattr(handle, 'code', 200), handle.read(),
+                             handle.info())
+    finally:
+      handle.close()
+
+
+class CrawlStats(object):
+  """Thread-safe accumulator of crawl throughput and stage timings.
+
+  Attributes:
+    urls: Number of URL's crawled (int)
+    errors: Number of URL's that failed (int)
+    bytes: Number of bytes fetched (int)
+    stage_secs: Total seconds spent in each stage (dict of str:float)
+    stage_counts: Number of times each stage ran (dict of str:int)
+  """
+
+  def __init__(self, _time=time.time):
+    """Initializes a CrawlStats object.
+
+    Args:
+      _time: dependency injection of clock function that returns seconds
+          (float)
+    """
+    self._time = _time
+    self._lock = threading.Lock()
+    self.urls = 0
+    self.errors = 0
+    self.bytes = 0
+    self.stage_secs = {}
+    self.stage_counts = {}
+
+  def Time(self, stage, func, *args, **kwargs):
+    """Calls a function, adding its elapsed time to a stage.
+
+    Args:
+      stage: Name of the stage (str)
+      func: Function to be called.
+      args: Positional arguments to func.
+      kwargs: Keyword arguments to func.
+
+    Returns:
+      Result of func.
+    """
+    start = self._time()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      elapsed = self._time() - start
+      self._lock.acquire()
+      try:
+        self.stage_secs[stage] = self.stage_secs.get(stage, 0.0) + elapsed
+        self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+      finally:
+        self._lock.release()
+
+  def CountUrl(self, num_bytes, is_error=False):
+    """Records a URL that has been crawled.
+
+    Args:
+      num_bytes: Size of the fetched content (int)
+      is_error: Whether the URL failed (bool)
+    """
+    self._lock.acquire()
+    try:
+      self.urls += 1
+      self.bytes += num_bytes
+      if is_error:
+        self.errors += 1
+    finally:
+      self._lock.release()
+
+  def Report(self, elapsed_secs):
+    """Summarizes the crawl.
+
+    Stage times are summed over all threads, so they can exceed the elapsed
+    time.
+
+    Args:
+      elapsed_secs: Wall time of the crawl (float)
+
+    Returns:
+      Lines of text (list of str)
+    """
+    # Avoid dividing by zero for trivially short crawls.
+    elapsed_secs = max(elapsed_secs, 1e-6)
+    lines = [
+        'Elapsed: %.3f secs' % elapsed_secs,
+        'URLs: %d (%d errors), %.1f URLs/sec' % (
+            self.urls, self.errors, self.urls / elapsed_secs),
+        'Bytes: %d, %.1f bytes/sec' % (self.bytes, self.bytes / elapsed_secs),
+        ]
+    for stage in STAGES:
+      count = self.stage_counts.get(stage, 0)
+      secs = self.stage_secs.get(stage, 0.0)
+      if count:
+        lines.append('%s: %d calls, %.3f secs, %.1f ms/call' % (
+            stage, count, secs, 1000.0 * secs / count))
+    return lines
+
+
+class NullSink(object):
+  """Discards everything that is crawled."""
+
+  def SaveCap(self, feed_url, url, parsed_cap):
+    """Stores a CAP alert.
+
+    Args:
+      feed_url: URL of the feed that led to the alert (str)
+      url: URL of the alert (str)
+      parsed_cap: cap_crawl.ParsedCap object
+    """
+    pass
+
+  def SaveIndex(self, feed_url, url, urls):
+    """Stores the contents of an index of CAP URL's.
+
+    Args:
+      feed_url: URL of the feed that led to the index (str)
+      url: URL of the index (str)
+      urls: URL's in the index (list of str)
+    """
+    pass
+
+  def Finish(self):
+    """Called once the crawl is complete."""
+    pass
+
+
+class DatastoreSink(NullSink):
+  """Saves alerts in the Datastore, as the App Engine crawl does.
+
+  All alerts belong to a single new cap_schema.Crawl, and to cap_schema.Feed
+  models that are created as needed.
+  """
+
+  def __init__(self, _now=datetime.datetime.now):
+    """Initializes a DatastoreSink object, and starts a new crawl.
+
+    Args:
+      _now: dependency injection of clock function that returns
+          datetime.datetime object.
+    """
+    self._now = _now
+    self._lock = threading.Lock()
+    # Maps feed URL to cap_schema.Feed object.
+    self._feeds = {}
+    self._crawl = cap_schema.Crawl(started=self._now())
+    self._crawl.put()
+
+  def GetCrawl(self):
+    """Returns the crawl (cap_schema.Crawl) that owns the saved alerts."""
+    return self._crawl
+
+  def _GetFeed(self, feed_url):
+    """Returns the cap_schema.Feed for a URL, creating it if necessary."""
+    self._lock.acquire()
+    try:
+      feed = self._feeds.get(feed_url)
+      if not feed:
+        feed = cap_schema.Feed.gql('WHERE url = :1', feed_url).get()
+        if not feed:
+          feed = cap_schema.Feed(url=feed_url)
+          feed.put()
+        self._feeds[feed_url] = feed
+      return feed
+    finally:
+      self._lock.release()
+
+  def SaveCap(self, feed_url, url, parsed_cap):
+    cap_crawl.SaveParsedCap(self._GetFeed(feed_url), self._crawl, url,
+                            parsed_cap)
+
+  def Finish(self):
+    self._crawl.feed_urls = sorted(self._feeds)
+    self._crawl.is_done = True
+    self._crawl.finished = self._now()
+    self._crawl.put()
+
+
+def UseDatastoreFile(path, app_id):
+  """Directs the Datastore API to a local file, as the dev_appserver does.
+
+  Args:
+    path: Datastore file, which is created if necessary (str)
+    app_id: Application ID (str)
+  """
+  os.environ['APPLICATION_ID'] = app_id
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  stub = datastore_file_stub.DatastoreFileStub(app_id, path, path + '.history')
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+
+class OfflineCrawler(object):
+  """Crawls feeds, and the indexes and alerts they refer to, with threads.
+
+  Like the App Engine crawl, each URL is assumed to be CAP, and if it is not,
+  it is parsed as an index whose URL's are crawled in turn.  Each URL is
+  crawled at most once.
+  """
+
+  def __init__(self, sink, num_threads=DEFAULT_NUM_THREADS, fetcher=None,
+               stats=None):
+    """Initializes an OfflineCrawler object.
+
+    Args:
+      sink: NullSink object (or anything with compatible methods) that
+          receives the crawled alerts and indexes.
+      num_threads: Number of URL's to crawl concurrently (int)
+      fetcher: Object with the methods of cap_crawl.AsyncUrlFetcher, which
+          must be safe to use from many threads.  Defaults to UrllibFetcher.
+      stats: CrawlStats object, or None for a new one.
+    """
+    self._sink = sink
+    self._num_threads = num_threads
+    self._fetcher = fetcher or UrllibFetcher()
+    self._stats = stats or CrawlStats()
+    self._queue = Queue.Queue()
+    self._seen_urls = set()
+    self._seen_lock = threading.Lock()
+
+  def Crawl(self, feed_urls):
+    """Crawls feeds until there is nothing left to crawl.
+
+    Args:
+      feed_urls: URL's of the root feeds (list of str)
+
+    Returns:
+      CrawlStats object
+    """
+    for feed_url in feed_urls:
+      self._Push(feed_url, feed_url)
+    for unused_i in xrange(self._num_threads):
+      thread = threading.Thread(target=self._Work)
+      # Idle workers should not keep the process alive.
+      thread.setDaemon(True)
+      thread.start()
+    self._queue.join()
+    self._sink.Finish()
+    return self._stats
+
+  def _Push(self, feed_url, url):
+    """Queues a URL, unless it has already been queued.
+
+    Args:
+      feed_url: URL of the root feed (str)
+      url: URL to be crawled (str)
+    """
+    self._seen_lock.acquire()
+    try:
+      if url in self._seen_urls:
+        logging.debug('Already crawled %r', url)
+        return
+      self._seen_urls.add(url)
+    finally:
+      self._seen_lock.release()
+    self._queue.put((feed_url, url))
+
+  def _Work(self):
+    """Crawls queued URL's forever (in a worker thread)."""
+    while True:
+      feed_url, url = self._queue.get()
+      try:
+        self._DoUrl(feed_url, url)
+      finally:
+        self._queue.task_done()
+
+  def _DoUrl(self, feed_url, url):
+    """Crawls a single URL.
+
+    Args:
+      feed_url: URL of the root feed (str)
+      url: URL to be crawled (str)
+
+    Postconditions:
+      The content is passed to the sink, the stats are updated, and any URL's
+      in an index are queued.
+    """
+    stats = self._stats
+    num_bytes = 0
+    try:
+      text = stats.Time(FETCH_STAGE, cap_crawl.FetchUrl, url,
+                        fetcher=self._fetcher)
+      num_bytes = len(text)
+      try:
+        parsed_cap = stats.Time(PARSE_STAGE, cap_crawl.ParseCap, text)
+      except cap_parse_mem.NotCapError:
+        urls = stats.Time(PARSE_STAGE, cap_index_parse.ParseCapIndex, text)
+        logging.debug('Found %d URLs in index %r', len(urls), url)
+        stats.Time(STORE_STAGE, self._sink.SaveIndex, feed_url, url, urls)
+        for nested_url in urls:
+          self._Push(feed_url, nested_url)
+      else:
+        stats.Time(STORE_STAGE, self._sink.SaveCap, feed_url, url,
+                   parsed_cap)
+      stats.CountUrl(num_bytes)
+    except Exception, e:
+      logging.error('Skipping URL %r: %r', url, e)
+      stats.CountUrl(num_bytes, is_error=True)
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options] [FEED ...]')
+  parser.add_option('--threads', type='int', default=DEFAULT_NUM_THREADS,
+                    help='Number of URL\'s to crawl concurrently')
+  parser.add_option('--fake', action='store_true', default=False,
+                    help='Crawl the fake feeds in cap_fake.FAKE_FEED_URLS')
+  parser.add_option('--datastore_path',
+                    help='Save alerts in this Datastore file, rather than '
+                    'discarding them')
+  parser.add_option('--app_id', default='cap2kml',
+                    help='Application ID for --datastore_path')
+  parser.add_option('--timeout', type='float',
+                    default=cap_crawl.URLFETCH_DEADLINE_SECS,
+                    help='Seconds to wait for each fetch')
+  parser.add_option('--verbose', action='store_true', default=False,
+                    help='Log each URL')
+  options, feed_urls = parser.parse_args(argv[1:])
+  if options.fake:
+    feed_urls.extend(sorted(cap_fake.FAKE_FEED_URLS))
+  if not feed_urls:
+    parser.error('No feeds to crawl')
+
+  if options.verbose:
+    logging.getLogger().setLevel(logging.DEBUG)
+  socket.setdefaulttimeout(options.timeout)
+  if options.datastore_path:
+    UseDatastoreFile(options.datastore_path, options.app_id)
+    sink = DatastoreSink()
+  else:
+    sink = NullSink()
+
+  crawler = OfflineCrawler(sink, num_threads=options.threads)
+  start = time.time()
+  stats = crawler.Crawl(feed_urls)
+  print '\n'.join(stats.Report(time.time() - start))
+  if stats.errors:
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,231 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for cap_crawl_cli."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import datetime
+import threading
+import urllib2
+
+import google3
+import mox
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import cap_crawl
+from google3.dotorg.gongo.appengine_cap2kml import cap_crawl_cli
+from google3.dotorg.gongo.appengine_cap2kml import cap_fake
+from google3.dotorg.gongo.appengine_cap2kml import cap_schema
+from google3.dotorg.gongo.appengine_cap2kml import db_test_util
+from google3.dotorg.gongo.appengine_cap2kml import fake_clock
+
+
+class _RecordingSink(cap_crawl_cli.NullSink):
+  """Sink that remembers what it was given."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.caps = []
+    self.indexes = []
+    self.is_finished = False
+
+  def SaveCap(self, feed_url, url, parsed_cap):
+    self.lock.acquire()
+    try:
+      self.caps.append((feed_url, url))
+    finally:
+      self.lock.release()
+
+  def SaveIndex(self, feed_url, url, urls):
+    self.lock.acquire()
+    try:
+      self.indexes.append((feed_url, url, list(urls)))
+    finally:
+      self.lock.release()
+
+  def Finish(self):
+    self.is_finished = True
+
+
+class OfflineCrawlerTest(mox.MoxTestBase):
+  """Tests for cap_crawl_cli.OfflineCrawler."""
+
+  def setUp(self):
+    super(OfflineCrawlerTest, self).setUp()
+    self.mox.StubOutWithMock(cap_crawl_cli, 'logging')
+    self.sink = _RecordingSink()
+    self.crawler = cap_crawl_cli.OfflineCrawler(self.sink, num_threads=3)
+
+  def testCrawl_fakeFeed(self):
+    feed_url = '_FAKE_FEED_URL_1_'
+    cap_urls = cap_fake.FAKE_FEED_URLS[feed_url]()
+    cap_crawl_cli.logging.debug('Found %d URLs in index %r', len(cap_urls),
+                                feed_url)
+    self.mox.ReplayAll()
+
+    stats = self.crawler.Crawl([feed_url])
+    self.assertTrue(self.sink.is_finished)
+    self.assertEquals([(feed_url, feed_url, cap_urls)], self.sink.indexes)
+    self.assertSameElements([(feed_url, x) for x in cap_urls],
+                            self.sink.caps)
+    self.assertEquals(len(cap_urls) + 1, stats.urls)
+    self.assertEquals(0, stats.errors)
+    self.assertTrue(stats.bytes > 0)
+    self.assertEquals(len(cap_urls) + 1,
+                      stats.stage_counts[cap_crawl_cli.FETCH_STAGE])
+    self.assertEquals(len(cap_urls) + 1,
+                      stats.stage_counts[cap_crawl_cli.STORE_STAGE])
+
+  def testCrawl_urlsCrawledOnce(self):
+    cap_url = 'testdata/fake1_cap1.xml'
+    cap_crawl_cli.logging.debug('Already crawled %r', cap_url)
+    self.mox.ReplayAll()
+
+    stats = self.crawler.Crawl([cap_url, cap_url])
+    self.assertEquals([(cap_url, cap_url)], self.sink.caps)
+    self.assertEquals(1, stats.urls)
+
+  def testCrawl_error(self):
+    bad_url = 'testdata/does_not_exist.xml'
+    self.mox.StubOutWithMock(cap_crawl, 'logging')
+    cap_crawl.logging.error('Cannot read file: %s', mox.IgnoreArg())
+    cap_crawl_cli.logging.error('Skipping URL %r: %r', bad_url,
+                                mox.IsA(IOError))
+    self.mox.ReplayAll()
+
+    stats = self.crawler.Crawl([bad_url])
+    self.assertEquals(1, stats.urls)
+    self.assertEquals(1, stats.errors)
+    self.assertEquals([], self.sink.caps)
+
+
+class CrawlStatsTest(googletest.TestCase):
+  """Tests for cap_crawl_cli.CrawlStats."""
+
+  def setUp(self):
+    self.clock = [0.0]
+    self.stats = cap_crawl_cli.CrawlStats(_time=self._Time)
+
+  def _Time(self):
+    # Every call advances the clock by a quarter second.
+    self.clock[0] += 0.25
+    return self.clock[0]
+
+  def testTime(self):
+    self.assertEquals('result', self.stats.Time('fetch', lambda: 'result'))
+    self.assertEquals(0.25, self.stats.stage_secs['fetch'])
+    self.assertEquals(1, self.stats.stage_counts['fetch'])
+
+  def testTime_exception(self):
+    def Fail():
+      raise ValueError('failed')
+    self.assertRaises(ValueError, self.stats.Time, 'parse', Fail)
+    self.assertEquals(1, self.stats.stage_counts['parse'])
+
+  def testReport(self):
+    self.stats.CountUrl(1000)
+    self.stats.CountUrl(500, is_error=True)
+    self.stats.Time('store', lambda: None)
+    self.assertEquals(
+        ['Elapsed: 2.000 secs',
+         'URLs: 2 (1 errors), 1.0 URLs/sec',
+         'Bytes: 1500, 750.0 bytes/sec',
+         'store: 1 calls, 0.250 secs, 250.0 ms/call'],
+        self.stats.Report(2.0))
+
+
+class UrllibFetcherTest(mox.MoxTestBase):
+  """Tests for cap_crawl_cli.UrllibFetcher."""
+
+  def setUp(self):
+    super(UrllibFetcherTest, self).setUp()
+    self.mox.StubOutWithMock(cap_crawl_cli.urllib2, 'urlopen')
+    self.fetcher = cap_crawl_cli.UrllibFetcher()
+    self.url = 'http://example.gov/cap.xml'
+
+  def testFetch(self):
+    handle = self.mox.CreateMockAnything()
+    cap_crawl_cli.urllib2.urlopen(mox.IsA(urllib2.Request)).AndReturn(handle)
+    handle.code = 200
+    handle.read().AndReturn('<alert/>')
+    headers = object()
+    handle.info().AndReturn(headers)
+    handle.close()
+    self.mox.ReplayAll()
+
+    response = self.fetcher.Fetch(self.url)
+    self.assertEquals(200, response.status_code)
+    self.assertEquals('<alert/>', response.content)
+    self.assertTrue(response.headers is headers)
+
+  def testFetch_notModified(self):
+    error = urllib2.HTTPError(self.url, cap_crawl.HTTP_NOT_MODIFIED,
+                              'Not Modified', {}, None)
+    cap_crawl_cli.urllib2.urlopen(mox.IsA(urllib2.Request)).AndRaise(error)
+    self.mox.ReplayAll()
+
+    response = self.fetcher.Fetch(self.url, {'If-None-Match': '"x"'})
+    self.assertEquals(cap_crawl.HTTP_NOT_MODIFIED, response.status_code)
+    self.assertEquals('', response.content)
+
+  def testFetch_error(self):
+    error = urllib2.HTTPError(self.url, 404, 'Not Found', {}, None)
+    cap_crawl_cli.urllib2.urlopen(mox.IsA(urllib2.Request)).AndRaise(error)
+    self.mox.ReplayAll()
+
+    self.assertRaises(urllib2.HTTPError, self.fetcher.Fetch, self.url)
+
+
+class DatastoreSinkTest(mox.MoxTestBase, db_test_util.DbTestBase):
+  """Tests for cap_crawl_cli.DatastoreSink."""
+
+  def setUp(self):
+    super(DatastoreSinkTest, self).setUp()
+    self.mox.StubOutWithMock(cap_crawl, 'SaveParsedCap')
+    self.now = fake_clock.FakeNow(datetime.datetime(2009, 9, 1, 12, 0))
+    self.sink = cap_crawl_cli.DatastoreSink(_now=self.now)
+
+  def testSaveCap(self):
+    feed_url = 'http://example.gov/feed.xml'
+    cap_url = 'http://example.gov/cap.xml'
+    crawl = self.sink.GetCrawl()
+    parsed_cap = cap_crawl.ParsedCap(u'<alert/>', None, None, [])
+    cap_crawl.SaveParsedCap(mox.IsA(cap_schema.Feed), crawl, cap_url,
+                            parsed_cap)
+    cap_crawl.SaveParsedCap(mox.IsA(cap_schema.Feed), crawl, cap_url,
+                            parsed_cap)
+    self.mox.ReplayAll()
+
+    self.sink.SaveCap(feed_url, cap_url, parsed_cap)
+    self.sink.SaveCap(feed_url, cap_url, parsed_cap)
+    self.sink.Finish()
+    # Only one Feed is created per URL.
+    self.assertEquals([feed_url], [x.url for x in cap_schema.Feed.all()])
+    crawl = cap_schema.Crawl.get(crawl.key())
+    self.assertTrue(crawl.is_done)
+    self.assertEquals([feed_url], crawl.feed_urls)
+    self.assertTrue(crawl.finished > crawl.started)
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
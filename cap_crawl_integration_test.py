@@ -18,6 +18,7 @@
 
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
+import base64
 import cgi
 import datetime
 import os.path
@@ -38,11 +39,13 @@ from google3.dotorg.gongo.appengine_cap2kml import cap_crawl
 from google3.dotorg.gongo.appengine_cap2kml import cap_schema
 from google3.dotorg.gongo.appengine_cap2kml import db_test_util
 from google3.dotorg.gongo.appengine_cap2kml import fake_clock
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
 from google3.dotorg.gongo.appengine_cap2kml import taskqueue_test_util
 from google3.dotorg.gongo.appengine_cap2kml import web_query
 
 
 class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
+                       memcache_test_util.MemcacheTestBase,
                        taskqueue_test_util.TaskQueueTestBase):
   """Base class for all cap_crawl integration tests."""
 
@@ -97,9 +100,8 @@ class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
       tasks = self.task_stub.GetTasks(cap_crawl.PUSH_TASKQUEUE_NAME)
       self.task_stub.FlushQueue(cap_crawl.PUSH_TASKQUEUE_NAME)
       for task in tasks:
-        (_, _, path, _, query, _) = urlparse.urlparse(task['url'])
+        path, params = _ParseTask(task)
         self.assertEquals('/crawlpush', path)
-        params = cgi.parse_qs(query)
         self.assertIn('crawl', params)
         self.assertIn('feed', params)
         self.assertIn('url', params)
@@ -108,21 +110,23 @@ class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
         feed_keys = params['feed']
         self.assertEquals(1, len(feed_keys))
         urls = params['url']
-        self.assertEquals(1, len(urls))
-        cap_crawl.CrawlPush(crawl_keys[0], feed_keys[0], urls[0])
+        self.assertTrue(1 <= len(urls) <= cap_crawl.PUSH_BATCH_SIZE)
+        cap_crawl.CrawlPush(crawl_keys[0], feed_keys[0], urls)
 
       # Empty the worker task queue.
       tasks = self.task_stub.GetTasks(cap_crawl.WORKER_TASKQUEUE_NAME)
       self.task_stub.FlushQueue(cap_crawl.WORKER_TASKQUEUE_NAME)
       for task in tasks:
-        (_, _, path, _, query, _) = urlparse.urlparse(task['url'])
+        path, params = _ParseTask(task)
         self.assertEquals('/crawlworker', path)
-        params = cgi.parse_qs(query)
         self.assertIn('shard', params)
         shard_keys = params['shard']
-        self.assertEquals(1, len(shard_keys))
-        worker_controller = cap_crawl.CrawlWorker(shard_keys[0], _now=self.now)
-        self.assertTrue(worker_controller.GetShard().is_done)
+        self.assertTrue(1 <= len(shard_keys) <= cap_crawl.WORKER_BATCH_SIZE)
+        worker_controller = cap_crawl.CrawlWorker(shard_keys, _now=self.now)
+        self.assertEquals(len(shard_keys),
+                          len(worker_controller.GetShards()))
+        for shard in worker_controller.GetShards():
+          self.assertTrue(shard.is_done)
 
     # Nudge it again, which should finish it.
     logging.debug('Finishing test crawl')
@@ -132,6 +136,23 @@ class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
     self.assertTrue(crawl.is_done)
 
 
+def _ParseTask(task):
+  """Extracts the path and parameters of a task from the Task Queue stub.
+
+  Args:
+    task: Dict describing the task, as returned by the stub's GetTasks.
+
+  Returns:
+    (path, params)
+    path: Path of the task's URL (str)
+    params: Dict mapping parameter names to lists of values.
+  """
+  (_, _, path, _, query, _) = urlparse.urlparse(task['url'])
+  if task['method'] == 'POST':
+    query = base64.b64decode(task['body'])
+  return path, cgi.parse_qs(query)
+
+
 def _GetModels(model_class, sort_key, **kwargs):
   """Queries the Datastore for a models having specified attributes.
 
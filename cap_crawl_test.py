@@ -40,11 +40,14 @@ from google3.dotorg.gongo.appengine_cap2kml import cap_schema
 from google3.dotorg.gongo.appengine_cap2kml import cap_test_util
 from google3.dotorg.gongo.appengine_cap2kml import db_test_util
 from google3.dotorg.gongo.appengine_cap2kml import fake_clock
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
 from google3.dotorg.gongo.appengine_cap2kml import mox_util
+from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
 from google3.dotorg.gongo.appengine_cap2kml import taskqueue_test_util
 
 
-class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase):
+class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
+                       memcache_test_util.MemcacheTestBase):
   """Base class for all cap_crawl unit tests."""
 
   def setUp(self):
@@ -55,7 +58,9 @@ class CapCrawlTestBase(mox.MoxTestBase, db_test_util.DbTestBase):
     self.mox.StubOutWithMock(cap_crawl, 'random')
     self.mox.StubOutWithMock(time, 'sleep')
     self.mox.StubOutWithMock(cap_crawl, '_EnqueuePush')
-    self.mox.StubOutWithMock(cap_crawl, '_EnqueueShard')
+    self.mox.StubOutWithMock(cap_crawl, '_EnqueuePushBatch')
+    self.mox.StubOutWithMock(cap_crawl, '_EnqueueShards')
+    self.mox.StubOutWithMock(cap_crawl, '_EnqueueNudge')
 
 
 class MakeAtomFeedTest(CapCrawlTestBase):
@@ -135,6 +140,122 @@ class FetchUrlTest(CapCrawlTestBase):
 
     self.assertEquals(cap_crawl.FetchUrl(url), content)
 
+  def testFetchUrl_externalFirstFetch(self):
+    url = 'http://whatever'
+    content = 'foo'
+    response = self.mox.CreateMockAnything()
+    response.status_code = 200
+    response.content = content
+    response.headers = {'ETag': '"abc"', 'Last-Modified': 'yesterday'}
+    cap_crawl.urlfetch.fetch(
+        url, headers={},
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(response)
+    self.mox.ReplayAll()
+
+    validator = cap_crawl.GetFetchValidator(url)
+    self.assertEquals(cap_crawl.FetchUrl(url, validator=validator), content)
+    self.assertEquals(validator.etag, '"abc"')
+    self.assertEquals(validator.last_modified, 'yesterday')
+
+  def testFetchUrl_externalNotModified(self):
+    url = 'http://whatever'
+    validator = cap_crawl.GetFetchValidator(url)
+    validator.etag = '"abc"'
+    validator.last_modified = 'yesterday'
+    validator.index_urls = [db.Text('http://some.cap')]
+    response = self.mox.CreateMockAnything()
+    response.status_code = cap_crawl.HTTP_NOT_MODIFIED
+    cap_crawl.urlfetch.fetch(
+        url, headers={'If-None-Match': '"abc"',
+                      'If-Modified-Since': 'yesterday'},
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(response)
+    cap_crawl.logging.debug('Not modified: %r', url)
+    self.mox.ReplayAll()
+
+    self.assertTrue(cap_crawl.FetchUrl(url, validator=validator) is None)
+    self.assertListEqual(validator.index_urls, ['http://some.cap'])
+
+  def testFetchUrl_externalModified(self):
+    url = 'http://whatever'
+    content = 'foo'
+    validator = cap_crawl.GetFetchValidator(url)
+    validator.etag = '"abc"'
+    validator.index_urls = [db.Text('http://some.cap')]
+    response = self.mox.CreateMockAnything()
+    response.status_code = 200
+    response.content = content
+    response.headers = {'ETag': '"def"'}
+    cap_crawl.urlfetch.fetch(
+        url, headers={'If-None-Match': '"abc"'},
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(response)
+    self.mox.ReplayAll()
+
+    self.assertEquals(cap_crawl.FetchUrl(url, validator=validator), content)
+    self.assertEquals(validator.etag, '"def"')
+    self.assertTrue(validator.last_modified is None)
+    self.assertListEqual(validator.index_urls, [])
+
+
+class ShardTimerTest(CapCrawlTestBase):
+  """Tests for cap_crawl.ShardTimer."""
+
+  def setUp(self):
+    super(ShardTimerTest, self).setUp()
+    self.clock = [0.0]
+    self.timer = cap_crawl.ShardTimer(_time=self._Time)
+
+  def _Time(self):
+    # Every call advances the clock by a quarter second.
+    self.clock[0] += 0.25
+    return self.clock[0]
+
+  def testTime(self):
+    self.assertEquals('result', self.timer.Time(
+        cap_schema.PARSE_MS, lambda x: x, 'result'))
+    self.assertEquals(250, self.timer.profile[cap_schema.PARSE_MS])
+    self.assertEquals(0, self.timer.profile[cap_schema.FETCH_MS])
+
+  def testTime_exception(self):
+    def Fail():
+      raise ValueError('failed')
+    self.assertRaises(ValueError, self.timer.Time, cap_schema.PUT_MS, Fail)
+    self.assertEquals(250, self.timer.profile[cap_schema.PUT_MS])
+
+  def testSaveTo(self):
+    self.timer.Add(cap_schema.FETCH_BYTES, 1234)
+    shard = cap_schema.CrawlShard()
+    self.timer.SaveTo(shard)
+    self.assertEquals(1234, shard.fetch_bytes)
+    self.assertEquals(0, shard.parse_ms)
+
+
+class CrawlProfileTest(CapCrawlTestBase):
+  """Tests for cap_schema.AddCrawlProfile and GetCrawlProfiles."""
+
+  def testGetCrawlProfiles(self):
+    crawl = cap_schema.Crawl()
+    crawl.put()
+    feeds = cap_test_util.NewFeeds(2)
+    for unused_i in xrange(3):
+      cap_schema.AddCrawlProfile(crawl, feeds[0].key(),
+                                 {cap_schema.PROFILE_SHARDS: 1,
+                                  cap_schema.FETCH_MS: 10})
+    cap_schema.AddCrawlProfile(crawl, feeds[1].key(),
+                               {cap_schema.PROFILE_SHARDS: 2,
+                                cap_schema.FETCH_BYTES: 100})
+    profiles = cap_schema.GetCrawlProfiles(crawl)
+    self.assertSameElements([x.key() for x in feeds], profiles.keys())
+    self.assertEquals(3, profiles[feeds[0].key()][cap_schema.PROFILE_SHARDS])
+    self.assertEquals(30, profiles[feeds[0].key()][cap_schema.FETCH_MS])
+    self.assertEquals(100, profiles[feeds[1].key()][cap_schema.FETCH_BYTES])
+
+    # The crawl totals are summed over the feeds, busiest first.
+    shadow = cap_schema.ShadowCrawl(crawl)
+    self.assertListEqual([x.url for x in feeds],
+                         [x['feed_url'] for x in shadow.feed_profiles])
+    self.assertEquals(5, shadow.profile[cap_schema.PROFILE_SHARDS])
+    self.assertEquals(100, shadow.profile[cap_schema.FETCH_BYTES])
+
 
 class GetCapTest(CapCrawlTestBase):
   """Tests for cap_crawl.GetCap."""
@@ -144,22 +265,38 @@ class GetCapTest(CapCrawlTestBase):
     self.mox.StubOutWithMock(cap_crawl, 'FetchUrl')
     self.mox.StubOutWithMock(cap_crawl.cap_parse_mem, 'MemoryCapParser')
     self.mox.StubOutWithMock(cap_crawl.cap_parse_db, 'MakeDbAlertFromMem')
+    self.mox.StubOutWithMock(cap_crawl.cap2kml, 'PlacemarkText')
+    self.mox.StubOutWithMock(cap_crawl.cap_parse_mem, 'NormalizeAlertText')
+    self.mox.StubOutWithMock(cap_crawl.packed_geometry, 'PackAlert')
     self.mox.StubOutWithMock(cap_crawl.xml_util, 'ParseText')
 
   def testGetCap_nominal(self):
     cap_url = 'http://this.is.a.cap'
     cap_str = '<alert/>'
     cap_text = db.Text(cap_str)
-    cap_crawl.FetchUrl(cap_url).AndReturn(cap_str)
+    cap_crawl.FetchUrl(cap_url, validator=None,
+                       fetcher=None).AndReturn(cap_str)
     cap_crawl.xml_util.ParseText(cap_str).AndReturn(cap_text)
     parser = self.mox.CreateMock(cap_parse_mem.CapParser)
-    cap_crawl.cap_parse_mem.MemoryCapParser().AndReturn(parser)
+    cap_crawl.cap_parse_mem.MemoryCapParser(
+        backend=cap_parse_mem.ELEMENT_TREE_BACKEND).AndReturn(parser)
     alert_mem = self.mox.CreateMockAnything()
     parse_errors = ['foo', 'bar']
-    parser.MakeAlert(mox.IgnoreArg(), cap_text).AndReturn(
+    alert_extract = {'identifier': ['x']}
+    parser.ExtractAlert(cap_text).AndReturn(alert_extract)
+    parser.MakeAlertFromExtract(mox.IgnoreArg(), alert_extract).AndReturn(
         (alert_mem, parse_errors))
     alert_db = cap_schema.CapAlert()
     cap_crawl.cap_parse_db.MakeDbAlertFromMem(alert_mem).AndReturn(alert_db)
+    placemark = u'<Placemark><name>x</name></Placemark>'
+    cap_crawl.cap2kml.PlacemarkText(alert_mem).AndReturn(placemark)
+    normalized_text = u'<alert xmlns="%s"/>' % (
+        cap_parse_mem.CAP_V1_1_NAMESPACE)
+    cap_crawl.cap_parse_mem.NormalizeAlertText(cap_text).AndReturn(
+        normalized_text)
+    geometry = packed_geometry.PackedAlert([[packed_geometry.PackedArea(
+        [], [packed_geometry.PackedCircle(39.74, -104.99, 10.0)])]])
+    cap_crawl.packed_geometry.PackAlert(alert_mem).AndReturn(geometry)
     cap_crawl.xml_util.ParseText('foo').AndReturn(db.Text('foo'))
     cap_crawl.xml_util.ParseText('bar').AndReturn(db.Text('bar'))
     self.mox.ReplayAll()
@@ -173,8 +310,218 @@ class GetCapTest(CapCrawlTestBase):
     self.assertTrue(actual_alert_db.crawl is crawl)
     self.assertTrue(actual_alert_db.feed is feed)
     self.assertEquals(actual_alert_db.url, cap_url)
-    self.assertEquals(actual_alert_db.text, cap_text)
+    self.assertEquals(actual_alert_db.digest,
+                      cap_schema.AlertDigest(cap_text))
+    self.assertEquals(actual_alert_db.GetText(), cap_text)
+    # The extract is stored, so that queries need not parse the text.
+    self.assertEquals(
+        alert_extract,
+        cap_parse_mem.DecodeExtract(actual_alert_db.GetExtract(
+            cap_parse_mem.EXTRACT_VERSION)))
+    self.assertEquals(None, actual_alert_db.GetExtract(
+        cap_parse_mem.EXTRACT_VERSION + 1))
+    self.assertEquals(placemark, actual_alert_db.GetPlacemark(
+        cap_crawl.cap2kml.PLACEMARK_VERSION))
+    self.assertEquals(normalized_text, actual_alert_db.GetNormalizedText(
+        cap_parse_mem.NORMALIZER_VERSION))
+    self.assertEquals(packed_geometry.Encode(geometry),
+                      actual_alert_db.GetGeometry(packed_geometry.VERSION))
     self.assertListEqual(actual_alert_db.parse_errors, parse_errors)
+    self.assertEquals(set([feed.key()]),
+                      cap_schema.GetChangedFeeds(crawl, [feed]))
+
+  def testGetCap_derivedTextErrors(self):
+    cap_url = 'http://this.is.a.cap'
+    cap_str = '<alert/>'
+    cap_text = db.Text(cap_str)
+    cap_crawl.FetchUrl(cap_url, validator=None,
+                       fetcher=None).AndReturn(cap_str)
+    cap_crawl.xml_util.ParseText(cap_str).AndReturn(cap_text)
+    parser = self.mox.CreateMock(cap_parse_mem.CapParser)
+    cap_crawl.cap_parse_mem.MemoryCapParser(
+        backend=cap_parse_mem.ELEMENT_TREE_BACKEND).AndReturn(parser)
+    alert_mem = self.mox.CreateMockAnything()
+    alert_extract = {'identifier': ['x']}
+    parser.ExtractAlert(cap_text).AndReturn(alert_extract)
+    parser.MakeAlertFromExtract(mox.IgnoreArg(), alert_extract).AndReturn(
+        (alert_mem, []))
+    alert_db = cap_schema.CapAlert()
+    cap_crawl.cap_parse_db.MakeDbAlertFromMem(alert_mem).AndReturn(alert_db)
+    cap_crawl.cap2kml.PlacemarkText(alert_mem).AndRaise(
+        cap_crawl.cap2kml.MultipleInfoError())
+    cap_crawl.logging.debug('%s', mox.IgnoreArg())
+    cap_crawl.logging.info('Unable to %s: %r', 'make placemark',
+                           mox.IsA(cap_crawl.cap2kml.MultipleInfoError))
+    cap_crawl.cap_parse_mem.NormalizeAlertText(cap_text).AndRaise(
+        IndexError())
+    cap_crawl.logging.debug('%s', mox.IgnoreArg())
+    cap_crawl.logging.info('Unable to %s: %r', 'normalize alert',
+                           mox.IsA(IndexError))
+    cap_crawl.packed_geometry.PackAlert(alert_mem).AndRaise(ValueError())
+    cap_crawl.logging.debug('%s', mox.IgnoreArg())
+    cap_crawl.logging.info('Unable to %s: %r', 'pack geometry',
+                           mox.IsA(ValueError))
+    self.mox.ReplayAll()
+
+    feed = cap_schema.Feed()
+    feed.put()
+    crawl = cap_schema.Crawl()
+    crawl.put()
+    actual_alert_db = cap_crawl.GetCap(feed, crawl, cap_url)
+    self.assertEquals(actual_alert_db.GetText(), cap_text)
+    # The placemark and normalized text will be built, and the shapes parsed,
+    # when the alert is queried.
+    self.assertEquals(None, actual_alert_db.GetPlacemark(
+        cap_crawl.cap2kml.PLACEMARK_VERSION))
+    self.assertEquals(None, actual_alert_db.GetNormalizedText(
+        cap_parse_mem.NORMALIZER_VERSION))
+    self.assertEquals(None, actual_alert_db.GetGeometry(
+        packed_geometry.VERSION))
+
+  def testGetCap_duplicateContent(self):
+    cap_url = 'http://this.is.a.cap'
+    cap_str = '<alert/>'
+    cap_text = db.Text(cap_str)
+    digest = cap_schema.AlertDigest(cap_text)
+    body = cap_schema.CapAlertBody(
+        key_name=cap_schema.CapAlertBodyKeyName(digest), text=cap_text)
+    body.put()
+    old_alert = cap_schema.CapAlert(url='http://old.url', digest=digest,
+                                    body=body, identifier='foo')
+    old_alert.put()
+    cap_crawl.FetchUrl(cap_url, validator=None,
+                       fetcher=None).AndReturn(cap_str)
+    cap_crawl.xml_util.ParseText(cap_str).AndReturn(cap_text)
+    cap_crawl.logging.debug('Reusing CAP %s for %r', digest, cap_url)
+    # The parser should not be invoked.
+    self.mox.ReplayAll()
+
+    feed = cap_schema.Feed()
+    feed.put()
+    crawl = cap_schema.Crawl()
+    crawl.put()
+    actual_alert_db = cap_crawl.GetCap(feed, crawl, cap_url)
+    self.assertNotEqual(actual_alert_db.key(), old_alert.key())
+    self.assertEquals(actual_alert_db.crawl.key(), crawl.key())
+    self.assertEquals(actual_alert_db.url, cap_url)
+    self.assertEquals(actual_alert_db.identifier, 'foo')
+    self.assertEquals(actual_alert_db.body.key(), body.key())
+    self.assertEquals(1, cap_schema.CapAlertBody.all().count())
+    # Content seen before does not count as a change to the feed.
+    self.assertEquals(set(), cap_schema.GetChangedFeeds(crawl, [feed]))
+
+  def testGetCap_notModified(self):
+    cap_url = 'http://this.is.a.cap'
+    old_feed = cap_schema.Feed()
+    old_feed.put()
+    old_crawl = cap_schema.Crawl()
+    old_crawl.put()
+    old_alert = cap_schema.CapAlert(crawl=old_crawl, feed=old_feed,
+                                    url=cap_url, text='<alert/>',
+                                    identifier='foo', category=['Met'])
+    old_alert.put()
+    validator = cap_crawl.GetFetchValidator(cap_url)
+    validator.alert = old_alert
+    cap_crawl.FetchUrl(cap_url, validator=validator,
+                       fetcher=None).AndReturn(None)
+    cap_crawl.logging.debug('Carrying forward CAP for %r', cap_url)
+    self.mox.ReplayAll()
+
+    feed = cap_schema.Feed()
+    feed.put()
+    crawl = cap_schema.Crawl()
+    crawl.put()
+    actual_alert_db = cap_crawl.GetCap(feed, crawl, cap_url,
+                                       validator=validator)
+    self.assertNotEqual(actual_alert_db.key(), old_alert.key())
+    self.assertEquals(actual_alert_db.crawl.key(), crawl.key())
+    self.assertEquals(actual_alert_db.feed.key(), feed.key())
+    self.assertEquals(actual_alert_db.url, cap_url)
+    self.assertEquals(actual_alert_db.text, old_alert.text)
+    self.assertEquals(actual_alert_db.identifier, 'foo')
+    self.assertListEqual(actual_alert_db.category, ['Met'])
+    self.assertEquals(validator.alert.key(), actual_alert_db.key())
+
+  def testGetCap_notModifiedIndex(self):
+    cap_url = 'http://this.is.an.index'
+    validator = cap_crawl.GetFetchValidator(cap_url)
+    validator.index_urls = [db.Text('http://some.cap')]
+    cap_crawl.FetchUrl(cap_url, validator=validator,
+                       fetcher=None).AndReturn(None)
+    self.mox.ReplayAll()
+
+    self.assertRaises(cap_parse_mem.NotCapError, cap_crawl.GetCap,
+                      None, None, cap_url, validator=validator)
+
+
+class SaveAlertBodyTest(CapCrawlTestBase):
+  """Tests for cap_crawl._SaveAlertBody."""
+
+  def setUp(self):
+    super(SaveAlertBodyTest, self).setUp()
+    self.cap_text = db.Text(u'<alert/>')
+    self.digest = cap_schema.AlertDigest(self.cap_text)
+    self.alert_extract = {'identifier': ['x']}
+    self.placemark = u'<Placemark/>'
+
+  def testSaveAlertBody_dropsFieldsOverBudget(self):
+    # Room for the text and the extract, but not the placemark.
+    extract_size = len(cap_parse_mem.EncodeExtract(self.alert_extract))
+    self.mox.stubs.Set(cap_schema, 'MAX_ALERT_BODY_BYTES',
+                       len(self.cap_text) + extract_size + 1)
+    self.mox.ReplayAll()
+
+    body = cap_crawl._SaveAlertBody(self.digest, self.cap_text,
+                                    self.alert_extract, self.placemark)
+    body = cap_schema.CapAlertBody.get(body.key())
+    self.assertEquals(self.cap_text, body.text)
+    self.assertEquals(self.alert_extract,
+                      cap_parse_mem.DecodeExtract(body.extract))
+    self.assertEquals(None, body.placemark)
+    # It will not be tried again by the same code.
+    self.assertEquals(cap_crawl.cap2kml.PLACEMARK_VERSION,
+                      body.placemark_version)
+
+  def testSaveAlertBody_updatesStaleBody(self):
+    old_body = cap_schema.CapAlertBody(
+        key_name=cap_schema.CapAlertBodyKeyName(self.digest),
+        text=self.cap_text, placemark=db.Text(u'<old/>'),
+        placemark_version=cap_crawl.cap2kml.PLACEMARK_VERSION - 1)
+    old_body.put()
+    cap_crawl.logging.debug('Updating derived fields of %s', self.digest)
+    self.mox.ReplayAll()
+
+    body = cap_crawl._SaveAlertBody(self.digest, self.cap_text,
+                                    self.alert_extract, self.placemark)
+    body = cap_schema.CapAlertBody.get(body.key())
+    self.assertEquals(self.placemark, body.placemark)
+    self.assertEquals(cap_crawl.cap2kml.PLACEMARK_VERSION,
+                      body.placemark_version)
+    self.assertEquals(cap_parse_mem.EXTRACT_VERSION, body.extract_version)
+    self.assertEquals(1, cap_schema.CapAlertBody.all().count())
+
+  def testSaveAlertBody_claimsOrphanedBody(self):
+    self.mox.ReplayAll()
+    cap_crawl._SaveAlertBody(self.digest, self.cap_text, self.alert_extract,
+                             self.placemark)
+    body = cap_schema.CapAlertBody.get_by_key_name(
+        cap_schema.CapAlertBodyKeyName(self.digest))
+    body.orphaned = datetime.datetime(2009, 1, 1)
+    body.put()
+
+    cap_crawl._SaveAlertBody(self.digest, self.cap_text, self.alert_extract,
+                             self.placemark)
+    body = cap_schema.CapAlertBody.get(body.key())
+    self.assertEquals(None, body.orphaned)
+
+  def testSaveAlertBody_keepsCurrentBody(self):
+    self.mox.ReplayAll()
+    cap_crawl._SaveAlertBody(self.digest, self.cap_text, self.alert_extract,
+                             self.placemark)
+    # Saving the same alert again leaves it alone.
+    body = cap_crawl._SaveAlertBody(self.digest, self.cap_text,
+                                    self.alert_extract, None)
+    self.assertEquals(self.placemark, body.placemark)
 
 
 class GetFeedIndexTest(CapCrawlTestBase):
@@ -183,17 +530,90 @@ class GetFeedIndexTest(CapCrawlTestBase):
   def setUp(self):
     super(GetFeedIndexTest, self).setUp()
     self.mox.StubOutWithMock(cap_crawl, 'FetchUrl')
-    self.mox.StubOutWithMock(cap_index_parse, 'ParseCapIndex')
+    self.mox.StubOutWithMock(cap_index_parse, 'IterCapIndex')
 
   def testGetFeedIndex(self):
     feed_url = 'http://some.feed'
     index_text = '<atom/>'
-    cap_crawl.FetchUrl(feed_url).AndReturn(index_text)
-    parsed_index = object()
-    cap_index_parse.ParseCapIndex(index_text).AndReturn(parsed_index)
+    cap_crawl.FetchUrl(feed_url, validator=None,
+                       fetcher=None).AndReturn(index_text)
+    urls = ['http://url1', 'http://url2']
+    cap_index_parse.IterCapIndex(index_text).AndReturn(iter(urls))
     self.mox.ReplayAll()
 
-    self.assertTrue(cap_crawl.GetFeedIndex(feed_url) is parsed_index)
+    self.assertListEqual(urls, cap_crawl.GetFeedIndex(feed_url))
+
+  def testGetFeedIndex_batches(self):
+    self.mox.stubs.Set(cap_crawl, 'INDEX_URLS_BATCH_SIZE', 2)
+    feed_url = 'http://some.feed'
+    index_text = '<atom/>'
+    cap_crawl.FetchUrl(feed_url, validator=None,
+                       fetcher=None).AndReturn(index_text)
+    urls = ['http://url%d' % x for x in xrange(5)]
+    cap_index_parse.IterCapIndex(index_text).AndReturn(iter(urls))
+    self.mox.ReplayAll()
+
+    batches = []
+    self.assertListEqual(
+        urls, cap_crawl.GetFeedIndex(feed_url, on_urls=batches.append))
+    self.assertListEqual([urls[0:2], urls[2:4], urls[4:]], batches)
+
+  def testGetFeedIndex_remembersUrls(self):
+    feed_url = 'http://some.feed'
+    index_text = '<atom/>'
+    validator = cap_crawl.GetFetchValidator(feed_url)
+    cap_crawl.FetchUrl(feed_url, validator=validator,
+                       fetcher=None).AndReturn(index_text)
+    urls = ['http://url1', 'http://url2']
+    cap_index_parse.IterCapIndex(index_text).AndReturn(iter(urls))
+    self.mox.ReplayAll()
+
+    self.assertListEqual(
+        cap_crawl.GetFeedIndex(feed_url, validator=validator), urls)
+    self.assertListEqual(validator.index_urls, urls)
+
+  def testGetFeedIndex_notModified(self):
+    feed_url = 'http://some.feed'
+    urls = ['http://url1', 'http://url2']
+    validator = cap_crawl.GetFetchValidator(feed_url)
+    validator.index_urls = [db.Text(x) for x in urls]
+    cap_crawl.FetchUrl(feed_url, validator=validator,
+                       fetcher=None).AndReturn(None)
+    cap_crawl.logging.debug('Carrying forward index for %r', feed_url)
+    self.mox.ReplayAll()
+
+    batches = []
+    self.assertListEqual(
+        cap_crawl.GetFeedIndex(feed_url, validator=validator,
+                               on_urls=batches.append), urls)
+    self.assertListEqual([urls], batches)
+
+
+class ClassifyDocumentTest(CapCrawlTestBase):
+  """Tests for cap_crawl.ClassifyDocument."""
+
+  def testClassifyDocument_cap(self):
+    self.assertEquals(cap_crawl.CAP_DOCUMENT,
+                      cap_crawl.ClassifyDocument('<alert/>'))
+    for namespace in cap_parse_mem.CAP_NAMESPACES:
+      self.assertEquals(
+          cap_crawl.CAP_DOCUMENT,
+          cap_crawl.ClassifyDocument('<x:alert xmlns:x="%s"/>' % namespace))
+
+  def testClassifyDocument_index(self):
+    self.assertEquals(cap_crawl.INDEX_DOCUMENT,
+                      cap_crawl.ClassifyDocument('<rss version="2.0"/>'))
+    self.assertEquals(
+        cap_crawl.INDEX_DOCUMENT,
+        cap_crawl.ClassifyDocument(
+            '<atom:feed xmlns:atom="%s"/>' % cap_index_parse.ATOM_NAMESPACE))
+
+  def testClassifyDocument_unknown(self):
+    self.assertEquals(None, cap_crawl.ClassifyDocument('<html/>'))
+    self.assertEquals(None, cap_crawl.ClassifyDocument('not XML'))
+    # An alert in some other namespace is not CAP.
+    self.assertEquals(
+        None, cap_crawl.ClassifyDocument('<alert xmlns="urn:not:cap"/>'))
 
 
 class CrawlControllerTestBase(CapCrawlTestBase):
@@ -244,63 +664,128 @@ class CrawlControllerTestBase(CapCrawlTestBase):
 
 
 class CrawlControllerWorkerDoShardTest(CrawlControllerTestBase):
-  """Tests for cap_crawl.CrawlControllerWorker.DoShard."""
+  """Tests for cap_crawl.CrawlControllerWorker.DoShards."""
 
   def setUp(self):
     super(CrawlControllerWorkerDoShardTest, self).setUp()
-    self.mox.StubOutWithMock(cap_crawl, 'GetCap')
-    self.mox.StubOutWithMock(cap_crawl, 'GetFeedIndex')
+    self.mox.StubOutWithMock(cap_crawl, 'FetchUrl')
+    self.mox.StubOutWithMock(cap_crawl, 'ProcessCap')
+    self.mox.StubOutWithMock(cap_crawl, 'ProcessFeedIndex')
+    self.mox.StubOutWithMock(cap_crawl, 'host_throttle')
 
     self.feed = cap_schema.Feed()
     self.feed.put()
     self.url = 'http://foo'
     self.shard = self._NewShard(self.url, feed=self.feed)
+    # Pretend that other shards are still in progress.
+    cap_schema.IncrementCrawlCounter(
+        self.crawl, cap_schema.SHARDS_CREATED, 100)
+    self.fetcher = self.mox.CreateMock(cap_crawl.AsyncUrlFetcher)
     self.worker = cap_crawl.CrawlControllerWorker(
-        str(self.shard.key()), _now=self.now)
+        [str(self.shard.key())], _now=self.now, fetcher=self.fetcher)
+
+  def _ExpectFetch(self, content):
+    cap_crawl.FetchUrl(self.url, validator=mox.IsA(cap_schema.FetchValidator),
+                       fetcher=self.fetcher).AndReturn(content)
 
   def testInit_findsShard(self):
-    self.assertTrue(self.worker.GetShard())
+    self.assertEquals(1, len(self.worker.GetShards()))
 
   def testDoShard_cap(self):
-    shard = self.worker.GetShard()
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
     started = self.now.now
     cap = cap_schema.CapAlert()
     parse_errors = [db.Text(x) for x in ['some error', 'some other error']]
     cap.parse_errors = parse_errors
-    cap_crawl.GetCap(shard.feed, shard.crawl, self.url).AndReturn(cap)
+    self._ExpectFetch('<alert/>')
+    cap_crawl.ProcessCap(shard.feed, shard.crawl, self.url, '<alert/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndReturn(cap)
     cap_crawl.logging.debug('Created CAP for %r', self.url)
+    cap_crawl.host_throttle.Release(self.url)
     self.mox.ReplayAll()
 
-    self.worker.DoShard()
+    self.worker.DoShards()
     self.assertEquals(shard.started, started)
     self.assertListEqual(shard.parse_errors, parse_errors)
     self.assertTrue(shard.is_done)
     self.assertEquals(shard.finished, started + self.now.increment)
+    counts = cap_schema.GetCrawlCounters(self.crawl)
+    self.assertEquals(1, counts[cap_schema.SHARDS_COMPLETED])
+    self.assertEquals(0, counts[cap_schema.SHARDS_ERRORED])
+    # Saving the validator is an API call.
+    self.assertTrue(shard.rpc_count >= 1)
+    profiles = cap_schema.GetCrawlProfiles(self.crawl)
+    self.assertListEqual([self.feed.key()], profiles.keys())
+    self.assertEquals(1, profiles[self.feed.key()][cap_schema.PROFILE_SHARDS])
+    self.assertEquals(shard.rpc_count,
+                      profiles[self.feed.key()][cap_schema.RPC_COUNT])
+
+  def testDoShards_lastShardNudgesMaster(self):
+    # Only this shard remains.
+    cap_schema.IncrementCrawlCounter(
+        self.crawl, cap_schema.SHARDS_COMPLETED, 99)
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
+    cap = cap_schema.CapAlert()
+    self._ExpectFetch('<alert/>')
+    cap_crawl.ProcessCap(shard.feed, shard.crawl, self.url, '<alert/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndReturn(cap)
+    cap_crawl.logging.debug('Created CAP for %r', self.url)
+    cap_crawl.host_throttle.Release(self.url)
+    cap_crawl.logging.debug('Last shard is done; nudging the master')
+    cap_crawl._EnqueueNudge()
+    self.mox.ReplayAll()
 
-  def testDoShard_GetCapRaisesDeadlineExceeded(self):
-    shard = self.worker.GetShard()
+    self.worker.DoShards()
+
+  def testDoShard_ProcessCapRaisesDeadlineExceeded(self):
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
     started = self.now.now
-    cap_crawl.GetCap(shard.feed, shard.crawl, self.url).AndRaise(
+    self._ExpectFetch('<alert/>')
+    cap_crawl.ProcessCap(shard.feed, shard.crawl, self.url, '<alert/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndRaise(
         DeadlineExceededError)
+    cap_crawl.host_throttle.Release(self.url)
     self.mox.ReplayAll()
 
-    self.assertRaises(DeadlineExceededError, self.worker.DoShard)
+    self.assertRaises(DeadlineExceededError, self.worker.DoShards)
     self.assertEquals(shard.started, started)
 
-  def testDoShard_GetCapRaisesException(self):
-    shard = self.worker.GetShard()
+  def testDoShard_ProcessCapRaisesException(self):
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
     started = self.now.now
-    cap_crawl.GetCap(shard.feed, shard.crawl, self.url).AndRaise(
+    self._ExpectFetch('<alert/>')
+    cap_crawl.ProcessCap(shard.feed, shard.crawl, self.url, '<alert/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndRaise(
         ValueError('foobar'))
     cap_crawl.logging.error(
         'Skipping URL %r: %r', self.url, mox.IsA(ValueError))
+    cap_crawl.host_throttle.Release(self.url)
     self.mox.ReplayAll()
 
-    self.worker.DoShard()
+    self.worker.DoShards()
     self.assertEquals(shard.started, started)
     self.assertListEqual(shard.parse_errors, [])
     self.assertTrue(shard.is_done)
     self.assertEquals(shard.finished, started + self.now.increment)
+    counts = cap_schema.GetCrawlCounters(self.crawl)
+    self.assertEquals(1, counts[cap_schema.SHARDS_COMPLETED])
+    self.assertEquals(1, counts[cap_schema.SHARDS_ERRORED])
 
     # Check that the error message contains key information.
     self.assertIn('Skipping URL', shard.error)
@@ -309,95 +794,360 @@ class CrawlControllerWorkerDoShardTest(CrawlControllerTestBase):
     self.assertIn('foobar', shard.error)
 
   def testDoShard_capIndex(self):
-    shard = self.worker.GetShard()
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
     started = self.now.now
-    cap_crawl.GetCap(shard.feed, shard.crawl, self.url).AndRaise(
-        cap_parse_mem.NotCapError('foo'))
-    cap_crawl.logging.debug('Not CAP ... assuming CAP index: %r', self.url)
+    self._ExpectFetch('<rss/>')
     num_urls = 3
     urls = ['http://url%d' % x for x in xrange(num_urls)]
-    cap_crawl.GetFeedIndex(self.url).AndReturn(urls)
+    # The URL's are pushed as they are parsed.
+    push_urls = lambda *args, **kwargs: kwargs['on_urls'](urls)
+    cap_crawl.ProcessFeedIndex(
+        self.url, '<rss/>', validator=mox.IsA(cap_schema.FetchValidator),
+        timer=mox.IsA(cap_crawl.ShardTimer),
+        on_urls=mox.IgnoreArg()).WithSideEffects(push_urls).AndReturn(urls)
+    cap_crawl._EnqueuePushBatch(shard.crawl, shard.feed, urls)
     cap_crawl.logging.debug('Found %d URLs in nested index', num_urls)
-    for i in xrange(num_urls):
-      cap_crawl._EnqueuePush(shard.crawl, shard.feed, urls[i])
+    cap_crawl.host_throttle.Release(self.url)
     self.mox.ReplayAll()
 
-    self.worker.DoShard()
+    self.worker.DoShards()
     self.assertEquals(shard.started, started)
     self.assertListEqual(shard.parse_errors, [])
     self.assertTrue(shard.is_done)
     self.assertEquals(shard.finished, started + self.now.increment)
 
+  def testDoShard_unknownRootFallsBackToIndex(self):
+    shard = self.worker.GetShards()[0]
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, {})
+    self._ExpectFetch('<unknown/>')
+    cap_crawl.ProcessCap(shard.feed, shard.crawl, self.url, '<unknown/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndRaise(
+        cap_parse_mem.NotCapError('foo'))
+    cap_crawl.logging.debug('Not CAP ... assuming CAP index: %r', self.url)
+    # The same content is parsed as an index, without fetching again.
+    cap_crawl.ProcessFeedIndex(
+        self.url, '<unknown/>', validator=mox.IsA(cap_schema.FetchValidator),
+        timer=mox.IsA(cap_crawl.ShardTimer),
+        on_urls=mox.IgnoreArg()).AndReturn([])
+    cap_crawl.logging.debug('Found %d URLs in nested index', 0)
+    cap_crawl.host_throttle.Release(self.url)
+    self.mox.ReplayAll()
+
+    self.worker.DoShards()
+    self.assertTrue(shard.is_done)
+
+  def testDoShard_indexNotModified(self):
+    shard = self.worker.GetShards()[0]
+    validator = cap_crawl.GetFetchValidator(self.url)
+    validator.index_urls = [db.Text('http://url0')]
+    validator.put()
+    cap_crawl.host_throttle.Acquire(self.url).AndReturn(0)
+    self.fetcher.Start(self.url, mox.IgnoreArg())
+    self._ExpectFetch(None)
+    cap_crawl.ProcessFeedIndex(
+        self.url, None, validator=mox.IsA(cap_schema.FetchValidator),
+        timer=mox.IsA(cap_crawl.ShardTimer),
+        on_urls=mox.IgnoreArg()).AndReturn(['http://url0'])
+    cap_crawl.logging.debug('Found %d URLs in nested index', 1)
+    cap_crawl.host_throttle.Release(self.url)
+    self.mox.ReplayAll()
+
+    self.worker.DoShards()
+    self.assertTrue(shard.is_done)
+
+
+class BatchesTest(CapCrawlTestBase):
+  """Tests for cap_crawl._Batches."""
+
+  def testBatches_empty(self):
+    self.assertListEqual([], cap_crawl._Batches([], 3))
+
+  def testBatches_partial(self):
+    self.assertListEqual([[1, 2, 3], [4, 5, 6], [7]],
+                         cap_crawl._Batches(range(1, 8), 3))
+
+
+class CrawlControllerWorkerBatchTest(CrawlControllerTestBase):
+  """Tests for cap_crawl.CrawlControllerWorker with several shards."""
+
+  def setUp(self):
+    super(CrawlControllerWorkerBatchTest, self).setUp()
+    self.mox.StubOutWithMock(cap_crawl, 'FetchUrl')
+    self.mox.StubOutWithMock(cap_crawl, 'ProcessCap')
+    self.mox.StubOutWithMock(cap_crawl, 'host_throttle')
+    self.fetcher = self.mox.CreateMock(cap_crawl.AsyncUrlFetcher)
+    self.feed = cap_schema.Feed()
+    self.feed.put()
+    # Pretend that other shards are still in progress.
+    cap_schema.IncrementCrawlCounter(
+        self.crawl, cap_schema.SHARDS_CREATED, 100)
+
+  def _ExpectCap(self, url, cap):
+    cap_crawl.FetchUrl(url, validator=mox.IsA(cap_schema.FetchValidator),
+                       fetcher=self.fetcher).AndReturn('<alert/>')
+    cap_crawl.ProcessCap(mox.IgnoreArg(), mox.IgnoreArg(), url, '<alert/>',
+                         validator=mox.IsA(cap_schema.FetchValidator),
+                         fetcher=self.fetcher,
+                         timer=mox.IsA(cap_crawl.ShardTimer)).AndReturn(cap)
+
+  def testDoShards_startsAllFetchesFirst(self):
+    urls = ['http://foo', 'testdata/bar', 'http://baz']
+    shards = [self._NewShard(url, feed=self.feed) for url in urls]
+    # Local URL's are neither throttled nor fetched.
+    cap_crawl.host_throttle.Acquire('http://foo').AndReturn(0)
+    self.fetcher.Start('http://foo', {})
+    cap_crawl.host_throttle.Acquire('http://baz').AndReturn(0)
+    self.fetcher.Start('http://baz', {})
+    for url in urls:
+      cap = cap_schema.CapAlert()
+      self._ExpectCap(url, cap)
+      cap_crawl.logging.debug('Created CAP for %r', url)
+      if not url.startswith('testdata/'):
+        cap_crawl.host_throttle.Release(url)
+    self.mox.ReplayAll()
+
+    worker = cap_crawl.CrawlControllerWorker(
+        [str(x.key()) for x in shards], _now=self.now, fetcher=self.fetcher)
+    worker.DoShards()
+    for shard in worker.GetShards():
+      self.assertTrue(shard.is_done)
+
+  def testDoShards_defersOverBudgetHosts(self):
+    urls = ['http://foo', 'http://busy/1', 'http://busy/2']
+    shards = [self._NewShard(url, feed=self.feed) for url in urls]
+    cap_crawl.host_throttle.Acquire('http://foo').AndReturn(0)
+    self.fetcher.Start('http://foo', {})
+    cap_crawl.host_throttle.Acquire('http://busy/1').AndReturn(30)
+    cap_crawl.host_throttle.Acquire('http://busy/2').AndReturn(30)
+    cap_crawl.logging.debug('Deferring %d shards for %d secs', 2, 30)
+    cap_crawl._EnqueueShards([str(x.key()) for x in shards[1:]], countdown=30)
+    cap = cap_schema.CapAlert()
+    self._ExpectCap('http://foo', cap)
+    cap_crawl.logging.debug('Created CAP for %r', 'http://foo')
+    cap_crawl.host_throttle.Release('http://foo')
+    self.mox.ReplayAll()
+
+    worker = cap_crawl.CrawlControllerWorker(
+        [str(x.key()) for x in shards], _now=self.now, fetcher=self.fetcher)
+    worker.DoShards()
+    self.assertListEqual([True, False, False],
+                         [x.is_done for x in worker.GetShards()])
+
+  def testDoShards_startFailsOnlyItsShard(self):
+    urls = ['http://bad', 'http://foo']
+    shards = [self._NewShard(url, feed=self.feed) for url in urls]
+    cap_crawl.host_throttle.Acquire('http://bad').AndReturn(0)
+    self.fetcher.Start('http://bad', {}).AndRaise(ValueError('bad url'))
+    cap_crawl.logging.error(
+        'Skipping URL %r: %r', 'http://bad', mox.IsA(ValueError))
+    cap_crawl.host_throttle.Acquire('http://foo').AndReturn(0)
+    self.fetcher.Start('http://foo', {})
+    cap = cap_schema.CapAlert()
+    self._ExpectCap('http://foo', cap)
+    cap_crawl.logging.debug('Created CAP for %r', 'http://foo')
+    cap_crawl.host_throttle.Release('http://foo')
+    cap_crawl.host_throttle.Release('http://bad')
+    self.mox.ReplayAll()
+
+    worker = cap_crawl.CrawlControllerWorker(
+        [str(x.key()) for x in shards], _now=self.now, fetcher=self.fetcher)
+    worker.DoShards()
+    bad_shard, good_shard = worker.GetShards()
+    self.assertTrue(bad_shard.is_done)
+    self.assertIn('ValueError', bad_shard.error)
+    self.assertTrue(good_shard.is_done)
+    self.assertEquals(None, good_shard.error)
+    counts = cap_schema.GetCrawlCounters(self.crawl)
+    self.assertEquals(2, counts[cap_schema.SHARDS_COMPLETED])
+    self.assertEquals(1, counts[cap_schema.SHARDS_ERRORED])
+
+  def testDoShards_skipsDoneShards(self):
+    shard = self._NewShard('http://foo', feed=self.feed)
+    shard.is_done = True
+    shard.put()
+    cap_crawl.logging.error('Shard is already done: %r', 'http://foo')
+    self.mox.ReplayAll()
+
+    worker = cap_crawl.CrawlControllerWorker(
+        [str(shard.key())], _now=self.now, fetcher=self.fetcher)
+    worker.DoShards()
+
+
+class AsyncUrlFetcherTest(CapCrawlTestBase):
+  """Tests for cap_crawl.AsyncUrlFetcher."""
+
+  def setUp(self):
+    super(AsyncUrlFetcherTest, self).setUp()
+    self.url = 'http://whatever'
+    self.fetcher = cap_crawl.AsyncUrlFetcher()
+
+  def _StartFetch(self, headers, status_code):
+    """Expects an asynchronous fetch.
+
+    Args:
+      headers: Dict of HTTP request headers.
+      status_code: HTTP status of the response (int)
+
+    Returns:
+      Mock response object.
+    """
+    rpc = self.mox.CreateMockAnything()
+    cap_crawl.urlfetch.create_rpc(
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(rpc)
+    cap_crawl.urlfetch.make_fetch_call(rpc, self.url, headers=headers)
+    response = self.mox.CreateMockAnything()
+    response.status_code = status_code
+    rpc.get_result().AndReturn(response)
+    return response
+
+  def testFetch_reusesStartedFetch(self):
+    response = self._StartFetch({}, 200)
+    self.mox.ReplayAll()
+
+    self.fetcher.Start(self.url)
+    self.assertTrue(self.fetcher.Fetch(self.url) is response)
+    # The response is good for any request.
+    self.assertTrue(
+        self.fetcher.Fetch(self.url, {'If-None-Match': 'x'}) is response)
+
+  def testFetch_refetchesNotModifiedWithDifferentHeaders(self):
+    headers = {'If-None-Match': 'x'}
+    not_modified = self._StartFetch(headers, cap_crawl.HTTP_NOT_MODIFIED)
+    response = self.mox.CreateMockAnything()
+    cap_crawl.urlfetch.fetch(
+        self.url, headers={},
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(response)
+    self.mox.ReplayAll()
+
+    self.fetcher.Start(self.url, headers)
+    self.assertTrue(self.fetcher.Fetch(self.url, headers) is not_modified)
+    self.assertTrue(self.fetcher.Fetch(self.url) is response)
+
+  def testFetch_notStarted(self):
+    response = self.mox.CreateMockAnything()
+    cap_crawl.urlfetch.fetch(
+        self.url, headers={},
+        deadline=cap_crawl.URLFETCH_DEADLINE_SECS).AndReturn(response)
+    self.mox.ReplayAll()
+
+    self.assertTrue(self.fetcher.Fetch(self.url) is response)
+
 
-class MaybePushShardUnsafeTest(CrawlControllerTestBase):
-  """Tests for cap_crawl._MaybePushShardUnsafe."""
+class MaybePushShardsTest(CrawlControllerTestBase):
+  """Tests for cap_crawl._MaybePushShards."""
 
   def setUp(self):
-    super(MaybePushShardUnsafeTest, self).setUp()
+    super(MaybePushShardsTest, self).setUp()
     self.feed = cap_schema.Feed()
     self.feed.put()
     self.crawl_started = datetime.datetime(2009, 9, 1, 2, 3, 4)
     self.crawl.started = self.crawl_started
-    self.url = 'http://foo'
+    self.urls = ['http://foo', 'http://bar']
 
-  def testMaybePushShardUnsafe_new(self):
-    cap_crawl.logging.debug('MaybePushShard %r', self.url)
+  def testMaybePushShards_new(self):
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 2)
+    cap_crawl._EnqueueShards(mox.IsA(list))
     self.mox.ReplayAll()
 
-    shard, is_new = cap_crawl._MaybePushShardUnsafe(self.crawl, self.feed, self.url)
-    self.assertEquals(shard.feed.key(), self.feed.key())
-    self.assertEquals(shard.url, self.url)
-    self.assertEquals(shard.crawl.key(), self.crawl.key())
-    self.assertEquals(shard.key().name(),
-                      'CrawlShard %s %s' % (self.crawl_started, self.url))
-    self.assertTrue(is_new)
-
-  def testMaybePushShardUnsafe_existing(self):
-    cap_crawl.logging.debug('MaybePushShard %r', self.url)
-    cap_crawl.logging.debug('MaybePushShard %r', self.url)
+    shards = cap_crawl._MaybePushShards(self.crawl, self.feed, self.urls)
+    self.assertListEqual(self.urls, [shard.url for shard in shards])
+    for shard, url in zip(shards, self.urls):
+      self.assertEquals(shard.feed.key(), self.feed.key())
+      self.assertEquals(shard.crawl.key(), self.crawl.key())
+      self.assertEquals(shard.key().name(),
+                        'CrawlShard %s %s' % (self.crawl_started, url))
+    self.assertEquals(2, cap_schema.CrawlShard.all().count())
+
+  def testMaybePushShards_existing(self):
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 1)
+    cap_crawl._EnqueueShards(mox.IsA(list))
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 3)
+    cap_crawl._EnqueueShards(mox.IsA(list))
     self.mox.ReplayAll()
 
-    cap_crawl._MaybePushShardUnsafe(self.crawl, self.feed, self.url)
-    # Second call should retrieve the existing shard.
-    shard, is_new = cap_crawl._MaybePushShardUnsafe(
-        self.crawl, self.feed, self.url)
-    self.assertEquals(shard.feed.key(), self.feed.key())
-    self.assertEquals(shard.url, self.url)
-    self.assertEquals(shard.crawl.key(), self.crawl.key())
-    self.assertEquals(shard.key().name(),
-                      'CrawlShard %s %s' % (self.crawl_started, self.url))
-    self.assertFalse(is_new)
+    cap_crawl._MaybePushShards(self.crawl, self.feed, self.urls[:1])
+    # Second call should only create the shard that doesn't exist yet, once.
+    shards = cap_crawl._MaybePushShards(
+        self.crawl, self.feed, self.urls + self.urls[1:])
+    self.assertListEqual(self.urls[1:], [shard.url for shard in shards])
+    self.assertEquals(2, cap_schema.CrawlShard.all().count())
+
+  def testMaybePushShards_allExisting(self):
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 2)
+    cap_crawl._EnqueueShards(mox.IsA(list))
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 2)
+    self.mox.ReplayAll()
 
+    cap_crawl._MaybePushShards(self.crawl, self.feed, self.urls)
+    # Nothing should be enqueued the second time.
+    self.assertListEqual(
+        [], cap_crawl._MaybePushShards(self.crawl, self.feed, self.urls))
 
-class MaybePushShardTest(CrawlControllerTestBase):
-  """Tests for cap_crawl._MaybePushShard."""
+  def testInsertShardUnsafe_concurrentPush(self):
+    self.mox.ReplayAll()
+    url = self.urls[0]
+    key_name = cap_crawl._CrawlShardKeyName(self.crawl, url)
+    shard = db.run_in_transaction(cap_crawl._InsertShardUnsafe, key_name,
+                                  self.crawl, self.feed, url)
+    self.assertEquals(key_name, shard.key().name())
+    shard.is_done = True
+    shard.put()
+    # Another task that pushes the same URL leaves the done shard alone.
+    self.assertEquals(None, db.run_in_transaction(
+        cap_crawl._InsertShardUnsafe, key_name, self.crawl, self.feed, url))
+    self.assertTrue(cap_schema.CrawlShard.get_by_key_name(key_name).is_done)
+
+
+class CrawlPushTest(CrawlControllerTestBase):
+  """Tests for cap_crawl.CrawlPush."""
 
   def setUp(self):
-    super(MaybePushShardTest, self).setUp()
-    self.mox.StubOutWithMock(cap_crawl, '_MaybePushShardUnsafe')
+    super(CrawlPushTest, self).setUp()
     self.feed = cap_schema.Feed()
-    self.url = 'http://foo'
-    self.shard = cap_schema.CrawlShard()
-    self.shard.put()
+    self.feed.put()
+    self.crawl.started = datetime.datetime(2009, 9, 1, 2, 3, 4)
+    self.crawl.put()
+
+  def _PushesDone(self):
+    return cap_schema.GetCrawlCounters(self.crawl)[cap_schema.PUSHES_DONE]
+
+  def testCrawlPush(self):
+    cap_crawl.logging.debug('MaybePushShards %d URLs', 1)
+    cap_crawl._EnqueueShards(mox.IsA(list))
+    self.mox.ReplayAll()
+
+    shards = cap_crawl.CrawlPush(str(self.crawl.key()), str(self.feed.key()),
+                                 ['http://foo'])
+    self.assertEquals(1, len(shards))
+    self.assertEquals(1, self._PushesDone())
 
-  def testMaybePushShard_new(self):
-    cap_crawl._MaybePushShardUnsafe(
-        self.crawl, self.feed, self.url).AndReturn((self.shard, True))
-    cap_crawl._EnqueueShard(str(self.shard.key()))
+  def testCrawlPush_noFeed(self):
+    feed_key = str(self.feed.key())
+    self.feed.delete()
+    cap_crawl.logging.error('No feed having key %r', feed_key)
     self.mox.ReplayAll()
 
-    shard, is_new = cap_crawl._MaybePushShard(self.crawl, self.feed, self.url)
-    self.assertEquals(shard, self.shard)
-    self.assertTrue(is_new)
+    self.assertEquals(None, cap_crawl.CrawlPush(
+        str(self.crawl.key()), feed_key, ['http://foo']))
+    self.assertEquals(1, self._PushesDone())
 
-  def testMaybePushShard_existing(self):
-    cap_crawl._MaybePushShardUnsafe(
-        self.crawl, self.feed, self.url).AndReturn((self.shard, False))
+  def testCrawlPush_noCrawl(self):
+    crawl_key = str(self.crawl.key())
+    self.crawl.delete()
+    cap_crawl.logging.error('No crawl having key %r', crawl_key)
     self.mox.ReplayAll()
 
-    shard, is_new = cap_crawl._MaybePushShard(self.crawl, self.feed, self.url)
-    self.assertEquals(shard, self.shard)
-    self.assertFalse(is_new)
+    self.assertEquals(None, cap_crawl.CrawlPush(
+        crawl_key, str(self.feed.key()), ['http://foo']))
+    # No counters are created for the missing crawl.
+    self.assertEquals(
+        [], list(cap_schema.CrawlCounter.gql('WHERE crawl = :1',
+                                             db.Key(crawl_key))))
 
 
 class CrawlControllerMasterTest(CrawlControllerTestBase):
@@ -444,6 +1194,41 @@ class CrawlControllerMasterTest(CrawlControllerTestBase):
 
     self.assertTrue(self.master._AreMoreShardsInProgress())
 
+  def testAreMoreShardsInProgress_countersSayInProgress(self):
+    self.crawl.started = self.now.now
+    cap_schema.IncrementCrawlCounter(self.crawl, cap_schema.SHARDS_CREATED, 5)
+    cap_schema.IncrementCrawlCounter(self.crawl, cap_schema.SHARDS_COMPLETED,
+                                     3)
+    self.mox.StubOutWithMock(cap_crawl.CrawlControllerMaster,
+                             '_QueryAnyIncompleteShard')
+    cap_crawl.logging.debug('%d shards remaining', 2)
+    self.mox.ReplayAll()
+
+    self.assertTrue(self.master._AreMoreShardsInProgress())
+
+  def testAreMoreShardsInProgress_countersCountPendingPushes(self):
+    self.crawl.started = self.now.now
+    cap_schema.IncrementCrawlCounter(self.crawl, cap_schema.PUSHES_ENQUEUED,
+                                     2)
+    cap_schema.IncrementCrawlCounter(self.crawl, cap_schema.PUSHES_DONE)
+    self.mox.StubOutWithMock(cap_crawl.CrawlControllerMaster,
+                             '_QueryAnyIncompleteShard')
+    cap_crawl.logging.debug('%d shards remaining', 1)
+    self.mox.ReplayAll()
+
+    self.assertTrue(self.master._AreMoreShardsInProgress())
+
+  def testAreMoreShardsInProgress_staleCrawlIsConfirmed(self):
+    self.crawl.started = (self.now.now - cap_crawl.STALE_CRAWL_AGE -
+                          datetime.timedelta(minutes=1))
+    cap_schema.IncrementCrawlCounter(self.crawl, cap_schema.SHARDS_CREATED, 5)
+    self.mox.StubOutWithMock(cap_crawl.CrawlControllerMaster,
+                             '_QueryAnyIncompleteShard')
+    self.master._QueryAnyIncompleteShard().AndReturn(None)
+    self.mox.ReplayAll()
+
+    self.assertFalse(self.master._AreMoreShardsInProgress())
+
   def testAreMoreShardsInProgress_false(self):
     self.mox.StubOutWithMock(cap_crawl.CrawlControllerMaster,
                              '_QueryAnyIncompleteShard')
@@ -531,6 +1316,10 @@ class CrawlControllerMasterTest(CrawlControllerTestBase):
     for feed_url in feed_urls_crawled:
       crawl.feed_urls.append(feed_url)
     crawl.put()
+    # Only the first feed had new content.
+    changed_feed = feeds[0]
+    cap_schema.MarkFeedChanged(crawl, changed_feed)
+    period = cap_schema.DEFAULT_CRAWL_PERIOD_IN_MINUTES
 
     cap_crawl.logging.debug('Crawl is done')
     self.mox.ReplayAll()
@@ -543,11 +1332,20 @@ class CrawlControllerMasterTest(CrawlControllerTestBase):
     actual_feed_urls = []
     for feed in cap_schema.Feed.all():
       actual_feed_urls.append(feed.url)
-      if feed.url in feed_urls_crawled:
+      if feed.url == changed_feed.url:
         self.assertEquals(feed.last_crawl.key(), self.crawl.key())
+        self.assertEquals([True], feed.change_history)
+        self.assertEquals(period / 2, feed.GetCrawlPeriodInMinutes())
+      elif feed.url in feed_urls_crawled:
+        self.assertEquals(feed.last_crawl.key(), self.crawl.key())
+        self.assertEquals([False], feed.change_history)
+        self.assertEquals(period * 3 / 2, feed.GetCrawlPeriodInMinutes())
       else:
         self.assertFalse(feed.last_crawl)
+        self.assertEquals([], feed.change_history)
+        self.assertEquals(period, feed.GetCrawlPeriodInMinutes())
     self.assertSameElements(actual_feed_urls, feed_urls)
+    self.assertEquals(set([crawl.key()]), cap_schema.LastCrawls())
 
   def testNewCrawl_noFeeds(self):
     self.master._crawl = object()
@@ -596,6 +1394,9 @@ class CrawlControllerMasterGetFeedsTest(CrawlControllerTestBase):
     recent_fast_crawl_feed_url: URL of a feed that was crawled within the
         default crawl interval (11:30am), but which has a short crawl period
         (5 min).
+    recent_active_crawl_feed_url: URL of a feed that was crawled within the
+        default crawl interval (11:30am), but whose crawl period has adapted
+        to frequent changes (5 min).
     never_crawled_feed_url: URL of a feed that has never been crawled.
     deleted_crawl_feed_url: URL of a feed that has a broken reference to a
         Crawl.
@@ -672,6 +1473,13 @@ class CrawlControllerMasterGetFeedsTest(CrawlControllerTestBase):
     feed.put()
     self.recent_fast_crawl_feed_url = feed.url
 
+    # Test a feed that we crawled recently, but which changes frequently.
+    feed = feeds.pop(0)
+    feed.last_crawl = recent_crawl
+    feed.effective_crawl_period_in_minutes = 5
+    feed.put()
+    self.recent_active_crawl_feed_url = feed.url
+
     # Test a feed that has never been crawled.
     feed = feeds.pop(0)
     self.never_crawled_feed_url = feed.url
@@ -704,6 +1512,9 @@ class CrawlControllerMasterGetFeedsTest(CrawlControllerTestBase):
   def testGetFeeds_includesRecentFastCrawlFeeds(self):
     self.assertIn(self.recent_fast_crawl_feed_url, self.actual_feed_urls)
 
+  def testGetFeeds_includesRecentActiveCrawlFeeds(self):
+    self.assertIn(self.recent_active_crawl_feed_url, self.actual_feed_urls)
+
   def testGetFeeds_includesNeverCrawledFeeds(self):
     self.assertIn(self.never_crawled_feed_url, self.actual_feed_urls)
 
@@ -737,13 +1548,13 @@ class CrawlWorkerTest(CapCrawlTestBase):
     self.controller = self.mox.CreateMock(cap_crawl.CrawlControllerWorker)
 
   def testCrawlWorker(self):
-    shard_key = 'foo'
+    shard_keys = ['foo', 'bar']
     cap_crawl.CrawlControllerWorker(
-        shard_key, _now=datetime.datetime.now).AndReturn(self.controller)
-    self.controller.DoShard()
+        shard_keys, _now=datetime.datetime.now).AndReturn(self.controller)
+    self.controller.DoShards()
     self.mox.ReplayAll()
 
-    actual_controller = cap_crawl.CrawlWorker(shard_key)
+    actual_controller = cap_crawl.CrawlWorker(shard_keys)
     self.assertTrue(actual_controller is self.controller)
 
 
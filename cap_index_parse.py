@@ -17,15 +17,20 @@
 """CAP parsing utilities.
 
 ParseCapIndex can parse either RSS or ATOM feed indices of CAP files.
+IterCapIndex does the same incrementally, so that the URL's from the start of
+a very large index can be used before the rest of it has been parsed.
+
+Both parse with expat rather than building a DOM, so memory use does not grow
+with the size of the index (other than the list of URL's returned by
+ParseCapIndex).
 """
 
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
-from xml.dom import minidom
-
 try:
   # Google3 environment.
   from google3.apphosting.runtime.apiproxy_errors import DeadlineExceededError
+
   from google3.dotorg.gongo.appengine_cap2kml import xml_util
 except ImportError:
   from google.appengine.runtime import DeadlineExceededError
@@ -50,99 +55,199 @@ class CapIndexFormatError(Error):
         self, 'CAP index format error: %s: %s' % (root_cause, text))
 
 
-def ParseCapIndex(index_text):
-  """Parses a CAP index and returns references to CAP files.
+# Number of characters of the index given to the parser at a time.
+CHUNK_SIZE = 64 * 1024
 
-  Args:
-    index_text: XML (RSS or ATOM) with links to CAP files (string)
+# Number of characters of the index quoted in a CapIndexFormatError.
+MAX_ERROR_EXCERPT = 1000
 
-  Returns:
-    List of CAP URL's (strings)
+# XML namespace of ATOM.  RSS 2.0 has no namespace.
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
 
-  Raises:
-    CapIndexFormatError, if there is a problem parsing.
+# Element names, as (namespace URI, local name).  ATOM elements that are not in
+# any namespace are accepted too.
+RSS_NAMES = frozenset([(None, 'rss')])
+ATOM_FEED_NAMES = frozenset([(ATOM_NAMESPACE, 'feed'), (None, 'feed')])
+_RSS_ITEM = (None, 'item')
+_RSS_LINK = (None, 'link')
+_ATOM_ENTRIES = frozenset([(ATOM_NAMESPACE, 'entry'), (None, 'entry')])
+_ATOM_LINKS = frozenset([(ATOM_NAMESPACE, 'link'), (None, 'link')])
+
+
+class _IndexHandler(object):
+  """Collects CAP URL's from the expat events of an RSS or ATOM index.
+
+  The events must come from a parser made by xml_util.CreateNamespaceParser,
+  so that elements are recognized by namespace rather than by prefix.  Only
+  the first link of each RSS item or ATOM entry is used.
+
+  Attributes:
+    urls: URL's found since the list was last emptied (list of unicode)
+    is_index: Whether an RSS or ATOM root has been seen (bool)
   """
-  try:
-    # Must be XML.
-    doc = minidom.parseString(index_text)
-
-    # See if it is RSS.
-    rss_nodes = doc.getElementsByTagName('rss')
-    if rss_nodes:
-      # Shouldn't have more than one, but it's easy enough to support.
-      urls = []
-      for rss_node in rss_nodes:
-        urls.extend(_ParseCapIndexRss(rss_node))
-      return urls
-
-    # See if it is ATOM.
-    feed_nodes = doc.getElementsByTagName('feed')
-    if not feed_nodes:
-      # TODO(Matt Frantz): Really support XML namespaces.
-      feed_nodes = doc.getElementsByTagName('atom:feed')
-
-    if feed_nodes:
-      # Shouldn't have more than one, but it's easy enough to support.
-      urls = []
-      for feed_node in feed_nodes:
-        urls.extend(_ParseCapIndexAtom(feed_node))
-      return urls
-
-    # Not sure what it is.
-    raise CapIndexFormatError(index_text, 'Unrecognized document type')
-  except (CapIndexFormatError, DeadlineExceededError, AssertionError):
-    raise
-  except Exception, e:
-    raise CapIndexFormatError(index_text, 'Parse error: %s' % e)
-
-
-def _ParseCapIndexRss(rss):
-  """Parses a CAP index in the RSS format.
+
+  def __init__(self):
+    self.urls = []
+    self.is_index = False
+    # Current element depth.
+    self._depth = 0
+    # Number of open RSS and ATOM elements, respectively.
+    self._rss_depth = 0
+    self._atom_depth = 0
+    # Depth of the open item or entry, or None.
+    self._item_depth = None
+    self._is_atom_item = False
+    # Whether the open item or entry has had its link.
+    self._has_link = False
+    # Depth of the RSS link whose text is being collected, or None.
+    self._link_depth = None
+    self._link_text = []
+
+  def Install(self, parser):
+    """Directs the events of an expat parser to this handler.
+
+    Args:
+      parser: expat parser object
+    """
+    parser.StartElementHandler = self.StartElement
+    parser.EndElementHandler = self.EndElement
+    parser.CharacterDataHandler = self.CharacterData
+
+  def StartElement(self, name, attrs):
+    name = xml_util.SplitExpatName(name)
+    self._depth += 1
+    if name in RSS_NAMES:
+      self._rss_depth += 1
+      self.is_index = True
+    elif name in ATOM_FEED_NAMES:
+      self._atom_depth += 1
+      self.is_index = True
+    elif self._item_depth is None:
+      if name == _RSS_ITEM and self._rss_depth:
+        self._StartItem(is_atom=False)
+      elif name in _ATOM_ENTRIES and self._atom_depth:
+        self._StartItem(is_atom=True)
+    elif not self._has_link:
+      if self._is_atom_item and name in _ATOM_LINKS:
+        # TODO(Matt Frantz): What about other kinds of links? http://b/2188342
+        self._AddUrl(attrs.get('href'))
+      elif not self._is_atom_item and name == _RSS_LINK:
+        self._link_depth = self._depth
+        self._link_text = []
+
+  def _StartItem(self, is_atom):
+    self._item_depth = self._depth
+    self._is_atom_item = is_atom
+    self._has_link = False
+
+  def _AddUrl(self, url):
+    self._has_link = True
+    if url:
+      self.urls.append(url)
+
+  def CharacterData(self, data):
+    # Like xml_util.GetText, only use text that is directly within the link.
+    if self._link_depth == self._depth:
+      self._link_text.append(data)
+
+  def EndElement(self, name):
+    name = xml_util.SplitExpatName(name)
+    if self._link_depth == self._depth:
+      self._link_depth = None
+      self._AddUrl(''.join(self._link_text).strip())
+      self._link_text = []
+    elif self._item_depth == self._depth:
+      self._item_depth = None
+    elif name in RSS_NAMES:
+      self._rss_depth -= 1
+    elif name in ATOM_FEED_NAMES:
+      self._atom_depth -= 1
+    self._depth -= 1
+
+
+def _Chunks(index):
+  """Splits an index into pieces for the parser.
 
   Args:
-    rss: RSS CAP index document (xml.dom.Node object)
+    index: Index text (string) or file-like object.
 
-  Returns:
-    List of CAP URL's (strings)
+  Yields:
+    Nonempty strings, which together are the whole index.
   """
-  link_urls = []
-  for item in rss.getElementsByTagName('item'):
-    link_node_name = 'link';
-    link_nodes = item.getElementsByTagName(link_node_name)
+  if hasattr(index, 'read'):
+    while True:
+      chunk = index.read(CHUNK_SIZE)
+      if not chunk:
+        return
+      yield chunk
+  else:
+    if isinstance(index, unicode):
+      index = index.encode('utf-8')
+    for start in xrange(0, len(index), CHUNK_SIZE):
+      yield index[start:start + CHUNK_SIZE]
+
+
+def _Excerpt(index):
+  """Returns the start of an index, for an error message."""
+  if hasattr(index, 'read'):
+    return '<stream>'
+  return index[:MAX_ERROR_EXCERPT]
+
+
+def IterCapIndex(index):
+  """Parses a CAP index incrementally, yielding references to CAP files.
+
+  URL's are yielded as each chunk of the index is parsed, so the caller can
+  start using them before the whole index has been parsed.
+
+  Args:
+    index: XML (RSS or ATOM) with links to CAP files (string), or a file-like
+        object from which to read it.
 
-    for link_node in link_nodes:
-      link_url = xml_util.GetText(link_nodes[0].childNodes)
-      if link_url:
-        link_urls.append(link_url)
+  Yields:
+    CAP URL's (strings)
 
-  return link_urls
+  Raises:
+    CapIndexFormatError, if there is a problem parsing.  This may happen after
+    some URL's have been yielded.
+  """
+  handler = _IndexHandler()
+  parser = xml_util.CreateNamespaceParser()
+  parser.buffer_text = True
+  handler.Install(parser)
+  chunks = _Chunks(index)
+  is_final = False
+  while not is_final:
+    try:
+      chunk = chunks.next()
+    except StopIteration:
+      chunk = ''
+      is_final = True
+    try:
+      parser.Parse(chunk, is_final)
+    except (DeadlineExceededError, AssertionError):
+      raise
+    except Exception, e:
+      raise CapIndexFormatError(_Excerpt(index), 'Parse error: %s' % e)
+    urls = handler.urls
+    handler.urls = []
+    for url in urls:
+      yield url
+
+  if not handler.is_index:
+    raise CapIndexFormatError(_Excerpt(index), 'Unrecognized document type')
 
 
-def _ParseCapIndexAtom(atom):
-  """Parses a CAP index in the ATOM format.
+def ParseCapIndex(index_text):
+  """Parses a CAP index and returns references to CAP files.
 
   Args:
-    atom: ATOM CAP index document (xml.dom.Node object)
+    index_text: XML (RSS or ATOM) with links to CAP files (string)
 
   Returns:
     List of CAP URL's (strings)
+
+  Raises:
+    CapIndexFormatError, if there is a problem parsing.
   """
-  link_urls = []
-  entries = atom.getElementsByTagName('entry')
-  if not entries:
-    # TODO(Matt Frantz): Really support XML namespaces.
-    entries = atom.getElementsByTagName('atom:entry')
-
-  for entry in entries:
-    link_nodes = entry.getElementsByTagName('link')
-    if not link_nodes:
-      # TODO(Matt Frantz): Really support XML namespaces.
-      link_nodes = entry.getElementsByTagName('atom:link')
-
-    for link_node in link_nodes:
-      # TODO(Matt Frantz): What about other kinds of links? http://b/2188342
-      href = link_nodes[0].getAttribute('href')
-      if href:
-        link_urls.append(href)
-
-  return link_urls
+  return list(IterCapIndex(index_text))
@@ -0,0 +1,128 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for cap_index_parse."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import StringIO
+
+import google3
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import cap_index_parse
+
+
+_RSS = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Alerts</title>
+    <link>http://example.gov/</link>
+    <item>
+      <title>First</title>
+      <link> http://example.gov/cap1.xml </link>
+    </item>
+    <item>
+      <link>http://example.gov/cap2.xml</link>
+      <link>http://example.gov/ignored.xml</link>
+    </item>
+    <item>
+      <title>No link</title>
+    </item>
+  </channel>
+</rss>
+"""
+
+_ATOM = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <link href="http://example.gov/feed.atom"/>
+  <entry><link href="http://example.gov/cap1.xml"/></entry>
+  <entry>
+    <link href="http://example.gov/cap2.xml"/>
+    <link href="http://example.gov/ignored.xml"/>
+  </entry>
+</feed>
+"""
+
+_ATOM_PREFIXED = """<?xml version="1.0" encoding="UTF-8"?>
+<atom:feed xmlns:atom="http://www.w3.org/2005/Atom">
+  <atom:entry><atom:link href="http://example.gov/cap1.xml"/></atom:entry>
+</atom:feed>
+"""
+
+
+class ParseCapIndexTest(googletest.TestCase):
+  """Tests for cap_index_parse.ParseCapIndex and IterCapIndex."""
+
+  def tearDown(self):
+    cap_index_parse.CHUNK_SIZE = 64 * 1024
+
+  def testParseCapIndex_rss(self):
+    self.assertListEqual(
+        ['http://example.gov/cap1.xml', 'http://example.gov/cap2.xml'],
+        cap_index_parse.ParseCapIndex(_RSS))
+
+  def testParseCapIndex_atom(self):
+    self.assertListEqual(
+        ['http://example.gov/cap1.xml', 'http://example.gov/cap2.xml'],
+        cap_index_parse.ParseCapIndex(_ATOM))
+
+  def testParseCapIndex_atomPrefixed(self):
+    self.assertListEqual(['http://example.gov/cap1.xml'],
+                         cap_index_parse.ParseCapIndex(_ATOM_PREFIXED))
+
+  def testParseCapIndex_smallChunks(self):
+    cap_index_parse.CHUNK_SIZE = 7
+    self.assertListEqual(
+        ['http://example.gov/cap1.xml', 'http://example.gov/cap2.xml'],
+        cap_index_parse.ParseCapIndex(_RSS))
+
+  def testParseCapIndex_notIndex(self):
+    self.assertRaises(cap_index_parse.CapIndexFormatError,
+                      cap_index_parse.ParseCapIndex, '<alert/>')
+
+  def testParseCapIndex_otherNamespace(self):
+    self.assertRaises(cap_index_parse.CapIndexFormatError,
+                      cap_index_parse.ParseCapIndex,
+                      '<feed xmlns="urn:not:atom"><entry><link href="x"/>'
+                      '</entry></feed>')
+
+  def testParseCapIndex_notXml(self):
+    self.assertRaises(cap_index_parse.CapIndexFormatError,
+                      cap_index_parse.ParseCapIndex, 'not XML')
+
+  def testIterCapIndex_file(self):
+    self.assertListEqual(
+        ['http://example.gov/cap1.xml', 'http://example.gov/cap2.xml'],
+        list(cap_index_parse.IterCapIndex(StringIO.StringIO(_ATOM))))
+
+  def testIterCapIndex_yieldsBeforeEnd(self):
+    cap_index_parse.CHUNK_SIZE = 100
+    # Truncate the index after the first entry.
+    truncated = _ATOM[:_ATOM.index('</entry>') + 20]
+    urls = cap_index_parse.IterCapIndex(truncated)
+    self.assertEquals('http://example.gov/cap1.xml', urls.next())
+    self.assertRaises(cap_index_parse.CapIndexFormatError, list, urls)
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -34,6 +34,9 @@ on hardcoded lists (FEED_LISTS).
 /purgecrawls: Deletes the oldest data up to, but not including, the data from
 the most recent crawl.
 
+/renormalize: Rebuilds the normalized XML of alerts that was stored by an
+older version of cap_parse_mem.NormalizeAlertText.
+
 /crawls: Displays a tabular view of crawl (cap_schema.Crawl) history.
 
 /shards: Displays a tabular view of shards (cap_schema.CrawlShard) from a
@@ -48,6 +51,7 @@ __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 import cgi
 import datetime
 import logging
+import urllib
 
 try:
   from google3.apphosting.ext import db
@@ -57,6 +61,7 @@ try:
   from google3.pyglib import logging
 
   from google3.dotorg.gongo.appengine_cap2kml import cap_fake
+  from google3.dotorg.gongo.appengine_cap2kml import cap_parse_mem
   from google3.dotorg.gongo.appengine_cap2kml import cap_schema
   from google3.dotorg.gongo.appengine_cap2kml import paged_query
   from google3.dotorg.gongo.appengine_cap2kml import webapp_util
@@ -68,6 +73,7 @@ except ImportError:
   from google.appengine.runtime import DeadlineExceededError
 
   import cap_fake
+  import cap_parse_mem
   import cap_schema
   import paged_query
   import webapp_util
@@ -169,7 +175,7 @@ class CrawlsHandler(webapp.RequestHandler):
     query = cap_schema.Crawl.gql('ORDER BY started DESC')
     crawls_in_progress = []
     crawls_finished = []
-    for crawl in query.fetch(limit, offset=offset):
+    for crawl in a_paged_query.Fetch(query):
       if crawl.is_done:
         the_list = crawls_finished
       else:
@@ -194,7 +200,9 @@ class ShardsHandler(webapp.RequestHandler):
     offset, limit = a_paged_query.ParseRequest(self.request)
     shard_query = cap_schema.CrawlShard.gql(
         'WHERE crawl = :1 ORDER BY started DESC', crawl)
-    shards = shard_query.fetch(limit, offset=offset)
+    shards = a_paged_query.Fetch(shard_query)
+    # Provide the crawl header with the progress counters.
+    crawl = cap_schema.ShadowCrawl(crawl)
 
     params = dict(locals())
     params.update(a_paged_query.MakeTemplateParams(
@@ -206,6 +214,11 @@ class ShardsHandler(webapp.RequestHandler):
 # other templates.
 _DEFAULT_PURGE_PARAMS = dict(purge_days_to_keep=7, purge_batch_size=20)
 
+# How long an alert body must stay orphaned before it is deleted.  It must
+# exceed the request deadline, so that a crawl that was about to reuse the
+# body has referred to it by then.
+ORPHANED_BODY_GRACE = datetime.timedelta(hours=1)
+
 
 class FeedsHandler(webapp.RequestHandler):
   """Displays the feed whitelist."""
@@ -215,8 +228,7 @@ class FeedsHandler(webapp.RequestHandler):
     a_paged_query = paged_query.PagedQuery()
     offset, limit = a_paged_query.ParseRequest(self.request)
     query = cap_schema.Feed.gql('WHERE is_root = :1 ORDER BY url', True)
-    feeds = [
-        cap_schema.ShadowFeed(x) for x in query.fetch(limit, offset=offset)]
+    feeds = [cap_schema.ShadowFeed(x) for x in a_paged_query.Fetch(query)]
     params = dict(feeds=feeds, feed_list_size=len(FEED_LISTS),
                   feed_lists=sorted(FEED_LISTS.keys()))
     params.update(a_paged_query.MakeTemplateParams('feeds'))
@@ -240,9 +252,10 @@ class SaveFeedHandler(webapp.RequestHandler):
     # Preserve the page.
     a_paged_query = paged_query.PagedQuery()
     offset, limit = a_paged_query.ParseRequest(self.request)
+    cursor = urllib.quote(self.request.get('cursor').encode('utf-8'))
     self.redirect(
-        '/feeds?offset=%(offset)d&limit=%(limit)d&error_msg=%(error_msg)s'
-        % locals())
+        ('/feeds?offset=%(offset)d&limit=%(limit)d&cursor=%(cursor)s' +
+         '&error_msg=%(error_msg)s') % locals())
 
   def _SaveFeed(self):
     """Processes the form data to update an existing Feed object.
@@ -295,18 +308,31 @@ def SaveFeed(key, is_crawlable, is_root, crawl_period_in_minutes):
   logging.info('Saving Feed %r', feed.url)
 
   # Populate the Feed object from the form data.
+  was_root = feed.is_root
   feed.is_crawlable = is_crawlable
   feed.is_root = is_root
-  if crawl_period_in_minutes >= 0:
+  if (crawl_period_in_minutes >= 0 and
+      crawl_period_in_minutes != feed.crawl_period_in_minutes):
     feed.crawl_period_in_minutes = crawl_period_in_minutes
+    # Start adapting again from the new period.
+    feed.effective_crawl_period_in_minutes = None
 
   # Save the feed.
   feed.put()
 
+  # Queries are served from the last crawls of the root feeds.
+  if is_root and not was_root:
+    crawl_key = cap_schema.Feed.last_crawl.get_value_for_datastore(feed)
+    if crawl_key:
+      cap_schema.UpdateServingGeneration(crawl_key, [feed.key()])
+  elif was_root and not is_root:
+    cap_schema.RemoveServingFeeds([feed.key()])
+
 
 def ClearFeeds():
   """Deletes the Feed Datastore."""
   DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM Feed'))
+  cap_schema.RebuildServingGeneration()
 
 
 class ClearFeedsHandler(webapp.RequestHandler):
@@ -413,10 +439,10 @@ class CapsHandler(webapp.RequestHandler):
     offset, limit = a_paged_query.ParseRequest(self.request)
     query = cap_schema.CapAlert.gql(
         'WHERE crawl = :1 ORDER BY __key__', crawl)
-    caps = list(query.fetch(limit, offset=offset))
+    caps = a_paged_query.Fetch(query)
 
     logging.debug('Cap IDs: %s', ', '.join([str(x.identifier) for x in caps]))
-    params = dict(caps=caps, crawl=crawl)
+    params = dict(caps=caps, crawl=cap_schema.ShadowCrawl(crawl))
     params.update(a_paged_query.MakeTemplateParams(
         'caps', params=dict(crawl=crawl.key())))
     webapp_util.WriteTemplate(self.response, 'caps.html', params)
@@ -447,7 +473,7 @@ class ClearCapsHandler(webapp.RequestHandler):
   def post(self):
     batch_size = int(self.request.get('batch_size', '20'))
     obsolete_models = ['Cap', 'CapInfo', 'CapResource', 'CapArea']
-    models = ['CapAlert'] + obsolete_models
+    models = ['CapAlert', 'CapAlertBody'] + obsolete_models
     for model in models:
       logging.info('Deleting %s', model)
       DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM %s' % model),
@@ -464,9 +490,19 @@ def ClearCrawls(batch_size):
   logging.info('Deleting crawl shards')
   DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM CrawlShard'),
                   batch_size=batch_size)
+  logging.info('Deleting crawl counters')
+  DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM CrawlCounter'),
+                  batch_size=batch_size)
+  logging.info('Deleting feed changes')
+  DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM FeedChange'),
+                  batch_size=batch_size)
+  logging.info('Deleting crawl profiles')
+  DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM CrawlProfile'),
+                  batch_size=batch_size)
   logging.info('Deleting crawls')
   DeleteInBatches(lambda: db.GqlQuery('SELECT __key__ FROM Crawl'),
                   batch_size=batch_size)
+  cap_schema.RebuildServingGeneration()
 
 
 # TODO(Matt Frantz): Make this less dangerous.
@@ -568,19 +604,254 @@ def PurgeCrawl(crawl_key, batch_size):
     batch_size: Number of model instances per batch (int)
   """
   logging.info('Purging crawl %s', crawl_key)
+  # Remember which alert bodies were in use before the alerts go away.
+  body_keys = _AlertBodyKeys(crawl_key, batch_size)
   obsolete_models = ['CapResource', 'CapArea', 'CapInfo', 'Cap']
-  models = ['CapAlert', 'CrawlShard'] + obsolete_models
+  models = (['CapAlert', 'CrawlShard', 'CrawlCounter', 'FeedChange',
+             'CrawlProfile'] + obsolete_models)
   for model in models:
     logging.info('Purging %s for crawl %s', model, crawl_key)
     query = lambda: db.GqlQuery(
         'SELECT __key__ FROM %s WHERE crawl = :1' % model, crawl_key)
     DeleteInBatches(query, batch_size=batch_size)
 
+  # Bodies may be shared with other crawls, so only delete the orphans.
+  logging.info('Purging orphaned CapAlertBody for crawl %s', crawl_key)
+  PurgeOrphanedAlertBodies(body_keys, batch_size)
+
   # Delete the Crawl itself.
   logging.info('Deleting crawl %s', crawl_key)
   DeleteInBatches(
       lambda: db.GqlQuery('SELECT __key__ FROM Crawl WHERE __key__ = :1',
                           crawl_key))
+  # Cached query responses may refer to the purged alerts.
+  cap_schema.RebuildServingGeneration()
+
+
+def _AlertBodyKeys(crawl_key, batch_size):
+  """Returns the keys of the alert bodies referenced by a crawl.
+
+  The reference is not available from a keys-only query, so the alerts are
+  read in small batches.
+
+  Args:
+    crawl_key: Model key for the Crawl (db.Key)
+    batch_size: Number of model instances per batch (int)
+
+  Returns:
+    Set of cap_schema.CapAlertBody keys (set of db.Key)
+  """
+  body_keys = set()
+  query = cap_schema.CapAlert.gql('WHERE crawl = :1', crawl_key)
+  while True:
+    alerts = query.fetch(batch_size)
+    if not alerts:
+      return body_keys
+    for alert in alerts:
+      body_key = cap_schema.CapAlert.body.get_value_for_datastore(alert)
+      if body_key:
+        body_keys.add(body_key)
+    query.with_cursor(query.cursor())
+
+
+def PurgeOrphanedAlertBodies(body_keys, batch_size,
+                             _now=datetime.datetime.now):
+  """Deletes alert bodies that are no longer referenced by any alert.
+
+  A crawl may be about to reuse a body just as its last alert is purged, so
+  bodies are deleted in two passes.  The candidates that are unreferenced are
+  marked as orphaned.  Bodies that were marked by an earlier purge at least
+  ORPHANED_BODY_GRACE ago, and are still unreferenced, are deleted.  A crawl
+  that reuses a marked body removes the mark (see cap_crawl._SaveAlertBody).
+
+  Args:
+    body_keys: Candidate cap_schema.CapAlertBody keys (iterable of db.Key)
+    batch_size: Number of model instances per batch (int)
+    _now: Dependency injection of clock function that returns
+        datetime.datetime object.
+
+  Returns:
+    Number of bodies deleted (int)
+  """
+  now = _now()
+  orphan_keys = [x for x in body_keys if not _IsAlertBodyReferenced(x)]
+  for start in xrange(0, len(orphan_keys), batch_size):
+    bodies = [x for x in db.get(orphan_keys[start:start + batch_size])
+              if x and not x.orphaned]
+    for body in bodies:
+      body.orphaned = now
+    db.put(bodies)
+
+  cutoff = now - ORPHANED_BODY_GRACE
+  query = db.GqlQuery(
+      'SELECT __key__ FROM CapAlertBody WHERE orphaned < :1', cutoff)
+  num_deleted = 0
+  while True:
+    marked_keys = query.fetch(batch_size)
+    if not marked_keys:
+      return num_deleted
+    for body_key in marked_keys:
+      if _IsAlertBodyReferenced(body_key):
+        db.run_in_transaction(_UnmarkOrphanedAlertBody, body_key)
+      elif db.run_in_transaction(_DeleteOrphanedAlertBody, body_key, cutoff):
+        num_deleted += 1
+    query.with_cursor(query.cursor())
+
+
+def _IsAlertBodyReferenced(body_key):
+  """Determines whether any alert refers to an alert body.
+
+  Args:
+    body_key: cap_schema.CapAlertBody key (db.Key)
+
+  Returns:
+    True iff there is such an alert.
+  """
+  return bool(db.GqlQuery(
+      'SELECT __key__ FROM CapAlert WHERE body = :1', body_key).fetch(1))
+
+
+def _UnmarkOrphanedAlertBody(body_key):
+  """Removes the orphaned mark of an alert body.  Runs in a transaction.
+
+  Args:
+    body_key: cap_schema.CapAlertBody key (db.Key)
+  """
+  body = cap_schema.CapAlertBody.get(body_key)
+  if body and body.orphaned:
+    body.orphaned = None
+    body.put()
+
+
+def _DeleteOrphanedAlertBody(body_key, cutoff):
+  """Deletes an alert body, if it is still marked.  Runs in a transaction.
+
+  Args:
+    body_key: cap_schema.CapAlertBody key (db.Key)
+    cutoff: Latest time that the body may have been marked
+        (datetime.datetime)
+
+  Returns:
+    True iff the body was deleted.
+  """
+  body = cap_schema.CapAlertBody.get(body_key)
+  if not body or not body.orphaned or body.orphaned >= cutoff:
+    return False
+  body.delete()
+  return True
+
+
+class RenormalizeHandler(webapp.RequestHandler):
+  """Rebuilds stored normalized XML of alerts after the normalizer changes."""
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    batch_size = int(self.request.get('batch_size', '20'))
+    bodies_renormalized, error = RenormalizeAlertBodies(batch_size)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write('Renormalized %d alert bodies\n' %
+                            bodies_renormalized)
+    if error:
+      self.response.out.write('Error: %s\n' % error)
+
+
+def RenormalizeAlertBodies(batch_size):
+  """Normalizes the XML of alert bodies that were normalized by old code.
+
+  Bodies whose normalization failed when they were crawled are retried.  If
+  it fails again, or the normalized text does not fit in the body, the body is
+  marked with the current version anyway, so that queries normalize it on the
+  fly.
+
+  Args:
+    batch_size: Number of model instances per batch (int)
+
+  Returns:
+    (bodies_renormalized, error)
+    bodies_renormalized: Number of alert bodies updated.
+    error: Description of any error that occurred.
+  """
+  version = cap_parse_mem.NORMALIZER_VERSION
+  query = cap_schema.CapAlertBody.gql('WHERE normalized_version < :1',
+                                      version)
+  bodies_renormalized = 0
+  error = None
+  try:
+    while True:
+      bodies = query.fetch(batch_size)
+      if not bodies:
+        logging.info('No more alert bodies to renormalize.')
+        break
+      for body in bodies:
+        _RenormalizeAlertBody(body, version)
+        bodies_renormalized += 1
+
+  except AssertionError:
+    raise
+  except DeadlineExceededError:
+    # Suppress the deadline exceeded so we can write a response.
+    error = 'Deadline exceeded'
+  except Exception, e:
+    logging.exception(e)
+    error = str(e)
+
+  return bodies_renormalized, error
+
+
+# Derived fields of CapAlertBody, other than the normalized text, in order of
+# their value to queries (see cap_crawl._DerivedBodyFields).
+_OTHER_BODY_FIELDS = [('extract', 'extract_version'),
+                      ('geometry', 'geometry_version'),
+                      ('placemark', 'placemark_version')]
+
+
+def _RenormalizeAlertBody(body, version):
+  """Replaces the normalized XML of an alert body, if it fits.
+
+  Args:
+    body: cap_schema.CapAlertBody object (modified and saved)
+    version: cap_parse_mem.NORMALIZER_VERSION
+  """
+  # The other derived fields are worth more to queries, so they are kept.
+  fields = [(name, version_name, getattr(body, version_name),
+             getattr(body, name))
+            for name, version_name in _OTHER_BODY_FIELDS]
+  fields.append(('normalized_text', 'normalized_version', version,
+                 _NormalizeAlertBody(body)))
+  properties = cap_schema.FitAlertBodyFields(body.key().name(), body.text,
+                                             fields)
+  body.normalized_text = properties['normalized_text']
+  body.normalized_version = version
+  try:
+    body.put()
+  except (DeadlineExceededError, AssertionError):
+    raise
+  except Exception, e:
+    # Leave the normalized text to queries, so that this body is not fetched
+    # again ahead of the others.
+    logging.info('Unable to save normalized text of %s: %r', body.key(), e)
+    body.normalized_text = None
+    body.put()
+
+
+def _NormalizeAlertBody(body):
+  """Normalizes the XML of an alert body.
+
+  Args:
+    body: cap_schema.CapAlertBody object
+
+  Returns:
+    Normalized XML text (db.Text), or None if the text cannot be normalized.
+  """
+  try:
+    return db.Text(cap_parse_mem.NormalizeAlertText(body.text))
+  except (DeadlineExceededError, AssertionError):
+    raise
+  except Exception, e:
+    logging.info('Unable to normalize %s: %r', body.key(), e)
+    return None
 
 
 application = webapp.WSGIApplication(
@@ -591,6 +862,7 @@ application = webapp.WSGIApplication(
      ('/crawls', CrawlsHandler),
      ('/feeds', FeedsHandler),
      ('/purgecrawls', PurgeCrawlsHandler),
+     ('/renormalize', RenormalizeHandler),
      ('/resetfeeds', ResetFeedsHandler),
      ('/savefeed', SaveFeedHandler),
      ('/shards', ShardsHandler),
@@ -36,11 +36,13 @@ from google3.dotorg.gongo.appengine_cap2kml import cap_schema
 from google3.dotorg.gongo.appengine_cap2kml import cap_test_util
 from google3.dotorg.gongo.appengine_cap2kml import db_test_util
 from google3.dotorg.gongo.appengine_cap2kml import fake_clock
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
 from google3.dotorg.gongo.appengine_cap2kml import mox_util
 from google3.dotorg.gongo.appengine_cap2kml import users_test_util
 
 
 class CapMirrorTestBase(mox.MoxTestBase, db_test_util.DbTestBase,
+                        memcache_test_util.MemcacheTestBase,
                         users_test_util.UsersTestBase):
   """Base class for all cap_mirror unit tests."""
 
@@ -170,6 +172,8 @@ class SaveFeedTest(CapMirrorTestBase):
     is_crawlable = not feed.is_crawlable
     is_root = not feed.is_root
     crawl_period_in_minutes = 2 * feed.crawl_period_in_minutes
+    feed.effective_crawl_period_in_minutes = 7
+    feed.put()
 
     cap_mirror.logging.info(mox.StrContains('Saving Feed'), mox.IgnoreArg())
     self.mox.ReplayAll()
@@ -179,6 +183,9 @@ class SaveFeedTest(CapMirrorTestBase):
     self.assertEquals(is_crawlable, new_feed.is_crawlable)
     self.assertEquals(is_root, new_feed.is_root)
     self.assertEquals(crawl_period_in_minutes, new_feed.crawl_period_in_minutes)
+    # Changing the crawl period restarts the adaptation.
+    self.assertEquals(crawl_period_in_minutes,
+                      new_feed.GetCrawlPeriodInMinutes())
 
   def testSaveFeed_negativeCrawlPeriod(self):
     feed = self.feeds[0]
@@ -196,6 +203,32 @@ class SaveFeedTest(CapMirrorTestBase):
     self.assertEquals(is_root, new_feed.is_root)
     self.assertEquals(feed.crawl_period_in_minutes, new_feed.crawl_period_in_minutes)
 
+  def testSaveFeed_unrootStopsServing(self):
+    feed = self.feeds[0]
+    feed.is_root = True
+    feed.put()
+    crawl = cap_test_util.NewCrawls(1, fake_clock.FakeNow())[0]
+    cap_schema.UpdateServingGeneration(crawl.key(), [feed.key()])
+    cap_mirror.logging.info(mox.StrContains('Saving Feed'), mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    cap_mirror.SaveFeed(str(feed.key()), feed.is_crawlable, False,
+                        feed.crawl_period_in_minutes)
+    self.assertEquals(set(), cap_schema.LastCrawls())
+
+  def testSaveFeed_rootStartsServing(self):
+    feed = self.feeds[0]
+    crawl = cap_test_util.NewCrawls(1, fake_clock.FakeNow())[0]
+    feed.is_root = False
+    feed.last_crawl = crawl
+    feed.put()
+    cap_mirror.logging.info(mox.StrContains('Saving Feed'), mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    cap_mirror.SaveFeed(str(feed.key()), feed.is_crawlable, True,
+                        feed.crawl_period_in_minutes)
+    self.assertEquals(set([crawl.key()]), cap_schema.LastCrawls())
+
 
 class ClearFeedsTest(CapMirrorTestBase):
   """Tests for cap_mirror.ClearFeeds."""
@@ -204,8 +237,14 @@ class ClearFeedsTest(CapMirrorTestBase):
     num_feeds = 3
     feeds = cap_test_util.NewFeeds(num_feeds)
 
+    crawl = cap_test_util.NewCrawls(1, fake_clock.FakeNow())[0]
+    cap_schema.UpdateServingGeneration(crawl.key(),
+                                       [feed.key() for feed in feeds])
+    self.assertEquals(set([crawl.key()]), cap_schema.LastCrawls())
+
     cap_mirror.ClearFeeds()
     self.assertListEqual([], list(cap_schema.Feed.all()))
+    self.assertEquals(set(), cap_schema.LastCrawls())
 
 
 class ResetFeedsTest(CapMirrorTestBase):
@@ -341,6 +380,9 @@ class ClearCrawlsTest(CapMirrorTestBase):
       cap_test_util.NewShards(num_shards, crawl)
 
     cap_mirror.logging.info(mox.StrContains('Deleting crawl shards'))
+    cap_mirror.logging.info(mox.StrContains('Deleting crawl counters'))
+    cap_mirror.logging.info(mox.StrContains('Deleting feed changes'))
+    cap_mirror.logging.info(mox.StrContains('Deleting crawl profiles'))
     cap_mirror.logging.info(mox.StrContains('Deleting crawls'))
     self.mox.ReplayAll()
 
@@ -350,6 +392,59 @@ class ClearCrawlsTest(CapMirrorTestBase):
     self.assertListEqual([], list(cap_schema.CrawlShard.all()))
 
 
+class PurgeOrphanedAlertBodiesTest(CapMirrorTestBase):
+  """Tests for cap_mirror.PurgeOrphanedAlertBodies."""
+
+  def testPurgeOrphanedAlertBodies_keepsReferencedBodies(self):
+    bodies = []
+    for i in xrange(5):
+      body = cap_schema.CapAlertBody(text='<alert>%d</alert>' % i)
+      body.put()
+      bodies.append(body)
+    # Only the first two bodies are still in use.
+    for body in bodies[:2]:
+      cap_schema.CapAlert(body=body).put()
+    self.mox.ReplayAll()
+
+    batch_size = 2
+    body_keys = [x.key() for x in bodies]
+    now = datetime.datetime(2009, 1, 1)
+    # The orphans are only marked at first.
+    self.assertEquals(0, cap_mirror.PurgeOrphanedAlertBodies(
+        body_keys, batch_size, _now=lambda: now))
+    self.assertEquals(5, cap_schema.CapAlertBody.all().count())
+    # A later purge deletes them.
+    later = now + cap_mirror.ORPHANED_BODY_GRACE + datetime.timedelta(1)
+    self.assertEquals(3, cap_mirror.PurgeOrphanedAlertBodies(
+        [], batch_size, _now=lambda: later))
+    self.assertSameElements([x.key() for x in bodies[:2]],
+                            [x.key() for x in cap_schema.CapAlertBody.all()])
+
+  def testPurgeOrphanedAlertBodies_keepsReusedBodies(self):
+    bodies = []
+    for i in xrange(2):
+      body = cap_schema.CapAlertBody(text='<alert>%d</alert>' % i)
+      body.put()
+      bodies.append(body)
+    self.mox.ReplayAll()
+
+    batch_size = 2
+    now = datetime.datetime(2009, 1, 1)
+    cap_mirror.PurgeOrphanedAlertBodies(
+        [x.key() for x in bodies], batch_size, _now=lambda: now)
+    # A crawl refers to one body again, and claims the other.
+    cap_schema.CapAlert(body=bodies[0]).put()
+    body = cap_schema.CapAlertBody.get(bodies[1].key())
+    body.orphaned = None
+    body.put()
+
+    later = now + cap_mirror.ORPHANED_BODY_GRACE + datetime.timedelta(1)
+    self.assertEquals(0, cap_mirror.PurgeOrphanedAlertBodies(
+        [], batch_size, _now=lambda: later))
+    for body in cap_schema.CapAlertBody.all():
+      self.assertEquals(None, body.orphaned)
+
+
 class PurgeCrawlsTest(CapMirrorTestBase):
   """Tests for cap_mirror.PurgeCrawls."""
 
@@ -499,7 +594,9 @@ class PurgeCrawlTest(CapMirrorTestBase):
     # Obsolete models should also be purged.
     obsolete_models = [cap_schema.CapResource, cap_schema.CapArea,
                        cap_schema.CapInfo, cap_schema.Cap]
-    models = [cap_schema.CapAlert, cap_schema.CrawlShard] + obsolete_models
+    models = ([cap_schema.CapAlert, cap_schema.CrawlShard,
+               cap_schema.CrawlCounter, cap_schema.FeedChange,
+               cap_schema.CrawlProfile] + obsolete_models)
     for crawl in crawls:
       for model in models:
         model_instance = model(crawl=crawl)
@@ -513,15 +610,78 @@ class PurgeCrawlTest(CapMirrorTestBase):
       cap_mirror.logging.info(
           mox.StrContains('Purging %s for crawl'),
           model.__name__, crawl_key).InAnyOrder()
+    cap_mirror.logging.info(mox.StrContains('Purging orphaned CapAlertBody'),
+                            crawl_key)
     cap_mirror.logging.info(mox.StrContains('Deleting crawl'), crawl_key)
     self.mox.ReplayAll()
 
     batch_size = 10
+    generation = cap_schema.CurrentServingGeneration()
     cap_mirror.PurgeCrawl(crawl_key, batch_size)
     for model in models:
       self.assertListEqual([], list(model.gql('WHERE crawl = :1', crawl_key)))
     self.assertListEqual(
         [], list(cap_schema.Crawl.gql('WHERE __key__ = :1', crawl_key)))
+    self.assertTrue(cap_schema.CurrentServingGeneration() > generation)
+
+
+class RenormalizeAlertBodiesTest(CapMirrorTestBase):
+  """Tests for cap_mirror.RenormalizeAlertBodies."""
+
+  def _NewBody(self, text, normalized_version, normalized_text=None):
+    body = cap_schema.CapAlertBody(text=text, normalized_text=normalized_text,
+                                   normalized_version=normalized_version)
+    body.put()
+    return body.key()
+
+  def testRenormalizeAlertBodies_nominal(self):
+    version = cap_mirror.cap_parse_mem.NORMALIZER_VERSION
+    stale_key = self._NewBody(
+        '<cap:alert xmlns:cap="urn:oasis:names:tc:emergency:cap:1.1">'
+        '<cap:identifier>x</cap:identifier></cap:alert>', version - 1,
+        normalized_text='stale')
+    current_key = self._NewBody('<alert/>', version, normalized_text='current')
+    invalid_key = self._NewBody('not XML', None)
+    cap_mirror.logging.info(mox.StrContains('Unable to normalize'),
+                            invalid_key, mox.IgnoreArg())
+    cap_mirror.logging.info(mox.StrContains('No more alert bodies'))
+    self.mox.ReplayAll()
+
+    batch_size = 1
+    self.assertEquals((2, None),
+                      cap_mirror.RenormalizeAlertBodies(batch_size))
+    stale_body = cap_schema.CapAlertBody.get(stale_key)
+    self.assertEquals(version, stale_body.normalized_version)
+    self.assertEquals(
+        u'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.1">'
+        u'<identifier>x</identifier></alert>', stale_body.normalized_text)
+    self.assertEquals('current',
+                      cap_schema.CapAlertBody.get(current_key).normalized_text)
+    # Invalid text is not retried, and queries normalize it on the fly.
+    invalid_body = cap_schema.CapAlertBody.get(invalid_key)
+    self.assertEquals(version, invalid_body.normalized_version)
+    self.assertEquals(None, invalid_body.normalized_text)
+
+  def testRenormalizeAlertBodies_overBudget(self):
+    version = cap_mirror.cap_parse_mem.NORMALIZER_VERSION
+    text = '<alert><identifier>x</identifier></alert>'
+    extract = db.Text(u'{}')
+    body = cap_schema.CapAlertBody(text=text, extract=extract,
+                                   extract_version=1)
+    body.put()
+    # Room for the text and the extract, but not the normalized text.
+    self.mox.stubs.Set(cap_schema, 'MAX_ALERT_BODY_BYTES',
+                       len(text) + len(extract) + 1)
+    cap_mirror.logging.info(mox.StrContains('No more alert bodies'))
+    self.mox.ReplayAll()
+
+    batch_size = 10
+    self.assertEquals((1, None),
+                      cap_mirror.RenormalizeAlertBodies(batch_size))
+    body = cap_schema.CapAlertBody.get(body.key())
+    self.assertEquals(version, body.normalized_version)
+    self.assertEquals(None, body.normalized_text)
+    self.assertEquals(extract, body.extract)
 
 
 # TODO(Matt Frantz): Write tests for the webapp.RequestHandler subclasses.
@@ -29,6 +29,7 @@ import logging
 try:
   import cap_schema
   import caplib_adapter
+  import geo_index
   import model_parser
 except ImportError:
   # google3
@@ -36,6 +37,7 @@ except ImportError:
 
   from google3.dotorg.gongo.appengine_cap2kml import cap_schema
   from google3.dotorg.gongo.appengine_cap2kml import caplib_adapter
+  from google3.dotorg.gongo.appengine_cap2kml import geo_index
   from google3.dotorg.gongo.appengine_cap2kml import model_parser
 
 
@@ -99,4 +101,16 @@ def MakeDbAlertFromMem(alert_mem):
           alert_db, area, ['altitude', 'ceiling'],
           caplib_adapter.AREA_NAME_MAP, float)
 
+  AssignGeohash(alert_db, alert_mem)
   return alert_db
+
+
+def AssignGeohash(alert_db, alert_mem):
+  """Indexes the polygons and circles of an alert.
+
+  Args:
+    alert_db: cap_schema.CapAlert object (modified, not saved)
+    alert_mem: caplib.Alert object
+  """
+  alert_db.geohash = geo_index.AlertTokens(alert_mem)
+  alert_db.geohash_version = geo_index.VERSION
@@ -29,6 +29,7 @@ from google3.pyglib import app
 from google3.testing.pybase import googletest
 from google3.dotorg.gongo.appengine_cap2kml import cap_parse_db
 from google3.dotorg.gongo.appengine_cap2kml import db_test_util
+from google3.dotorg.gongo.appengine_cap2kml import geo_index
 from google3.dotorg.gongo.appengine_cap2kml import model_parser
 
 
@@ -299,10 +300,15 @@ class MakeDbAlertFromMemTest(CapParseDbTestBase):
 
     alert_db = self._MakeDbAlertFromMem()
     # TODO(Matt Frantz): Check "areaDesc" when we index it.
-    # TODO(Matt Frantz): Check "polygon" when we index it.
-    # TODO(Matt Frantz): Check "circle" when we index it.
     self.assertListEqual([5.1, 6.2], alert_db.altitude)
     self.assertListEqual([700, 14.92], alert_db.ceiling)
+    # Polygons and circles are indexed.
+    self.assertListEqual(geo_index.AlertTokens(self.alert_mem),
+                         alert_db.geohash)
+    self.assertEquals(geo_index.VERSION, alert_db.geohash_version)
+    for latitude, longitude in [(1.23, 4.56), (-3.45, -6.78), (7.8, 9.0)]:
+      self.assertTrue(geo_index.Encode(latitude, longitude, 1) in
+                      alert_db.geohash)
 
 
 def main(unused_argv):
@@ -17,9 +17,10 @@
 """CAP parsing utilities.
 
 ParseCapAlertNodes extracts a DOM containing CAP <alert> nodes from XML.
+ParseCapAlertElements does the same with ElementTree.
 
 CapParser (abstract) can parse CAP (XML) to produce in-memory representations
-of each <alert> element.
+of each <alert> element, using either of those XML backends.
 
 MemoryCapParser is a concrete subclass of CapParser that produces data model
 objects defined in the third party caplib library.  This parsing code is more
@@ -35,6 +36,15 @@ __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 import traceback
 from xml.dom import minidom
 
+try:
+  import json
+except ImportError:
+  try:
+    import simplejson as json
+  except ImportError:
+    # App Engine's Python 2.5 runtime includes simplejson within Django.
+    from django.utils import simplejson as json
+
 try:
   # Google3 environment.
   from google3.apphosting.runtime.apiproxy_errors import DeadlineExceededError
@@ -99,9 +109,34 @@ class NotCapError(CapFormatError):
     CapFormatError.__init__(self, text, 'Unrecognized document type')
 
 
+# XML namespaces of the versions of CAP that are recognized.  Alerts that are
+# not in any namespace are accepted too.
+CAP_V1_0_NAMESPACE = 'http://www.incident.com/cap/1.0'
+CAP_V1_1_NAMESPACE = 'urn:oasis:names:tc:emergency:cap:1.1'
+CAP_V1_2_NAMESPACE = 'urn:oasis:names:tc:emergency:cap:1.2'
+CAP_NAMESPACES = frozenset([
+    CAP_V1_0_NAMESPACE, CAP_V1_1_NAMESPACE, CAP_V1_2_NAMESPACE])
+
+
+def IsCapAlertName(namespace_uri, local_name):
+  """Determines whether an element is a CAP <alert>.
+
+  Args:
+    namespace_uri: Namespace URI of the element (str), or None.
+    local_name: Name of the element without any prefix (str)
+
+  Returns:
+    True if the element is <alert> in a CAP namespace or in no namespace.
+  """
+  return local_name == 'alert' and (
+      namespace_uri is None or namespace_uri in CAP_NAMESPACES)
+
+
 def ParseCapAlertNodes(cap_text):
   """Extracts the CAP alert XML node from the CAP document.
 
+  Alerts are recognized by namespace, whatever prefix the document uses.
+
   Args:
     cap_text: XML document containing CAP.
 
@@ -110,12 +145,131 @@ def ParseCapAlertNodes(cap_text):
     alert node(s).
   """
   doc = minidom.parseString(cap_text)
-  # TODO(Matt Frantz): Deal with namespaces formally.
-  for tag in ['alert', 'cap:alert']:
-    alerts = doc.getElementsByTagName(tag)
-    if alerts:
-      return alerts
-  return []
+  return [x for x in doc.getElementsByTagNameNS('*', 'alert')
+          if IsCapAlertName(x.namespaceURI, x.localName)]
+
+
+def ParseCapAlertElements(cap_text):
+  """Extracts the CAP alert elements from the CAP document with ElementTree.
+
+  Like ParseCapAlertNodes, but no DOM is built.
+
+  Args:
+    cap_text: XML document containing CAP.
+
+  Returns:
+    List of zero or more ElementTree.Element objects representing the CAP
+    alert element(s).
+  """
+  root = xml_util.ParseElement(cap_text)
+  alerts = []
+  for element in root.getiterator():
+    # Skip comments and processing instructions, if the parser kept them.
+    if isinstance(element.tag, basestring):
+      namespace_uri, local_name = xml_util.SplitElementTag(element.tag)
+      if IsCapAlertName(namespace_uri, local_name):
+        alerts.append(element)
+  return alerts
+
+
+# Version of the XML produced by NormalizeAlertText.  Increment it whenever the
+# normalization changes, so that stored normalized XML of the old version is
+# rebuilt (see cap_mirror.RenormalizeAlertBodies).
+NORMALIZER_VERSION = 1
+
+
+def NormalizeAlertText(alert_text):
+  """Normalizes the XML text representation of a CAP alert node.
+
+  Strips any tag namespace prefixes, and declares the CAP 1.1 namespace.
+
+  Args:
+    alert_text: XML representation (str or unicode)
+
+  Returns:
+    Normalized XML representation (unicode)
+  """
+  alert_nodes = ParseCapAlertNodes(alert_text)
+  if len(alert_nodes) > 1:
+    logging.error(
+        'How did that get in there?  I thought cap_mirror rejected CAPs' +
+        ' with more than one alert node!\n%r', alert_text)
+  alert_node = alert_nodes[0]
+  _NormalizeAlert(alert_node, CAP_V1_1_NAMESPACE)
+  return xml_util.NodeToString(alert_node)
+
+
+def _NormalizeAlert(node, namespace_urn):
+  """Normalizes the XML representation of a CAP alert node.
+
+  Strips any tag namespace prefixes.
+
+  Args:
+    node: xml.dom.Node representing the CAP alert (modified in place)
+    namespace_urn: XML namespace URN (str)
+  """
+  # Apply the namespace prefix throughout.
+  _NormalizeNode(node)
+  # Strip out any xmlns attributes.
+  attributes = node.attributes
+  for name in [attributes.item(i).name for i in xrange(attributes.length)]:
+    if name == 'xmlns' or name.startswith('xmlns:'):
+      node.removeAttribute(name)
+  # Apply the XML namespace attribute to the alert node.
+  node.setAttribute('xmlns', namespace_urn)
+
+
+def _NormalizeNode(node):
+  """Normalizes the XML representation of an XML node.
+
+  Strips any tag namespace prefix.
+
+  Args:
+    node: xml.dom.Node (modified in place).
+  """
+  try:
+    tag = node.tagName
+  except AttributeError:
+    # Not an XML element.
+    return
+
+  node.tagName = _NormalizeTag(tag)
+  for child in node.childNodes:
+    _NormalizeNode(child)
+
+
+def _NormalizeTag(tag):
+  """Normalizes the XML tag name.
+
+  Strips any tag namespace prefix.
+
+  Args:
+    tag: XML node tag (str)
+
+  Returns:
+    tag without any namespace prefix.
+  """
+  colon = tag.find(':')
+  if colon >= 0:
+    tag = tag[colon + 1:]
+  return tag
+
+
+# XML libraries that CapParser can use.  The DOM backend uses minidom, and the
+# ELEMENT_TREE backend uses cElementTree, which is faster and smaller.
+DOM_BACKEND = 'dom'
+ELEMENT_TREE_BACKEND = 'etree'
+
+# Functions that extract the alerts from a document, and NodeCopier classes
+# that copy their children, for each backend.
+_ALERT_PARSERS = {
+    DOM_BACKEND: ParseCapAlertNodes,
+    ELEMENT_TREE_BACKEND: ParseCapAlertElements,
+    }
+_COPIER_CLASSES = {
+    DOM_BACKEND: xml_util.NodeCopier,
+    ELEMENT_TREE_BACKEND: xml_util.ElementCopier,
+    }
 
 
 class CapParser(object):
@@ -126,13 +280,22 @@ class CapParser(object):
   <info>, <resource>, and <area>.
   """
 
-  def __init__(self, query=None):
+  def __init__(self, query=None, backend=DOM_BACKEND):
     """Initializes a CapParser object.
 
     Args:
       query: web_query.Query object for applying deferred filtering.
+      backend: XML library to use, DOM_BACKEND or ELEMENT_TREE_BACKEND.
     """
     self._query = query
+    self._parse_alert_nodes = _ALERT_PARSERS[backend]
+    # Tables that dispatch the child elements of each composite element.
+    copier_class = _COPIER_CLASSES[backend]
+    self._alert_copier = _AlertCopier(copier_class, self.ALERT_NAME_MAP)
+    self._info_copier = _InfoCopier(copier_class, self.INFO_NAME_MAP)
+    self._resource_copier = _ResourceCopier(copier_class,
+                                            self.RESOURCE_NAME_MAP)
+    self._area_copier = _AreaCopier(copier_class, self.AREA_NAME_MAP)
 
   def MakeAlert(self, new_alert_model, alert_text):
     """Parses CAP XML data and produces data model object.
@@ -141,6 +304,8 @@ class CapParser(object):
     This parser is more forgiving than the standard would require.  Any
     deviations are indicated in the list of errors that is returned.
 
+    This is the same as MakeAlertFromExtract(ExtractAlert(alert_text)).
+
     Args:
       new_alert_model: Factory that returns a CAP Alert model object.
       alert_text: XML representing the alert (unicode)
@@ -155,13 +320,34 @@ class CapParser(object):
       CapFormatError: Problem interpreting the alert_text as a CAP alert.
       DeadlineExceededError: Ran out of time.
    """
+    return self.MakeAlertFromExtract(new_alert_model,
+                                     self.ExtractAlert(alert_text))
+
+  def ExtractAlert(self, alert_text):
+    """Parses CAP XML data into an extract, without making any models.
+
+    The extract is a tree of the text of the fields of the alert, which can be
+    serialized with EncodeExtract and stored, so that models can later be made
+    by MakeAlertFromExtract without parsing the XML again.
+
+    Args:
+      alert_text: XML representing the alert (unicode)
+
+    Returns:
+      Extract of the <alert> (dict).  It maps the tag name of each field to a
+      list of the texts of the elements with that name, and 'info' to a list
+      of extracts of the <info> elements.  Those map 'resource' and 'area' to
+      extracts of their own children.
+
+    Raises:
+      CapFormatError: Problem interpreting the alert_text as a CAP alert.
+      DeadlineExceededError: Ran out of time.
+    """
     try:
-      alert_nodes = ParseCapAlertNodes(alert_text)
+      alert_nodes = self._parse_alert_nodes(alert_text)
       # The CAP standard does not allows multiple <alert> nodes.
       if len(alert_nodes) == 1:
-        alert_model = new_alert_model()
-        errors = self._ParseAlert(alert_model, alert_nodes[0])
-        return alert_model, errors
+        return self._ExtractAlert(alert_nodes[0])
       elif len(alert_nodes) > 1:
         raise CapFormatError(alert_text, 'More than one <alert> node.')
       else:
@@ -172,6 +358,73 @@ class CapParser(object):
       logging.debug(traceback.format_exc())
       raise CapFormatError(alert_text, 'Parse error: %s' % e)
 
+  def MakeAlertFromExtract(self, new_alert_model, alert_extract,
+                           geometry=None):
+    """Produces a data model object from the result of ExtractAlert.
+
+    Args:
+      new_alert_model: Factory that returns a CAP Alert model object.
+      alert_extract: Result of ExtractAlert (dict), possibly after a round
+          trip through EncodeExtract and DecodeExtract.
+      geometry: packed_geometry.PackedAlert of the same alert, or None.  If
+          present, it is assigned to the 'geometry' attributes of the alert
+          and area models, in place of their polygons and circles, which are
+          not parsed.
+
+    Returns:
+      (alert_model, errors), as from MakeAlert.
+
+    Raises:
+      CapFormatError: Problem interpreting the extract as a CAP alert.
+      DeadlineExceededError: Ran out of time.
+    """
+    try:
+      alert_model = new_alert_model()
+      if geometry is not None:
+        if len(geometry.infos) != len(alert_extract.get('info', [])):
+          raise CapFormatError(repr(alert_extract),
+                               'Geometry does not match the extract')
+        alert_model.geometry = geometry
+      errors = self._ParseAlert(alert_model, alert_extract, geometry)
+      return alert_model, errors
+    except (CapFormatError, DeadlineExceededError, AssertionError):
+      raise
+    except Exception, e:
+      logging.debug(traceback.format_exc())
+      raise CapFormatError(repr(alert_extract), 'Parse error: %s' % e)
+
+  def _ExtractAlert(self, alert_node):
+    """Extracts the text of the fields of an <alert> and its descendants.
+
+    Args:
+      alert_node: Alert node (xml.dom.Node or ElementTree.Element)
+
+    Returns:
+      Extract (dict), as described in ExtractAlert.
+    """
+    extract, children = self._alert_copier.Extract(alert_node)
+    if 'info' in children:
+      extract['info'] = [self._ExtractInfo(x) for x in children['info']]
+    return extract
+
+  def _ExtractInfo(self, info_node):
+    """Extracts the text of the fields of an <info> and its descendants.
+
+    Args:
+      info_node: Alert.info node (xml.dom.Node or ElementTree.Element)
+
+    Returns:
+      Extract (dict), as described in ExtractAlert.
+    """
+    extract, children = self._info_copier.Extract(info_node)
+    if 'resource' in children:
+      extract['resource'] = [self._resource_copier.Extract(x)[0]
+                             for x in children['resource']]
+    if 'area' in children:
+      extract['area'] = [self._area_copier.Extract(x)[0]
+                         for x in children['area']]
+    return extract
+
   # Maps of XML tag name to model attribute name, in case they differ.  By
   # default, the same name is assumed.
   ALERT_NAME_MAP = None
@@ -213,12 +466,14 @@ class CapParser(object):
     """
     raise NotImplementedError()
 
-  def _MakeCapInfo(self, alert_model, info_node):
-    """Creates a CAP Info model object, and populates it from XML node.
+  def _MakeCapInfo(self, alert_model, info_extract, area_geometries=None):
+    """Creates a CAP Info model object, and populates it from an extract.
 
     Args:
       alert_model: CAP Alert model object.
-      info_node: Alert.info node (xml.dom.Node)
+      info_extract: Extract of an Alert.info node (dict)
+      area_geometries: packed_geometry.PackedArea of each Alert.info.area
+          node (list), or None.
 
     Returns:
       (info_model, errors)
@@ -227,15 +482,15 @@ class CapParser(object):
       errors: List of recoverable errors encountered.
     """
     info_model = self._NewCapInfo(alert_model)
-    errors = self._ParseCapInfo(info_model, info_node)
+    errors = self._ParseCapInfo(info_model, info_extract, area_geometries)
     return info_model, errors
 
-  def _MakeCapResource(self, info_model, resource_node):
-    """Creates a CAP Resource model object, and populates it from XML node.
+  def _MakeCapResource(self, info_model, resource_extract):
+    """Creates a CAP Resource model object, and populates it from an extract.
 
     Args:
       info_model: CAP Info model object.
-      resource_node: Alert.info.resource node (xml.dom.Node)
+      resource_extract: Extract of an Alert.info.resource node (dict)
 
     Returns:
       (resource_model, errors)
@@ -244,15 +499,16 @@ class CapParser(object):
       errors: List of recoverable errors encountered.
     """
     resource_model = self._NewCapResource(info_model)
-    errors = self._ParseCapResource(resource_model, resource_node)
+    errors = self._ParseCapResource(resource_model, resource_extract)
     return resource_model, errors
 
-  def _MakeCapArea(self, info_model, area_node):
-    """Creates a CAP Area model object, and populates it from XML node.
+  def _MakeCapArea(self, info_model, area_extract, area_geometry=None):
+    """Creates a CAP Area model object, and populates it from an extract.
 
     Args:
       info_model: CAP Info model object.
-      area_node: Alert.info.area node (xml.dom.Node)
+      area_extract: Extract of an Alert.info.area node (dict)
+      area_geometry: packed_geometry.PackedArea of the node, or None.
 
     Returns:
       (area_model, errors)
@@ -261,124 +517,168 @@ class CapParser(object):
       errors: List of recoverable errors encountered.
     """
     area_model = self._NewCapArea(info_model)
-    errors = self._ParseCapArea(area_model, area_node)
+    errors = self._ParseCapArea(area_model, area_extract, area_geometry)
     return area_model, errors
 
-  def _ParseAlert(self, alert_model, alert_node):
-    """Parses CAP alert node and populates data model.
+  def _ParseAlert(self, alert_model, alert_extract, geometry=None):
+    """Populates the data model from the extract of a CAP alert node.
 
     Args:
       alert_model: CAP Alert model object, modified in place.
-      alert_node: Alert node (xml.dom.Node)
+      alert_extract: Extract of an Alert node (dict)
+      geometry: packed_geometry.PackedAlert of the node, or None.
 
     Returns:
       List of recoverable errors, possibly empty.
     """
-    errors = []
-    errors.extend(xml_util.CopyStringNodes(alert_model, alert_node, [
-        'identifier', 'sender', 'status', 'msgType', 'source', 'scope',
-        'restriction'], name_map=self.ALERT_NAME_MAP))
-    errors.extend(xml_util.CopyStringNodeLists(alert_model, alert_node, [
-        'code', 'references'], name_map=self.ALERT_NAME_MAP))
-    errors.extend(xml_util.CopyTextNodes(alert_model, alert_node, [
-        'addresses', 'note', 'incidents'], name_map=self.ALERT_NAME_MAP))
-    errors.extend(xml_util.CopyDateTimeNodes(alert_model, alert_node, ['sent'],
-                                             name_map=self.ALERT_NAME_MAP))
-    info_nodes = alert_node.getElementsByTagName('info')
-    if info_nodes:
-      for info_node in info_nodes:
+    errors = self._alert_copier.CopyExtract(alert_model, alert_extract)
+    info_extracts = alert_extract.get('info')
+    if info_extracts:
+      for i, info_extract in enumerate(info_extracts):
+        area_geometries = None
+        if geometry is not None:
+          area_geometries = geometry.infos[i]
         unused_info_model, info_errors = self._MakeCapInfo(
-            alert_model, info_node)
+            alert_model, info_extract, area_geometries)
         errors.extend(info_errors)
     else:
       errors.append(NoInfoNodesError())
 
     return errors
 
-  def _ParseCapInfo(self, info_model, info_node):
-    """Parses alert.info data and populates the data model.
+  def _ParseCapInfo(self, info_model, info_extract, area_geometries=None):
+    """Populates the data model from the extract of an alert.info node.
 
     Args:
       info_model: CAP Info model object, modified in place.
-      info_node: Alert.info node (xml.dom.Node)
+      info_extract: Extract of an Alert.info node (dict)
+      area_geometries: packed_geometry.PackedArea of each Alert.info.area
+          node (list), or None.
 
     Returns:
       List of recoverable errors, possibly empty.
     """
-    errors = []
-    errors.extend(xml_util.CopyStringNodes(
-        info_model, info_node, [
-        'language', 'urgency', 'severity', 'certainty', 'audience',
-        'senderName', 'web', 'contact'],
-        name_map=self.INFO_NAME_MAP))
-    errors.extend(xml_util.CopyStringNodeLists(
-        info_model, info_node, ['category', 'responseType'],
-        name_map=self.INFO_NAME_MAP))
-    errors.extend(xml_util.CopyTextNodes(
-        info_model, info_node, [
-        'event', 'headline', 'description', 'instruction'],
-        name_map=self.INFO_NAME_MAP))
-    errors.extend(xml_util.CopyDateTimeNodes(
-        info_model, info_node, ['effective', 'onset', 'expires'],
-        name_map=self.INFO_NAME_MAP))
-    for resource_node in info_node.getElementsByTagName('resource'):
+    errors = self._info_copier.CopyExtract(info_model, info_extract)
+    for resource_extract in info_extract.get('resource', []):
       unused_resource_model, resource_errors = self._MakeCapResource(
-          info_model, resource_node)
+          info_model, resource_extract)
       errors.extend(resource_errors)
-    area_nodes = info_node.getElementsByTagName('area')
-    if area_nodes:
-      for area_node in area_nodes:
+    area_extracts = info_extract.get('area')
+    if (area_geometries is not None and
+        len(area_geometries) != len(area_extracts or [])):
+      raise CapFormatError(repr(info_extract),
+                           'Geometry does not match the extract')
+    if area_extracts:
+      for i, area_extract in enumerate(area_extracts):
+        area_geometry = None
+        if area_geometries is not None:
+          area_geometry = area_geometries[i]
         unused_area_model, area_errors = self._MakeCapArea(
-            info_model, area_node)
+            info_model, area_extract, area_geometry)
         errors.extend(area_errors)
     else:
       errors.append(NoAreaNodesError())
 
     return errors
 
-  def _ParseCapResource(self, resource_model, resource_node):
-    """Parses alert.info.resource data and populates the data model.
+  def _ParseCapResource(self, resource_model, resource_extract):
+    """Populates the data model from the extract of an alert.info.resource.
 
     Args:
       resource_model: CAP Resource model object, modified in place.
-      resource_node: Alert.info.resource node (xml.dom.Node)
+      resource_extract: Extract of an Alert.info.resource node (dict)
 
     Returns:
       List of recoverable errors, possibly empty.
     """
-    errors = []
-    errors.extend(xml_util.CopyStringNodes(
-        resource_model, resource_node, ['resourceDesc', 'mimeType', 'uri'],
-        name_map=self.RESOURCE_NAME_MAP))
-    errors.extend(xml_util.CopyTextNodes(
-        resource_model, resource_node, ['derefUri', 'digest'],
-        name_map=self.RESOURCE_NAME_MAP))
-    errors.extend(xml_util.CopyIntegerNodes(
-        resource_model, resource_node, ['size'],
-        name_map=self.RESOURCE_NAME_MAP))
-    return errors
+    return self._resource_copier.CopyExtract(resource_model, resource_extract)
 
-  def _ParseCapArea(self, area_model, area_node):
-    """Parses alert.info.area data and populates the data model.
+  def _ParseCapArea(self, area_model, area_extract, area_geometry=None):
+    """Populates the data model from the extract of an alert.info.area node.
 
     Args:
       area_model: CAP Area model object, modified in place.
-      area_node: Alert.info.area node (xml.dom.Node)
+      area_extract: Extract of an Alert.info.area node (dict)
+      area_geometry: packed_geometry.PackedArea of the node, or None.
 
     Returns:
       List of recoverable errors, possibly empty.
     """
-    errors = []
-    errors.extend(xml_util.CopyTextNodes(
-        area_model, area_node, ['areaDesc', 'altitude', 'ceiling'],
-        name_map=self.AREA_NAME_MAP))
-    # Parse 'polygon', 'circle' lists.
-    errors.extend(xml_util.CopyTextNodeLists(
-        area_model, area_node, ['polygon'], name_map=self.AREA_NAME_MAP))
-    errors.extend(xml_util.CopyStringNodeLists(
-        area_model, area_node, ['circle'], name_map=self.AREA_NAME_MAP))
     # TODO(Matt Frantz): Parse geocode tag/value pairs.
-    return errors
+    if area_geometry is not None:
+      # The shapes are already packed, so don't parse them again.
+      area_model.geometry = area_geometry
+      area_extract = dict(area_extract)
+      area_extract.pop('polygon', None)
+      area_extract.pop('circle', None)
+    return self._area_copier.CopyExtract(area_model, area_extract)
+
+
+def _AlertCopier(copier_class, name_map):
+  """Returns an xml_util.NodeCopier for the fields of CAP <alert>."""
+  return copier_class(name_map).AddNodes(
+      ['identifier', 'sender', 'status', 'msgType', 'source', 'scope',
+       'restriction'], xml_util.ParseString).AddNodeLists(
+      ['code', 'references'], xml_util.ParseString).AddNodes(
+      ['addresses', 'note', 'incidents'], xml_util.ParseText).AddNodes(
+      ['sent'], xml_util.ParseDateTime)
+
+
+def _InfoCopier(copier_class, name_map):
+  """Returns an xml_util.NodeCopier for the fields of CAP <info>."""
+  return copier_class(name_map).AddNodes(
+      ['language', 'urgency', 'severity', 'certainty', 'audience',
+       'senderName', 'web', 'contact'], xml_util.ParseString).AddNodeLists(
+      ['category', 'responseType'], xml_util.ParseString).AddNodes(
+      ['event', 'headline', 'description', 'instruction'],
+      xml_util.ParseText).AddNodes(
+      ['effective', 'onset', 'expires'], xml_util.ParseDateTime)
+
+
+def _ResourceCopier(copier_class, name_map):
+  """Returns an xml_util.NodeCopier for the fields of CAP <resource>."""
+  return copier_class(name_map).AddNodes(
+      ['resourceDesc', 'mimeType', 'uri'], xml_util.ParseString).AddNodes(
+      ['derefUri', 'digest'], xml_util.ParseText).AddNodes(
+      ['size'], int)
+
+
+def _AreaCopier(copier_class, name_map):
+  """Returns an xml_util.NodeCopier for the fields of CAP <area>."""
+  return copier_class(name_map).AddNodes(
+      ['areaDesc', 'altitude', 'ceiling'], xml_util.ParseText).AddNodeLists(
+      ['polygon'], xml_util.ParseText).AddNodeLists(
+      ['circle'], xml_util.ParseString)
+
+
+# Version of the extracts produced by CapParser.ExtractAlert.  Increment it
+# whenever the copier tables above or the shape of the extract change, so that
+# stored extracts of the old version are ignored.
+EXTRACT_VERSION = 1
+
+
+def EncodeExtract(alert_extract):
+  """Serializes the result of CapParser.ExtractAlert compactly.
+
+  Args:
+    alert_extract: Result of CapParser.ExtractAlert (dict)
+
+  Returns:
+    JSON (str), which is pure ASCII.
+  """
+  return json.dumps(alert_extract, separators=(',', ':'))
+
+
+def DecodeExtract(encoded_extract):
+  """Deserializes the result of EncodeExtract.
+
+  Args:
+    encoded_extract: Result of EncodeExtract (str or unicode)
+
+  Returns:
+    Extract (dict) suitable for CapParser.MakeAlertFromExtract.
+  """
+  return json.loads(encoded_extract)
 
 
 class MemoryCapParser(CapParser):
@@ -28,12 +28,17 @@ from google3.pyglib import app
 from google3.pyglib import resources
 from google3.testing.pybase import googletest
 from google3.dotorg.gongo.appengine_cap2kml import cap_parse_mem
+from google3.dotorg.gongo.appengine_cap2kml import cap_schema_mem
+from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
 
 
 class CapParseMemTest(googletest.TestCase):
 
+  # XML library that the parser uses.
+  BACKEND = cap_parse_mem.DOM_BACKEND
+
   def setUp(self):
-    self.parser = cap_parse_mem.MemoryCapParser()
+    self.parser = cap_parse_mem.MemoryCapParser(backend=self.BACKEND)
     self.new_alert_model = lambda: caplib.Alert()
 
   def _ReadTestData(self, basename):
@@ -76,12 +81,148 @@ class CapParseMemTest(googletest.TestCase):
         list(area.circle),
         [caplib.Circle(caplib.Point(41.7806015, 12.3580999), 0.01)])
 
+  def testManyInfos(self):
+    num_infos = 50
+    info = ('<info><event>Test</event>'
+            '<area><areaDesc>Here</areaDesc><circle>1,2 3</circle></area>'
+            '<area><areaDesc>There</areaDesc></area></info>')
+    alert, errors = self.parser.MakeAlert(
+        self.new_alert_model,
+        '<alert><identifier>x</identifier>%s</alert>' % (info * num_infos))
+    self.assertListEqual(errors, [])
+    self.assertEquals(alert.identifier, 'x')
+    self.assertEquals(len(alert.info), num_infos)
+    for info in alert.info:
+      self.assertEquals(info.event, 'Test')
+      self.assertListEqual([x.description for x in info.area],
+                           ['Here', 'There'])
+
+  def testMakeAlertFromExtract(self):
+    alert_text = self._ReadTestData('aquila_cap2.xml')
+    expected_alert, expected_errors = self.parser.MakeAlert(
+        self.new_alert_model, alert_text)
+    # Round trip the extract through its serialized form.
+    encoded_extract = cap_parse_mem.EncodeExtract(
+        self.parser.ExtractAlert(alert_text))
+    alert, errors = self.parser.MakeAlertFromExtract(
+        self.new_alert_model, cap_parse_mem.DecodeExtract(encoded_extract))
+    self.assertListEqual([str(x) for x in expected_errors],
+                         [str(x) for x in errors])
+    self.assertEquals(expected_alert.identifier, alert.identifier)
+    self.assertEquals(expected_alert.sent, alert.sent)
+    info = list(alert.info)[0]
+    self.assertEquals(list(expected_alert.info)[0].headline, info.headline)
+    self.assertListEqual(list(list(expected_alert.info)[0].area)[0].circle,
+                         list(list(info.area)[0].circle))
+
+  def testMakeAlertFromExtract_geometry(self):
+    alert_extract = self.parser.ExtractAlert(
+        self._ReadTestData('aquila_cap2.xml'))
+    expected_alert, unused_errors = self.parser.MakeAlertFromExtract(
+        self.new_alert_model, alert_extract)
+    geometry = packed_geometry.PackAlert(expected_alert)
+    alert, errors = self.parser.MakeAlertFromExtract(
+        cap_schema_mem.ShadowAlert, alert_extract, geometry=geometry)
+    self.assertListEqual([], errors)
+    self.assertTrue(alert.geometry is geometry)
+    area = list(list(alert.info)[0].area)[0]
+    self.assertEquals('Via Pietro Aldi, 21, 00125 Roma, Italia',
+                      area.description)
+    # The shapes come from the geometry, rather than the extract.
+    self.assertTrue(area.geometry is geometry.infos[0][0])
+    self.assertListEqual([], list(area.circle))
+
+  def testMakeAlertFromExtract_mismatchedGeometry(self):
+    alert_extract = self.parser.ExtractAlert(
+        self._ReadTestData('aquila_cap2.xml'))
+    for geometry in [packed_geometry.PackedAlert([]),
+                     packed_geometry.PackedAlert([[]])]:
+      self.assertRaises(cap_parse_mem.CapFormatError,
+                        self.parser.MakeAlertFromExtract,
+                        cap_schema_mem.ShadowAlert, alert_extract,
+                        geometry=geometry)
+
+  def testMakeAlertFromExtract_errors(self):
+    alert_extract = {'identifier': ['x', 'y']}
+    alert, errors = self.parser.MakeAlertFromExtract(self.new_alert_model,
+                                                     alert_extract)
+    self.assertEquals(None, alert.identifier)
+    self.assertListEqual(
+        [cap_parse_mem.xml_util.MultipleNodeError,
+         cap_parse_mem.NoInfoNodesError],
+        [x.__class__ for x in errors])
+
   # TODO(Matt Frantz): Test more of the sample CAP files that we have
   # accumulated.
 
   # TODO(Matt Frantz): Write unit tests for cap_parse_mem.
 
 
+class CapParseMemElementTreeTest(CapParseMemTest):
+  """Runs the same tests with the ElementTree backend."""
+
+  BACKEND = cap_parse_mem.ELEMENT_TREE_BACKEND
+
+  def testNotCap(self):
+    self.assertRaises(cap_parse_mem.NotCapError, self.parser.MakeAlert,
+                      self.new_alert_model, '<rss/>')
+
+  def testNotXml(self):
+    self.assertRaises(cap_parse_mem.CapFormatError, self.parser.MakeAlert,
+                      self.new_alert_model, 'not XML')
+
+  def testNamespace(self):
+    alert, errors = self.parser.MakeAlert(
+        self.new_alert_model,
+        '<cap:alert xmlns:cap="urn:oasis:names:tc:emergency:cap:1.1">'
+        '<cap:identifier>x</cap:identifier><cap:info><cap:area>'
+        '<cap:areaDesc>Here</cap:areaDesc></cap:area></cap:info>'
+        '</cap:alert>')
+    self.assertListEqual(errors, [])
+    self.assertEquals(alert.identifier, 'x')
+    area = list(list(alert.info)[0].area)[0]
+    self.assertEquals(area.description, 'Here')
+
+  def testCdata_matchesDom(self):
+    cap_text = ('<alert><identifier><![CDATA[x&y]]></identifier><info>'
+                '<headline>Flood <![CDATA[<warning>]]></headline></info>'
+                '</alert>')
+    alert, errors = self.parser.MakeAlert(self.new_alert_model, cap_text)
+    self.assertListEqual(errors, [])
+    self.assertEquals(alert.identifier, 'x&y')
+    self.assertEquals(list(alert.info)[0].headline, 'Flood <warning>')
+
+    dom_parser = cap_parse_mem.MemoryCapParser(
+        backend=cap_parse_mem.DOM_BACKEND)
+    dom_alert, dom_errors = dom_parser.MakeAlert(self.new_alert_model,
+                                                 cap_text)
+    self.assertListEqual(dom_errors, [])
+    self.assertEquals(dom_alert.identifier, alert.identifier)
+    self.assertEquals(list(dom_alert.info)[0].headline,
+                      list(alert.info)[0].headline)
+
+
+class NormalizeAlertTextTest(googletest.TestCase):
+  """Tests for cap_parse_mem.NormalizeAlertText."""
+
+  def testNormalizeAlertText_prefixes(self):
+    self.assertEquals(
+        u'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.1">'
+        u'<identifier>x</identifier></alert>',
+        cap_parse_mem.NormalizeAlertText(
+            '<cap:alert xmlns:cap="urn:oasis:names:tc:emergency:cap:1.2"'
+            ' xmlns:foo="urn:foo"><cap:identifier>x</cap:identifier>'
+            '</cap:alert>'))
+
+  def testNormalizeAlertText_enclosed(self):
+    self.assertEquals(
+        u'<alert xmlns="urn:oasis:names:tc:emergency:cap:1.1">'
+        u'<identifier>x</identifier></alert>',
+        cap_parse_mem.NormalizeAlertText(
+            '<foo><alert xmlns="urn:oasis:names:tc:emergency:cap:1.1">'
+            '<identifier>x</identifier></alert></foo>'))
+
+
 def main(unused_argv):
   googletest.main()
 
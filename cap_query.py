@@ -20,27 +20,39 @@ __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
 import logging
 import traceback
-from xml.parsers import expat
-
-# Third party imports.
-import pyfo
-import cap as caplib
-
-from google.appengine.ext import db
-from google.appengine.ext import webapp
-from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.runtime import DeadlineExceededError
-
-import cap2kml
-import cap_parse_mem
-import cap_schema
-import cap_schema_mem
-import web_query
-import webapp_util
-import xml_util
-
-
-CAP_V1_1_XMLNS_URN = 'urn:oasis:names:tc:emergency:cap:1.1'
+import urllib
+import xml.sax.saxutils
+
+try:
+  from google3.apphosting.ext import db
+  from google3.apphosting.ext import webapp
+  from google3.apphosting.ext.webapp.util import run_wsgi_app
+  from google3.apphosting.runtime.apiproxy_errors import DeadlineExceededError
+  from google3.pyglib import logging
+
+  from google3.dotorg.gongo.appengine_cap2kml import cap2kml
+  from google3.dotorg.gongo.appengine_cap2kml import cap_parse_mem
+  from google3.dotorg.gongo.appengine_cap2kml import cap_schema
+  from google3.dotorg.gongo.appengine_cap2kml import cap_schema_mem
+  from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
+  from google3.dotorg.gongo.appengine_cap2kml import query_cache
+  from google3.dotorg.gongo.appengine_cap2kml import web_query
+  from google3.dotorg.gongo.appengine_cap2kml import webapp_util
+
+except ImportError:
+  from google.appengine.ext import db
+  from google.appengine.ext import webapp
+  from google.appengine.ext.webapp.util import run_wsgi_app
+  from google.appengine.runtime import DeadlineExceededError
+
+  import cap2kml
+  import cap_parse_mem
+  import cap_schema
+  import cap_schema_mem
+  import packed_geometry
+  import query_cache
+  import web_query
+  import webapp_util
 
 
 def _MakeCapSchema():
@@ -89,12 +101,94 @@ def _MakeCapSchema():
           # Area
           'altitude': list_ops,
           'ceiling': list_ops,
+          'geohash': web_query.Operators.GEO_ALL,
           },
       }, default_model)
 
 
 CAP_SCHEMA = _MakeCapSchema()
 
+_XML_PROLOG = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# Escape quotes too, since values are also written in attributes.
+_XML_ESCAPES = {'"': '&quot;', "'": '&#39;'}
+
+
+def _Escape(value):
+  """Escapes a value for inclusion in XML text or attributes.
+
+  Args:
+    value: Anything; values that are not strings are converted with str.
+
+  Returns:
+    Escaped text (str or unicode)
+  """
+  if not isinstance(value, basestring):
+    value = str(value)
+  return xml.sax.saxutils.escape(value, _XML_ESCAPES)
+
+
+# Largest page, which is as many models as one Datastore fetch can return.
+MAX_LIMIT = 1000
+
+# Prefixes of the "cursor" argument, which say how the rest is interpreted.
+_DATASTORE_CURSOR = 'c'
+_OFFSET_CURSOR = 'o'
+
+
+class InvalidCursorError(ValueError):
+  """Used by CapQuery._FetchPage to indicate a malformed Datastore cursor."""
+
+
+def _ParseLimit(limit):
+  """Parses the "limit" CGI argument.
+
+  Args:
+    limit: Argument value (str or unicode), possibly empty.
+
+  Returns:
+    Number of models (int), at most MAX_LIMIT, or None if there is no limit.
+
+  Raises:
+    ValueError: if the limit is not a positive integer.
+  """
+  if not limit:
+    return None
+  try:
+    limit = int(limit)
+  except ValueError:
+    limit = 0
+  if limit <= 0:
+    raise ValueError('limit must be a positive integer')
+  return min(limit, MAX_LIMIT)
+
+
+def _ParseCursor(cursor):
+  """Parses the "cursor" CGI argument.
+
+  Args:
+    cursor: Argument value (str or unicode), possibly empty.
+
+  Returns:
+    (kind, position)
+    kind: _DATASTORE_CURSOR, _OFFSET_CURSOR, or None for the first page.
+    position: Datastore cursor (str), offset (int), or None.
+
+  Raises:
+    ValueError: if the cursor is malformed.
+  """
+  if not cursor:
+    return None, None
+  kind, position = cursor[:1], cursor[1:]
+  try:
+    if kind == _DATASTORE_CURSOR and position:
+      return kind, position.encode('ascii')
+    if kind == _OFFSET_CURSOR and int(position) >= 0:
+      return kind, int(position)
+  except ValueError:
+    pass
+  raise ValueError('Invalid cursor %r' % cursor)
+
 
 class CapQueryResult(object):
   """Contains a single element of a CapQuery result.
@@ -103,12 +197,18 @@ class CapQueryResult(object):
     model: cap_schema_mem.ShadowAlert object
     text: Original XML text (str or unicode)
     url: URL from which the text was fetched (str or unicode)
+    placemark: KML Placemark stored when the alert was crawled (see
+        cap_schema.CapAlert.GetPlacemark), or None.
+    normalized_text: Normalized XML stored when the alert was crawled (see
+        cap_schema.CapAlert.GetNormalizedText), or None.
   """
 
-  def __init__(self, model, text, url):
+  def __init__(self, model, text, url, placemark=None, normalized_text=None):
     self.model = model
     self.text = text
     self.url = url
+    self.placemark = placemark
+    self.normalized_text = normalized_text
 
 
 class CapQuery(webapp.RequestHandler):
@@ -120,11 +220,41 @@ class CapQuery(webapp.RequestHandler):
   an indirect query via references from Feed.  The _WriteResponse virtual
   method will be provided with an iterable of instances of CAP Alert model
   types.
+
+  Results are generated as the Datastore query is iterated, and the response
+  is written as they are generated, so that the whole result is never held in
+  memory at once.
+
+  The optional "limit" argument bounds the number of CapAlert models that are
+  read, in which case the response links to the next page of the query (see
+  _NextPageUrl).  The "cursor" argument of that link tells where the page
+  starts.  It is opaque to clients: a Datastore query cursor, or an offset for
+  queries that cannot use cursors (those with "IN" or "!=" operators).  The
+  Datastore reads and discards the models before an offset, so the cost of
+  each page of such a query grows with its offset, and the whole query is
+  quadratic in its number of pages.  Duplicate alerts are only suppressed
+  within a page.
+
+  Attributes:
+    limit: Maximum number of models to read (int), or None for all of them.
+    cursor: Where the page starts, as decoded by _ParseCursor.
+    next_cursor: Where the next page starts (str), or None if this is the last
+        page.  (Written by _DoQuery once the results have been consumed.)
   """
 
   def get(self):
     """Parses query predicates and responds with error screens or CAP data."""
     user_query, unknown_arguments = CAP_SCHEMA.QueryFromRequest(self.request)
+    unknown_arguments = set(unknown_arguments)
+    unknown_arguments.discard('limit')
+    unknown_arguments.discard('cursor')
+    try:
+      self.limit = _ParseLimit(self.request.get('limit'))
+      self.cursor = _ParseCursor(self.request.get('cursor'))
+    except ValueError, e:
+      self._WriteBadRequest(e)
+      return
+    self.next_cursor = None
     unknown_arguments = self._HandleUnknownArguments(
         frozenset(unknown_arguments))
     if unknown_arguments:
@@ -145,15 +275,53 @@ class CapQuery(webapp.RequestHandler):
                                 dict(models=CAP_SCHEMA.Help()))
       return
 
-    # Use the most recent completed crawl for each feed to serve queries.
-    restricted_query = self._ApplyLastCrawlsToQuery(user_query)
+    # Responses only change with the serving generation, so reuse them until
+    # then.  Identical requests that arrive together wait for the first one.
+    # Responses contain absolute URLs, so they also depend on the host.
+    cache_key = query_cache.MakeKey(
+        self.__class__.__name__, user_query,
+        cap_schema.CurrentServingGeneration(),
+        '%s&limit=%s&cursor=%s&host=%s' % (
+            self._ResponseVariant(), self.limit, self.request.get('cursor'),
+            self.request.host_url))
+    cached_response, has_lease = query_cache.GetOrLease(cache_key)
+    if cached_response:
+      logging.info('Writing cached response')
+      content_type, body = cached_response
+      self.response.headers['Content-Type'] = content_type
+      self.response.out.write(body)
+      return
 
-    # Execute the query.
-    alerts = execute(user_query, restricted_query)
+    try:
+      # Use the most recent completed crawl for each feed to serve queries.
+      restricted_query = self._ApplyLastCrawlsToQuery(user_query)
+
+      # Execute the query.
+      alerts = execute(user_query, restricted_query)
+
+      # If an error response is written, no CAP data will be returned.
+      if alerts is not None:
+        self._WriteResponse(alerts, user_query)
+        query_cache.Put(cache_key, self.response.headers['Content-Type'],
+                        self.response.out.getvalue())
+    except InvalidCursorError, e:
+      self._WriteBadRequest(e)
+    finally:
+      if has_lease:
+        query_cache.ReleaseLease(cache_key)
+
+  def _WriteBadRequest(self, e):
+    """Responds that the CGI arguments are invalid.
 
-    # If an error response is written, no CAP data will be returned.
-    if alerts is not None:
-      self._WriteResponse(alerts, user_query)
+    Args:
+      e: Exception that describes the invalid argument.
+
+    Postconditions:
+      self.response is replaced with a 400 error.
+    """
+    self.error(400)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write('%s\n' % e)
 
   def _HandleUnknownArguments(self, unknown_arguments):
     """Filters arguments that are not web_query parameters.
@@ -168,11 +336,22 @@ class CapQuery(webapp.RequestHandler):
     """
     raise NotImplementedError()
 
+  def _ResponseVariant(self):
+    """Describes any arguments, other than the query, that affect the response.
+
+    Called after _HandleUnknownArguments.
+
+    Returns:
+      str, which is part of the key of cached responses.
+    """
+    return ''
+
   def _WriteResponse(self, alerts, user_query):
     """Abstract method that writes the response of a slow path query.
 
     Args:
-      alerts: Iterable of CapQueryResult objects.
+      alerts: Iterable of CapQueryResult objects, which should be consumed
+          only once.
       user_query: What the user specified (web_query.Query)
 
     Postconditions:
@@ -180,6 +359,35 @@ class CapQuery(webapp.RequestHandler):
     """
     raise NotImplementedError()
 
+  def _NextPageUrl(self):
+    """Returns the URL of the next page of the query.
+
+    Only valid once the results have been consumed.
+
+    Returns:
+      Absolute URL (str), or None if this is the last page.
+    """
+    if not self.next_cursor:
+      return None
+    arguments = []
+    for name in self.request.arguments():
+      if name == 'cursor':
+        continue
+      for value in self.request.get_all(name):
+        arguments.append((name, value.encode('utf-8')))
+    arguments.append(('cursor', self.next_cursor))
+    return '%s?%s' % (self.request.path_url, urllib.urlencode(arguments))
+
+  def _Write(self, text):
+    """Appends text to the response.
+
+    Args:
+      text: str or unicode, which is encoded as UTF-8.
+    """
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    self.response.out.write(text)
+
   def _ApplyLastCrawlsToQuery(self, user_query):
     """Restrict the user query to the latest crawl.
 
@@ -267,124 +475,145 @@ class CapQuery(webapp.RequestHandler):
       user_query: What the user specified (web_query.Query)
       restricted_query: Last crawled version of user_query (web_query.Query)
 
-    Returns:
-      Iterable of CapQueryResult objects.
+    Yields:
+      CapQueryResult objects, as the models are fetched.
     """
     gql_list, gql_params = restricted_query.ApplyToGql(model_name)
     db_query = model_class.gql('WHERE %s' % ' AND '.join(gql_list),
                                **gql_params)
+    models = self._FetchPage(db_query)
     model_count = 0
 
     # Avoid duplicate alerts.
-    alert_texts = set()
+    alert_digests = set()
 
-    # We may need the cap_parse parser.
-    parser = cap_parse_mem.MemoryCapParser(query=user_query)
+    # Alerts are built from the extract that was stored when they were crawled,
+    # or else parsed once, whatever their CAP version and prefixes.
+    parser = cap_parse_mem.MemoryCapParser(
+        query=user_query, backend=cap_parse_mem.ELEMENT_TREE_BACKEND)
 
     # Count how many alerts were handled in different execution paths.
-    caplib_alerts = 0
+    extracted_alerts = 0
+    outside_alerts = 0
     parseable_alerts = 0
     clean_alerts = 0
     unparseable_alerts = 0
-    unicode_alerts = 0
-    bad_xml_alerts = 0
 
-    # Transform ShadowCap list into a list of CapQueryResult objects.
-    alerts = []
-    for model in db_query:
+    # Transform the models into CapQueryResult objects.
+    unique_model_count = 0
+    for model in models:
       model_count += 1
 
-      # Suppress duplicates.
-      alert_text = model.text
-      if alert_text in alert_texts:
+      # Suppress duplicates.  Alerts saved before digests existed are compared
+      # by their text.
+      alert_digest = model.digest
+      if not alert_digest:
+        alert_digest = model.text
+      if alert_digest in alert_digests:
         continue
       else:
-        alert_texts.add(alert_text)
-
-      # We will eventually have to get a Cap, ShadowCap, or proxy object.
-      # We'll get it in the most efficient way possible.
+        alert_digests.add(alert_digest)
+
+      # The stored geometry rejects alerts outside a bounding box without
+      # building them.
+      geometry = CapQuery._DecodeGeometry(
+          model.GetGeometry(packed_geometry.VERSION))
+      if geometry and not user_query.PermitsBox(model_name, geometry.box):
+        outside_alerts += 1
+        continue
+      alert_text = model.GetText()
 
-      # Try it with the standard-conforming parser.
-      alert_model = CapQuery._ParseConformingCap(alert_text, query=user_query)
-      if alert_model:
-        caplib_alerts += 1
-      else:
-        # If we were unable to use the caplib parser, try our own.
-        alert_model, errors = CapQuery._ParseNonconformingCap(parser, alert_text)
+      alert_model = None
+      alert_extract = model.GetExtract(cap_parse_mem.EXTRACT_VERSION)
+      if alert_extract:
+        alert_model, errors = CapQuery._MakeCapFromExtract(
+            parser, alert_extract, query=user_query, geometry=geometry)
         if alert_model:
-          if errors:
-            parseable_alerts += 1
-          else:
-            clean_alerts += 1
+          extracted_alerts += 1
+      if not alert_model:
+        alert_model, errors = CapQuery._ParseCap(parser, alert_text,
+                                                 query=user_query)
+      if alert_model:
+        if errors:
+          parseable_alerts += 1
         else:
-          unparseable_alerts += 1
+          clean_alerts += 1
+      else:
+        unparseable_alerts += 1
 
       # Filter any predicates that might not have been applied in the GQL query.
+      # An alert none of whose areas are in a bounding box does not match.
+      if (alert_model and user_query.IsSpatial(model_name) and
+          alert_model.IsFiltered() and not len(alert_model.info)):
+        continue
       if alert_model and user_query.PermitsModel('Cap', alert_model):
-        # Save the model and the original XML.
-        alerts.append(
-            CapQueryResult(alert_model, alert_text, model.url))
+        # Return the model and the original XML.
+        unique_model_count += 1
+        yield CapQueryResult(
+            alert_model, alert_text, model.url,
+            placemark=model.GetPlacemark(cap2kml.PLACEMARK_VERSION),
+            normalized_text=model.GetNormalizedText(
+                cap_parse_mem.NORMALIZER_VERSION))
 
-    unique_model_count = len(alerts)
     logging.info(
         ('Visited %(model_count)d models, %(unique_model_count)d unique = ' +
-         '%(caplib_alerts)d caplib + %(clean_alerts)d clean + ' +
-         '%(parseable_alerts)d parseable + %(unparseable_alerts)d unparseable'),
+         '%(clean_alerts)d clean + %(parseable_alerts)d parseable + ' +
+         '%(unparseable_alerts)d unparseable, ' +
+         '%(extracted_alerts)d from stored extracts, ' +
+         '%(outside_alerts)d outside the bounding box'),
         locals())
-    return alerts
 
-  @classmethod
-  def _ParseConformingCap(cls, alert_text, query=None):
-    """Parses CAP alert with the standard-conforming caplib parser.
+  def _FetchPage(self, db_query):
+    """Reads the page of models requested by self.limit and self.cursor.
 
     Args:
-      alert_text: XML representation of the alert (unicode)
-      query: web_query.Query object for deferred filtering.
+      db_query: db.GqlQuery object
 
     Returns:
-      cap_schema_mem.ShadowCap object or None if there was a problem parsing.
+      Iterable of models.
+
+    Raises:
+      InvalidCursorError: if self.cursor is not a Datastore cursor.
+
+    Postconditions:
+      self.next_cursor is set if there may be more models.
     """
-    cap_namespaces = [CAP_V1_1_XMLNS_URN]
+    if self.limit is None:
+      return db_query
+    kind, position = self.cursor
+    offset = 0
+    if kind == _DATASTORE_CURSOR:
+      try:
+        db_query.with_cursor(position)
+      except db.BadValueError, e:
+        raise InvalidCursorError('cursor is invalid: %s' % e)
+    elif kind == _OFFSET_CURSOR:
+      offset = position
     try:
-      # Convert to string, since expat parser does not seem to support
-      # Unicode.
-      # TODO(Matt Frantz): Figure out why we have to do this.  Expat claims
-      # to support Unicode.  Maybe we can use a different parser for
-      # caplib.
-      alert_text_str = str(alert_text)
-      for cap_namespace in cap_namespaces:
-        try:
-          # Parse the XML into a caplib.Alert object.
-          alert_model = caplib.ParseString(alert_text_str,
-                                           namespace=cap_namespace)
-          # Create a shadow alert object that can apply the deferred query.
-          shadow_alert = cap_schema_mem.ShadowAlert(query=query)
-          # Copy the data from the original alert to the shadow using an
-          # internal method (defined in caplib's Container class).  The
-          # Container constructor is overly restrictive about the type of the
-          # template argument, so this hack is necessary.
-          # TODO(Matt Frantz): Avoid this hack.
-          shadow_alert._init_from_obj_(alert_model)
-          break
-        except (caplib.ConformanceError, ValueError, TypeError), e:
-          logging.debug('caplib error %s (%s) parsing %r',
-                        type(e), e, alert_text_str)
-
-    except UnicodeEncodeError, e:
-      # We can't convert to string, so we can't really parse this with the
-      # caplib parser.
-      logging.debug('UnicodeEncodeError (%s) parsing %r', e, alert_text)
-    except expat.ExpatError, e:
-      # XML parsing errors are namespace-independent (right?), so log it
-      # and stop trying.
-      logging.debug('ExpatError (%s) parsing %r', e, alert_text)
-
-    return None
+      models = db_query.fetch(self.limit, offset=offset)
+    except (AssertionError, db.BadRequestError), e:
+      if kind != _DATASTORE_CURSOR:
+        raise
+      # The cursor is for a different query, e.g. one restricted to crawls that
+      # are no longer served, so start again from the first page.
+      logging.info('Restarting query with stale cursor: %r', e)
+      db_query.with_cursor(None)
+      models = db_query.fetch(self.limit)
+    if len(models) == self.limit:
+      try:
+        self.next_cursor = _DATASTORE_CURSOR + db_query.cursor()
+      except AssertionError:
+        # Queries that are split into several (e.g. by "IN") have no cursor.
+        self.next_cursor = _OFFSET_CURSOR + str(offset + len(models))
+    return models
 
   @classmethod
-  def _ParseNonconformingCap(cls, parser, alert_text, query=None):
+  def _ParseCap(cls, parser, alert_text, query=None):
     """Parses CAP alert with our own permissive parser.
 
+    The parser is namespace-aware, so CAP 1.0, 1.1, and 1.2 alerts are all
+    handled in one parse, whatever prefixes they use.
+
     Args:
       parser: cap_parse_mem.MemoryCapParser object
       alert_text: XML representation of the alert (unicode)
@@ -407,83 +636,49 @@ class CapQuery(webapp.RequestHandler):
     return None, []
 
   @classmethod
-  def _NormalizeAlertText(cls, alert_text):
-    """Normalizes the XML text representation of a CAP alert node.
-
-    Strips any tag namespace prefixes.
+  def _DecodeGeometry(cls, geometry):
+    """Decodes the packed shapes stored when an alert was crawled.
 
     Args:
-      alert_text: XML representation (str or unicode)
+      geometry: Serialized geometry (see packed_geometry.Encode), or None.
 
     Returns:
-      Normalized XML representation (unicode)
-    """
-    alert_nodes = cap_parse_mem.ParseCapAlertNodes(alert_text)
-    if len(alert_nodes) > 1:
-      logging.error(
-          'How did that get in there?  I thought cap_mirror rejected CAPs' +
-          ' with more than one alert node!\n%r', alert_text)
-    alert_node = alert_nodes[0]
-    cls._NormalizeAlert(alert_node, CAP_V1_1_XMLNS_URN)
-    return xml_util.NodeToString(alert_node)
-
-  @classmethod
-  def _NormalizeAlert(cls, node, namespace_urn):
-    """Normalizes the XML representation of a CAP alert node.
-
-    Strips any tag namespace prefixes.
-
-    Args:
-      node: xml.dom.Node representing the CAP alert (modified in place)
-      namespace_urn: XML namespace URN (str)
-    """
-    # Apply the namespace prefix throughout.
-    cls._NormalizeNode(node)
-    # Strip out any xmlns attributes.
-    attributes = node.attributes
-    for i in xrange(attributes.length):
-      attribute = attributes.item(i)
-      name = attribute.name
-      if name == 'xmlns' or name.startswith('xmlns:'):
-        node.removeAttribute(name)
-    # Apply the XML namespace attribute to the alert node.
-    node.setAttribute('xmlns', namespace_urn)
-
-  @classmethod
-  def _NormalizeNode(cls, node):
-    """Normalizes the XML representation of an XML node.
-
-    Strips any tag namespace prefix.
-
-    Args:
-      node: xml.dom.Node (modified in place).
+      packed_geometry.PackedAlert object, or None if there is no usable
+      geometry, in which case the shapes must be parsed instead.
     """
+    if not geometry:
+      return None
     try:
-      tag = node.tagName
-    except AttributeError:
-      # Not an XML element.
-      return
-
-    node.tagName = cls._NormalizeTag(tag)
-    for child in node.childNodes:
-      cls._NormalizeNode(child)
+      return packed_geometry.Decode(geometry)
+    except ValueError, e:
+      logging.debug('Unusable geometry (%s)', e)
+      return None
 
   @classmethod
-  def _NormalizeTag(cls, tag):
-    """Normalizes the XML tag name.
-
-    Strips any tag namespace prefix.
+  def _MakeCapFromExtract(cls, parser, alert_extract, query=None,
+                          geometry=None):
+    """Makes a CAP alert model from the extract stored when it was crawled.
 
     Args:
-      tag: XML node tag (str)
+      parser: cap_parse_mem.MemoryCapParser object
+      alert_extract: Serialized extract (see cap_parse_mem.EncodeExtract)
+      query: web_query.Query object for deferred filtering.
+      geometry: packed_geometry.PackedAlert stored with the extract, or None.
 
     Returns:
-      tag without any namespace prefix.
+      (alert_model, errors), as from _ParseCap.  alert_model is None if the
+      extract is unusable, in which case the XML should be parsed instead.
     """
-    colon = tag.find(':')
-    if colon >= 0:
-      tag = tag[colon + 1:]
-    return tag
+    try:
+      new_alert_model = lambda: cap_schema_mem.ShadowAlert(query=query)
+      return parser.MakeAlertFromExtract(
+          new_alert_model, cap_parse_mem.DecodeExtract(alert_extract),
+          geometry=geometry)
+    except (cap_parse_mem.Error, ValueError), e:
+      logging.debug('%s', traceback.format_exc())
+      logging.debug('Unusable extract %s (%s): %r', type(e), e, alert_extract)
+
+    return None, []
 
 
 class Cap2Kml(CapQuery):
@@ -511,6 +706,17 @@ class Cap2Kml(CapQuery):
     unknown_arguments.discard('as_xml')
     return frozenset(unknown_arguments)
 
+  def _ResponseVariant(self):
+    """Describes any arguments, other than the query, that affect the response.
+
+    Returns:
+      str, which is part of the key of cached responses.
+    """
+    if self.as_xml:
+      return 'as_xml'
+    else:
+      return ''
+
   def _WriteResponse(self, alerts, user_query):
     """Writes a KML response.
 
@@ -521,25 +727,62 @@ class Cap2Kml(CapQuery):
     Postconditions:
       self.response is populated.
     """
-    logging.info('Generating KML')
-    placemarks = []
-    for alert in alerts:
-      try:
-        placemark = cap2kml.CapAlertAsKmlPlacemark(alert.model).ToKml()
-        placemarks.append(placemark)
-      except (DeadlineExceededError, AssertionError):
-        raise
-      except Exception, e:
-        logging.exception(e)
-
     if self.as_xml:
       content_type = 'text/xml'
     else:
       content_type = 'application/vnd.google-earth.kml+xml'
 
-    logging.info('Writing response as %s', content_type)
+    logging.info('Writing KML as %s', content_type)
     self.response.headers['Content-Type'] = content_type
-    self.response.out.write(pyfo.pyfo(cap2kml.Kml(placemarks), prolog=True))
+    for text in cap2kml.KmlTexts(self._KmlFeatureTexts(alerts)):
+      self._Write(text)
+
+  def _KmlFeatureTexts(self, alerts):
+    """Generates the serialized KML features of the response.
+
+    Args:
+      alerts: Iterable of CapQueryResult objects.
+
+    Yields:
+      Serialized placemarks, followed by a NetworkLink to the next page of the
+      query, if any (unicode)
+    """
+    for text in Cap2Kml._PlacemarkTexts(alerts):
+      yield text
+    next_page_url = self._NextPageUrl()
+    if next_page_url:
+      yield cap2kml.NetworkLinkText('Next page', next_page_url)
+
+  @classmethod
+  def _PlacemarkTexts(cls, alerts):
+    """Generates the serialized KML placemarks for query results.
+
+    Args:
+      alerts: Iterable of CapQueryResult objects.
+
+    Yields:
+      Results of cap2kml.PlacemarkText (unicode)
+    """
+    alert_count = 0
+    rebuilt_placemarks = 0
+    for alert in alerts:
+      alert_count += 1
+      # The stored placemark is the whole alert, so it can be used unless the
+      # query hides some of its info or area elements.
+      if alert.placemark is not None and not alert.model.IsFiltered():
+        yield alert.placemark
+        continue
+      rebuilt_placemarks += 1
+      try:
+        placemark_text = cap2kml.PlacemarkText(alert.model)
+      except (DeadlineExceededError, AssertionError):
+        raise
+      except Exception, e:
+        logging.exception(e)
+        continue
+      yield placemark_text
+    logging.info('Rebuilt %d of %d placemarks', rebuilt_placemarks,
+                 alert_count)
 
 
 class Cap2Atom(CapQuery):
@@ -572,22 +815,43 @@ class Cap2Atom(CapQuery):
     # Generate a feed title based on the query.
     title = 'CapQuery: %s' % user_query
 
-    # Normalize the XML.
-    logging.info('Normalizing XML')
+    logging.info('Writing response')
+    self.response.headers['Content-Type'] = 'text/xml'
+    self._Write(_XML_PROLOG)
+    self._Write('<atom:feed xmlns:atom="http://www.w3.org/2005/Atom">\n')
+    self._Write('<atom:title>%s</atom:title>\n' % _Escape(title))
+
+    # Normalize the XML.  It is normally done when the alert is crawled, and
+    # redone by cap_mirror.RenormalizeAlertBodies when the normalizer changes.
     # TODO(Matt Frantz): Some deferred predicates will be ignored because we are
     # returning to the source XML rather than allowing the shadow models to
     # apply the predicates.  When cap_parse is a complete parser, we can use
     # the model to generate the filtered, normalized XML.
-    # TODO(Matt Frantz): We could normalize XML during crawl, although that
-    # would make it difficult to apply improvements to the parser
-    # retroactively on historical data.
+    alert_count = 0
+    normalized_alerts = 0
     for alert in alerts:
-      alert.text = Cap2Atom._NormalizeAlertText(alert.text)
-
-    logging.info('Writing response')
-    webapp_util.WriteTemplate(self.response, 'atom_index.xml',
-                              dict(title=title, alerts=alerts))
-    self.response.headers['Content-Type'] = 'text/xml'
+      alert_count += 1
+      if alert.normalized_text is not None:
+        text = alert.normalized_text
+      else:
+        text = cap_parse_mem.NormalizeAlertText(alert.text)
+        normalized_alerts += 1
+      for info in alert.model.info:
+        self._Write('<atom:entry>\n')
+        self._Write('<atom:title>%s</atom:title>\n' % _Escape(info.headline))
+        self._Write('<atom:summary>%s</atom:summary>\n' %
+                    _Escape(info.description))
+        self._Write('<atom:link href="%s"/>\n' % _Escape(alert.url))
+        self._Write('<atom:content type="text/xml">\n')
+        self._Write(text)
+        self._Write('\n</atom:content>\n')
+        self._Write('</atom:entry>\n')
+    next_page_url = self._NextPageUrl()
+    if next_page_url:
+      self._Write('<atom:link rel="next" href="%s"/>\n' %
+                  _Escape(next_page_url))
+    self._Write('</atom:feed>\n')
+    logging.info('Normalized %d of %d alerts', normalized_alerts, alert_count)
 
 
 class Cap2Dump(CapQuery):
@@ -622,8 +886,19 @@ class Cap2Dump(CapQuery):
 
     logging.info('Writing response')
     self.response.headers['Content-Type'] = 'text/xml'
-    webapp_util.WriteTemplate(self.response, 'cap_dump.xml',
-                              dict(title=title, alerts=alerts))
+    self._Write(_XML_PROLOG)
+    self._Write('<cap_query:dump xmlns:cap_query="/cap_query.dtd">\n')
+    self._Write('<cap_query:title>%s</cap_query:title>\n' % _Escape(title))
+    self._Write('<cap_query:alerts>\n')
+    for alert in alerts:
+      self._Write('<cap_query:alert url="%s">\n' % _Escape(alert.url))
+      self._Write(unicode(alert.model))
+      self._Write('\n</cap_query:alert>\n')
+    self._Write('</cap_query:alerts>\n')
+    next_page_url = self._NextPageUrl()
+    if next_page_url:
+      self._Write('<cap_query:next href="%s"/>\n' % _Escape(next_page_url))
+    self._Write('</cap_query:dump>\n')
 
 
 application = webapp.WSGIApplication(
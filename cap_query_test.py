@@ -0,0 +1,145 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for cap_query."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+
+from google3.apphosting.ext import db
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import cap_query
+from google3.dotorg.gongo.appengine_cap2kml import cap_schema
+from google3.dotorg.gongo.appengine_cap2kml import db_test_util
+
+
+class ParseLimitTest(googletest.TestCase):
+  """Tests for cap_query._ParseLimit."""
+
+  def testParseLimit(self):
+    self.assertEquals(None, cap_query._ParseLimit(''))
+    self.assertEquals(7, cap_query._ParseLimit('7'))
+    self.assertEquals(cap_query.MAX_LIMIT,
+                      cap_query._ParseLimit(str(cap_query.MAX_LIMIT + 1)))
+
+  def testParseLimit_invalid(self):
+    for limit in ['0', '-1', 'x']:
+      self.assertRaises(ValueError, cap_query._ParseLimit, limit)
+
+
+class ParseCursorTest(googletest.TestCase):
+  """Tests for cap_query._ParseCursor."""
+
+  def testParseCursor(self):
+    self.assertEquals((None, None), cap_query._ParseCursor(''))
+    self.assertEquals(('o', 5), cap_query._ParseCursor(u'o5'))
+    self.assertEquals(('c', 'abc'), cap_query._ParseCursor(u'cabc'))
+
+  def testParseCursor_invalid(self):
+    for cursor in ['c', 'o', 'o-1', 'ox', 'x5', u'c\xe9']:
+      self.assertRaises(ValueError, cap_query._ParseCursor, cursor)
+
+
+class FetchPageTest(db_test_util.DbTestBase):
+  """Tests for cap_query.CapQuery._FetchPage."""
+
+  def setUp(self):
+    super(FetchPageTest, self).setUp()
+    self.identifiers = ['a', 'b', 'c', 'd', 'e']
+    for identifier in self.identifiers:
+      cap_schema.CapAlert(identifier=identifier).put()
+
+  def _FetchAllPages(self, gql, *args):
+    """Follows the cursors of a query two models at a time.
+
+    Args:
+      gql: GQL query of CapAlert models (str)
+      args: Positional parameters of the query
+
+    Returns:
+      (identifiers, cursor kinds) of all of the pages
+    """
+    handler = cap_query.CapQuery()
+    handler.limit = 2
+    handler.cursor = (None, None)
+    identifiers = []
+    kinds = []
+    while True:
+      handler.next_cursor = None
+      models = handler._FetchPage(db.GqlQuery(gql, *args))
+      identifiers.extend([x.identifier for x in models])
+      if not handler.next_cursor:
+        return identifiers, kinds
+      # Cursors are passed through a URL.
+      handler.cursor = cap_query._ParseCursor(unicode(handler.next_cursor))
+      kinds.append(handler.cursor[0])
+
+  def testFetchPage_datastoreCursor(self):
+    identifiers, kinds = self._FetchAllPages(
+        'SELECT * FROM CapAlert ORDER BY identifier')
+    self.assertEquals(self.identifiers, identifiers)
+    self.assertEquals(['c', 'c'], kinds)
+
+  def testFetchPage_offsetWithoutCursor(self):
+    # Queries that use "IN" have no cursors.
+    identifiers, kinds = self._FetchAllPages(
+        'SELECT * FROM CapAlert WHERE identifier IN :1 ORDER BY identifier',
+        self.identifiers)
+    self.assertEquals(self.identifiers, identifiers)
+    self.assertEquals(['o', 'o'], kinds)
+
+  def testFetchPage_invalidCursor(self):
+    handler = cap_query.CapQuery()
+    handler.limit = 2
+    handler.cursor = (cap_query._DATASTORE_CURSOR, 'bogus')
+    handler.next_cursor = None
+    self.assertRaises(
+        cap_query.InvalidCursorError, handler._FetchPage,
+        db.GqlQuery('SELECT * FROM CapAlert ORDER BY identifier'))
+
+  def testFetchPage_staleCursor(self):
+    # A cursor from a different query restarts from the first page.
+    other_query = db.GqlQuery('SELECT * FROM CapAlert ORDER BY identifier DESC')
+    other_query.fetch(2)
+    handler = cap_query.CapQuery()
+    handler.limit = 2
+    handler.cursor = (cap_query._DATASTORE_CURSOR, other_query.cursor())
+    handler.next_cursor = None
+    models = handler._FetchPage(
+        db.GqlQuery('SELECT * FROM CapAlert ORDER BY identifier'))
+    self.assertEquals(['a', 'b'], [x.identifier for x in models])
+    self.assertTrue(handler.next_cursor)
+
+  def testFetchPage_noLimit(self):
+    handler = cap_query.CapQuery()
+    handler.limit = None
+    handler.cursor = (None, None)
+    handler.next_cursor = None
+    models = handler._FetchPage(
+        db.GqlQuery('SELECT * FROM CapAlert ORDER BY identifier'))
+    self.assertEquals(self.identifiers, [x.identifier for x in models])
+    self.assertEquals(None, handler.next_cursor)
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -29,9 +29,12 @@ http://www.oasis-open.org/committees/download.php/14759/emergency-CAPv1.1.pdf
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
 import datetime
+import hashlib
+import random
 
 try:
   # google3
+  from google3.apphosting.api import memcache
   from google3.apphosting.ext import db
   from google3.pyglib import logging
 
@@ -41,6 +44,7 @@ try:
 except ImportError:
   import logging
 
+  from google.appengine.api import memcache
   from google.appengine.ext import db
 
   import db_util
@@ -65,26 +69,198 @@ DEFAULT_CRAWL_PERIOD_IN_MINUTES = 60
 DEFAULT_CRAWL_PERIOD = datetime.timedelta(
     minutes=DEFAULT_CRAWL_PERIOD_IN_MINUTES)
 
+# Default bounds on the adaptive crawl period of a Feed.
+DEFAULT_MIN_CRAWL_PERIOD_IN_MINUTES = 5
+DEFAULT_MAX_CRAWL_PERIOD_IN_MINUTES = 6 * 60
+
+# Factors applied to the adaptive crawl period after a crawl in which a Feed
+# did or did not change.
+CHANGED_CRAWL_PERIOD_FACTOR = 0.5
+UNCHANGED_CRAWL_PERIOD_FACTOR = 1.5
+
+# Number of recent crawls remembered in Feed.change_history.
+CHANGE_HISTORY_LENGTH = 24
+
 
 class Feed(db.Model):
-  """Site containing CAP data."""
+  """Site containing CAP data.
+
+  The crawl period starts out as crawl_period_in_minutes.  After each crawl,
+  effective_crawl_period_in_minutes shrinks if the feed changed and grows if
+  it did not, staying between min_crawl_period_in_minutes and
+  max_crawl_period_in_minutes.
+  """
   url = db.StringProperty()
   is_crawlable = db.BooleanProperty(default=True)
   is_root = db.BooleanProperty(default=True)
   crawl_period_in_minutes = db.IntegerProperty(
       default=DEFAULT_CRAWL_PERIOD_IN_MINUTES)
+  min_crawl_period_in_minutes = db.IntegerProperty(
+      default=DEFAULT_MIN_CRAWL_PERIOD_IN_MINUTES)
+  max_crawl_period_in_minutes = db.IntegerProperty(
+      default=DEFAULT_MAX_CRAWL_PERIOD_IN_MINUTES)
+  effective_crawl_period_in_minutes = db.IntegerProperty()
+  # Whether the feed changed in each of the most recent crawls, oldest first.
+  change_history = db.ListProperty(bool)
   last_crawl = db.Reference(Crawl)
 
   def __str__(self):
     return str(db_util.ModelAsDict(Feed, self))
 
+  def GetCrawlPeriodInMinutes(self):
+    """Returns the current crawl period, adapted to the feed's change rate.
+
+    Returns:
+      Minutes between crawls (int)
+    """
+    if self.effective_crawl_period_in_minutes:
+      return self.effective_crawl_period_in_minutes
+    else:
+      return self.crawl_period_in_minutes
+
+  def RecordChange(self, changed):
+    """Adapts the crawl period after a crawl.
+
+    Args:
+      changed: Whether the feed changed during the crawl (bool)
+
+    Postconditions:
+      change_history and effective_crawl_period_in_minutes are updated, but
+      not saved.
+    """
+    history = list(self.change_history) + [bool(changed)]
+    self.change_history = history[-CHANGE_HISTORY_LENGTH:]
+    if changed:
+      factor = CHANGED_CRAWL_PERIOD_FACTOR
+    else:
+      factor = UNCHANGED_CRAWL_PERIOD_FACTOR
+    period = int(round(self.GetCrawlPeriodInMinutes() * factor))
+    period = max(period, self.min_crawl_period_in_minutes)
+    period = min(period, self.max_crawl_period_in_minutes)
+    self.effective_crawl_period_in_minutes = period
+
+
+class CapAlertBody(db.Model):
+  """Original XML text of a CAP alert, shared by all identical alerts.
+
+  The key name is derived from the digest of the text (see AlertDigest), so
+  an alert that appears unchanged in many crawls is stored only once.
+
+  The alert is parsed once, when it is crawled, and the text of its fields is
+  stored in 'extract' (see cap_parse_mem.EncodeExtract), so that queries need
+  not parse the XML again.  Its KML Placemark (see cap2kml.PlacemarkText), its
+  normalized XML (see cap_parse_mem.NormalizeAlertText), and the packed shapes
+  of its areas (see packed_geometry.Encode) are stored at the same time.  Each
+  is tagged with the version of the code that produced it, so that stale ones
+  can be ignored or rebuilt.  A field that could not be derived, or that would
+  not fit in the model, is None, but still has its version.
+
+  A body that no alert refers to is marked as orphaned, and deleted later if
+  no crawl has reused it by then (see cap_mirror.PurgeOrphanedAlertBodies).
+  """
+  text = db.TextProperty()
+  extract = db.TextProperty()
+  # cap_parse_mem.EXTRACT_VERSION that produced the extract.
+  extract_version = db.IntegerProperty()
+  placemark = db.TextProperty()
+  # cap2kml.PLACEMARK_VERSION that produced the placemark.
+  placemark_version = db.IntegerProperty()
+  normalized_text = db.TextProperty()
+  # cap_parse_mem.NORMALIZER_VERSION that produced the normalized_text.
+  normalized_version = db.IntegerProperty()
+  geometry = db.BlobProperty()
+  # packed_geometry.VERSION that produced the geometry.
+  geometry_version = db.IntegerProperty()
+  # When a purge found that no alert refers to this body, or None.
+  orphaned = db.DateTimeProperty()
+
+
+def AlertDigest(text):
+  """Computes the content digest of CAP alert text.
+
+  Args:
+    text: XML text of the alert (str or unicode)
+
+  Returns:
+    Hex digest (str)
+  """
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  return hashlib.sha1(text).hexdigest()
+
+
+def CapAlertBodyKeyName(digest):
+  """Generates the key name for the CapAlertBody with the given digest.
+
+  Args:
+    digest: Result of AlertDigest (str)
+
+  Returns:
+    Key name (str) for the CapAlertBody model.
+  """
+  return 'CapAlertBody %s' % digest
+
+
+# Datastore limits each model to 1MB, so the text and derived fields of a
+# CapAlertBody may use at most this many bytes, which leaves room for the
+# property names and the key.
+MAX_ALERT_BODY_BYTES = 1000 * 1000
+
+
+def FitAlertBodyFields(key_name, text, fields):
+  """Chooses the derived fields that fit in a CapAlertBody with its text.
+
+  Every version is assigned, even for fields that are dropped or could not be
+  derived, so that the body is not derived again by the same code.  Queries
+  derive missing fields themselves.
+
+  Args:
+    key_name: Result of CapAlertBodyKeyName (str)
+    text: XML text of the alert (db.Text)
+    fields: List of (name, version name, version, value or None), in order of
+        their value to queries, since those that do not fit are dropped from
+        the end.
+
+  Returns:
+    Dict mapping CapAlertBody property name (str) to value
+  """
+  budget = MAX_ALERT_BODY_BYTES - _ByteSize(text)
+  properties = {}
+  for name, version_name, version, value in fields:
+    if value is not None:
+      size = _ByteSize(value)
+      if size > budget:
+        logging.info('Not storing %s of %s: %d bytes', name, key_name, size)
+        value = None
+      else:
+        budget -= size
+    properties[name] = value
+    properties[version_name] = version
+  return properties
+
+
+def _ByteSize(value):
+  """Returns the number of bytes that the Datastore stores for a value.
+
+  Args:
+    value: db.Text (or other unicode) or db.Blob (or other str)
+  """
+  if isinstance(value, unicode):
+    return len(value.encode('utf-8'))
+  else:
+    return len(value)
+
 
 class CapAlert(db.Model):
   """CAP file from a feed."""
   crawl = db.Reference(Crawl)
   feed = db.Reference(Feed)
   url = db.StringProperty()
+  # Alerts saved before CapAlertBody existed keep their XML in 'text'.  Newer
+  # alerts refer to a shared body instead.  Use GetText to read either.
   text = db.TextProperty()
+  digest = db.StringProperty()
+  body = db.Reference(CapAlertBody)
   parse_errors = db.ListProperty(db.Text)
   # CAP alert properties that we care about.  (CAP 1.1 sec 3.2.1)
   identifier = db.StringProperty()
@@ -133,15 +309,100 @@ class CapAlert(db.Model):
 
   # Area.
   # TODO(Matt Frantz): Save "areaDesc" when Datastore has text search.
-  # TODO(Matt Frantz): Save "polygon" in an indexable way.
-  # TODO(Matt Frantz): Save "circle" in an indexable way.
   # TODO(Matt Frantz): Save "geocode" tag/value pairs?
   altitude = db.ListProperty(float)
   ceiling = db.ListProperty(float)
+  # Polygons and circles, as indexed by geo_index.AlertTokens.
+  geohash = db.StringListProperty()
+  # geo_index.VERSION of geohash, or None if the alert has not been indexed.
+  geohash_version = db.IntegerProperty()
 
   def __str__(self):
     return str(db_util.ModelAsDict(Cap, self))
 
+  def GetText(self):
+    """Returns the original XML text of the alert.
+
+    Returns:
+      XML text (db.Text), or None if it is unavailable.
+    """
+    body = db_util.SafelyDereference(self, 'body')
+    if body:
+      return body.text
+    else:
+      return self.text
+
+  def GetExtract(self, version):
+    """Returns the serialized extract of the alert, if it is current.
+
+    Args:
+      version: Extract version that the caller can decode (int)
+
+    Returns:
+      Serialized extract (db.Text), or None if there is no extract of that
+      version, in which case the caller must parse GetText instead.
+    """
+    return self._GetBodyProperty('extract', version)
+
+  def GetPlacemark(self, version):
+    """Returns the serialized KML Placemark of the alert, if it is current.
+
+    Args:
+      version: Placemark version that the caller would produce (int)
+
+    Returns:
+      Serialized placemark (db.Text), which is empty if the alert has no
+      placemark, or None if there is no placemark of that version, in which
+      case the caller must build it from the alert.
+    """
+    return self._GetBodyProperty('placemark', version)
+
+  def GetNormalizedText(self, version):
+    """Returns the normalized XML text of the alert, if it is current.
+
+    Args:
+      version: Normalizer version that the caller would apply (int)
+
+    Returns:
+      Normalized XML text (db.Text), or None if there is no normalized text of
+      that version, in which case the caller must normalize GetText instead.
+    """
+    return self._GetBodyProperty('normalized_text', version,
+                                 version_name='normalized_version')
+
+  def GetGeometry(self, version):
+    """Returns the packed shapes of the areas of the alert, if current.
+
+    Args:
+      version: Geometry version that the caller can decode (int)
+
+    Returns:
+      Serialized geometry (db.Blob), or None if there is no geometry of that
+      version, in which case the caller must use the polygons and circles of
+      the alert instead.
+    """
+    return self._GetBodyProperty('geometry', version)
+
+  def _GetBodyProperty(self, name, version, version_name=None):
+    """Returns a property of the alert body, if it is of the given version.
+
+    Args:
+      name: CapAlertBody property name (str)
+      version: Required version of the property (int)
+      version_name: CapAlertBody property that holds the version (str), by
+          default the name with a '_version' suffix.
+
+    Returns:
+      Property value, or None if there is no body, or the version differs.
+    """
+    if not version_name:
+      version_name = name + '_version'
+    body = db_util.SafelyDereference(self, 'body')
+    if body and getattr(body, version_name) == version:
+      return getattr(body, name)
+    else:
+      return None
+
 
 class CrawlShard(db.Model):
   """Single atom of crawl work, which is a URL."""
@@ -154,6 +415,298 @@ class CrawlShard(db.Model):
   finished = db.DateTimeProperty()
   error = db.TextProperty()
   parse_errors = db.ListProperty(db.Text)
+  # Resources spent on the shard (see PROFILE_FIELDS).
+  fetch_ms = db.IntegerProperty()
+  fetch_bytes = db.IntegerProperty()
+  parse_ms = db.IntegerProperty()
+  convert_ms = db.IntegerProperty()
+  put_ms = db.IntegerProperty()
+  rpc_count = db.IntegerProperty()
+
+
+class FetchValidator(db.Model):
+  """HTTP cache validators from the most recent fetch of a URL.
+
+  The content found at the URL is remembered (as a CapAlert reference or as the
+  list of URL's in an index) so that it can be carried forward into a new crawl
+  when the server reports that the content has not been modified.
+  """
+  url = db.TextProperty()
+  etag = db.TextProperty()
+  last_modified = db.TextProperty()
+  alert = db.Reference(CapAlert)
+  index_urls = db.ListProperty(db.Text)
+
+
+# Number of CrawlCounter models per counter.  Increments go to a random one,
+# so more of them permit more concurrent increments without contention.
+NUM_CRAWL_COUNTER_SHARDS = 20
+
+# Names of the counters maintained for each crawl.
+SHARDS_CREATED = 'shards_created'
+SHARDS_COMPLETED = 'shards_completed'
+SHARDS_ERRORED = 'shards_errored'
+PUSHES_ENQUEUED = 'pushes_enqueued'
+PUSHES_DONE = 'pushes_done'
+CRAWL_COUNTER_NAMES = (SHARDS_CREATED, SHARDS_COMPLETED, SHARDS_ERRORED,
+                       PUSHES_ENQUEUED, PUSHES_DONE)
+
+
+class CrawlCounter(db.Model):
+  """One shard of a named counter for a crawl.
+
+  The value of the counter is the sum over all of its shards (see
+  GetCrawlCounters).
+  """
+  crawl = db.Reference(Crawl)
+  name = db.StringProperty()
+  count = db.IntegerProperty(default=0)
+
+
+def _CrawlKey(crawl):
+  """Returns the key of a crawl.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+
+  Returns:
+    db.Key object
+  """
+  if isinstance(crawl, db.Model):
+    return crawl.key()
+  else:
+    return crawl
+
+
+def _CrawlCounterKeyName(crawl_key, name, index):
+  """Generates a stable, unique key name for a shard of a crawl counter.
+
+  Args:
+    crawl_key: Key of the Crawl (db.Key)
+    name: Name of the counter (str)
+    index: Shard index of the counter (int)
+
+  Returns:
+    Key name (str) for the CrawlCounter model.
+  """
+  return 'CrawlCounter %s %s %d' % (crawl_key, name, index)
+
+
+def IncrementCrawlCounter(crawl, name, delta=1):
+  """Adds to a counter for a crawl.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+    name: Name of the counter, e.g. SHARDS_CREATED (str)
+    delta: Amount to add (int)
+  """
+  crawl_key = _CrawlKey(crawl)
+  key_name = _CrawlCounterKeyName(
+      crawl_key, name, random.randint(0, NUM_CRAWL_COUNTER_SHARDS - 1))
+
+  def Increment():
+    counter = CrawlCounter.get_by_key_name(key_name)
+    if not counter:
+      counter = CrawlCounter(key_name=key_name, crawl=crawl_key, name=name)
+    counter.count += delta
+    counter.put()
+
+  db.run_in_transaction(Increment)
+
+
+def GetCrawlCounters(crawl, names=CRAWL_COUNTER_NAMES):
+  """Reads counters for a crawl with a single batch get.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+    names: Names of the counters (sequence of str)
+
+  Returns:
+    Dict mapping each counter name (str) to its value (int)
+  """
+  crawl_key = _CrawlKey(crawl)
+  key_names = []
+  for name in names:
+    for index in xrange(NUM_CRAWL_COUNTER_SHARDS):
+      key_names.append(_CrawlCounterKeyName(crawl_key, name, index))
+  counts = dict([(name, 0) for name in names])
+  for counter in CrawlCounter.get_by_key_name(key_names):
+    if counter:
+      counts[counter.name] += counter.count
+  return counts
+
+
+class FeedChange(db.Model):
+  """Flag that a feed had new content during a crawl (see MarkFeedChanged).
+
+  There is at most one per crawl and feed, and it is written only once, so
+  that it does not contend with itself.
+  """
+  crawl = db.Reference(Crawl)
+  feed = db.Reference(Feed)
+
+
+def _FeedChangeKeyName(crawl_key, feed_key):
+  """Generates a stable, unique key name for a FeedChange.
+
+  Args:
+    crawl_key: Key of the Crawl (db.Key)
+    feed_key: Key of the Feed (db.Key)
+
+  Returns:
+    Key name (str) for the FeedChange model.
+  """
+  return 'FeedChange %s %s' % (crawl_key, feed_key)
+
+
+def MarkFeedChanged(crawl, feed):
+  """Records that a feed had new content during a crawl.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+    feed: Feed object or key (db.Key)
+  """
+  crawl_key = _CrawlKey(crawl)
+  if isinstance(feed, db.Model):
+    feed = feed.key()
+  key_name = _FeedChangeKeyName(crawl_key, feed)
+  if not FeedChange.get_by_key_name(key_name):
+    FeedChange(key_name=key_name, crawl=crawl_key, feed=feed).put()
+
+
+def GetChangedFeeds(crawl, feeds):
+  """Determines which feeds had new content during a crawl.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+    feeds: Feed objects (list)
+
+  Returns:
+    Set of keys (db.Key) of the feeds that changed.
+  """
+  crawl_key = _CrawlKey(crawl)
+  key_names = [_FeedChangeKeyName(crawl_key, feed.key()) for feed in feeds]
+  changed = set()
+  for feed, flag in zip(feeds, FeedChange.get_by_key_name(key_names)):
+    if flag:
+      changed.add(feed.key())
+  return changed
+
+
+# Resources spent on each shard, which are recorded in the CrawlShard and
+# summed per feed in CrawlProfile.
+FETCH_MS = 'fetch_ms'  # Waiting for the content of the URL.
+FETCH_BYTES = 'fetch_bytes'  # Size of the content.
+PARSE_MS = 'parse_ms'  # Parsing the XML of the CAP or index.
+CONVERT_MS = 'convert_ms'  # Converting parsed CAP to Datastore models.
+PUT_MS = 'put_ms'  # Writing to the Datastore.
+RPC_COUNT = 'rpc_count'  # Number of App Engine API calls.
+PROFILE_FIELDS = (FETCH_MS, FETCH_BYTES, PARSE_MS, CONVERT_MS, PUT_MS,
+                  RPC_COUNT)
+
+# Number of shards summed into a CrawlProfile.
+PROFILE_SHARDS = 'shards'
+
+# Number of CrawlProfile models per crawl and feed.
+NUM_CRAWL_PROFILE_SHARDS = 5
+
+
+class CrawlProfile(db.Model):
+  """One shard of the totals of the resources a crawl spent on a feed.
+
+  The totals are the sums over all of the shards (see GetCrawlProfiles).
+  """
+  crawl = db.Reference(Crawl)
+  feed = db.Reference(Feed)
+  shards = db.IntegerProperty(default=0)
+  fetch_ms = db.IntegerProperty(default=0)
+  fetch_bytes = db.IntegerProperty(default=0)
+  parse_ms = db.IntegerProperty(default=0)
+  convert_ms = db.IntegerProperty(default=0)
+  put_ms = db.IntegerProperty(default=0)
+  rpc_count = db.IntegerProperty(default=0)
+
+
+def _CrawlProfileKeyName(crawl_key, feed_key, index):
+  """Generates a stable, unique key name for a shard of a crawl profile.
+
+  Args:
+    crawl_key: Key of the Crawl (db.Key)
+    feed_key: Key of the Feed (db.Key)
+    index: Shard index of the profile (int)
+
+  Returns:
+    Key name (str) for the CrawlProfile model.
+  """
+  return 'CrawlProfile %s %s %d' % (crawl_key, feed_key, index)
+
+
+def EmptyProfile():
+  """Returns a profile in which nothing has been spent.
+
+  Returns:
+    Dict mapping PROFILE_SHARDS and each of PROFILE_FIELDS to zero.
+  """
+  return dict([(name, 0) for name in (PROFILE_SHARDS,) + PROFILE_FIELDS])
+
+
+def AddCrawlProfile(crawl, feed_key, profile):
+  """Adds to the resources a crawl spent on a feed.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+    feed_key: Key of the Feed (db.Key)
+    profile: Dict mapping PROFILE_SHARDS and PROFILE_FIELDS names to amounts
+        (int).  Missing names are not changed.
+  """
+  crawl_key = _CrawlKey(crawl)
+  key_name = _CrawlProfileKeyName(
+      crawl_key, feed_key, random.randint(0, NUM_CRAWL_PROFILE_SHARDS - 1))
+
+  def Add():
+    crawl_profile = CrawlProfile.get_by_key_name(key_name)
+    if not crawl_profile:
+      crawl_profile = CrawlProfile(key_name=key_name, crawl=crawl_key,
+                                   feed=feed_key)
+    for name, amount in profile.iteritems():
+      setattr(crawl_profile, name, getattr(crawl_profile, name) + amount)
+    crawl_profile.put()
+
+  db.run_in_transaction(Add)
+
+
+def GetCrawlProfiles(crawl):
+  """Reads the resources a crawl spent on each feed.
+
+  Args:
+    crawl: Crawl object or key (db.Key)
+
+  Returns:
+    Dict mapping Feed keys (db.Key) to profiles (see EmptyProfile).
+  """
+  crawl_key = _CrawlKey(crawl)
+  profiles = {}
+  for crawl_profile in CrawlProfile.gql('WHERE crawl = :1', crawl_key):
+    feed_key = CrawlProfile.feed.get_value_for_datastore(crawl_profile)
+    profile = profiles.setdefault(feed_key, EmptyProfile())
+    for name in profile:
+      profile[name] += getattr(crawl_profile, name)
+  return profiles
+
+
+def CrawlWorkRemaining(counts):
+  """Calculates how much work is outstanding for a crawl.
+
+  Args:
+    counts: Result of GetCrawlCounters, including all CRAWL_COUNTER_NAMES.
+
+  Returns:
+    Number of incomplete shards plus unprocessed push tasks (int).  A value
+    that is not positive means that (according to the counters) the crawl is
+    done.
+  """
+  return (counts[SHARDS_CREATED] - counts[SHARDS_COMPLETED] +
+          counts[PUSHES_ENQUEUED] - counts[PUSHES_DONE])
 
 
 class ShadowCrawl(Crawl):
@@ -168,12 +721,60 @@ class ShadowCrawl(Crawl):
     super(ShadowCrawl, self).__init__(**db_util.ModelAsDict(Crawl, crawl))
     self.__feeds = None
     self.__shards = None
-    self.__shards_remaining = None
+    self.__counters = None
+    self.__feed_profiles = None
     self.__key = crawl.key()
 
   def key(self):
     return self.__key
 
+  @property
+  def counters(self):
+    """Returns the progress counters of this crawl.
+
+    Returns:
+      Dict mapping counter names (e.g. SHARDS_CREATED) to values (int)
+    """
+    if self.__counters is None:
+      self.__counters = GetCrawlCounters(self.__key)
+    return self.__counters
+
+  @property
+  def feed_profiles(self):
+    """Returns the resources this crawl spent on each feed.
+
+    Returns:
+      List of profiles (see EmptyProfile) with an additional 'feed_url' key,
+      ordered from the longest total fetch time to the shortest.
+    """
+    if self.__feed_profiles is None:
+      profiles = GetCrawlProfiles(self.__key)
+      feed_keys = profiles.keys()
+      feed_profiles = []
+      for feed_key, feed in zip(feed_keys, db.get(feed_keys)):
+        profile = dict(profiles[feed_key])
+        if feed:
+          profile['feed_url'] = feed.url
+        else:
+          profile['feed_url'] = str(feed_key)
+        feed_profiles.append(profile)
+      feed_profiles.sort(key=lambda x: x[FETCH_MS], reverse=True)
+      self.__feed_profiles = feed_profiles
+    return self.__feed_profiles
+
+  @property
+  def profile(self):
+    """Returns the resources spent on this crawl, summed over all feeds.
+
+    Returns:
+      Profile (see EmptyProfile)
+    """
+    total = EmptyProfile()
+    for profile in self.feed_profiles:
+      for name in total:
+        total[name] += profile[name]
+    return total
+
   @property
   def feeds(self):
     """Returns the set of feeds involved in this crawl.
@@ -277,28 +878,193 @@ def DereferenceFilterAndShadow(referenced_model, subordinate_model_name,
   return list(subordinate_models)
 
 
+class ServingGeneration(db.Model):
+  """The crawls from which queries are served.
+
+  There is only one instance (see LastCrawls).  It maps each root feed to its
+  last completed crawl, as parallel lists, so that the set of crawls can be
+  found without reading every Feed.  The generation increases whenever the
+  mapping changes.
+  """
+  generation = db.IntegerProperty(default=0)
+  feeds = db.ListProperty(db.Key)
+  crawls = db.ListProperty(db.Key)
+
+
+_SERVING_GENERATION_KEY_NAME = 'serving'
+
+# Memcache keys for the generation number, and for (generation, crawl keys).
+_SERVING_GENERATION_MEMCACHE_KEY = 'ServingGeneration.generation'
+_SERVING_CRAWLS_MEMCACHE_KEY = 'ServingGeneration.crawls'
+
+# Most recent (generation, crawl keys) seen by this instance.
+_serving_crawls = None
+
+
 def LastCrawls():
   """Returns the last completed crawl for each feed.
 
+  Usually costs one small memcache get, since the crawls are cached in memcache
+  and in this instance until the serving generation changes.
+
   Returns:
-    set of Crawl objects, empty if there are no crawls
+    set of Crawl keys, empty if there are no crawls
+  """
+  global _serving_crawls
+  generation = memcache.get(_SERVING_GENERATION_MEMCACHE_KEY)
+  if (generation is not None and _serving_crawls and
+      _serving_crawls[0] == generation):
+    return set(_serving_crawls[1])
+
+  serving_crawls = memcache.get(_SERVING_CRAWLS_MEMCACHE_KEY)
+  if (generation is None or serving_crawls is None or
+      serving_crawls[0] != generation):
+    serving = _GetServingGeneration()
+    serving_crawls = (serving.generation, list(serving.crawls))
+    # Don't clobber a newer generation cached by UpdateServingGeneration.
+    memcache.add(_SERVING_CRAWLS_MEMCACHE_KEY, serving_crawls)
+    memcache.add(_SERVING_GENERATION_MEMCACHE_KEY, serving.generation)
+  _serving_crawls = serving_crawls
+  return set(serving_crawls[1])
+
+
+def CurrentServingGeneration():
+  """Returns the current serving generation.
+
+  Usually costs one small memcache get.
+
+  Returns:
+    Generation (int)
+  """
+  generation = memcache.get(_SERVING_GENERATION_MEMCACHE_KEY)
+  if generation is None:
+    generation = _GetServingGeneration().generation
+    # Don't clobber a newer generation cached by UpdateServingGeneration.
+    memcache.add(_SERVING_GENERATION_MEMCACHE_KEY, generation)
+  return generation
+
+
+def UpdateServingGeneration(crawl_key, feed_keys):
+  """Records a completed crawl as the last crawl of some root feeds.
+
+  Args:
+    crawl_key: Crawl key (db.Key)
+    feed_keys: Keys of root feeds whose last crawl this is (list of db.Key)
+
+  Returns:
+    The new generation (int)
+  """
+  def Update(serving):
+    crawls_by_feed = dict(zip(serving.feeds, serving.crawls))
+    for feed_key in feed_keys:
+      crawls_by_feed[feed_key] = crawl_key
+    serving.feeds = crawls_by_feed.keys()
+    serving.crawls = [crawls_by_feed[x] for x in serving.feeds]
+
+  return _UpdateServingGeneration(Update)
+
+
+def RemoveServingFeeds(feed_keys):
+  """Stops serving the last crawls of some feeds that are no longer roots.
+
+  Args:
+    feed_keys: Keys of feeds (list of db.Key)
+
+  Returns:
+    The new generation (int)
+  """
+  def Update(serving):
+    crawls_by_feed = dict(zip(serving.feeds, serving.crawls))
+    for feed_key in feed_keys:
+      crawls_by_feed.pop(feed_key, None)
+    serving.feeds = crawls_by_feed.keys()
+    serving.crawls = [crawls_by_feed[x] for x in serving.feeds]
+
+  return _UpdateServingGeneration(Update)
+
+
+def RebuildServingGeneration():
+  """Rebuilds the serving generation from the feeds.
+
+  Called when feeds or crawls are deleted wholesale.
+
+  Returns:
+    The new generation (int)
+  """
+  feed_keys, crawl_keys = _ScanLastCrawls()
+
+  def Update(serving):
+    serving.feeds = feed_keys
+    serving.crawls = crawl_keys
+
+  return _UpdateServingGeneration(Update)
+
+
+def _UpdateServingGeneration(update):
+  """Modifies the serving generation in a transaction, and advances it.
+
+  Args:
+    update: Function that modifies a ServingGeneration object in place.
+
+  Returns:
+    The new generation (int)
+  """
+  # Make sure the singleton exists, since it can't be built in a transaction.
+  _GetServingGeneration()
+
+  def Transaction():
+    serving = ServingGeneration.get_by_key_name(_SERVING_GENERATION_KEY_NAME)
+    update(serving)
+    serving.generation += 1
+    serving.put()
+    return serving
+
+  serving = db.run_in_transaction(Transaction)
+  memcache.set_multi({
+      _SERVING_CRAWLS_MEMCACHE_KEY: (serving.generation, serving.crawls),
+      _SERVING_GENERATION_MEMCACHE_KEY: serving.generation})
+  return serving.generation
+
+
+def _GetServingGeneration():
+  """Returns the ServingGeneration, building it from the feeds if necessary.
+
+  Returns:
+    ServingGeneration object
+  """
+  serving = ServingGeneration.get_by_key_name(_SERVING_GENERATION_KEY_NAME)
+  if serving:
+    return serving
+  feed_keys, crawl_keys = _ScanLastCrawls()
+  logging.info('Building ServingGeneration from %d feeds', len(feed_keys))
+  return ServingGeneration.get_or_insert(
+      _SERVING_GENERATION_KEY_NAME, feeds=feed_keys, crawls=crawl_keys)
+
+
+def _ScanLastCrawls():
+  """Reads the last completed crawl of every root feed.
+
+  Returns:
+    (feed_keys, crawl_keys), parallel lists of db.Key for the root feeds that
+    have been crawled.
   """
   # We only need to look at root feeds, because the children are only
   # crawled when their root is crawled.
   query = Feed.gql('WHERE is_root = :1', True)
-  crawls = set()
+  feed_keys = []
+  crawl_keys = []
   limit = 100
   offset = 0
   while True:
     feeds = query.fetch(limit, offset=offset)
     offset += limit
-    if feeds:
-      for feed in feeds:
-        crawl = feed.last_crawl
-        if crawl:
-          crawls.add(crawl.key())
-    else:
-      return crawls
+    if not feeds:
+      return feed_keys, crawl_keys
+    for feed in feeds:
+      crawl_key = Feed.last_crawl.get_value_for_datastore(feed)
+      if crawl_key:
+        feed_keys.append(feed.key())
+        crawl_keys.append(crawl_key)
 
 
 # TODO(Matt Frantz): Remove obsolete models, which are sticking around only to
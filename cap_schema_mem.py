@@ -128,6 +128,18 @@ def FilteredList(model_name):
       else:
         return super(TheList, self).__contains__(obj)
 
+    def IsFiltered(self):
+      """Determines if the query hides any of the elements.
+
+      Returns:
+        True iff at least one element is rejected by the query.
+      """
+      query = self.__Query()
+      if query:
+        return len(self) < super(TheList, self).__len__()
+      else:
+        return False
+
   return TheList
 
 
@@ -206,6 +218,10 @@ class ShadowArea(caplib.Area):
   polygon = caplib.ListProperty(ShadowObjectList, ShadowPolygon)
   circle = caplib.ListProperty(ShadowObjectList, ShadowCircle)
 
+  # packed_geometry.PackedArea, if the area was made from stored geometry, in
+  # which case polygon and circle are empty.  See packed_geometry.AreaGeometry.
+  geometry = None
+
 
 class ShadowResource(caplib.Resource):
   pass
@@ -231,3 +247,20 @@ class ShadowAlert(caplib.Alert):
 
   references = caplib.ListProperty(caplib.ReferenceList, ShadowReference)
   info = caplib.ListProperty(FilteredListForCapAlert, ShadowInfo)
+
+  # packed_geometry.PackedAlert, if the alert was made from stored geometry.
+  geometry = None
+
+  def IsFiltered(self):
+    """Determines if the query hides any of the info or area elements.
+
+    Returns:
+      True iff the filtered alert differs from the alert as it was crawled in
+      its info or area elements.
+    """
+    if self.info.IsFiltered():
+      return True
+    for info in self.info:
+      if info.area.IsFiltered():
+        return True
+    return False
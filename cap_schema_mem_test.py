@@ -87,6 +87,47 @@ class CapSchemaMemTest(googletest.TestCase):
 
     self.assertListEqual([x.size for x in info.resource], [12, 78])
 
+  def testShadowAlert_isFilteredByInfo(self):
+    predicate = web_query.SimpleComparisonPredicate(
+        'CapAlert', 'urgency', 'Future', self.equals)
+    query = web_query.Query([predicate])
+    alert = cap_schema_mem.ShadowAlert(query=query)
+
+    info = cap_schema_mem.ShadowInfo(query=query)
+    info.urgency = 'Future'
+    alert.info.append(info)
+    self.assertFalse(alert.IsFiltered())
+
+    info = cap_schema_mem.ShadowInfo(query=query)
+    info.urgency = 'Past'
+    alert.info.append(info)
+    self.assertTrue(alert.IsFiltered())
+
+  def testShadowAlert_isFilteredByArea(self):
+    predicate = web_query.SimpleComparisonPredicate(
+        'CapAlert', 'areaDesc', 'foo', self.equals)
+    query = web_query.Query([predicate])
+    alert = cap_schema_mem.ShadowAlert(query=query)
+    info = cap_schema_mem.ShadowInfo(query=query)
+    alert.info.append(info)
+
+    area = cap_schema_mem.ShadowArea()
+    area.areaDesc = 'foo'
+    info.area.append(area)
+    self.assertFalse(alert.IsFiltered())
+
+    area = cap_schema_mem.ShadowArea()
+    area.areaDesc = 'bar'
+    info.area.append(area)
+    self.assertTrue(alert.IsFiltered())
+
+  def testShadowAlert_isFilteredWithoutQuery(self):
+    alert = cap_schema_mem.ShadowAlert()
+    info = cap_schema_mem.ShadowInfo()
+    info.urgency = 'Past'
+    alert.info.append(info)
+    self.assertFalse(alert.IsFiltered())
+
 
 def main(unused_argv):
   googletest.main()
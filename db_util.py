@@ -55,6 +55,29 @@ def ModelAsDict(model_class, model):
   return props
 
 
+def CloneModel(model_class, model, **kwargs):
+  """Makes an unsaved copy of a db.Model without dereferencing references.
+
+  Args:
+    model_class: db.Model subclass
+    model: db.Model object
+    kwargs: Property values that override those copied from model.
+
+  Returns:
+    New model_class object (not saved).
+  """
+  props = {}
+  for name, prop in model_class.properties().iteritems():
+    # For a ReferenceProperty, this is the key, so the referent is not fetched.
+    value = prop.get_value_for_datastore(model)
+    if isinstance(value, list):
+      # Don't let the copy share a list with the original.
+      value = list(value)
+    props[name] = value
+  props.update(kwargs)
+  return model_class(**props)
+
+
 def SafelyDereference(model, property_name):
   """Safely dereference a property that may be a Reference.
 
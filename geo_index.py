@@ -0,0 +1,531 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spatial index of CAP areas, based on geohash cells.
+
+Each CAP area shape (polygon or circle) is approximated by its bounding box,
+which is covered by a few geohash cells.  The finest level (number of geohash
+characters) whose covering has at most MAX_SHAPE_CELLS cells is chosen, so
+small shapes are covered by small cells and large shapes by large ones.
+
+The covering is stored as a list of tokens (see AlertTokens), so that the
+Datastore can find the alerts that may intersect a query box with an "IN"
+filter on the tokens of the query box (see BoxTokens).  A shape covered at
+level P stores its cells and all of their prefixes, which match query cells
+at levels up to P.  It also stores its cells with a TERMINAL suffix, which
+match query cells at finer levels, since the query includes the prefixes of
+its cells with that suffix.
+
+The index only narrows the candidates.  AreaIntersectsBoxes decides exactly
+whether an area intersects the query box, using the packed shapes of the area
+(see packed_geometry), whose bounding boxes reject most shapes cheaply.
+
+Boxes are (south, west, north, east) tuples of decimal degrees (WGS-84), with
+west <= east.  Boxes that cross the 180th meridian are split in two.
+"""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import math
+
+try:
+  from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
+except ImportError:
+  import packed_geometry
+
+
+# Version of the index tokens.  Increment this whenever the tokens change, so
+# that they are recomputed.
+VERSION = 1
+
+# Finest geohash level (about 4.9km by 4.9km).
+MAX_LEVEL = 5
+
+# Most cells in the covering of a single shape.
+MAX_SHAPE_CELLS = 16
+
+# Most cells in the covering of a query box.  Each one, and each of their
+# prefixes, becomes a value of an "IN" filter, so this must stay small.
+MAX_QUERY_CELLS = 4
+
+# Most tokens of a query box.  The Datastore runs a subquery for each value of
+# an "IN" filter, and allows no more than this many subqueries.
+MAX_QUERY_TOKENS = 30
+
+# Suffix of the tokens of the cells at which a covering stops.
+TERMINAL = '*'
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def Encode(latitude, longitude, level):
+  """Returns the geohash of a point.
+
+  Args:
+    latitude: Decimal degrees (float)
+    longitude: Decimal degrees (float)
+    level: Number of characters (int)
+
+  Returns:
+    Geohash (str)
+  """
+  south, north = -90.0, 90.0
+  west, east = -180.0, 180.0
+  chars = []
+  bits = 0
+  bit_count = 0
+  is_longitude = True
+  while len(chars) < level:
+    if is_longitude:
+      middle = (west + east) / 2
+      if longitude >= middle:
+        bits = bits * 2 + 1
+        west = middle
+      else:
+        bits *= 2
+        east = middle
+    else:
+      middle = (south + north) / 2
+      if latitude >= middle:
+        bits = bits * 2 + 1
+        south = middle
+      else:
+        bits *= 2
+        north = middle
+    is_longitude = not is_longitude
+    bit_count += 1
+    if bit_count == 5:
+      chars.append(_BASE32[bits])
+      bits = 0
+      bit_count = 0
+  return ''.join(chars)
+
+
+def CellBox(cell):
+  """Returns the box of a geohash cell.
+
+  Args:
+    cell: Geohash (str)
+
+  Returns:
+    (south, west, north, east)
+  """
+  south, north = -90.0, 90.0
+  west, east = -180.0, 180.0
+  is_longitude = True
+  for char in cell:
+    bits = _BASE32.index(char)
+    for shift in (4, 3, 2, 1, 0):
+      bit = (bits >> shift) & 1
+      if is_longitude:
+        middle = (west + east) / 2
+        if bit:
+          west = middle
+        else:
+          east = middle
+      else:
+        middle = (south + north) / 2
+        if bit:
+          south = middle
+        else:
+          north = middle
+      is_longitude = not is_longitude
+  return south, west, north, east
+
+
+def _CellSize(level):
+  """Returns the size of the cells of a level.
+
+  Args:
+    level: Number of geohash characters (int)
+
+  Returns:
+    (height, width) in degrees
+  """
+  bits = 5 * level
+  longitude_bits = (bits + 1) / 2
+  latitude_bits = bits / 2
+  return 180.0 / 2 ** latitude_bits, 360.0 / 2 ** longitude_bits
+
+
+def _CellRange(low, high, size, origin):
+  """Returns the indexes of the cells that span an interval.
+
+  Args:
+    low: Start of the interval (float)
+    high: End of the interval (float)
+    size: Cell size (float)
+    origin: Start of the first cell (float)
+
+  Returns:
+    (first, last) cell indexes (int)
+  """
+  count = int(round(-2 * origin / size))
+  first = min(count - 1, int(math.floor((low - origin) / size)))
+  last = min(count - 1, int(math.floor((high - origin) / size)))
+  return max(0, first), max(0, last)
+
+
+def _Covering(boxes, level):
+  """Returns the cells of a level that cover boxes.
+
+  Args:
+    boxes: List of (south, west, north, east)
+    level: Number of geohash characters (int)
+
+  Returns:
+    Set of geohashes (str)
+  """
+  height, width = _CellSize(level)
+  cells = set()
+  for south, west, north, east in boxes:
+    first_row, last_row = _CellRange(south, north, height, -90.0)
+    first_column, last_column = _CellRange(west, east, width, -180.0)
+    for row in xrange(first_row, last_row + 1):
+      latitude = -90.0 + (row + 0.5) * height
+      for column in xrange(first_column, last_column + 1):
+        longitude = -180.0 + (column + 0.5) * width
+        cells.add(Encode(latitude, longitude, level))
+  return cells
+
+
+def _CoveringSize(boxes, level):
+  """Returns an upper bound on the number of cells of a level that cover boxes.
+
+  Args:
+    boxes: List of (south, west, north, east)
+    level: Number of geohash characters (int)
+
+  Returns:
+    int
+  """
+  height, width = _CellSize(level)
+  size = 0
+  for south, west, north, east in boxes:
+    first_row, last_row = _CellRange(south, north, height, -90.0)
+    first_column, last_column = _CellRange(west, east, width, -180.0)
+    size += (last_row - first_row + 1) * (last_column - first_column + 1)
+  return size
+
+
+def Cover(boxes, max_cells):
+  """Covers boxes with geohash cells, as finely as possible.
+
+  Args:
+    boxes: List of (south, west, north, east)
+    max_cells: Most cells in the covering, unless even the coarsest level
+        needs more (int)
+
+  Returns:
+    (level, cells)
+    level: Number of geohash characters (int)
+    cells: Set of geohashes (str)
+  """
+  level = 1
+  while (level < MAX_LEVEL and
+         _CoveringSize(boxes, level + 1) <= max_cells):
+    level += 1
+  return level, _Covering(boxes, level)
+
+
+def _ShapeTokens(boxes):
+  """Returns the index tokens of a shape.
+
+  Args:
+    boxes: Bounding boxes of the shape (list of (south, west, north, east))
+
+  Returns:
+    Set of tokens (str)
+  """
+  level, cells = Cover(boxes, MAX_SHAPE_CELLS)
+  tokens = set()
+  for cell in cells:
+    for length in xrange(1, level + 1):
+      tokens.add(cell[:length])
+    if level < MAX_LEVEL:
+      tokens.add(cell + TERMINAL)
+  return tokens
+
+
+def BoxTokens(boxes, max_tokens=MAX_QUERY_TOKENS):
+  """Returns the index tokens that find the shapes that may intersect boxes.
+
+  If the covering has too many tokens, coarser ones are tried.
+
+  Args:
+    boxes: List of (south, west, north, east)
+    max_tokens: Most tokens to return (int)
+
+  Returns:
+    Sorted list of tokens (str), or None if even the coarsest covering has
+    more than max_tokens, in which case the index cannot narrow the query.
+  """
+  level, cells = Cover(boxes, MAX_QUERY_CELLS)
+  while True:
+    tokens = set()
+    for cell in cells:
+      tokens.add(cell)
+      for length in xrange(1, level):
+        tokens.add(cell[:length] + TERMINAL)
+    if len(tokens) <= max_tokens:
+      return sorted(tokens)
+    if level == 1:
+      return None
+    level -= 1
+    cells = _Covering(boxes, level)
+
+
+def AlertTokens(alert):
+  """Returns the index tokens of the areas of an alert.
+
+  Args:
+    alert: caplib.Alert object
+
+  Returns:
+    Sorted list of tokens (str)
+  """
+  tokens = set()
+  for info in alert.info:
+    for area in info.area:
+      for boxes in AreaBoxes(area):
+        tokens.update(_ShapeTokens(boxes))
+  return sorted(tokens)
+
+
+def AreaBoxes(area):
+  """Returns the bounding boxes of the shapes of an area.
+
+  Shapes that are malformed are ignored.
+
+  Args:
+    area: caplib.Area object
+
+  Returns:
+    List with a list of boxes (south, west, north, east) for each shape.
+  """
+  geometry = packed_geometry.AreaGeometry(area)
+  shapes = []
+  for polygon in geometry.polygons:
+    shapes.append(_SplitBox(*polygon.box))
+  for circle in geometry.circles:
+    # Split the circle's box at the 180th meridian, rather than use its
+    # packed box, which spans all longitudes in that case.
+    height = circle.radius / packed_geometry.KM_PER_DEGREE
+    width = packed_geometry.LongitudeDegrees(circle.radius, circle.latitude)
+    shapes.append(_SplitBox(circle.latitude - height, circle.longitude - width,
+                            circle.latitude + height, circle.longitude + width))
+  return shapes
+
+
+def ParseBox(text):
+  """Parses a bounding box as written in KML view formats.
+
+  Args:
+    text: "west,south,east,north" in decimal degrees (str or unicode)
+
+  Returns:
+    List of (south, west, north, east), with two boxes if the box crosses the
+    180th meridian.
+
+  Raises:
+    ValueError: if the text is not a valid box.
+  """
+  try:
+    west, south, east, north = [float(x) for x in text.split(',')]
+  except ValueError:
+    raise ValueError('Bounding box %r is not west,south,east,north' % text)
+  if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and
+          -180 <= east <= 180):
+    raise ValueError('Bounding box %r is out of range' % text)
+  if west <= east:
+    return [(south, west, north, east)]
+  else:
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def AreaIntersectsBoxes(area, boxes):
+  """Determines if any shape of an area intersects any of some boxes.
+
+  Args:
+    area: caplib.Area object
+    boxes: List of (south, west, north, east)
+
+  Returns:
+    bool
+  """
+  geometry = packed_geometry.AreaGeometry(area)
+  if not packed_geometry.BoxesIntersect(geometry.box, boxes):
+    return False
+  for polygon in geometry.polygons:
+    if packed_geometry.BoxesIntersect(polygon.box, boxes):
+      points = polygon.Vertices()
+      for box in boxes:
+        if _PolygonIntersectsBox(points, box):
+          return True
+  for circle in geometry.circles:
+    if packed_geometry.BoxesIntersect(circle.box, boxes):
+      for box in boxes:
+        if _CircleIntersectsBox(circle, box):
+          return True
+  return False
+
+
+def _SplitBox(south, west, north, east):
+  """Clips a box to valid coordinates, splitting it at the 180th meridian.
+
+  Args:
+    south, west, north, east: Decimal degrees, where west and east may extend
+        past +/-180 (float).
+
+  Returns:
+    List of (south, west, north, east)
+  """
+  south = max(-90.0, south)
+  north = min(90.0, north)
+  if east - west >= 360:
+    return [(south, -180.0, north, 180.0)]
+  boxes = []
+  if west < -180:
+    boxes.append((south, west + 360, north, 180.0))
+    west = -180.0
+  if east > 180:
+    boxes.append((south, -180.0, north, east - 360))
+    east = 180.0
+  boxes.append((south, west, north, east))
+  return boxes
+
+
+def _BoxContains(box, latitude, longitude):
+  south, west, north, east = box
+  return south <= latitude <= north and west <= longitude <= east
+
+
+def _PolygonIntersectsBox(points, box):
+  """Determines if a polygon intersects a box.
+
+  Args:
+    points: Vertices of the polygon (list of (latitude, longitude))
+    box: (south, west, north, east)
+
+  Returns:
+    bool
+  """
+  # A vertex of the polygon is in the box.
+  for latitude, longitude in points:
+    if _BoxContains(box, latitude, longitude):
+      return True
+  # A corner of the box is in the polygon, e.g. the polygon contains the box.
+  south, west, north, east = box
+  corners = [(south, west), (south, east), (north, east), (north, west)]
+  for latitude, longitude in corners:
+    if _PolygonContains(points, latitude, longitude):
+      return True
+  # Otherwise, they intersect only if their edges cross.
+  box_edges = zip(corners, corners[1:] + corners[:1])
+  for edge in zip(points, points[1:] + points[:1]):
+    for box_edge in box_edges:
+      if _SegmentsIntersect(edge, box_edge):
+        return True
+  return False
+
+
+def _PolygonContains(points, latitude, longitude):
+  """Determines if a point is inside a polygon, by the even-odd rule.
+
+  Args:
+    points: Vertices of the polygon (list of (latitude, longitude))
+    latitude: Decimal degrees (float)
+    longitude: Decimal degrees (float)
+
+  Returns:
+    bool
+  """
+  is_inside = False
+  for (lat1, lon1), (lat2, lon2) in zip(points, points[1:] + points[:1]):
+    if (lat1 > latitude) != (lat2 > latitude):
+      crossing = lon1 + (latitude - lat1) * (lon2 - lon1) / (lat2 - lat1)
+      if longitude < crossing:
+        is_inside = not is_inside
+  return is_inside
+
+
+def _SegmentsIntersect(segment1, segment2):
+  """Determines if two line segments intersect (including touching).
+
+  Args:
+    segment1: ((y, x), (y, x))
+    segment2: ((y, x), (y, x))
+
+  Returns:
+    bool
+  """
+  p1, p2 = segment1
+  p3, p4 = segment2
+  d1 = _Cross(p3, p4, p1)
+  d2 = _Cross(p3, p4, p2)
+  d3 = _Cross(p1, p2, p3)
+  d4 = _Cross(p1, p2, p4)
+  if ((d1 > 0 and d2 < 0 or d1 < 0 and d2 > 0) and
+      (d3 > 0 and d4 < 0 or d3 < 0 and d4 > 0)):
+    return True
+  return ((d1 == 0 and _OnSegment(p3, p4, p1)) or
+          (d2 == 0 and _OnSegment(p3, p4, p2)) or
+          (d3 == 0 and _OnSegment(p1, p2, p3)) or
+          (d4 == 0 and _OnSegment(p1, p2, p4)))
+
+
+def _Cross(origin, a, b):
+  return ((a[0] - origin[0]) * (b[1] - origin[1]) -
+          (a[1] - origin[1]) * (b[0] - origin[0]))
+
+
+def _OnSegment(a, b, point):
+  return (min(a[0], b[0]) <= point[0] <= max(a[0], b[0]) and
+          min(a[1], b[1]) <= point[1] <= max(a[1], b[1]))
+
+
+def _CircleIntersectsBox(circle, box):
+  """Determines if a circle intersects a box.
+
+  Distances are approximated on a plane tangent to the circle's center, which
+  is accurate for the sizes of CAP circles.
+
+  Args:
+    circle: packed_geometry.PackedCircle object
+    box: (south, west, north, east)
+
+  Returns:
+    bool
+  """
+  latitude = circle.latitude
+  longitude = circle.longitude
+  radius = circle.radius
+  south, west, north, east = box
+  nearest_latitude = min(max(latitude, south), north)
+  if west <= longitude <= east:
+    longitude_difference = 0
+  else:
+    # Measure the short way around, in case the box is across the 180th
+    # meridian from the center.
+    longitude_difference = 360
+    for edge in (west, east):
+      difference = abs(longitude - edge)
+      longitude_difference = min(longitude_difference, difference,
+                                 360 - difference)
+  dy = (latitude - nearest_latitude) * packed_geometry.KM_PER_DEGREE
+  dx = (longitude_difference * packed_geometry.KM_PER_DEGREE *
+        math.cos(math.radians(latitude)))
+  return dx * dx + dy * dy <= radius * radius
@@ -0,0 +1,201 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for geo_index."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+import cap as caplib
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import geo_index
+from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
+
+
+def _Alert(polygons=(), circles=()):
+  """Makes an alert with one area.
+
+  Args:
+    polygons: Polygons for caplib.Polygon.fromString (list of str)
+    circles: Circles for caplib.Circle.fromString (list of str)
+
+  Returns:
+    caplib.Alert object
+  """
+  alert = caplib.Alert()
+  info = caplib.Info()
+  alert.info.append(info)
+  area = caplib.Area()
+  info.area.append(area)
+  for polygon in polygons:
+    area.polygon.append(caplib.Polygon.fromString(polygon))
+  for circle in circles:
+    area.circle.append(caplib.Circle.fromString(circle))
+  return alert
+
+
+class _PackedArea(object):
+  """Stands in for an area made from stored geometry by cap_parse_mem."""
+
+  polygon = ()
+  circle = ()
+
+  def __init__(self, geometry):
+    self.geometry = geometry
+
+
+# Boulder, Colorado, and Colorado.
+_SMALL_POLYGON = '40.0,-105.3 40.1,-105.3 40.1,-105.2 40.0,-105.2 40.0,-105.3'
+_LARGE_POLYGON = '37,-109 41,-109 41,-102 37,-102 37,-109'
+# Denver, Colorado.
+_CIRCLE = '39.74,-104.99 10'
+
+
+class GeohashTest(googletest.TestCase):
+  """Tests for geo_index.Encode and geo_index.CellBox."""
+
+  def testEncode(self):
+    self.assertEquals('u4pruydqqvj', geo_index.Encode(57.64911, 10.40744, 11))
+    self.assertEquals('9xj5', geo_index.Encode(40.05, -105.27, 4))
+
+  def testCellBox(self):
+    south, west, north, east = geo_index.CellBox('u4pru')
+    self.assertTrue(south <= 57.64911 <= north)
+    self.assertTrue(west <= 10.40744 <= east)
+    self.assertAlmostEqual(0.0439453125, north - south)
+
+
+class ParseBoxTest(googletest.TestCase):
+  """Tests for geo_index.ParseBox."""
+
+  def testParseBox(self):
+    self.assertEquals([(40.0, -106.0, 41.0, -105.0)],
+                      geo_index.ParseBox('-106,40,-105,41'))
+
+  def testParseBox_antimeridian(self):
+    self.assertEquals([(-10.0, 170.0, 10.0, 180.0),
+                       (-10.0, -180.0, 10.0, -170.0)],
+                      geo_index.ParseBox('170,-10,-170,10'))
+
+  def testParseBox_invalid(self):
+    for text in ['', '1,2,3', 'a,b,c,d', '-106,41,-105,40', '0,-91,1,0']:
+      self.assertRaises(ValueError, geo_index.ParseBox, text)
+
+
+class TokensTest(googletest.TestCase):
+  """Tests for geo_index.AlertTokens and geo_index.BoxTokens."""
+
+  def _Matches(self, alert, box_text):
+    """Determines if the index finds an alert for a box.
+
+    Args:
+      alert: caplib.Alert object
+      box_text: Argument of geo_index.ParseBox
+
+    Returns:
+      True iff the alert's tokens match the box's tokens.
+    """
+    boxes = geo_index.ParseBox(box_text)
+    return bool(set(geo_index.AlertTokens(alert)) &
+                set(geo_index.BoxTokens(boxes)))
+
+  def testSmallBoxFindsLargeShape(self):
+    alert = _Alert(polygons=[_LARGE_POLYGON])
+    self.assertTrue(self._Matches(alert, '-104.6,38.5,-104.5,38.6'))
+    self.assertFalse(self._Matches(alert, '-80,30,-70,40'))
+
+  def testLargeBoxFindsSmallShape(self):
+    alert = _Alert(polygons=[_SMALL_POLYGON])
+    self.assertTrue(self._Matches(alert, '-110,30,-90,45'))
+    self.assertTrue(self._Matches(alert, '-105.28,40.01,-105.25,40.05'))
+    self.assertFalse(self._Matches(alert, '-104.6,38.5,-104.5,38.6'))
+
+  def testCircle(self):
+    alert = _Alert(circles=[_CIRCLE])
+    self.assertTrue(self._Matches(alert, '-105.0,39.7,-104.95,39.75'))
+    self.assertFalse(self._Matches(alert, '-105.28,40.01,-105.25,40.05'))
+
+  def testNoAreas(self):
+    self.assertEquals([], geo_index.AlertTokens(_Alert()))
+
+  def testBoxTokensAreFew(self):
+    boxes = geo_index.ParseBox('-105.0,39.7,-104.95,39.75')
+    self.assertTrue(
+        len(geo_index.BoxTokens(boxes)) <=
+        geo_index.MAX_QUERY_CELLS * geo_index.MAX_LEVEL)
+
+  def testBoxTokens_world(self):
+    # Even the coarsest covering of the world has a token for every cell.
+    boxes = geo_index.ParseBox('-180,-90,180,90')
+    self.assertEquals(None, geo_index.BoxTokens(boxes))
+    self.assertEquals(32, len(geo_index.BoxTokens(boxes, max_tokens=32)))
+
+  def testBoxTokens_coarserWhenLimited(self):
+    boxes = geo_index.ParseBox('-105.0,39.7,-104.95,39.75')
+    fine_tokens = geo_index.BoxTokens(boxes)
+    coarse_tokens = geo_index.BoxTokens(boxes, max_tokens=2)
+    self.assertTrue(len(coarse_tokens) <= 2 < len(fine_tokens))
+    # The coarse covering still finds the shapes that the fine one does.
+    alert = _Alert(circles=[_CIRCLE])
+    self.assertTrue(set(geo_index.AlertTokens(alert)) & set(coarse_tokens))
+
+
+class AreaIntersectsBoxesTest(googletest.TestCase):
+  """Tests for geo_index.AreaIntersectsBoxes."""
+
+  def _Intersects(self, alert, box_text):
+    area = alert.info[0].area[0]
+    return geo_index.AreaIntersectsBoxes(area, geo_index.ParseBox(box_text))
+
+  def testPolygon(self):
+    alert = _Alert(polygons=[_SMALL_POLYGON])
+    # Vertex in the box.
+    self.assertTrue(self._Intersects(alert, '-105.35,39.95,-105.25,40.05'))
+    # Box in the polygon.
+    self.assertTrue(self._Intersects(alert, '-105.26,40.04,-105.25,40.05'))
+    # Edges cross.
+    self.assertTrue(self._Intersects(alert, '-105.4,40.04,-105.1,40.05'))
+    # Disjoint.
+    self.assertFalse(self._Intersects(alert, '-106,40.2,-105,41'))
+
+  def testCircle(self):
+    alert = _Alert(circles=[_CIRCLE])
+    self.assertTrue(self._Intersects(alert, '-105.0,39.7,-104.95,39.75'))
+    # Inside the circle's bounding box, but beyond its radius.
+    self.assertFalse(self._Intersects(alert, '-104.9,39.8,-104.87,39.82'))
+
+  def testPackedArea(self):
+    alert = _Alert(polygons=[_SMALL_POLYGON], circles=[_CIRCLE])
+    area = _PackedArea(packed_geometry.PackArea(alert.info[0].area[0]))
+    self.assertTrue(geo_index.AreaIntersectsBoxes(
+        area, geo_index.ParseBox('-105.26,40.04,-105.25,40.05')))
+    self.assertTrue(geo_index.AreaIntersectsBoxes(
+        area, geo_index.ParseBox('-105.0,39.7,-104.95,39.75')))
+    self.assertFalse(geo_index.AreaIntersectsBoxes(
+        area, geo_index.ParseBox('-106,40.2,-105,41')))
+    self.assertEquals(geo_index.AreaBoxes(alert.info[0].area[0]),
+                      geo_index.AreaBoxes(area))
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -0,0 +1,214 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-host politeness for crawl fetches.
+
+Limits how hard the crawler hits any one origin, no matter how many of its
+URL's are waiting in the task queues.  Each host has a budget of fetches in
+progress at once and of fetches started per time window.  The budgets are
+tracked in memcache, so they are shared by all crawl workers.  A fetch that
+would exceed its host's budget is not refused; instead, the caller is told how
+long to wait before trying again.
+
+If memcache evicts a counter, that host's budget is briefly more generous than
+configured, which is acceptable for politeness.
+"""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import logging
+import math
+import time
+import urlparse
+
+try:
+  # google3
+  from google3.apphosting.api import memcache
+  from google3.pyglib import logging
+
+except ImportError:
+  from google.appengine.api import memcache
+
+
+class HostLimits(object):
+  """Fetch budget for a single host.
+
+  Attributes:
+    max_concurrent: Maximum number of fetches in progress at once (int)
+    max_per_window: Maximum number of fetches started per window (int)
+    window_secs: Length of the rate limiting window in seconds (int)
+  """
+
+  def __init__(self, max_concurrent, max_per_window, window_secs=60):
+    self.max_concurrent = max_concurrent
+    self.max_per_window = max_per_window
+    self.window_secs = window_secs
+
+
+# Budget for any host that is not listed in HOST_LIMITS.
+DEFAULT_HOST_LIMITS = HostLimits(max_concurrent=4, max_per_window=60)
+
+# Budgets for hosts (lowercase, including any port) that need something other
+# than DEFAULT_HOST_LIMITS.
+HOST_LIMITS = {}
+
+# A fetch that is never released (e.g. because its request died) stops
+# counting against the concurrency budget once no fetch of its host has started
+# or finished for this long.
+ACTIVE_FETCH_TIMEOUT_SECS = 60
+
+# How long to wait before retrying a host that has too many fetches in
+# progress.
+CONCURRENCY_RETRY_SECS = 10
+
+# Prefix for all memcache keys used by this module.
+_KEY_PREFIX = 'host_throttle'
+
+
+def GetHost(url):
+  """Extracts the host from a URL.
+
+  Args:
+    url: URL (str)
+
+  Returns:
+    Lowercase host, including any port (str)
+  """
+  return urlparse.urlparse(url)[1].lower()
+
+
+def GetHostLimits(host):
+  """Returns the fetch budget of a host.
+
+  Args:
+    host: Result of GetHost (str)
+
+  Returns:
+    HostLimits object
+  """
+  return HOST_LIMITS.get(host, DEFAULT_HOST_LIMITS)
+
+
+def _RateKey(host, window):
+  """Returns the memcache key of the count of fetches started in a window.
+
+  Args:
+    host: Result of GetHost (str)
+    window: Index of the rate limiting window since the epoch (int)
+
+  Returns:
+    Memcache key (str)
+  """
+  return '%s rate %s %d' % (_KEY_PREFIX, host, window)
+
+
+def _ActiveKey(host):
+  """Returns the memcache key of the count of fetches in progress.
+
+  Args:
+    host: Result of GetHost (str)
+
+  Returns:
+    Memcache key (str)
+  """
+  return '%s active %s' % (_KEY_PREFIX, host)
+
+
+def _ActivityKey(host):
+  """Returns the memcache key of the time a fetch last started or finished.
+
+  Args:
+    host: Result of GetHost (str)
+
+  Returns:
+    Memcache key (str)
+  """
+  return '%s activity %s' % (_KEY_PREFIX, host)
+
+
+def _Increment(key, timeout_secs):
+  """Atomically increments a memcache counter, creating it if necessary.
+
+  Args:
+    key: Memcache key (str)
+    timeout_secs: Expiration of the counter, if it is created (int), or 0 for
+        none
+
+  Returns:
+    New value of the counter (int), or None if memcache is unavailable.
+  """
+  memcache.add(key, 0, time=timeout_secs)
+  return memcache.incr(key)
+
+
+def Acquire(url, _time=time.time):
+  """Reserves a fetch of a URL within its host's budget.
+
+  Args:
+    url: URL to be fetched (str)
+    _time: dependency injection of clock function that returns seconds since
+        the epoch (float)
+
+  Returns:
+    0 if the fetch may proceed now, in which case Release must be called when
+    it is done.  Otherwise, the number of seconds to wait before trying again
+    (int).
+  """
+  host = GetHost(url)
+  limits = GetHostLimits(host)
+  now = _time()
+  window = int(now // limits.window_secs)
+  rate_key = _RateKey(host, window)
+  count = _Increment(rate_key, limits.window_secs * 2)
+  if count is not None and count > limits.max_per_window:
+    # Give back what we took, and wait for the next window.
+    memcache.decr(rate_key)
+    wait_secs = int(math.ceil((window + 1) * limits.window_secs - now))
+    logging.debug('Host %s over rate budget; wait %d secs', host, wait_secs)
+    return max(1, wait_secs)
+
+  # The count of fetches in progress does not expire while they are starting
+  # and finishing, since memcache.incr does not extend its expiration.
+  active_key = _ActiveKey(host)
+  activity_key = _ActivityKey(host)
+  last_activity = memcache.get(activity_key)
+  if (last_activity is None or
+      now - last_activity > ACTIVE_FETCH_TIMEOUT_SECS):
+    # Any fetches that are still counted were never released.
+    memcache.set(active_key, 0)
+  active = _Increment(active_key, 0)
+  if active is not None and active > limits.max_concurrent:
+    # Give back what we took, including the unused part of the rate budget.
+    memcache.decr(active_key)
+    memcache.decr(rate_key)
+    logging.debug('Host %s over concurrency budget', host)
+    return CONCURRENCY_RETRY_SECS
+
+  memcache.set(activity_key, now, time=ACTIVE_FETCH_TIMEOUT_SECS)
+  return 0
+
+
+def Release(url, _time=time.time):
+  """Indicates that a fetch reserved by Acquire is done.
+
+  Args:
+    url: URL that was fetched (str)
+    _time: dependency injection of clock function that returns seconds since
+        the epoch (float)
+  """
+  host = GetHost(url)
+  memcache.decr(_ActiveKey(host))
+  memcache.set(_ActivityKey(host), _time(), time=ACTIVE_FETCH_TIMEOUT_SECS)
@@ -0,0 +1,116 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for host_throttle."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+import mox
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import host_throttle
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
+
+
+class HostThrottleTest(mox.MoxTestBase, memcache_test_util.MemcacheTestBase):
+  """Tests for host_throttle."""
+
+  def setUp(self):
+    super(HostThrottleTest, self).setUp()
+    self.mox.StubOutWithMock(host_throttle, 'logging')
+    self.limits = host_throttle.HostLimits(
+        max_concurrent=2, max_per_window=3, window_secs=60)
+    self.host = 'slow.example.gov'
+    self.url = 'http://SLOW.example.gov/cap/feed.xml'
+    self.stubs.Set(host_throttle, 'HOST_LIMITS', {self.host: self.limits})
+    # A time in the middle of a window.
+    self.now = 6000.0 + 15
+
+  def _Now(self):
+    return self.now
+
+  def testGetHost(self):
+    self.assertEquals(self.host, host_throttle.GetHost(self.url))
+    self.assertEquals('foo:8080', host_throttle.GetHost('http://foo:8080/x'))
+
+  def testGetHostLimits(self):
+    self.assertTrue(host_throttle.GetHostLimits(self.host) is self.limits)
+    self.assertTrue(host_throttle.GetHostLimits('other') is
+                    host_throttle.DEFAULT_HOST_LIMITS)
+
+  def testAcquire_concurrency(self):
+    host_throttle.logging.debug(mox.StrContains('concurrency'), self.host)
+    self.mox.ReplayAll()
+
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    self.assertEquals(host_throttle.CONCURRENCY_RETRY_SECS,
+                      host_throttle.Acquire(self.url, _time=self._Now))
+    # After one is released, there's room for another.
+    host_throttle.Release(self.url)
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+
+  def testAcquire_concurrencyOutlivesTimeout(self):
+    host_throttle.logging.debug(mox.StrContains('concurrency'), self.host)
+    self.mox.ReplayAll()
+
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    self.now += host_throttle.ACTIVE_FETCH_TIMEOUT_SECS - 10
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    # Both fetches still count, since the host has been busy.
+    self.now += host_throttle.ACTIVE_FETCH_TIMEOUT_SECS - 10
+    self.assertEquals(host_throttle.CONCURRENCY_RETRY_SECS,
+                      host_throttle.Acquire(self.url, _time=self._Now))
+
+  def testAcquire_unreleasedFetchesExpire(self):
+    self.mox.ReplayAll()
+
+    for i in xrange(2):
+      self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    # Neither fetch was released, but the host has been idle long enough.
+    self.now += host_throttle.ACTIVE_FETCH_TIMEOUT_SECS + 1
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+
+  def testAcquire_rate(self):
+    host_throttle.logging.debug(mox.StrContains('rate'), self.host, 45)
+    self.mox.ReplayAll()
+
+    for i in xrange(3):
+      self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+      host_throttle.Release(self.url)
+    # The window is exhausted, so wait for the next one.
+    self.assertEquals(45, host_throttle.Acquire(self.url, _time=self._Now))
+    self.now += 45
+    self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+
+  def testAcquire_hostsAreIndependent(self):
+    self.mox.ReplayAll()
+
+    for i in xrange(2):
+      self.assertEquals(0, host_throttle.Acquire(self.url, _time=self._Now))
+    self.assertEquals(
+        0, host_throttle.Acquire('http://other/', _time=self._Now))
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -0,0 +1,373 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact geometry of CAP areas.
+
+caplib parses each vertex of a CAP polygon into a Point object.  Weather
+alerts often have many polygons with hundreds of vertices, so building those
+objects for every query is expensive.  Instead, the crawler packs the shapes
+of each alert once (see PackAlert), and stores them in binary form with the
+alert (see Encode).  Queries decode them (see Decode) into arrays of floats,
+along with the bounding box of each shape, area, and alert, which the KML
+writer and the spatial filters use directly.
+
+Boxes are (south, west, north, east) tuples of decimal degrees (WGS-84), as
+in geo_index.  The box of a shape that crosses the 180th meridian spans all
+longitudes, so boxes are conservative, but never split.
+"""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import array
+import itertools
+import math
+import struct
+import sys
+
+
+# Version of the encoding.  Increment this whenever Encode changes, so that
+# stored geometry of an older version is ignored.
+VERSION = 1
+
+# Mean radius of the Earth in kilometers, which is the unit of CAP circles.
+EARTH_RADIUS_KM = 6371.0
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Encoded integers and floats are little-endian, whatever the platform.
+_COUNT = struct.Struct('<I')
+_BOX = struct.Struct('<4d')
+_CIRCLE = struct.Struct('<3d')
+_DOUBLE_SIZE = struct.calcsize('<d')
+
+
+class PackedPolygon(object):
+  """Vertices of a CAP polygon.
+
+  Attributes:
+    coordinates: Longitude and latitude of each vertex, in that order, as in
+        KML (array of 'd')
+    box: Bounding box (south, west, north, east)
+  """
+
+  def __init__(self, coordinates, box=None):
+    """Initializes a PackedPolygon object.
+
+    Args:
+      coordinates: Longitude, latitude pairs (array of 'd'), at least one.
+      box: Bounding box, if it is already known.
+    """
+    self.coordinates = coordinates
+    if box is None:
+      longitudes = list(itertools.islice(coordinates, 0, None, 2))
+      latitudes = list(itertools.islice(coordinates, 1, None, 2))
+      box = (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+    self.box = box
+
+  def __len__(self):
+    """Returns the number of vertices."""
+    return len(self.coordinates) / 2
+
+  def Vertices(self):
+    """Returns the vertices as a list of (latitude, longitude)."""
+    coordinates = self.coordinates
+    return zip(itertools.islice(coordinates, 1, None, 2),
+               itertools.islice(coordinates, 0, None, 2))
+
+
+class PackedCircle(object):
+  """Center and radius of a CAP circle.
+
+  Attributes:
+    latitude: Decimal degrees (float)
+    longitude: Decimal degrees (float)
+    radius: Kilometers (float)
+    box: Bounding box (south, west, north, east)
+  """
+
+  def __init__(self, latitude, longitude, radius):
+    self.latitude = latitude
+    self.longitude = longitude
+    self.radius = radius
+    height = radius / KM_PER_DEGREE
+    width = LongitudeDegrees(radius, latitude)
+    west = longitude - width
+    east = longitude + width
+    if west < -180 or east > 180:
+      west, east = -180.0, 180.0
+    self.box = (max(-90.0, latitude - height), west,
+                min(90.0, latitude + height), east)
+
+
+class PackedArea(object):
+  """Shapes of a CAP area.
+
+  Attributes:
+    polygons: List of PackedPolygon
+    circles: List of PackedCircle
+    box: Bounding box of all of the shapes, or None if there are none.
+  """
+
+  def __init__(self, polygons, circles, box=None):
+    self.polygons = polygons
+    self.circles = circles
+    if box is None:
+      box = UnionBox([x.box for x in polygons + circles])
+    self.box = box
+
+
+class PackedAlert(object):
+  """Shapes of the areas of a CAP alert.
+
+  Attributes:
+    infos: List with a list of PackedArea for each info element, in order.
+    box: Bounding box of all of the areas, or None if there are no shapes.
+  """
+
+  def __init__(self, infos, box=None):
+    self.infos = infos
+    if box is None:
+      areas = []
+      for areas_of_info in infos:
+        areas.extend(areas_of_info)
+      box = UnionBox([x.box for x in areas])
+    self.box = box
+
+
+def UnionBox(boxes):
+  """Returns the smallest box that contains some boxes.
+
+  Args:
+    boxes: List of (south, west, north, east), or None for empty boxes.
+
+  Returns:
+    (south, west, north, east), or None if there are no boxes.
+  """
+  boxes = [x for x in boxes if x is not None]
+  if not boxes:
+    return None
+  return (min([x[0] for x in boxes]), min([x[1] for x in boxes]),
+          max([x[2] for x in boxes]), max([x[3] for x in boxes]))
+
+
+def BoxesIntersect(box, boxes):
+  """Determines if a box intersects any of some boxes.
+
+  Args:
+    box: (south, west, north, east), or None for an empty box.
+    boxes: List of (south, west, north, east)
+
+  Returns:
+    bool
+  """
+  if box is None:
+    return False
+  south, west, north, east = box
+  for other_south, other_west, other_north, other_east in boxes:
+    if (south <= other_north and other_south <= north and
+        west <= other_east and other_west <= east):
+      return True
+  return False
+
+
+def LongitudeDegrees(distance, latitude):
+  """Converts an east-west distance to degrees of longitude.
+
+  Args:
+    distance: Kilometers (float)
+    latitude: Decimal degrees (float)
+
+  Returns:
+    Degrees of longitude (float), at most 360.
+  """
+  cosine = math.cos(math.radians(min(89.0, abs(latitude))))
+  return min(360.0, distance / (KM_PER_DEGREE * cosine))
+
+
+def PackAlert(alert):
+  """Packs the shapes of an alert.
+
+  Args:
+    alert: caplib.Alert object
+
+  Returns:
+    PackedAlert object
+  """
+  return PackedAlert([[PackArea(x) for x in info.area]
+                      for info in alert.info])
+
+
+def AreaGeometry(area):
+  """Returns the packed shapes of an area.
+
+  Areas made by cap_parse_mem from a stored PackedAlert carry their shapes in
+  a 'geometry' attribute, and have no caplib polygons or circles.  Others are
+  packed on the fly.
+
+  Args:
+    area: caplib.Area object
+
+  Returns:
+    PackedArea object
+  """
+  geometry = getattr(area, 'geometry', None)
+  if geometry is None:
+    geometry = PackArea(area)
+  return geometry
+
+
+def PackArea(area):
+  """Packs the shapes of an area.  Shapes that are malformed are ignored.
+
+  Args:
+    area: caplib.Area object
+
+  Returns:
+    PackedArea object
+  """
+  polygons = []
+  for polygon in area.polygon:
+    try:
+      coordinates = array.array('d')
+      for point in polygon:
+        coordinates.append(float(point.longitude))
+        coordinates.append(float(point.latitude))
+    except (TypeError, ValueError, AttributeError):
+      continue
+    if coordinates:
+      polygons.append(PackedPolygon(coordinates))
+  circles = []
+  for circle in area.circle:
+    try:
+      circles.append(PackedCircle(float(circle.point.latitude),
+                                  float(circle.point.longitude),
+                                  float(circle.radius)))
+    except (TypeError, ValueError, AttributeError):
+      continue
+  return PackedArea(polygons, circles)
+
+
+def Encode(packed_alert):
+  """Serializes a PackedAlert compactly.
+
+  Args:
+    packed_alert: PackedAlert object
+
+  Returns:
+    Binary data (str)
+  """
+  chunks = [_COUNT.pack(len(packed_alert.infos))]
+  _AppendBox(chunks, packed_alert.box)
+  for areas in packed_alert.infos:
+    chunks.append(_COUNT.pack(len(areas)))
+    for area in areas:
+      _AppendBox(chunks, area.box)
+      chunks.append(_COUNT.pack(len(area.polygons)))
+      for polygon in area.polygons:
+        chunks.append(_COUNT.pack(len(polygon)))
+        _AppendBox(chunks, polygon.box)
+        coordinates = polygon.coordinates
+        if sys.byteorder != 'little':
+          coordinates = array.array('d', coordinates)
+          coordinates.byteswap()
+        chunks.append(coordinates.tostring())
+      chunks.append(_COUNT.pack(len(area.circles)))
+      for circle in area.circles:
+        chunks.append(_CIRCLE.pack(circle.latitude, circle.longitude,
+                                   circle.radius))
+  return ''.join(chunks)
+
+
+def _AppendBox(chunks, box):
+  if box is None:
+    chunks.append(_COUNT.pack(0))
+  else:
+    chunks.append(_COUNT.pack(1))
+    chunks.append(_BOX.pack(*box))
+
+
+def Decode(data):
+  """Deserializes the result of Encode.
+
+  Args:
+    data: Result of Encode (str)
+
+  Returns:
+    PackedAlert object
+
+  Raises:
+    ValueError: if the data is truncated or otherwise malformed.
+  """
+  try:
+    decoder = _Decoder(data)
+    packed_alert = decoder.DecodeAlert()
+  except struct.error, e:
+    raise ValueError('Malformed geometry: %s' % e)
+  if decoder.offset != len(data):
+    raise ValueError('Malformed geometry: %d extra bytes' %
+                     (len(data) - decoder.offset))
+  return packed_alert
+
+
+class _Decoder(object):
+  """Reads the parts of the result of Encode in order."""
+
+  def __init__(self, data):
+    self.data = data
+    self.offset = 0
+
+  def DecodeAlert(self):
+    info_count = self._Unpack(_COUNT)[0]
+    box = self._DecodeBox()
+    infos = []
+    for unused_info in xrange(info_count):
+      infos.append([self._DecodeArea()
+                    for unused_area in xrange(self._Unpack(_COUNT)[0])])
+    return PackedAlert(infos, box=box)
+
+  def _DecodeArea(self):
+    box = self._DecodeBox()
+    polygons = [self._DecodePolygon()
+                for unused_polygon in xrange(self._Unpack(_COUNT)[0])]
+    circles = [PackedCircle(*self._Unpack(_CIRCLE))
+               for unused_circle in xrange(self._Unpack(_COUNT)[0])]
+    return PackedArea(polygons, circles, box=box)
+
+  def _DecodePolygon(self):
+    vertex_count = self._Unpack(_COUNT)[0]
+    box = self._DecodeBox()
+    if not vertex_count or box is None:
+      raise ValueError('Malformed geometry: empty polygon')
+    end = self.offset + 2 * vertex_count * _DOUBLE_SIZE
+    if end > len(self.data):
+      raise ValueError('Malformed geometry: truncated polygon')
+    coordinates = array.array('d')
+    coordinates.fromstring(self.data[self.offset:end])
+    if sys.byteorder != 'little':
+      coordinates.byteswap()
+    self.offset = end
+    return PackedPolygon(coordinates, box=box)
+
+  def _DecodeBox(self):
+    if self._Unpack(_COUNT)[0]:
+      return self._Unpack(_BOX)
+    else:
+      return None
+
+  def _Unpack(self, a_struct):
+    values = a_struct.unpack_from(self.data, self.offset)
+    self.offset += a_struct.size
+    return values
@@ -0,0 +1,140 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for packed_geometry."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+import cap as caplib
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
+
+
+def _Alert(polygons=(), circles=()):
+  """Makes an alert with one area, and another area without shapes.
+
+  Args:
+    polygons: Polygons for caplib.Polygon.fromString (list of str)
+    circles: Circles for caplib.Circle.fromString (list of str)
+
+  Returns:
+    caplib.Alert object
+  """
+  alert = caplib.Alert()
+  info = caplib.Info()
+  alert.info.append(info)
+  area = caplib.Area()
+  info.area.append(area)
+  for polygon in polygons:
+    area.polygon.append(caplib.Polygon.fromString(polygon))
+  for circle in circles:
+    area.circle.append(caplib.Circle.fromString(circle))
+  info.area.append(caplib.Area())
+  return alert
+
+
+# Boulder, Colorado.
+_POLYGON = '40.0,-105.3 40.1,-105.3 40.1,-105.2 40.0,-105.2 40.0,-105.3'
+# Denver, Colorado.
+_CIRCLE = '39.74,-104.99 10'
+
+
+class PackAlertTest(googletest.TestCase):
+  """Tests for packed_geometry.PackAlert."""
+
+  def testPackAlert(self):
+    packed_alert = packed_geometry.PackAlert(
+        _Alert(polygons=[_POLYGON], circles=[_CIRCLE]))
+    self.assertEquals(1, len(packed_alert.infos))
+    area, empty_area = packed_alert.infos[0]
+    self.assertEquals(None, empty_area.box)
+
+    polygon = area.polygons[0]
+    self.assertEquals(5, len(polygon))
+    self.assertEquals([-105.3, 40.0, -105.3, 40.1],
+                      list(polygon.coordinates[:4]))
+    self.assertEquals((40.0, -105.3), polygon.Vertices()[0])
+    self.assertEquals((40.0, -105.3, 40.1, -105.2), polygon.box)
+
+    circle = area.circles[0]
+    self.assertEquals((39.74, -104.99, 10.0),
+                      (circle.latitude, circle.longitude, circle.radius))
+    south, west, north, east = circle.box
+    self.assertAlmostEqual(39.74 - 10 / packed_geometry.KM_PER_DEGREE, south)
+    self.assertTrue(west < -104.99 < east)
+
+    # The area and alert boxes contain both shapes.
+    self.assertEquals((south, -105.3, 40.1, east), area.box)
+    self.assertEquals(area.box, packed_alert.box)
+
+  def testCircleAcrossAntimeridian(self):
+    circle = packed_geometry.PackedCircle(0.0, 179.99, 10.0)
+    self.assertEquals(-180.0, circle.box[1])
+    self.assertEquals(180.0, circle.box[3])
+
+  def testNoShapes(self):
+    self.assertEquals(None, packed_geometry.PackAlert(_Alert()).box)
+
+
+class EncodeTest(googletest.TestCase):
+  """Tests for packed_geometry.Encode and packed_geometry.Decode."""
+
+  def testRoundTrip(self):
+    packed_alert = packed_geometry.PackAlert(
+        _Alert(polygons=[_POLYGON, _POLYGON], circles=[_CIRCLE]))
+    decoded = packed_geometry.Decode(packed_geometry.Encode(packed_alert))
+    self.assertEquals(packed_alert.box, decoded.box)
+    self.assertEquals([2], [len(x) for x in decoded.infos])
+    area = decoded.infos[0][0]
+    expected_area = packed_alert.infos[0][0]
+    self.assertEquals(expected_area.box, area.box)
+    self.assertEquals([list(x.coordinates) for x in expected_area.polygons],
+                      [list(x.coordinates) for x in area.polygons])
+    self.assertEquals([x.box for x in expected_area.polygons],
+                      [x.box for x in area.polygons])
+    self.assertEquals([x.box for x in expected_area.circles],
+                      [x.box for x in area.circles])
+    self.assertEquals(None, decoded.infos[0][1].box)
+
+  def testDecode_malformed(self):
+    data = packed_geometry.Encode(packed_geometry.PackAlert(
+        _Alert(polygons=[_POLYGON])))
+    for malformed in ['', data[:-1], data + 'x']:
+      self.assertRaises(ValueError, packed_geometry.Decode, malformed)
+
+
+class BoxesIntersectTest(googletest.TestCase):
+  """Tests for packed_geometry.BoxesIntersect."""
+
+  def testBoxesIntersect(self):
+    box = (40.0, -105.3, 40.1, -105.2)
+    self.assertTrue(packed_geometry.BoxesIntersect(
+        box, [(0, 0, 1, 1), (40.1, -105.2, 41, -105)]))
+    self.assertFalse(packed_geometry.BoxesIntersect(
+        box, [(40.2, -105.3, 41, -105)]))
+    self.assertFalse(packed_geometry.BoxesIntersect(None, [box]))
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -18,10 +18,36 @@
 
 The PagedQuery class assists the CGI handler, and the pager.html implements a
 simple control element.
+
+Pages are located by Datastore query cursors, so that every page costs the
+same, however deep it is.  The Datastore only moves cursors forward, so each
+page remembers the cursor of the page before it in memcache, for the "Prev"
+link.  Offsets are passed along with the cursors, and are used whenever a
+cursor is unavailable (e.g. queries with "IN" or "!=" operators, or cursors
+forgotten by memcache).
 """
 
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
+import hashlib
+import urllib
+
+try:
+  # google3
+  from google3.apphosting.api import memcache
+  from google3.apphosting.ext import db
+
+except ImportError:
+  from google.appengine.api import memcache
+  from google.appengine.ext import db
+
+
+# Prefix for the memcache keys of previous page cursors.
+_PREV_CURSOR_KEY_PREFIX = 'paged_query:prev:'
+
+# How long to remember previous page cursors.
+PREV_CURSOR_EXPIRATION_SECS = 3600
+
 
 class PagedQuery(object):
   """Handler of a page containing a paged query."""
@@ -36,9 +62,11 @@ class PagedQuery(object):
     self.__default_limit = default_limit
     self.__offset = 0
     self.__limit = default_limit
+    self.__cursor = None
+    self.__next_cursor = None
 
   def ParseRequest(self, request):
-    """Parses offset/limit from the CGI request.
+    """Parses offset/limit/cursor from the CGI request.
 
     Args:
       request: webapp.Request object
@@ -62,14 +90,53 @@ class PagedQuery(object):
       try:
         limit = int(limit)
       except ValueError:
-        limit = default_limit
+        limit = self.__default_limit
       if limit <= 0:
-        limit = DEFAULT_LIMIT
+        limit = self.__default_limit
     else:
-      limit = 20
-    self.__offset, self.__limit = offset, limit
+      limit = self.__default_limit
+
+    # Cursors are websafe base64, so anything else is not a cursor.
+    cursor = request.get('cursor')
+    try:
+      cursor = cursor.encode('ascii')
+    except UnicodeError:
+      cursor = ''
+
+    self.__offset, self.__limit, self.__cursor = offset, limit, cursor or None
     return offset, limit
 
+  def Fetch(self, query):
+    """Fetches the requested page of a query.
+
+    Args:
+      query: db.Query or db.GqlQuery object, which must be the same query
+          from page to page.
+
+    Returns:
+      List of models (or keys, for a keys-only query).
+    """
+    models = None
+    if self.__cursor:
+      try:
+        query.with_cursor(self.__cursor)
+        models = query.fetch(self.__limit)
+      except (AssertionError, db.BadValueError, db.BadRequestError):
+        # This query has no cursors, or the cursor is not for this query.
+        query.with_cursor(None)
+    if models is None:
+      models = query.fetch(self.__limit, offset=self.__offset)
+
+    try:
+      self.__next_cursor = query.cursor()
+    except AssertionError:
+      self.__next_cursor = None
+    if self.__next_cursor and len(models) == self.__limit:
+      # Remember this page for the "Prev" link of the next one.
+      memcache.set(_PrevCursorKey(self.__next_cursor), self.__cursor or '',
+                   time=PREV_CURSOR_EXPIRATION_SECS)
+    return models
+
   def MakeTemplateParams(self, base_url, params=None):
     """Returns the Django template parameters that control a paged query.
 
@@ -88,8 +155,47 @@ class PagedQuery(object):
     else:
       param_str = ''
 
+    # The previous page is found by offset unless its cursor is remembered.
+    prev_cursor = ''
+    if self.__cursor:
+      prev_cursor = memcache.get(_PrevCursorKey(self.__cursor)) or ''
+
+    prev_offset = max(0, self.__offset - self.__limit)
+    next_offset = self.__offset + self.__limit
+    next_cursor = self.__next_cursor or ''
     return dict(
         base_url=base_url, pager_params=param_str,
         limit=self.__limit, offset=self.__offset,
-        prev=max(0, self.__offset - self.__limit),
-        next=self.__offset + self.__limit)
+        prev=prev_offset, next=next_offset,
+        cursor=self.__cursor or '', prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        prev_args=_PageArgs(self.__limit, prev_offset, prev_cursor),
+        next_args=_PageArgs(self.__limit, next_offset, next_cursor))
+
+
+def _PageArgs(limit, offset, cursor):
+  """Returns the CGI arguments that locate a page.
+
+  Args:
+    limit: Number of rows per page (int)
+    offset: Offset of the page (int)
+    cursor: Cursor of the page (str), or '' if there is none
+
+  Returns:
+    URL-encoded arguments (str)
+  """
+  return urllib.urlencode(
+      [('limit', limit), ('offset', offset), ('cursor', cursor)])
+
+
+def _PrevCursorKey(cursor):
+  """Returns the memcache key of the cursor of the page before another.
+
+  Args:
+    cursor: Cursor of a page (str)
+
+  Returns:
+    Memcache key (str)
+  """
+  # Cursors can be longer than memcache keys.
+  return _PREV_CURSOR_KEY_PREFIX + hashlib.sha1(cursor).hexdigest()
@@ -0,0 +1,110 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for paged_query."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import cap_schema
+from google3.dotorg.gongo.appengine_cap2kml import cap_test_util
+from google3.dotorg.gongo.appengine_cap2kml import db_test_util
+from google3.dotorg.gongo.appengine_cap2kml import fake_clock
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
+from google3.dotorg.gongo.appengine_cap2kml import paged_query
+
+
+class _FakeRequest(object):
+  """Stands in for webapp.Request with a dict of CGI arguments."""
+
+  def __init__(self, **arguments):
+    self.arguments = arguments
+
+  def get(self, name, default_value=''):
+    return self.arguments.get(name, default_value)
+
+
+class PagedQueryTest(db_test_util.DbTestBase,
+                     memcache_test_util.MemcacheTestBase):
+  """Tests for paged_query.PagedQuery."""
+
+  def setUp(self):
+    super(PagedQueryTest, self).setUp()
+    self.crawls = cap_test_util.NewCrawls(5, fake_clock.FakeNow())
+    self.crawl_keys = [x.key() for x in self.crawls]
+
+  def _FetchPage(self, **arguments):
+    """Fetches a page of Crawls.
+
+    Args:
+      arguments: CGI arguments
+
+    Returns:
+      (crawl_keys, template_params)
+    """
+    a_paged_query = paged_query.PagedQuery(default_limit=2)
+    a_paged_query.ParseRequest(_FakeRequest(**arguments))
+    crawls = a_paged_query.Fetch(cap_schema.Crawl.all().order('started'))
+    return ([x.key() for x in crawls],
+            a_paged_query.MakeTemplateParams('crawls'))
+
+  def testParseRequest(self):
+    a_paged_query = paged_query.PagedQuery(default_limit=7)
+    self.assertEquals((0, 7), a_paged_query.ParseRequest(_FakeRequest()))
+    self.assertEquals((4, 3), a_paged_query.ParseRequest(
+        _FakeRequest(offset='4', limit='3')))
+    self.assertEquals((0, 7), a_paged_query.ParseRequest(
+        _FakeRequest(offset='-1', limit='x')))
+
+  def testFetch_cursors(self):
+    keys, params = self._FetchPage()
+    self.assertEquals(self.crawl_keys[:2], keys)
+    self.assertEquals(2, params['next'])
+    cursor2 = params['next_cursor']
+    self.assertTrue(cursor2)
+    self.assertEquals('limit=2&offset=0&cursor=', params['prev_args'])
+    self.assertTrue(params['next_args'].startswith('limit=2&offset=2&cursor='))
+
+    # The offset is ignored when there is a cursor.
+    keys, params = self._FetchPage(offset='2', cursor=cursor2)
+    self.assertEquals(self.crawl_keys[2:4], keys)
+    self.assertEquals('', params['prev_cursor'])
+    cursor4 = params['next_cursor']
+
+    keys, params = self._FetchPage(offset='4', cursor=cursor4)
+    self.assertEquals(self.crawl_keys[4:], keys)
+    self.assertEquals(cursor2, params['prev_cursor'])
+
+    # Going back uses the remembered cursor.
+    keys, params = self._FetchPage(offset='2', cursor=cursor2)
+    self.assertEquals(self.crawl_keys[2:4], keys)
+
+  def testFetch_invalidCursor(self):
+    keys, params = self._FetchPage(offset='2', cursor='bogus')
+    self.assertEquals(self.crawl_keys[2:4], keys)
+    self.assertEquals('', params['prev_cursor'])
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
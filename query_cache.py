@@ -0,0 +1,225 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of query responses.
+
+The response to a query only changes when the set of crawls being served
+changes, so responses are cached under a key that includes the serving
+generation (see cap_schema.ServingGeneration).  Whatever advances the
+generation (a crawl completing, or feeds or crawls being saved or deleted)
+orphans every cached response at once.
+
+Responses are shared by all instances through memcache.  Each instance also
+keeps the most recently used responses in memory, so that popular responses
+need not be fetched from memcache.  If memcache is unavailable, responses are
+only cached in memory.
+
+When many identical requests arrive at once and the response is not cached,
+only the first computes it, holding a lease in memcache (see GetOrLease).  The
+others wait a bounded time for the response to appear, rather than all
+running the same query.
+"""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import hashlib
+import logging
+import time
+
+try:
+  # google3
+  from google3.apphosting.api import memcache
+  from google3.pyglib import logging
+
+except ImportError:
+  from google.appengine.api import memcache
+
+
+# Prefix for all memcache keys used by this module.
+_KEY_PREFIX = 'query_cache'
+
+# Cached responses expire after this long, even if the generation is the same.
+EXPIRATION_SECS = 3600
+
+# Number of responses that each instance keeps in memory.
+LOCAL_CACHE_SIZE = 20
+
+# Responses larger than this (in bytes) are not cached, since memcache would
+# reject them.
+MAX_RESPONSE_SIZE = 1000000
+
+# A lease that is never released (e.g. because its request died) expires after
+# this long, which is the request deadline.
+LEASE_SECS = 30
+
+# How long a request waits for another to compute the same response, before
+# computing it anyway.
+WAIT_SECS = 10
+
+# How often a waiting request checks for the response.
+POLL_SECS = 0.25
+
+
+class LruCache(object):
+  """Mapping of limited size that forgets the least recently used items."""
+
+  def __init__(self, max_size):
+    """Initializes an LruCache object.
+
+    Args:
+      max_size: Maximum number of items (int)
+    """
+    self.__max_size = max_size
+    # Maps key to (tick, value), where tick records the last use.
+    self.__items = {}
+    self.__tick = 0
+
+  def Get(self, key):
+    """Returns the value for a key, or None if it is not cached."""
+    item = self.__items.get(key)
+    if item is None:
+      return None
+    value = item[1]
+    self.__items[key] = (self.__NextTick(), value)
+    return value
+
+  def Put(self, key, value):
+    """Caches a value, possibly forgetting the least recently used one."""
+    if key not in self.__items and len(self.__items) >= self.__max_size:
+      oldest_key = min(self.__items, key=lambda x: self.__items[x][0])
+      del self.__items[oldest_key]
+    self.__items[key] = (self.__NextTick(), value)
+
+  def Clear(self):
+    """Forgets all items."""
+    self.__items.clear()
+
+  def __len__(self):
+    return len(self.__items)
+
+  def __NextTick(self):
+    self.__tick += 1
+    return self.__tick
+
+
+_local_cache = LruCache(LOCAL_CACHE_SIZE)
+
+
+def MakeKey(handler_name, query, generation, variant=''):
+  """Generates the cache key for a query response.
+
+  Args:
+    handler_name: Name of the handler that writes the response (str)
+    query: What the user specified (web_query.Query)
+    generation: Serving generation from which the response is computed (int)
+    variant: Anything else that affects the response, e.g. other CGI
+        arguments (str)
+
+  Returns:
+    Cache key (str)
+  """
+  # Queries can be long, so hash them to fit within memcache key limits.
+  digest = hashlib.sha1('\n'.join(
+      [handler_name, query.CanonicalString(), variant])).hexdigest()
+  return '%s:%d:%s' % (_KEY_PREFIX, generation, digest)
+
+
+def Get(key):
+  """Returns a cached response.
+
+  Args:
+    key: Result of MakeKey (str)
+
+  Returns:
+    (content_type, body) as passed to Put, or None if it is not cached.
+  """
+  response = _local_cache.Get(key)
+  if response is None:
+    response = memcache.get(key)
+    if response is not None:
+      _local_cache.Put(key, response)
+  return response
+
+
+def GetOrLease(key, _time=time.time, _sleep=time.sleep):
+  """Returns a cached response, or else a lease to compute it.
+
+  If another request holds the lease, waits for it to cache the response.  A
+  request that gets the lease must call ReleaseLease when it is done, whether
+  or not it caches the response.
+
+  Args:
+    key: Result of MakeKey (str)
+    _time: Dependency injection of a clock function that returns seconds.
+    _sleep: Dependency injection of time.sleep.
+
+  Returns:
+    (response, has_lease)
+    response: (content_type, body) as passed to Put, or None if the caller
+        must compute the response.
+    has_lease: True iff the caller holds the lease, and so must release it.
+  """
+  response = Get(key)
+  if response is not None:
+    return response, False
+  lease_key = _LeaseKey(key)
+  if memcache.add(lease_key, 1, time=LEASE_SECS):
+    return None, True
+
+  # Another request is computing the response.
+  deadline = _time() + WAIT_SECS
+  while _time() < deadline:
+    _sleep(POLL_SECS)
+    response = Get(key)
+    if response is not None:
+      return response, False
+    if memcache.get(lease_key) is None:
+      # The response was not cacheable, or its request failed.
+      break
+  logging.info('Gave up waiting for %s', key)
+  return None, False
+
+
+def ReleaseLease(key):
+  """Releases the lease obtained from GetOrLease.
+
+  Args:
+    key: Result of MakeKey (str)
+  """
+  memcache.delete(_LeaseKey(key))
+
+
+def _LeaseKey(key):
+  return key + ':lease'
+
+
+def Put(key, content_type, body):
+  """Caches a response.
+
+  Args:
+    key: Result of MakeKey (str)
+    content_type: Content-Type header of the response (str)
+    body: Content of the response (str)
+
+  Returns:
+    True iff the response was cached.
+  """
+  if len(body) > MAX_RESPONSE_SIZE:
+    logging.info('Response of %d bytes is too large to cache', len(body))
+    return False
+  response = (content_type, body)
+  _local_cache.Put(key, response)
+  return bool(memcache.set(key, response, time=EXPIRATION_SECS))
@@ -0,0 +1,167 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for query_cache."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+import mox
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import memcache_test_util
+from google3.dotorg.gongo.appengine_cap2kml import query_cache
+from google3.dotorg.gongo.appengine_cap2kml import web_query
+
+
+def _Query(*predicate_args):
+  """Makes a web_query.Query of CapAlert equality predicates.
+
+  Args:
+    predicate_args: (attribute, constant) tuples
+
+  Returns:
+    web_query.Query object
+  """
+  predicates = []
+  for attribute, constant in predicate_args:
+    if isinstance(constant, list):
+      operator = web_query.Operators.SCALAR_IN
+    else:
+      operator = web_query.Operators.SCALAR_EQUALS
+    predicates.append(web_query.SimpleComparisonPredicate(
+        'CapAlert', attribute, constant, operator))
+  return web_query.Query(predicates)
+
+
+class LruCacheTest(googletest.TestCase):
+  """Tests for query_cache.LruCache."""
+
+  def testLruCache(self):
+    cache = query_cache.LruCache(2)
+    cache.Put('a', 1)
+    cache.Put('b', 2)
+    # Using 'a' makes 'b' the least recently used.
+    self.assertEquals(1, cache.Get('a'))
+    cache.Put('c', 3)
+    self.assertEquals(2, len(cache))
+    self.assertEquals(None, cache.Get('b'))
+    self.assertEquals(1, cache.Get('a'))
+    self.assertEquals(3, cache.Get('c'))
+    cache.Clear()
+    self.assertEquals(None, cache.Get('a'))
+
+
+class QueryCacheTest(mox.MoxTestBase, memcache_test_util.MemcacheTestBase):
+  """Tests for query_cache."""
+
+  def setUp(self):
+    super(QueryCacheTest, self).setUp()
+    self.mox.StubOutWithMock(query_cache, 'logging')
+    self.stubs.Set(query_cache, '_local_cache', query_cache.LruCache(2))
+    self.query = _Query(('category', 'Met'), ('severity', ['Minor', 'Severe']))
+
+  def testMakeKey_canonical(self):
+    self.mox.ReplayAll()
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    self.assertEquals(key, query_cache.MakeKey(
+        'Cap2Kml',
+        _Query(('severity', ['Severe', 'Minor']), ('category', 'Met')), 1))
+    self.assertNotEqual(key, query_cache.MakeKey('Cap2Atom', self.query, 1))
+    self.assertNotEqual(key, query_cache.MakeKey('Cap2Kml', self.query, 1,
+                                                 'as_xml'))
+    self.assertNotEqual(key, query_cache.MakeKey(
+        'Cap2Kml', _Query(('category', 'Geo')), 1))
+    # A new serving generation orphans the old responses.
+    self.assertNotEqual(key, query_cache.MakeKey('Cap2Kml', self.query, 2))
+
+  def testPutAndGet(self):
+    self.mox.ReplayAll()
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    self.assertEquals(None, query_cache.Get(key))
+    self.assertTrue(query_cache.Put(key, 'text/xml', '<kml/>'))
+    self.assertEquals(('text/xml', '<kml/>'), query_cache.Get(key))
+    # Other instances get it from memcache.
+    query_cache._local_cache.Clear()
+    self.assertEquals(('text/xml', '<kml/>'), query_cache.Get(key))
+
+  def _Sleep(self, secs):
+    """Fake time.sleep that advances self.now."""
+    self.now += secs
+
+  def _Time(self):
+    return self.now
+
+  def testGetOrLease_cached(self):
+    self.mox.ReplayAll()
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    query_cache.Put(key, 'text/xml', '<kml/>')
+    self.assertEquals((('text/xml', '<kml/>'), False),
+                      query_cache.GetOrLease(key))
+
+  def testGetOrLease_waitsForLeaseHolder(self):
+    self.mox.ReplayAll()
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    self.assertEquals((None, True), query_cache.GetOrLease(key))
+
+    # The lease holder caches the response while the other request waits.
+    def Sleep(secs):
+      query_cache.Put(key, 'text/xml', '<kml/>')
+    self.assertEquals((('text/xml', '<kml/>'), False),
+                      query_cache.GetOrLease(key, _sleep=Sleep))
+
+  def testGetOrLease_leaseReleasedWithoutResponse(self):
+    query_cache.logging.info(mox.StrContains('Gave up'), mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    self.assertEquals((None, True), query_cache.GetOrLease(key))
+    def Sleep(secs):
+      query_cache.ReleaseLease(key)
+    self.assertEquals((None, False),
+                      query_cache.GetOrLease(key, _sleep=Sleep))
+    # The lease is available again.
+    self.assertEquals((None, True), query_cache.GetOrLease(key))
+
+  def testGetOrLease_timeout(self):
+    query_cache.logging.info(mox.StrContains('Gave up'), mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    self.assertEquals((None, True), query_cache.GetOrLease(key))
+    self.now = 1000.0
+    self.assertEquals((None, False), query_cache.GetOrLease(
+        key, _time=self._Time, _sleep=self._Sleep))
+    self.assertTrue(self.now >= 1000.0 + query_cache.WAIT_SECS)
+
+  def testPut_tooLarge(self):
+    query_cache.logging.info(mox.StrContains('too large'), mox.IsA(int))
+    self.mox.ReplayAll()
+
+    key = query_cache.MakeKey('Cap2Kml', self.query, 1)
+    body = 'x' * (query_cache.MAX_RESPONSE_SIZE + 1)
+    self.assertFalse(query_cache.Put(key, 'text/xml', body))
+    self.assertEquals(None, query_cache.Get(key))
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -35,9 +35,20 @@ __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
 try:
   from google3.pyglib import logging
+
+  from google3.dotorg.gongo.appengine_cap2kml import geo_index
+  from google3.dotorg.gongo.appengine_cap2kml import packed_geometry
 except ImportError:
   import logging
 
+  import geo_index
+  import packed_geometry
+
+
+# The Datastore runs a query with "IN" filters as a subquery for each
+# combination of their values, and allows no more than this many.
+MAX_SUBQUERIES = 30
+
 
 class Schema(object):
   """Defines the queryable components of a Datastore schema."""
@@ -96,7 +107,11 @@ class Schema(object):
       # See what the argument values are.
       values = request.get_all(argument)
       # Form the predicate.
-      predicates.append(operator.MakePredicate(model, attribute, values))
+      try:
+        predicates.append(operator.MakePredicate(model, attribute, values))
+      except ValueError, e:
+        logging.error('Invalid value for %r: %s', argument, e)
+        unknown_arguments.add(argument)
     return Query(predicates), unknown_arguments
 
   def Help(self):
@@ -191,6 +206,34 @@ class EqualityOperator(BinaryOperator):
       operator.in_operator = in_operator
 
 
+class BoundingBoxOperator(BinaryOperator):
+  """Represents the intersection of geo_index areas with bounding boxes.
+
+  The attribute must be a list of geo_index tokens.  See BoundingBoxPredicate.
+  """
+
+  def __init__(self, gql):
+    super(BoundingBoxOperator, self).__init__(gql,
+                                              geo_index.AreaIntersectsBoxes)
+
+  def MakePredicate(self, model, attribute, argument):
+    """Constructs a predicate.
+
+    Args:
+      model: Model name (str)
+      attribute: Attribute name (str)
+      argument: CGI argument (list of str), each one a box for
+          geo_index.ParseBox.
+
+    Raises:
+      ValueError: if a box is invalid.
+    """
+    boxes = []
+    for text in argument:
+      boxes.extend(geo_index.ParseBox(text))
+    return BoundingBoxPredicate(model, attribute, boxes, self)
+
+
 class Operators(object):
   """Enumeration of query operators."""
 
@@ -198,7 +241,7 @@ class Operators(object):
   SCALAR_IN = EqualityOperator('IN', lambda x, y: x in y)
   EqualityOperator.Tie(SCALAR_EQUALS, SCALAR_IN)
 
-  # TODO(Matt Frantz): Add operators for ranges (timestamps) and geo.
+  # TODO(Matt Frantz): Add operators for ranges (timestamps).
 
   SCALAR_ALL = dict([(x.gql, x) for x in [SCALAR_EQUALS, SCALAR_IN]])
 
@@ -219,6 +262,11 @@ class Operators(object):
   EqualityOperator.Tie(KEY_EQUALS, KEY_IN)
   KEY_ALL = dict([(x.gql, x) for x in [KEY_EQUALS, KEY_IN]])
 
+  # Operators on geo_index token list properties.  The argument is a bounding
+  # box, "west,south,east,north".
+  BBOX = BoundingBoxOperator('bbox')
+  GEO_ALL = {'bbox': BBOX}
+
 
 class Query(object):
   """Collection of Predicates that apply to a hierarchical Datastore query.
@@ -267,8 +315,18 @@ class Query(object):
     logging.debug('Query %s ApplyToGql for model %s', self, model_name)
     gql_list = []
     gql_params = {}
+    # Filters that only narrow the query are applied last, with whatever is
+    # left of the Datastore's subqueries.
+    subqueries = 1
+    for predicate in self.__predicates:
+      if not predicate.only_narrows:
+        subqueries *= predicate.MaybeApplyToGql(model_name, gql_list,
+                                                gql_params)
     for predicate in self.__predicates:
-      predicate.MaybeApplyToGql(model_name, gql_list, gql_params)
+      if predicate.only_narrows:
+        subqueries *= predicate.MaybeApplyToGql(
+            model_name, gql_list, gql_params,
+            max_subqueries=MAX_SUBQUERIES // subqueries)
     logging.debug('Query %s ApplyToGql => %s WHERE %r <= %r', self, model_name,
                   ' AND '.join(gql_list), gql_params)
     return gql_list, gql_params
@@ -289,6 +347,50 @@ class Query(object):
         return False
     return True
 
+  def IsSpatial(self, model_name):
+    """Determines if any predicate selects the CAP areas of a model.
+
+    Args:
+      model_name: Name of the db.Model being queried
+
+    Returns:
+      True, iff a model none of whose areas are permitted does not match.
+    """
+    for predicate in self.__predicates:
+      if predicate.is_spatial and predicate.model == model_name:
+        return True
+    return False
+
+  def PermitsBox(self, model_name, box):
+    """Determines if any shape within a bounding box could be permitted.
+
+    This allows models to be rejected by their bounding box (see
+    packed_geometry), before they are materialized.
+
+    Args:
+      model_name: Name of the db.Model being queried
+      box: (south, west, north, east), or None if the model has no shapes.
+
+    Returns:
+      False, iff this query proscribes every model within the box.
+    """
+    for predicate in self.__predicates:
+      if not predicate.PermitsBox(model_name, box):
+        return False
+    return True
+
+  def CanonicalString(self):
+    """Returns a representation that is the same for equivalent queries.
+
+    Queries whose predicates differ only in their order, or in the order of
+    the values of IN predicates, have the same canonical string.
+
+    Returns:
+      str
+    """
+    return ' and '.join(sorted([x.CanonicalString()
+                                for x in self.__predicates]))
+
   def __str__(self):
     return ' and '.join([str(x) for x in self.__predicates])
 
@@ -298,8 +400,15 @@ class Predicate(object):
 
   Attributes:
     model: Model class name (str)
+    only_narrows: Whether the Datastore filter may be left out, because the
+        predicate is applied to the models as well (bool)
+    is_spatial: Whether the predicate selects CAP areas, so that a model
+        with no permitted areas does not match (bool)
   """
 
+  only_narrows = False
+  is_spatial = False
+
   def __init__(self, model):
     """Initializes a Predicate object.
 
@@ -308,7 +417,8 @@ class Predicate(object):
     """
     self.model = model
 
-  def MaybeApplyToGql(self, model_name, gql_list, gql_params):
+  def MaybeApplyToGql(self, model_name, gql_list, gql_params,
+                      max_subqueries=MAX_SUBQUERIES):
     """Maybe applies this predicate as a filter on the Datastore query.
 
     If this predicate references a Model that does not apply to this query,
@@ -318,14 +428,20 @@ class Predicate(object):
       model_name: Name of the db.Model being queried
       gql_list: GQL predicate list (list of str)
       gql_params: Name/value pairs for binding the query
+      max_subqueries: Most subqueries that the filter may split the query
+          into (int).  Only predicates that only_narrows heed it, by leaving
+          out the filter.
+
+    Returns:
+      Number of subqueries that the filter splits the query into (int)
 
     Postconditions:
       gql_list possibly modified with a filter based on this predicate.
       gql_params possibly extended with predicate names and values.
     """
     if self.model != model_name:
-      return
-    self._ApplyToGql(gql_list, gql_params)
+      return 1
+    return self._ApplyToGql(gql_list, gql_params, max_subqueries)
 
   def PermitsModel(self, model_name, model):
     """Applies the predicate to an instance of a model.
@@ -344,7 +460,20 @@ class Predicate(object):
       return True
     return self._PermitsModel(model)
 
-  def _ApplyToQuery(self, gql_list):
+  def PermitsBox(self, model_name, box):
+    """Determines if the predicate could permit shapes within a box.
+
+    Args:
+      model_name: Name of the db.Model being queried
+      box: (south, west, north, east), or None if the model has no shapes.
+
+    Returns:
+      False, iff this predicate rejects every model within the box.  Only
+      spatial predicates do.
+    """
+    return True
+
+  def _ApplyToGql(self, gql_list, gql_params, max_subqueries):
     """Applies this predicate as a filter on the Datastore query.
 
     Preconditions:
@@ -352,12 +481,25 @@ class Predicate(object):
 
     Args:
       gql_list: GQL predicate list (list of str)
+      gql_params: Name/value pairs for binding the query
+      max_subqueries: See MaybeApplyToGql.
+
+    Returns:
+      Number of subqueries that the filter splits the query into (int)
 
     Postconditions:
       gql_list modified with a filter based on this predicate.
     """
     raise NotImplementedError()
 
+  def CanonicalString(self):
+    """Returns a representation that is the same for equivalent predicates.
+
+    Returns:
+      str
+    """
+    return str(self)
+
   def _PermitsModel(self, model):
     """Applies this predicate to a model instance.
 
@@ -406,7 +548,7 @@ class SimpleComparisonPredicate(Predicate):
     self.constant = constant
     self.gql_name = None
 
-  def _ApplyToGql(self, gql_list, gql_params):
+  def _ApplyToGql(self, gql_list, gql_params, unused_max_subqueries):
     """Applies this predicate as a filter on the Datastore query.
 
     Preconditions:
@@ -415,6 +557,10 @@ class SimpleComparisonPredicate(Predicate):
     Args:
       gql_list: GQL predicate list (list of str)
       gql_params: Name/value pairs for binding the query
+      unused_max_subqueries: The filter is applied regardless.
+
+    Returns:
+      Number of subqueries that the filter splits the query into (int)
 
     Postconditions:
       gql_list modified with a GQL predicate string based on this predicate.
@@ -424,6 +570,13 @@ class SimpleComparisonPredicate(Predicate):
     logging.debug('Predicate %s applied as GQL %r', self, gql)
     gql_list.append(gql)
     gql_params[self.gql_name] = self.constant
+    # The Datastore runs one subquery per value of "IN", and two for "!="
+    # (less than and greater than).
+    if self.operator.gql == 'IN':
+      return max(1, len(self.constant))
+    elif self.operator.gql == '!=':
+      return 2
+    return 1
 
   def _PermitsModel(self, model):
     """Applies this predicate to a model instance.
@@ -455,6 +608,122 @@ class SimpleComparisonPredicate(Predicate):
     return '%s.%s %s %r' % (
         self.model, self.attribute, self.operator, self.constant)
 
+  def CanonicalString(self):
+    """Returns a representation that is the same for equivalent predicates.
+
+    The values of an IN predicate are sorted.
+
+    Returns:
+      str
+    """
+    constant = self.constant
+    if isinstance(constant, (list, tuple, set, frozenset)):
+      constant = sorted(constant)
+    return '%s.%s %s %r' % (self.model, self.attribute, self.operator, constant)
+
+
+class BoundingBoxPredicate(Predicate):
+  """A predicate that selects areas that intersect bounding boxes.
+
+  The Datastore query is narrowed to the models whose geo_index tokens
+  (attribute) match those of the boxes.  That is approximate, so the
+  predicate is also applied to the CAP areas of each model.  Infos are
+  permitted if any of their areas are.  If the boxes need too many tokens
+  (e.g. a box around the world), the Datastore query is not narrowed at all.
+
+  Attributes:
+    model: Model name (str)
+    attribute: Name of the attribute with the geo_index tokens (str)
+    boxes: List of (south, west, north, east)
+    operator: BoundingBoxOperator object
+  """
+
+  only_narrows = True
+  is_spatial = True
+
+  def __init__(self, model, attribute, boxes, operator):
+    """Initializes a BoundingBoxPredicate object.
+
+    Args:
+      model: Model name (str)
+      attribute: Name of the attribute with the geo_index tokens (str)
+      boxes: List of (south, west, north, east)
+      operator: BoundingBoxOperator object
+    """
+    super(BoundingBoxPredicate, self).__init__(model)
+    self.attribute = attribute
+    self.boxes = boxes
+    self.operator = operator
+    self.gql_name = None
+
+  def _ApplyToGql(self, gql_list, gql_params, max_subqueries):
+    """Applies this predicate as a filter on the Datastore query.
+
+    Args:
+      gql_list: GQL predicate list (list of str)
+      gql_params: Name/value pairs for binding the query
+      max_subqueries: Most geo_index tokens to use (int)
+
+    Returns:
+      Number of subqueries that the filter splits the query into (int)
+
+    Postconditions:
+      gql_list modified with a GQL predicate string based on this predicate,
+      and gql_params extended with the geo_index tokens, unless the boxes
+      need more than max_subqueries tokens.
+    """
+    tokens = geo_index.BoxTokens(self.boxes, max_tokens=max_subqueries)
+    if not tokens:
+      logging.debug('Predicate %s not applied as GQL: too many tokens', self)
+      return 1
+    gql = '%s IN :%s' % (self.attribute, self.gql_name)
+    logging.debug('Predicate %s applied as GQL %r', self, gql)
+    gql_list.append(gql)
+    gql_params[self.gql_name] = tokens
+    return len(tokens)
+
+  def _PermitsModel(self, model):
+    """Applies this predicate to a model instance.
+
+    Args:
+      model: CAP area, info, or other element
+
+    Returns:
+      True, if the predicate allows the model; False, if it rejects it.
+    """
+    if hasattr(model, 'polygon') and hasattr(model, 'circle'):
+      is_permitted = self.operator(model, self.boxes)
+    elif hasattr(model, 'area'):
+      # The areas are filtered by this predicate as well.
+      is_permitted = len(model.area) > 0
+    else:
+      return True
+    logging.debug('Predicate %s permits model? %s', self, is_permitted)
+    return is_permitted
+
+  def PermitsBox(self, model_name, box):
+    """Determines if the predicate could permit shapes within a box.
+
+    Args:
+      model_name: Name of the db.Model being queried
+      box: (south, west, north, east), or None if the model has no shapes.
+
+    Returns:
+      False, iff the box is disjoint from the boxes of this predicate.
+    """
+    if self.model != model_name:
+      return True
+    return packed_geometry.BoxesIntersect(box, self.boxes)
+
+  def __str__(self):
+    """Human-readable representation of this predicate.
+
+    Returns:
+      str
+    """
+    return '%s.%s %s %r' % (
+        self.model, self.attribute, self.operator, self.boxes)
+
 
 def _ParseArgument(argument):
   """Parses a CGI argument name.
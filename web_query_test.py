@@ -0,0 +1,98 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for web_query."""
+
+__author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
+
+import google3
+
+from google3.pyglib import app
+from google3.testing.pybase import googletest
+
+from google3.dotorg.gongo.appengine_cap2kml import web_query
+
+
+class ApplyToGqlTest(googletest.TestCase):
+  """Tests for web_query.Query.ApplyToGql."""
+
+  def _Query(self, box_text, num_crawls):
+    """Makes a query of a bounding box in some crawls.
+
+    Args:
+      box_text: Argument of geo_index.ParseBox
+      num_crawls: Number of values of the "crawl IN" filter (int)
+
+    Returns:
+      web_query.Query object
+    """
+    crawls = ['crawl%d' % i for i in xrange(num_crawls)]
+    return web_query.Query([
+        web_query.Operators.BBOX.MakePredicate('CapAlert', 'geohash',
+                                               [box_text]),
+        web_query.SimpleComparisonPredicate('CapAlert', 'crawl', crawls,
+                                            web_query.Operators.KEY_IN)])
+
+  def testApplyToGql_smallBox(self):
+    gql_list, gql_params = self._Query(
+        '-105.0,39.7,-104.95,39.75', 3).ApplyToGql('CapAlert')
+    self.assertEquals(['crawl IN :p1', 'geohash IN :p0'], gql_list)
+    self.assertTrue(
+        3 * len(gql_params['p0']) <= web_query.MAX_SUBQUERIES)
+
+  def testApplyToGql_worldBox(self):
+    # The Datastore can't split the query by every cell of the world, so the
+    # areas are only filtered in memory.
+    gql_list, gql_params = self._Query(
+        '-180,-90,180,90', 1).ApplyToGql('CapAlert')
+    self.assertEquals(['crawl IN :p1'], gql_list)
+    self.assertEquals(['p1'], gql_params.keys())
+
+  def testApplyToGql_manyCrawls(self):
+    # The box is covered more coarsely, to leave room for the crawls.
+    gql_list, gql_params = self._Query(
+        '-105.0,39.7,-104.95,39.75', 15).ApplyToGql('CapAlert')
+    self.assertEquals(['crawl IN :p1', 'geohash IN :p0'], gql_list)
+    self.assertTrue(0 < len(gql_params['p0']) <= 2)
+
+  def testApplyToGql_notEqualsCountsTwice(self):
+    predicate = web_query.SimpleComparisonPredicate(
+        'CapAlert', 'status', 'Test',
+        web_query.BinaryOperator('!=', lambda x, y: x != y))
+    predicate.gql_name = 'p0'
+    self.assertEquals(2, predicate.MaybeApplyToGql('CapAlert', [], {}))
+
+
+class IsSpatialTest(googletest.TestCase):
+  """Tests for web_query.Query.IsSpatial."""
+
+  def testIsSpatial(self):
+    crawls = web_query.SimpleComparisonPredicate(
+        'CapAlert', 'crawl', ['crawl0'], web_query.Operators.KEY_IN)
+    self.assertFalse(web_query.Query([crawls]).IsSpatial('CapAlert'))
+    box = web_query.Operators.BBOX.MakePredicate('CapAlert', 'geohash',
+                                                 ['-105,39,-104,40'])
+    query = web_query.Query([crawls, box])
+    self.assertTrue(query.IsSpatial('CapAlert'))
+    self.assertFalse(query.IsSpatial('Feed'))
+
+
+def main(unused_argv):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
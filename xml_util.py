@@ -23,6 +23,12 @@ App Engine Datastore (google.appengine.ext.db).
 __author__ = 'Matthew.H.Frantz@gmail.com (Matt Frantz)'
 
 import re
+from xml.parsers import expat
+
+try:
+  from xml.etree import cElementTree as ElementTree
+except ImportError:
+  from xml.etree import ElementTree
 
 try:
   import google3
@@ -60,7 +66,8 @@ class MultipleNodeError(RecoverableError):
 
   Attributes:
     tag_name: Name of the XML node (str)
-    child_nodes: List of two or more XML nodes (List of xml.dom.Node)
+    child_nodes: List of two or more XML nodes (List of xml.dom.Node), or
+        their texts (list of str or unicode).
   """
 
   def __init__(self, tag_name, child_nodes):
@@ -68,11 +75,17 @@ class MultipleNodeError(RecoverableError):
 
     Args:
       node_name: Name of the XML node (str)
-      child_nodes: List of two or more XML nodes (List of xml.dom.Node)
+      child_nodes: List of two or more XML nodes (List of xml.dom.Node), or
+          their texts (list of str or unicode).
     """
+    texts = []
+    for child_node in child_nodes:
+      if isinstance(child_node, unicode):
+        # str cannot convert non-ASCII text.
+        child_node = child_node.encode('utf-8')
+      texts.append(str(child_node))
     RecoverableError.__init__(
-        self, 'Duplicate child nodes "%s": %s' %
-        (tag_name, ','.join([str(x) for x in child_nodes])))
+        self, 'Duplicate child nodes "%s": %s' % (tag_name, ','.join(texts)))
     self.tag_name = tag_name
     self.child_nodes = child_nodes
 
@@ -103,6 +116,85 @@ class CopyNodeError(RecoverableError):
     self.root_cause = root_cause
 
 
+# Separates the namespace URI from the local name in the element names
+# reported by a namespace-aware expat parser.  URI's cannot contain spaces.
+EXPAT_NAMESPACE_SEPARATOR = ' '
+
+
+def CreateNamespaceParser():
+  """Returns a namespace-aware expat parser.
+
+  Element names are reported as they are by SplitExpatName.
+
+  Returns:
+    expat parser object
+  """
+  return expat.ParserCreate(namespace_separator=EXPAT_NAMESPACE_SEPARATOR)
+
+
+def SplitExpatName(name):
+  """Splits an element name from a parser made by CreateNamespaceParser.
+
+  Args:
+    name: Element name, like 'urn:some:namespace alert' or 'alert' (unicode)
+
+  Returns:
+    (namespace_uri, local_name)
+    namespace_uri: Namespace URI (unicode), or None if there is none.
+    local_name: Element name without any namespace (unicode)
+  """
+  parts = name.split(EXPAT_NAMESPACE_SEPARATOR, 1)
+  if len(parts) == 2:
+    return parts[0], parts[1]
+  else:
+    return None, name
+
+
+class _FoundRootError(Exception):
+  """Used by GetRootName to stop parsing at the root element."""
+
+
+# Number of characters parsed at a time while looking for the root element.
+_ROOT_PEEK_CHUNK_SIZE = 1024
+
+
+def GetRootName(text):
+  """Returns the namespace and name of the root element of an XML document.
+
+  Parsing stops at the root element, so the cost does not depend on the size
+  of the document.  Prefixes are resolved to namespace URI's, so the result
+  does not depend on which prefix (if any) the document uses.
+
+  Args:
+    text: XML (str)
+
+  Returns:
+    (namespace_uri, local_name), as from SplitExpatName, or None if the text
+    does not start like namespace-well-formed XML.
+  """
+  names = []
+
+  def StartElement(name, unused_attrs):
+    names.append(name)
+    raise _FoundRootError()
+
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  parser = CreateNamespaceParser()
+  parser.StartElementHandler = StartElement
+  try:
+    for start in xrange(0, len(text), _ROOT_PEEK_CHUNK_SIZE):
+      parser.Parse(text[start:start + _ROOT_PEEK_CHUNK_SIZE], False)
+  except _FoundRootError:
+    pass
+  except expat.ExpatError:
+    return None
+  if names:
+    return SplitExpatName(names[0])
+  else:
+    return None
+
+
 def NodeToString(xml_node):
   """Returns an XML string.
 
@@ -122,13 +214,12 @@ def GetText(nodes):
     nodes: List of xml.dom.Node objects
 
   Returns:
-    Concatenation of text from any TEXT_NODE nodes (string)
+    Concatenation of text from any TEXT_NODE or CDATA_SECTION_NODE nodes
+    (string)
   """
-  text = ""
-  for node in nodes:
-    if node.nodeType == node.TEXT_NODE:
-      text = text + node.data
-  return text.strip()
+  return "".join([node.data for node in nodes
+                  if node.nodeType in (node.TEXT_NODE,
+                                       node.CDATA_SECTION_NODE)]).strip()
 
 
 def CopyNodes(model, node, names, converter, name_map=None):
@@ -398,3 +489,273 @@ def CopyIntegerNodes(model, node, names, name_map=None):
     converting the text into the appropriate value object.
   """
   return CopyNodes(model, node, names, int, name_map)
+
+
+class NodeCopier(object):
+  """Copies the child elements of XML nodes into model attributes.
+
+  Unlike CopyNodes, which searches the whole subtree once per name, this
+  visits the direct children of a node once and dispatches on tag name through
+  a table, so the cost is linear in the number of children.
+
+  Children are matched by local name, ignoring any namespace prefix, so
+  documents that qualify their elements are copied like those that do not.
+  Fields are copied in the order that they were added, and the same
+  recoverable errors are reported as CopyNodes and CopyNodeLists would.
+  """
+
+  def __init__(self, name_map=None):
+    """Initializes a NodeCopier object.
+
+    Args:
+      name_map: Dict to translate child node names to model attribute names
+          (str:str)
+    """
+    self._name_map = name_map or {}
+    # List of (tag_name, attr_name, converter, is_list) tuples.
+    self._fields = []
+
+  def AddNodes(self, names, converter):
+    """Adds child nodes that each appear at most once.
+
+    Args:
+      names: List of child node / model attribute names (strings)
+      converter: Function which converts the text from the XML into an
+          appropriate object for the data model.
+
+    Returns:
+      This NodeCopier object, for chaining.
+    """
+    self._AddFields(names, converter, False)
+    return self
+
+  def AddNodeLists(self, names, converter):
+    """Adds child nodes that may be repeated, copied into list attributes.
+
+    Args:
+      names: List of child node / model attribute names (strings)
+      converter: Function which converts the text from the XML into an
+          appropriate object for the data model.
+
+    Returns:
+      This NodeCopier object, for chaining.
+    """
+    self._AddFields(names, converter, True)
+    return self
+
+  def _AddFields(self, names, converter, is_list):
+    for tag_name in names:
+      attr_name = self._name_map.get(tag_name, tag_name)
+      self._fields.append((tag_name, attr_name, converter, is_list))
+
+  def Copy(self, model, node):
+    """Copies the children of an XML node into a model.
+
+    This is the same as calling CopyExtract with the result of Extract.
+
+    Args:
+      model: db.Model object
+      node: xml.dom.Node object
+
+    Returns:
+      (errors, other_children)
+      errors: List of RecoverableError objects, possibly empty, representing
+          multiple nodes that are found for any of the non-list names, or
+          problems converting the text into the appropriate value object.
+      other_children: Dict of the child elements that were not copied, keyed
+          by local name (str: list of xml.dom.Node), in document order.
+    """
+    extract, children = self.Extract(node)
+    return self.CopyExtract(model, extract), children
+
+  def Extract(self, node):
+    """Collects the text of the children of an XML node, without converting it.
+
+    The extract contains only str, unicode, list, and dict objects, so it can
+    be serialized (e.g. as JSON) and copied into a model later by CopyExtract,
+    without the XML.
+
+    Args:
+      node: xml.dom.Node object
+
+    Returns:
+      (extract, other_children)
+      extract: Dict of tag name to the text of each child with that name, in
+          document order (str: list of str or unicode), for the names that
+          were added to this copier and are present.
+      other_children: Dict of the child elements that were not extracted,
+          keyed by local name (str: list of xml.dom.Node), in document order.
+    """
+    children = self._GroupChildren(node)
+    extract = {}
+    for tag_name, unused_attr_name, unused_converter, unused_is_list in (
+        self._fields):
+      child_nodes = children.pop(tag_name, None)
+      if child_nodes:
+        extract[tag_name] = [self._GetChildText(x) for x in child_nodes]
+    return extract, children
+
+  def CopyExtract(self, model, extract):
+    """Copies the result of Extract into a model.
+
+    Args:
+      model: db.Model object
+      extract: Extract dict from Extract, possibly after a round trip through
+          serialization.
+
+    Returns:
+      List of RecoverableError objects, possibly empty, representing multiple
+      nodes that are found for any of the non-list names, or problems
+      converting the text into the appropriate value object.
+    """
+    errors = []
+    for tag_name, attr_name, converter, is_list in self._fields:
+      texts = extract.get(tag_name)
+      if not texts:
+        continue
+      # If we have a validating XML parser, we shouldn't have to check this.
+      if not is_list and len(texts) > 1:
+        errors.append(MultipleNodeError(tag_name, texts))
+        continue
+
+      for text in texts:
+        if not text:
+          continue
+        try:
+          if is_list:
+            logger.debug('Appending "%s" with "%s"', attr_name, text)
+            getattr(model, attr_name).append(converter(text))
+          else:
+            logger.debug('Setting "%s" to "%s"', attr_name, text)
+            setattr(model, attr_name, converter(text))
+        except (DeadlineExceededError, AssertionError):
+          raise
+        except Exception, e:
+          errors.append(CopyNodeError(attr_name, text, e))
+
+    return errors
+
+  def _GroupChildren(self, node):
+    """Returns the child elements of a node, keyed by local name.
+
+    Args:
+      node: xml.dom.Node object
+
+    Returns:
+      Dict of local name to child elements (str: list of xml.dom.Node), in
+      document order.
+    """
+    children = {}
+    for child_node in node.childNodes:
+      if child_node.nodeType == child_node.ELEMENT_NODE:
+        # Nodes from a parser without namespace support have no localName.
+        name = child_node.localName or child_node.tagName
+        children.setdefault(name, []).append(child_node)
+    return children
+
+  def _GetChildText(self, child_node):
+    """Returns the text directly within a child element.
+
+    Args:
+      child_node: xml.dom.Node object
+
+    Returns:
+      Stripped text (str or unicode)
+    """
+    return GetText(child_node.childNodes)
+
+
+def ParseElement(xml_text):
+  """Parses an XML document into an ElementTree element.
+
+  Args:
+    xml_text: XML document (str or unicode)
+
+  Returns:
+    Root element (ElementTree.Element)
+
+  Raises:
+    SyntaxError: if the text is not well-formed XML.  (ElementTree's
+        ParseError and expat.ExpatError are both possible.)
+  """
+  if isinstance(xml_text, unicode):
+    xml_text = xml_text.encode('utf-8')
+  return ElementTree.fromstring(xml_text)
+
+
+def SplitElementTag(tag):
+  """Splits an ElementTree tag into its namespace and local name.
+
+  Args:
+    tag: ElementTree tag, like '{urn:some:namespace}alert' or 'alert' (str)
+
+  Returns:
+    (namespace_uri, local_name)
+    namespace_uri: Namespace URI (str), or None if there is none.
+    local_name: Tag name without the namespace (str)
+  """
+  if tag[:1] == '{':
+    end = tag.find('}')
+    return tag[1:end], tag[end + 1:]
+  else:
+    return None, tag
+
+
+def GetLocalName(tag):
+  """Strips the namespace from an ElementTree tag.
+
+  Args:
+    tag: ElementTree tag, like '{urn:some:namespace}alert' or 'alert' (str)
+
+  Returns:
+    Tag name without the namespace (str)
+  """
+  return SplitElementTag(tag)[1]
+
+
+def GetElementText(element):
+  """Concatenates the text directly within an ElementTree element.
+
+  This is the ElementTree equivalent of GetText(node.childNodes).
+
+  Args:
+    element: ElementTree.Element object
+
+  Returns:
+    Stripped text (str or unicode)
+  """
+  parts = [element.text or '']
+  parts.extend([child.tail or '' for child in element])
+  return ''.join(parts).strip()
+
+
+class ElementCopier(NodeCopier):
+  """NodeCopier for ElementTree elements instead of DOM nodes."""
+
+  def _GroupChildren(self, element):
+    """Returns the child elements of an element, keyed by local name.
+
+    Args:
+      element: ElementTree.Element object
+
+    Returns:
+      Dict of local name to child elements (str: list of
+      ElementTree.Element), in document order.
+    """
+    children = {}
+    for child in element:
+      # Skip comments and processing instructions, if the parser kept them.
+      if isinstance(child.tag, basestring):
+        children.setdefault(GetLocalName(child.tag), []).append(child)
+    return children
+
+  def _GetChildText(self, child):
+    """Returns the text directly within a child element.
+
+    Args:
+      child: ElementTree.Element object
+
+    Returns:
+      Stripped text (str or unicode)
+    """
+    return GetElementText(child)
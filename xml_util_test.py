@@ -356,6 +356,42 @@ class XmlUtilTest(XmlUtilTestBase):
     self.assertEquals(model.integer2, 123)
 
 
+class GetRootNameTest(XmlUtilTestBase):
+  """Tests for xml_util.GetRootName."""
+
+  def testGetRootName(self):
+    self.mox.ReplayAll()
+    self.assertEquals((None, 'alert'), xml_util.GetRootName(
+        '<?xml version="1.0"?>\n<alert><info/></alert>'))
+
+  def testGetRootName_prefixed(self):
+    self.mox.ReplayAll()
+    self.assertEquals(('urn:x', 'alert'), xml_util.GetRootName(
+        '<cap:alert xmlns:cap="urn:x"><cap:info/></cap:alert>'))
+
+  def testGetRootName_defaultNamespace(self):
+    self.mox.ReplayAll()
+    self.assertEquals(('urn:x', 'alert'), xml_util.GetRootName(
+        '<alert xmlns="urn:x"><info/></alert>'))
+
+  def testGetRootName_truncated(self):
+    self.mox.ReplayAll()
+    # Only the start of the document matters.
+    self.assertEquals((None, 'rss'), xml_util.GetRootName('<rss><channel><ite'))
+
+  def testGetRootName_unicode(self):
+    self.mox.ReplayAll()
+    self.assertEquals((None, 'alert'),
+                      xml_util.GetRootName(u'<alert>\xe9</alert>'))
+
+  def testGetRootName_notXml(self):
+    self.mox.ReplayAll()
+    self.assertEquals(None, xml_util.GetRootName('not XML'))
+    self.assertEquals(None, xml_util.GetRootName(''))
+    # Prefixes must be declared.
+    self.assertEquals(None, xml_util.GetRootName('<cap:alert/>'))
+
+
 class ParseDateTimeTest(XmlUtilTestBase):
   """Tests for xml_util.ParseDateTime."""
 
@@ -756,6 +792,118 @@ class CopyNodeListsTest(XmlUtilTestBase):
     self.assertListEqual(list(alert.codes), ['123', '456'])
 
 
+class NodeCopierTest(XmlUtilTestBase):
+  """Tests for xml_util.NodeCopier."""
+
+  def setUp(self):
+    super(NodeCopierTest, self).setUp()
+    self.copier = xml_util.NodeCopier({'string1': 'string2'}).AddNodes(
+        ['string1', 'text1'], xml_util.ParseText).AddNodeLists(
+        ['integer_list1'], int)
+
+  def testCopy(self):
+    xml_util.logger.debug(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
+    xml_util.logger.debug(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
+    xml_util.logger.debug(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
+    self.mox.ReplayAll()
+
+    nodes = ParseXml(
+        """<?xml version="1.0" ?>
+        <foo>
+          <integer_list1>1</integer_list1>
+          <string1>bar</string1>
+          <bar><text1>nested</text1></bar>
+          <integer_list1>2</integer_list1>
+          <bar/>
+        </foo>""", 'foo')
+    model = FooModel()
+    errors, children = self.copier.Copy(model, nodes[0])
+    self.assertListEqual([], errors)
+    self.assertEquals(None, model.string1)
+    self.assertEquals(u'bar', model.string2)
+    # Only direct children are copied.
+    self.assertEquals(None, model.text1)
+    self.assertListEqual([1, 2], model.integer_list1)
+    self.assertListEqual(['bar'], children.keys())
+    self.assertEquals(2, len(children['bar']))
+
+  def testExtract(self):
+    xml_util.logger.debug(mox.IgnoreArg(), 'string2', 'bar')
+    self.mox.ReplayAll()
+
+    nodes = ParseXml('<?xml version="1.0" ?><foo><string1>bar</string1>'
+                     '<text1/><bar/></foo>', 'foo')
+    extract, children = self.copier.Extract(nodes[0])
+    self.assertDictEqual({'string1': ['bar'], 'text1': ['']}, extract)
+    self.assertListEqual(['bar'], children.keys())
+    model = FooModel()
+    self.assertListEqual([], self.copier.CopyExtract(model, extract))
+    self.assertEquals(u'bar', model.string2)
+    self.assertEquals(None, model.text1)
+
+  def testCopy_duplicateChildNodes(self):
+    self.mox.ReplayAll()
+    nodes = ParseXml('<?xml version="1.0" ?><foo><text1>a</text1>'
+                     '<text1>b\xc3\xa9</text1></foo>', 'foo')
+    model = FooModel()
+    errors, unused_children = self.copier.Copy(model, nodes[0])
+    self.assertEquals(1, len(errors))
+    self.assertTrue(isinstance(errors[0], xml_util.MultipleNodeError))
+    self.assertEquals('Duplicate child nodes "text1": a,b\xc3\xa9',
+                      str(errors[0]))
+    self.assertEquals(None, model.text1)
+
+  def testCopy_conversionError(self):
+    xml_util.logger.debug(mox.IgnoreArg(), 'integer_list1', 'x')
+    self.mox.ReplayAll()
+    nodes = ParseXml('<?xml version="1.0" ?><foo>'
+                     '<integer_list1>x</integer_list1></foo>', 'foo')
+    model = FooModel()
+    self.assertReturnsErrorWithRegexpMatch(
+        xml_util.CopyNodeError, 'Error copying .integer_list1.',
+        lambda: self.copier.Copy(model, nodes[0])[0])
+
+
+class ElementCopierTest(XmlUtilTestBase):
+  """Tests for xml_util.ElementCopier and its helpers."""
+
+  def testGetLocalName(self):
+    self.mox.ReplayAll()
+    self.assertEquals('alert', xml_util.GetLocalName('alert'))
+    self.assertEquals('alert', xml_util.GetLocalName('{urn:x}alert'))
+
+  def testSplitElementTag(self):
+    self.mox.ReplayAll()
+    self.assertEquals((None, 'alert'), xml_util.SplitElementTag('alert'))
+    self.assertEquals(('urn:x', 'alert'),
+                      xml_util.SplitElementTag('{urn:x}alert'))
+
+  def testGetElementText(self):
+    self.mox.ReplayAll()
+    element = xml_util.ParseElement(' <foo> bar<baz>x</baz>qux </foo>')
+    self.assertEquals('barqux', xml_util.GetElementText(element))
+
+  def testCopy(self):
+    xml_util.logger.debug(mox.IgnoreArg(), 'string2', 'bar')
+    xml_util.logger.debug(mox.IgnoreArg(), 'integer_list1', '1')
+    self.mox.ReplayAll()
+
+    element = xml_util.ParseElement(
+        u"""<foo xmlns="urn:x">
+          <string1>bar</string1>
+          <integer_list1>1</integer_list1>
+          <bar/>
+        </foo>""")
+    model = FooModel()
+    copier = xml_util.ElementCopier({'string1': 'string2'}).AddNodes(
+        ['string1'], xml_util.ParseString).AddNodeLists(['integer_list1'], int)
+    errors, children = copier.Copy(model, element)
+    self.assertListEqual([], errors)
+    self.assertEquals(u'bar', model.string2)
+    self.assertListEqual([1], model.integer_list1)
+    self.assertListEqual(['bar'], children.keys())
+
+
 def main(unused_argv):
   googletest.main()
 